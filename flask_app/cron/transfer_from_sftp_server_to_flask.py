@@ -93,6 +93,11 @@ class SFTPClient:
         shutil.move(
             os.path.join(destination_dir, 'html', 'study_data.js'),
             os.path.join(destination_dir, 'study_data.js'))
+        # The chunk files of the per sample objects of study_data.js
+        if os.path.isdir(os.path.join(destination_dir, 'html', 'study_data_chunks')):
+            shutil.move(
+                os.path.join(destination_dir, 'html', 'study_data_chunks'),
+                os.path.join(destination_dir, 'study_data_chunks'))
         logging.info(f'Extracting files from the archive to {destination_dir}.')
     def zip_study_output_info(self, folder_path):
         if not os.path.exists(folder_path):
@@ -107,7 +112,8 @@ class SFTPClient:
             logging.debug('study_output_info.json zipped and removed.')
 
         for root, dirs, files in os.walk(folder_path):
-            if root != folder_path:
+            # The study_data_chunks are fetched by the data explorer and so are left unzipped
+            if root != folder_path and os.path.relpath(root, folder_path).split(os.sep)[0] != 'study_data_chunks':
                 for file in files:
                     if not file.endswith('.zip'):
                         file_path = os.path.join(root, file)
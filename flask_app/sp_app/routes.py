@@ -170,8 +170,11 @@ def get_study_data(study_name, file_path):
     # Else it will return to index
 
     # If the study requested is published, send the study_data.js
+    # The study_data.js and the chunk files of the per sample objects (that are fetched by the
+    # data explorer as they are needed) are sent inline. All other files are sent as attachments.
     file_dir = os.path.join(EXPLORER_DATA_DIR, study_name, os.path.dirname(file_path))
     filename = ntpath.basename(file_path)
+    explorer_data_file = filename == 'study_data.js' or os.path.dirname(file_path) == 'study_data_chunks'
 
     try:
         study_obj = get_study_by_name_from_orm_study_list(study_name_to_match=study_name)
@@ -190,7 +193,7 @@ def get_study_data(study_name, file_path):
             if (sp_user in study_obj.users) or current_user.is_admin:
                 # Then this study belongs to the logged in user and we should release the data
                 # Or the user is an admin and we should release the data
-                if filename == 'study_data.js':
+                if explorer_data_file:
                     print(f'returning {os.path.join(file_dir, filename)}')
                     return send_from_directory(directory=file_dir,
                                                path=filename)
@@ -203,7 +206,7 @@ def get_study_data(study_name, file_path):
                 return redirect(url_for('index'))
     else:
         # Study is published
-        if filename == 'study_data.js':
+        if explorer_data_file:
             print(f'returning {os.path.join(file_dir, filename)}')
             return send_from_directory(directory=file_dir, path=filename)
         else:
@@ -1,4 +1,39 @@
 $(document).ready(function () {
+    // The per sample rectangle data may have been written out as size bounded chunk files
+    // rather than directly into study_data.js. If so, fetch the chunks before initiating the plots.
+    load_study_data_chunks(['getRectDataPostMEDBySample']).then(init_data_explorer).catch(function (error) {
+        console.error(error);
+        alert('Unable to load the data of this study. Please try reloading the page.\n' + error.message);
+    });
+});
+
+function load_study_data_chunks(function_names){
+    // For each of the objects that has been chunked (i.e. study_data.js has a <function_name>ChunkIndex function)
+    // fetch its chunks in parallel and define <function_name> to return the merged object.
+    let chunk_promises = [];
+    for (const function_name of function_names){
+        const index_function = window[function_name + 'ChunkIndex'];
+        if (typeof index_function !== 'function'){
+            // The object was written directly into study_data.js
+            continue;
+        }
+        const chunk_index = index_function();
+        chunk_promises.push(Promise.all(chunk_index.chunks.map(function (chunk_file_name) {
+            return fetch(study_data_chunks_url + chunk_file_name + '/').then(function (response) {
+                if (!response.ok){
+                    throw new Error(`Unable to fetch ${chunk_file_name}: ${response.status} ${response.statusText}`);
+                }
+                return response.json();
+            });
+        })).then(function (chunks) {
+            const study_data_obj = Object.assign({}, ...chunks);
+            window[function_name] = function () {return study_data_obj;};
+        }));
+    }
+    return Promise.all(chunk_promises);
+}
+
+function init_data_explorer() {
 
     /* Populate the tabs that display the information on the DataSet, the DataAnalysis
     and the resources that can be downloaded */
@@ -72,4 +107,4 @@ $(document).ready(function () {
     
     
 
-});
\ No newline at end of file
+}
\ No newline at end of file
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Bray-Curtis distances between all pairs of a set of objects (samples or ITS2 type profiles) computed from a
+sparse matrix of their normalised ReferenceSequence abundances.
+
+As the abundances are non-negative, the distance between rows i and j is
+(S_i + S_j - 2 * sum(min(x_i, x_j))) / (S_i + S_j), where S_i is the sum of row i. The sum of minimums is only
+non-zero for the columns that both rows have an abundance in, so it is accumulated column by column, in blocks of
+rows that can be given to separate workers. The distances are those of scipy.spatial.distance.braycurtis up to
+floating point rounding, and are identical when the abundances are integers (as for the ITS2 type profiles).
+"""
+from multiprocessing import Queue as mp_Queue, Process
+from queue import Queue as mt_Queue
+from threading import Thread
+import traceback
+import numpy as np
+
+
+class SparseBrayCurtisCalculator:
+    def __init__(self, obj_uid_list, obj_uid_to_rs_uid_to_abund_dict_dict, num_proc=1, multiprocess=True,
+                 block_size=None):
+        """
+        :param obj_uid_list: the uids of the objects in the order of the rows (and columns) of the distance matrix
+        :param obj_uid_to_rs_uid_to_abund_dict_dict: key = object uid, value = dict of ReferenceSequence uid
+        to (normalised) abundance
+        :param block_size: the number of rows that are computed at once. Each block requires block_size * n float64s.
+        If None, a block size is chosen that keeps each block below ~80MB.
+        """
+        self.obj_uid_list = list(obj_uid_list)
+        self.num_objs = len(self.obj_uid_list)
+        self.num_proc = max(num_proc, 1)
+        self.multiprocess = multiprocess
+        if block_size is None:
+            block_size = max(1, 10000000 // max(self.num_objs, 1))
+        self.block_size = block_size
+        # For every column, the ascending row indices and abundances of the non-zero entries
+        self.col_row_indices_list = []
+        self.col_abundances_list = []
+        self._make_columns(obj_uid_to_rs_uid_to_abund_dict_dict)
+        self.row_sums = self._compute_row_sums()
+
+    def _make_columns(self, obj_uid_to_rs_uid_to_abund_dict_dict):
+        row_index_list = []
+        rs_uid_list = []
+        abundance_list = []
+        for row_index, obj_uid in enumerate(self.obj_uid_list):
+            rs_uid_to_abund_dict = obj_uid_to_rs_uid_to_abund_dict_dict[obj_uid]
+            row_index_list.extend([row_index] * len(rs_uid_to_abund_dict))
+            rs_uid_list.extend(rs_uid_to_abund_dict.keys())
+            abundance_list.extend(rs_uid_to_abund_dict.values())
+        if not rs_uid_list:
+            return
+        row_indices = np.array(row_index_list, dtype=np.int64)
+        rs_uids = np.array(rs_uid_list, dtype=np.int64)
+        abundances = np.array(abundance_list, dtype=np.float64)
+        # A zero abundance contributes nothing to either of the sums
+        non_zero = abundances != 0
+        row_indices, rs_uids, abundances = row_indices[non_zero], rs_uids[non_zero], abundances[non_zero]
+        # Sort by column and then by row so that the rows of each column are ascending
+        order = np.lexsort((row_indices, rs_uids))
+        row_indices, rs_uids, abundances = row_indices[order], rs_uids[order], abundances[order]
+        col_starts = np.flatnonzero(np.r_[True, rs_uids[1:] != rs_uids[:-1]])
+        col_ends = np.r_[col_starts[1:], len(rs_uids)]
+        for start, end in zip(col_starts, col_ends):
+            self.col_row_indices_list.append(row_indices[start:end])
+            self.col_abundances_list.append(abundances[start:end])
+
+    def _compute_row_sums(self):
+        row_sums = np.zeros(self.num_objs, dtype=np.float64)
+        for row_indices, abundances in zip(self.col_row_indices_list, self.col_abundances_list):
+            row_sums[row_indices] += abundances
+        return row_sums
+
+    def get_block_start_stop_list(self):
+        return [(start, min(start + self.block_size, self.num_objs)) for
+                start in range(0, self.num_objs, self.block_size)]
+
+    def compute_block(self, start, stop):
+        """Return the (stop - start) x n array of the distances between rows start:stop and all rows."""
+        sum_of_mins = np.zeros((stop - start, self.num_objs), dtype=np.float64)
+        for row_indices, abundances in zip(self.col_row_indices_list, self.col_abundances_list):
+            block_start_index, block_stop_index = np.searchsorted(row_indices, (start, stop))
+            if block_start_index == block_stop_index:
+                continue
+            sum_of_mins[np.ix_(row_indices[block_start_index:block_stop_index] - start, row_indices)] += \
+                np.minimum.outer(abundances[block_start_index:block_stop_index], abundances)
+        sum_of_row_sums = self.row_sums[start:stop, None] + self.row_sums[None, :]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            block = (sum_of_row_sums - 2 * sum_of_mins) / sum_of_row_sums
+        # Guard against tiny negative values from rounding
+        np.maximum(block, 0, out=block)
+        for i in range(start, stop):
+            block[i - start, i] = 0
+        return block
+
+    def compute_distance_matrix(self):
+        """Return the full n x n distance matrix"""
+        dist_matrix = np.empty((self.num_objs, self.num_objs), dtype=np.float64)
+        for start, stop, block in self.iter_blocks():
+            dist_matrix[start:stop] = block
+        return dist_matrix
+
+    def iter_blocks(self):
+        """Yield (start, stop, block) for every block of rows, in order.
+        If num_proc > 1 the blocks are computed by workers."""
+        block_start_stop_list = self.get_block_start_stop_list()
+        if self.num_proc == 1 or len(block_start_stop_list) == 1:
+            for start, stop in block_start_stop_list:
+                yield start, stop, self.compute_block(start, stop)
+            return
+        yield from self._iter_blocks_parallel(block_start_stop_list)
+
+    def _iter_blocks_parallel(self, block_start_stop_list):
+        num_proc = min(self.num_proc, len(block_start_stop_list))
+        if self.multiprocess:
+            block_input_queue = mp_Queue()
+            block_output_queue = mp_Queue()
+        else:
+            block_input_queue = mt_Queue()
+            block_output_queue = mt_Queue()
+
+        for start_stop in block_start_stop_list:
+            block_input_queue.put(start_stop)
+        for n in range(num_proc):
+            block_input_queue.put('STOP')
+
+        all_processes = []
+        for n in range(num_proc):
+            if self.multiprocess:
+                p = Process(target=self._block_worker, args=(block_input_queue, block_output_queue, self))
+            else:
+                p = Thread(target=self._block_worker, args=(block_input_queue, block_output_queue, self))
+            all_processes.append(p)
+            p.start()
+
+        # Yield the blocks in order, holding on to any that arrive early.
+        # A worker that raises an error puts the error (as a formatted traceback) followed by its 'DONE'.
+        start_to_block_dict = {}
+        next_block_index = 0
+        worker_error_list = []
+        done_count = 0
+        while done_count < num_proc:
+            block_output = block_output_queue.get()
+            if block_output == 'DONE':
+                done_count += 1
+                continue
+            if block_output[0] == 'ERROR':
+                worker_error_list.append(block_output[1])
+                continue
+            start, block = block_output
+            start_to_block_dict[start] = block
+            while next_block_index < len(block_start_stop_list) and \
+                    block_start_stop_list[next_block_index][0] in start_to_block_dict:
+                start, stop = block_start_stop_list[next_block_index]
+                yield start, stop, start_to_block_dict.pop(start)
+                next_block_index += 1
+
+        for p in all_processes:
+            p.join()
+
+        if worker_error_list or next_block_index != len(block_start_stop_list):
+            raise RuntimeError(
+                f'Only {next_block_index} of the {len(block_start_stop_list)} blocks of Bray-Curtis distances '
+                f'were computed. The worker errors were:\n' + '\n'.join(worker_error_list))
+
+    @staticmethod
+    def _block_worker(in_q, out_q, calculator):
+        try:
+            for start, stop in iter(in_q.get, 'STOP'):
+                out_q.put((start, calculator.compute_block(start, stop)))
+        except Exception:
+            out_q.put(('ERROR', traceback.format_exc()))
+        finally:
+            out_q.put('DONE')
@@ -101,6 +101,7 @@ def output(submissions, num_proc):
                 str(submission.associated_study.id),
                 '--num_proc', num_proc,
                 '--data_analysis_id', str(latest_data_analysis.id),
+                '--incremental_output',
             ])
             submission.study_output_started_date_time = \
                 analysis_runner.workflow_manager.date_time_str
@@ -15,6 +15,10 @@ import re
 import sp_config
 import json
 from django import db
+from multiprocessing import Queue as mp_Queue, Process
+from queue import Queue as mt_Queue
+from threading import Thread
+import traceback
 
 class SPDataAnalysis:
     def __init__(self, workflow_manager_parent, data_analysis_obj, force_basal_lineage_separation):
@@ -109,6 +113,7 @@ class SPDataAnalysis:
         for vat in self.virtual_object_manager.vat_manager.vat_dict.values():
             new_dict[vat.id] = vat
         self.virtual_object_manager.vat_manager.vat_dict = new_dict
+        self.virtual_object_manager.vat_manager.rebuild_div_index()
 
     def _update_uid_of_vat(self, new_at, vat):
         # now update the id of the vat
@@ -394,9 +399,7 @@ class SPDataAnalysis:
 
         def assign_profiles(self):
             print(f'\nAssigning ITS2 type profiles to {self.vcc}:')
-            list_of_vats_to_search = self._get_list_of_vats_to_search()
-
-            self._find_vats_in_vcc(list_of_vats_to_search)
+            self.find_vat_matches()
 
             # # TODO here we want to make sure that the most abundant sequence of the
             # # VCC is represented by one of the profiles in the self.vat_match_objects_list
@@ -406,11 +409,16 @@ class SPDataAnalysis:
             #     self._create_vat_of_maj_seq()
             #     self._add_maj_seq_vat_to_matched_list()
 
-            self._associate_vcc_to_vats()
+            self.associate_vcc_to_vats()
 
+        def find_vat_matches(self):
+            """Populate self.vat_match_object_list. This only reads the VirtualAnalysisTypes and so can be
+            run for several VirtualCladeCollections concurrently."""
+            list_of_vats_to_search = self._get_list_of_vats_to_search()
 
+            self._find_vats_in_vcc(list_of_vats_to_search)
 
-        def _associate_vcc_to_vats(self):
+        def associate_vcc_to_vats(self):
             for vat_match in self.vat_match_object_list:
                 print(f'Assigning {vat_match.at.name}')
                 vat_match.at.clade_collection_obj_set_profile_assignment.add(vat_match.cc)
@@ -426,10 +434,9 @@ class SPDataAnalysis:
                         self.vat_match_object_list.append(self.potential_match_object)
 
         def _get_list_of_vats_to_search(self):
-            return [
-                vat for vat in
-                self.sp_data_analysis.virtual_object_manager.vat_manager.vat_dict.values() if
-                vat.ref_seq_uids_set.issubset(self.vcc.footprint_as_frozen_set_of_ref_seq_uids)]
+            """The VirtualAnalysisTypes, in vat_dict order, whose DIVs are all found in the VirtualCladeCollection"""
+            return self.sp_data_analysis.virtual_object_manager.vat_manager.get_vats_with_divs_in_footprint(
+                self.vcc.footprint_as_frozen_set_of_ref_seq_uids)
 
         def _add_new_vat_to_list_if_highest_rel_abund_representative(self):
             """Get a list of the current matches that have refseqs in common with the potential match.
@@ -506,12 +513,13 @@ class SPDataAnalysis:
 
     def _profile_assignment(self):
         print('\n\nBeginning profile assignment')
-        for virtual_clade_collection in self.virtual_object_manager.vcc_manager.vcc_dict.values():
-            if virtual_clade_collection.id == 111118:
-                foo = "bar"
-            profile_assigner = self.ProfileAssigner(virtual_clade_collection = virtual_clade_collection,
-                parent_sp_data_analysis = self)
-            profile_assigner.assign_profiles()
+        if self.workflow_manager.args.num_proc > 1:
+            self._profile_assignment_parallel()
+        else:
+            for virtual_clade_collection in self.virtual_object_manager.vcc_manager.vcc_dict.values():
+                profile_assigner = self.ProfileAssigner(virtual_clade_collection = virtual_clade_collection,
+                    parent_sp_data_analysis = self)
+                profile_assigner.assign_profiles()
 
         # Reinit the VirtualAnalysisTypes to populate the post-profile assignment objects
         self.reinit_vats_post_profile_assignment()
@@ -519,6 +527,92 @@ class SPDataAnalysis:
         self.multimodal_detection()
         print('Profile Assignment Complete')
 
+    def _profile_assignment_parallel(self):
+        """The searching of the VirtualCladeCollections for VirtualAnalysisTypes is done by the workers.
+        The VirtualAnalysisTypes are not modified by the searching so the workers only need to return the uids
+        of the matched VirtualAnalysisTypes and their relative abundances.
+        The matches are then associated to the VirtualCladeCollections here, in the vcc_dict order, so that the
+        outcome is identical to doing the profile assignment serially."""
+        vcc_dict = self.virtual_object_manager.vcc_manager.vcc_dict
+        vat_dict = self.virtual_object_manager.vat_manager.vat_dict
+        num_proc = min(self.workflow_manager.args.num_proc, max(len(vcc_dict), 1))
+        if self.workflow_manager.args.multiprocess:
+            vcc_uid_input_queue = mp_Queue()
+            vat_match_output_queue = mp_Queue()
+        else:
+            vcc_uid_input_queue = mt_Queue()
+            vat_match_output_queue = mt_Queue()
+
+        for vcc_uid in vcc_dict.keys():
+            vcc_uid_input_queue.put(vcc_uid)
+        for n in range(num_proc):
+            vcc_uid_input_queue.put('STOP')
+
+        if self.workflow_manager.args.multiprocess:
+            db.connections.close_all()
+
+        all_processes = []
+        for n in range(num_proc):
+            if self.workflow_manager.args.multiprocess:
+                p = Process(target=self._profile_assignment_worker, args=(
+                    vcc_uid_input_queue, vat_match_output_queue, self))
+            else:
+                p = Thread(target=self._profile_assignment_worker, args=(
+                    vcc_uid_input_queue, vat_match_output_queue, self))
+            all_processes.append(p)
+            p.start()
+
+        # A worker that raises an error puts the error (as a formatted traceback) followed by its 'DONE'.
+        vcc_uid_to_vat_match_tup_list_dict = {}
+        worker_error_list = []
+        done_count = 0
+        while done_count < num_proc:
+            vat_match_result = vat_match_output_queue.get()
+            if vat_match_result == 'DONE':
+                done_count += 1
+                continue
+            if vat_match_result[0] == 'ERROR':
+                worker_error_list.append(vat_match_result[1])
+                continue
+            vcc_uid, vat_match_tup_list = vat_match_result
+            vcc_uid_to_vat_match_tup_list_dict[vcc_uid] = vat_match_tup_list
+            sys.stdout.write(f'\rSearched {len(vcc_uid_to_vat_match_tup_list_dict)} of {len(vcc_dict)} '
+                             f'VirtualCladeCollections for ITS2 type profiles')
+
+        for p in all_processes:
+            p.join()
+
+        if worker_error_list or len(vcc_uid_to_vat_match_tup_list_dict) != len(vcc_dict):
+            raise RuntimeError(
+                f'Only {len(vcc_uid_to_vat_match_tup_list_dict)} of the {len(vcc_dict)} VirtualCladeCollections '
+                f'were searched for ITS2 type profiles. The worker errors were:\n' + '\n'.join(worker_error_list))
+
+        for vcc_uid, virtual_clade_collection in vcc_dict.items():
+            print(f'\nAssigning ITS2 type profiles to {virtual_clade_collection}:')
+            profile_assigner = self.ProfileAssigner(
+                virtual_clade_collection=virtual_clade_collection, parent_sp_data_analysis=self)
+            profile_assigner.vat_match_object_list = [
+                CCToATMatchInfoHolder(vcc=virtual_clade_collection, vat=vat_dict[vat_uid],
+                                      rel_abund_of_at_in_cc=rel_abund_of_at_in_cc) for
+                vat_uid, rel_abund_of_at_in_cc in vcc_uid_to_vat_match_tup_list_dict[vcc_uid]]
+            profile_assigner.associate_vcc_to_vats()
+
+    @staticmethod
+    def _profile_assignment_worker(in_q, out_q, sp_data_analysis):
+        vcc_dict = sp_data_analysis.virtual_object_manager.vcc_manager.vcc_dict
+        try:
+            for vcc_uid in iter(in_q.get, 'STOP'):
+                profile_assigner = SPDataAnalysis.ProfileAssigner(
+                    virtual_clade_collection=vcc_dict[vcc_uid], parent_sp_data_analysis=sp_data_analysis)
+                profile_assigner.find_vat_matches()
+                out_q.put((vcc_uid, [
+                    (vat_match.at.id, vat_match.rel_abund_of_at_in_cc) for
+                    vat_match in profile_assigner.vat_match_object_list]))
+        except Exception:
+            out_q.put(('ERROR', traceback.format_exc()))
+        finally:
+            out_q.put('DONE')
+
     def multimodal_detection(self):
         mmd = self.MultiModalDetection(parent_sp_data_analysis=self)
         mmd.run_multimodal_detection()
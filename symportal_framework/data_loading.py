@@ -9,8 +9,8 @@ import pandas as pd
 import json
 from collections import Counter
 from django import db
-from multiprocessing import Queue as mp_Queue, Manager, Process, Lock as mp_Lock
-from threading import Lock as mt_Lock, Thread, get_ident
+from multiprocessing import Queue as mp_Queue, Manager, Process
+from threading import Thread, Lock
 from queue import Queue as mt_Queue
 from general import ThreadSafeGeneral, file_as_blockiter, hash_bytestr_iter
 from datetime import datetime
@@ -24,12 +24,18 @@ from numpy import NaN
 from collections import defaultdict
 import itertools
 import time
+from array import array
 from shutil import which
 import sp_config
 from django_general import CreateStudyAndAssociateUsers
 import logging
 import hashlib
+import traceback
 from general import check_lat_lon
+from seq_index import SequenceContainmentIndex
+from seq_classification_cache import SequenceClassificationCache
+from symclade_delta_db import SymCladeDeltaDB
+from lib.med_decompose.med_api import decompose as med_decompose
 import re
 from calendar import month_abbr, month_name
 from psycopg2 import InterfaceError
@@ -45,7 +51,8 @@ class DataLoading:
             screen_sub_evalue, num_proc,no_fig, no_ord, no_output,
             distance_method, no_pre_med_seqs, multiprocess, start_time, date_time_str, is_cron_loading,
             study_name=None, study_user_string=None,
-            debug=False):
+            debug=False, dedup_blast=True, use_classification_cache=False, use_med_cache=False,
+            sparse_count_tables=False, unifrac_tree_cache_dir=None):
         self.parent = parent_work_flow_obj
         self.is_cron_loading = is_cron_loading
         self.thread_safe_general = ThreadSafeGeneral()
@@ -102,6 +109,8 @@ class DataLoading:
         self.no_output = no_output
         self.distance_method = distance_method
         self.no_pre_med_seqs = no_pre_med_seqs
+        # If True, the count tables are also output as SparseCountTables (see sparse_count_table.py)
+        self.sparse_count_tables = sparse_count_tables
         # this is the path of the file we will use to deposit a backup copy of the reference sequences
         self.seq_dump_file_path = self._setup_sequence_dump_file_path()
         self.dataset_object.working_directory = self.temp_working_directory
@@ -125,6 +134,10 @@ class DataLoading:
         self.symclade_db_directory_path = os.path.abspath(os.path.join(
             self.symportal_root_directory, 'symbiodiniaceaeDB'))
         self.symclade_db_full_path = os.path.join(self.symclade_db_directory_path, 'symClade.fa')
+        # The sequences added to the symClade database during the taxonomic screening are held in a small
+        # delta blast database until they are compacted into symClade.fa (see SymCladeDeltaDB)
+        self.symclade_delta_db = SymCladeDeltaDB(
+            symclade_fasta_path=self.symclade_db_full_path, pipe_stdout_sterr=not self.debug)
 
         self.path_to_mothur_batch_file_for_dot_file_creation = None
         self.path_to_latest_mothur_batch_file = None
@@ -135,6 +148,18 @@ class DataLoading:
         self.post_initial_qc_fasta_file_name = None
         # args for the taxonomic screening
         self.screen_sub_evalue = screen_sub_evalue
+        # whether to blast the unique sequences of all samples together rather than blasting each sample separately
+        self.dedup_blast = dedup_blast
+        # whether to use (and add to) the persistent cache of the symClade blast results of sequences
+        # (see SequenceClassificationCache)
+        self.use_classification_cache = use_classification_cache
+        # the directory of the persistent cache of MED decomposition results (see MEDResultCache)
+        # None if the cache should not be used
+        self.med_cache_dir = os.path.join(
+            self.symportal_root_directory, 'med_cache') if use_med_cache else None
+        # the directory of the persistent cache of the UniFrac alignments and trees (see UniFracTreeCache)
+        # None if the cache should not be used
+        self.unifrac_tree_cache_dir = unifrac_tree_cache_dir
         self.new_seqs_added_in_iteration = 0
         self.new_seqs_added_running_total = 0
         self.checked_samples_with_no_additional_symbiodiniaceae_sequences = []
@@ -157,10 +182,8 @@ class DataLoading:
         self.required_symbiodiniaceae_matches = 3
         # med
         self.list_of_med_output_directories = []
-        self.path_to_med_padding_executable = os.path.join(
-            self.symportal_root_directory, 'lib/med_decompose/o_pad_with_gaps.py')
-        self.path_to_med_decompose_executable = os.path.join(
-            self.symportal_root_directory, 'lib/med_decompose/decompose.py')
+        # key = MED output directory, value = the MEDResult of the decomposition (None if it failed)
+        self.med_output_directory_to_med_result_dict = {}
         self.perform_med_handler_instance = None
         # data set sample creation
         self.data_set_sample_creator_handler_instance = None
@@ -175,9 +198,9 @@ class DataLoading:
         # we will use this sequence stacked bar plotter when plotting the pre_MED seqs so that the plotting
         # can be put in the same order
         self.seq_stacked_bar_plotter = None
-        # path to executable for multithreading the checking pre-MED sequences against existing ReferenceSequences
-        self.path_to_seq_match_executable = os.path.join(
-            self.symportal_root_directory, 'seq_match.py')
+        # The index of the ReferenceSequence table that is used to match both the MED nodes and the
+        # pre-MED sequences to ReferenceSequence objects. It is built once when creating the DataSetSampleSequences.
+        self.ref_seq_match_index = None
         # Timers
         # The timers for meausring how long it takes to create the DataSetSampleSequencePM
         self.pre_med_seq_start_time = None
@@ -322,6 +345,7 @@ class DataLoading:
         braycurtis_dist_pcoa_creator = distance.SampleBrayCurtisDistPCoACreator(
             date_time_str=self.date_time_str,
             data_set_uid_list=[self.dataset_object.id],
+            num_processors=self.num_proc, multiprocess=self.multiprocess,
             output_dir=self.output_directory, html_dir=self.html_dir,
             js_output_path_dict=self.js_output_path_dict)
         braycurtis_dist_pcoa_creator.compute_braycurtis_dists_and_pcoa_coords()
@@ -331,7 +355,8 @@ class DataLoading:
         unifrac_dict_pcoa_creator = distance.SampleUnifracDistPCoACreator(
             date_time_str=self.date_time_str, output_dir=self.output_directory,
             data_set_uid_list=[self.dataset_object.id], num_processors=self.num_proc,
-            html_dir=self.html_dir, js_output_path_dict=self.js_output_path_dict)
+            html_dir=self.html_dir, js_output_path_dict=self.js_output_path_dict,
+            tree_cache_dir=self.unifrac_tree_cache_dir)
         unifrac_dict_pcoa_creator.compute_unifrac_dists_and_pcoa_coords()
         self.output_path_list.extend(unifrac_dict_pcoa_creator.output_path_list)
 
@@ -349,7 +374,8 @@ class DataLoading:
                     no_pre_med_seqs=self.no_pre_med_seqs,
                     ordered_seq_list=self.sequence_count_table_creator.clade_abundance_ordered_ref_seq_list,
                     date_time_str=self.date_time_str,
-                    seq_relative_abund_df_pre_med=self.seq_abund_relative_df_pre_med
+                    seq_relative_abund_df_pre_med=self.seq_abund_relative_df_pre_med,
+                    seq_count_table_sparse_path=self.sequence_count_table_creator.path_to_seq_output_sparse_relative
                     )
                 self.seq_stacked_bar_plotter.plot_stacked_bar_seqs()
                 self.output_path_list.extend(self.seq_stacked_bar_plotter.output_path_list)
@@ -361,7 +387,8 @@ class DataLoading:
             no_pre_med_seqs=self.no_pre_med_seqs, ds_uids_output_str=str(self.dataset_object.id),
             num_proc=self.num_proc, date_time_str=self.date_time_str,
             html_dir=self.html_dir,
-            js_output_path_dict=self.js_output_path_dict, multiprocess=self.multiprocess)
+            js_output_path_dict=self.js_output_path_dict, multiprocess=self.multiprocess,
+            sparse_count_tables=self.sparse_count_tables)
         self.sequence_count_table_creator.make_seq_output_tables()
         self.seq_abund_relative_df_post_med = self.sequence_count_table_creator.output_df_relative_post_med
         self.output_path_list.extend(self.sequence_count_table_creator.output_paths_list)
@@ -415,21 +442,25 @@ class DataLoading:
                      f'{failed_count} samples produced errors\n')
 
     def _create_data_set_sample_sequences_from_med_nodes(self):
-        self.data_set_sample_creator_handler_instance = DataSetSampleCreatorHandler()
+        self.ref_seq_match_index = RefSeqMatchIndex()
+        self.data_set_sample_creator_handler_instance = DataSetSampleCreatorHandler(
+            ref_seq_match_index=self.ref_seq_match_index, num_proc=self.num_proc, multiprocess=self.multiprocess)
         self.data_set_sample_creator_handler_instance.execute_data_set_sample_creation(
             data_loading_list_of_med_output_directories=self.list_of_med_output_directories,
-            data_loading_debug=self.debug, data_loading_dataset_object=self.dataset_object)
+            data_loading_debug=self.debug, data_loading_dataset_object=self.dataset_object,
+            data_loading_med_output_directory_to_med_result_dict=self.med_output_directory_to_med_result_dict)
         self.dataset_object.currently_being_processed = False
         self.dataset_object.save()
 
     def _create_data_set_sample_sequence_pre_med_objs(self):
         print('\n\nCreating DataSetSampleSequencePM objects')
         self.pre_med_seq_start_time = time.time()
+        if self.ref_seq_match_index is None:
+            self.ref_seq_match_index = RefSeqMatchIndex()
         data_set_sample_pre_med_obj_creator = FastDataSetSampleSequencePMCreator(
             dataset_object=self.dataset_object,
             pre_med_sequence_output_directory_path=self.pre_med_sequence_output_directory_path,
-            num_proc=self.num_proc, path_to_seq_match_executable=self.path_to_seq_match_executable,
-            temp_working_directory=self.temp_working_directory)
+            ref_seq_match_index=self.ref_seq_match_index, num_proc=self.num_proc, multiprocess=self.multiprocess)
         data_set_sample_pre_med_obj_creator.make_data_set_sample_pm_objects()
         self.pre_med_seq_stop_time = time.time()
         print(f'\n\nCreation of DataSetSampleSequencePM objects took '
@@ -439,14 +470,13 @@ class DataLoading:
         self.perform_med_handler_instance = PerformMEDHandler(
             data_loading_temp_working_directory=self.temp_working_directory,
             data_loading_num_proc=self.num_proc,
-            multiprocess=self.multiprocess)
+            multiprocess=self.multiprocess, med_cache_dir=self.med_cache_dir)
 
-        self.perform_med_handler_instance.execute_perform_med_worker(
-            data_loading_debug=self.debug,
-            data_loading_path_to_med_decompose_executable=self.path_to_med_decompose_executable,
-            data_loading_path_to_med_padding_executable=self.path_to_med_padding_executable)
+        self.perform_med_handler_instance.execute_perform_med_worker(data_loading_debug=self.debug)
 
         self.list_of_med_output_directories = self.perform_med_handler_instance.list_of_med_result_dirs
+        self.med_output_directory_to_med_result_dict = \
+            self.perform_med_handler_instance.med_output_directory_to_med_result_dict
 
         if self.debug:
             print('MED dirs:')
@@ -495,6 +525,10 @@ class DataLoading:
             if not len(self.samples_that_caused_errors_in_qc_list) == self.list_of_samples_names:
                 self._create_symclade_backup_incase_of_accidental_deletion_of_corruption()
 
+            if self.symclade_delta_db.has_delta():
+                # A delta left over from a data loading that did not complete
+                self._taxa_screening_compact_symclade_db()
+
             while 1:
                 self.new_seqs_added_in_iteration = 0
                 # This method simply identifies whether there are sequences that need screening.
@@ -510,6 +544,9 @@ class DataLoading:
                 else:
                     break
 
+            if self.symclade_delta_db.has_delta():
+                self._taxa_screening_compact_symclade_db()
+
         else:
             # if not doing the screening we can simply run the execute_worker_taxa_screening once.
             # During its run it will have output all of the files we need to run the following workers.
@@ -578,13 +615,39 @@ class DataLoading:
         new_symclade_fasta_as_list = self._taxa_screening_make_new_fasta_of_screened_seqs_to_be_added_to_symclade_db(
             query_sequences_verified_as_symbiodiniaceae_list
         )
-        combined_fasta = self._taxa_screening_combine_new_symclade_seqs_with_current(new_symclade_fasta_as_list)
+        # Rather than remaking the whole symClade blast database, we add the new sequences to the delta database
+        self.symclade_delta_db.add_seqs(new_symclade_fasta_as_list)
+        # The new sequences may be a match for the sequences that had no match, or only a match below the
+        # evalue cut off, so these are removed from the cache to be blasted again. The sequences that were
+        # classified as symbiodiniaceae keep their cached results. This is done whenever there is a cache, even if
+        # it is not being used by this loading, so that it is not out of date when it is next used.
+        if SequenceClassificationCache.exists(self.symclade_db_full_path):
+            classification_cache = SequenceClassificationCache(
+                symclade_db_path=self.symclade_db_full_path, check_fingerprint=False)
+            classification_cache.invalidate_failures()
+            classification_cache.close()
+        if self.symclade_delta_db.needs_compaction():
+            self._taxa_screening_compact_symclade_db()
+
+    def _taxa_screening_compact_symclade_db(self):
+        """Merge the sequences of the delta database into symClade.fa, remake the symClade blast database
+        and remove the delta"""
+        combined_fasta = self._taxa_screening_combine_new_symclade_seqs_with_current(
+            self.symclade_delta_db.read_delta_fasta_as_list())
         self._taxa_screening_make_new_symclade_db(combined_fasta)
+        self.symclade_delta_db.delete()
 
     def _taxa_screening_make_new_symclade_db(self, combined_fasta):
         self.thread_safe_general.write_list_to_destination(self.symclade_db_full_path, combined_fasta)
         self.thread_safe_general.make_new_blast_db(
             input_fasta_to_make_db_from=self.symclade_db_full_path, db_title='symClade')
+        # The cache was already updated when the sequences were added to the delta database (the results against
+        # the delta alias database are those against the remade database) so only the fingerprint needs updating
+        if SequenceClassificationCache.exists(self.symclade_db_full_path):
+            classification_cache = SequenceClassificationCache(
+                symclade_db_path=self.symclade_db_full_path, check_fingerprint=False)
+            classification_cache.update_fingerprint()
+            classification_cache.close()
 
     def _taxa_screening_combine_new_symclade_seqs_with_current(self, new_symclade_fasta_as_list):
         old_symclade_fasta_as_list = self.thread_safe_general.read_defined_file_to_list(self.symclade_db_full_path)
@@ -626,14 +689,14 @@ class DataLoading:
         key and the number of samples that sequences was found in as the value.
         """
         sub_evalue_nuclotide_sequence_to_number_of_samples_found_in_dict = dict(
-            self.taxonomic_screening_handler.sub_evalue_sequence_to_num_sampes_found_in_mp_dict)
+            self.taxonomic_screening_handler.sub_evalue_sequence_to_num_samples_found_in_counter)
         self.sequences_to_screen_fasta_as_list = []
         sequence_number_counter = 0
         for nucleotide_sequence, num_samples_found_in in \
                 sub_evalue_nuclotide_sequence_to_number_of_samples_found_in_dict.items():
             if num_samples_found_in >= self.required_sample_support_for_sub_evalue_sequencs:
                 # then this is a sequences that was found in three or more samples
-                clade_of_sequence = self.taxonomic_screening_handler.sub_evalue_nucleotide_sequence_to_clade_mp_dict[
+                clade_of_sequence = self.taxonomic_screening_handler.sub_evalue_nucleotide_sequence_to_clade_dict[
                     nucleotide_sequence
                 ]
                 self.sequences_to_screen_fasta_as_list.extend(
@@ -667,11 +730,11 @@ class DataLoading:
     def _make_fasta_of_sequences_that_need_taxa_screening(self):
         self._init_potential_sym_tax_screen_handler()
 
-        # the self.taxonomic_screening_handler.sub_evalue_sequence_to_num_sampes_found_in_mp_dict is populated here
+        # the self.taxonomic_screening_handler.sub_evalue_sequence_to_num_samples_found_in_counter is populated here
         self.taxonomic_screening_handler.execute_potential_sym_tax_screening(
             data_loading_temp_working_directory=self.temp_working_directory,
-            data_loading_path_to_symclade_db=self.symclade_db_full_path,
-            data_loading_debug=self.debug
+            data_loading_path_to_symclade_db=self.symclade_delta_db.get_blast_db_path(),
+            data_loading_debug=self.debug, data_loading_path_to_symclade_fasta=self.symclade_db_full_path
         )
 
         self._taxa_screening_update_checked_samples_list()
@@ -680,14 +743,15 @@ class DataLoading:
 
     def _taxa_screening_update_checked_samples_list(self):
         self.checked_samples_with_no_additional_symbiodiniaceae_sequences = \
-            list(self.taxonomic_screening_handler.checked_samples_mp_list)
+            list(self.taxonomic_screening_handler.checked_samples_list)
 
     def _init_potential_sym_tax_screen_handler(self):
 
         self.taxonomic_screening_handler = PotentialSymTaxScreeningHandler(
             samples_that_caused_errors_in_qc_list=self.samples_that_caused_errors_in_qc_list,
             checked_samples_list=self.checked_samples_with_no_additional_symbiodiniaceae_sequences,
-            list_of_samples_names=self.list_of_samples_names, num_proc=self.num_proc, multiprocess=self.multiprocess
+            list_of_samples_names=self.list_of_samples_names, num_proc=self.num_proc, multiprocess=self.multiprocess,
+            dedup_blast=self.dedup_blast, use_classification_cache=self.use_classification_cache
         )
 
     def _if_symclade_binaries_not_present_remake_db(self):
@@ -1474,262 +1538,385 @@ class DataLoading:
         os.makedirs(self.temp_working_directory)
 
 
+class RefSeqMatchIndex:
+    """An in memory index of the ReferenceSequence table that is used to match sequences to ReferenceSequence
+    objects. The same instance is used for matching the MED nodes (DataSetSampleSequenceCreatorWorker) and the
+    pre-MED sequences (FastDataSetSampleSequencePMCreator). It is built with a single query of the database and
+    must be updated with add_ref_seq whenever a new ReferenceSequence is created during the loading.
+
+    When a sequence is a sub or super string of several ReferenceSequences, the ReferenceSequence that is
+    matched is the first of them in order of uid (with those created during the loading coming
+    at the end in the order that they were created).
+
+    When the MED nodes are matched by threads, the index is matched against while ReferenceSequences are being
+    added to it, so the adding and matching are done holding a lock."""
+    def __init__(self):
+        self._lock = Lock()
+        # dictionaries to save us having to do lots of database look ups
+        self.ref_seq_uid_to_ref_seq_name_dict = {}
+        self.ref_seq_sequence_to_ref_seq_id_dict = {}
+        # Index of the ReferenceSequences of all clades and the uids in the same order as the indexed sequences
+        self.all_clade_seq_index = SequenceContainmentIndex()
+        self.all_clade_ref_seq_uid_list = []
+        # The same as above but for each clade separately
+        self.clade_to_seq_index_dict = defaultdict(SequenceContainmentIndex)
+        self.clade_to_ref_seq_uid_list_dict = defaultdict(list)
+        self._populate_from_ref_seq_table()
+
+    def _populate_from_ref_seq_table(self):
+        print('Indexing ReferenceSequence objects')
+        all_clade_seq_list = []
+        clade_to_seq_list_dict = defaultdict(list)
+        for ref_seq_uid, name, has_name, clade, sequence in ReferenceSequence.objects.order_by('id').values_list(
+                'id', 'name', 'has_name', 'clade', 'sequence'):
+            self.ref_seq_uid_to_ref_seq_name_dict[ref_seq_uid] = name if has_name else f'{ref_seq_uid}_{clade}'
+            self.ref_seq_sequence_to_ref_seq_id_dict[sequence] = ref_seq_uid
+            all_clade_seq_list.append(sequence)
+            self.all_clade_ref_seq_uid_list.append(ref_seq_uid)
+            clade_to_seq_list_dict[clade].append(sequence)
+            self.clade_to_ref_seq_uid_list_dict[clade].append(ref_seq_uid)
+        # Add the sequences in bulk so that the index is able to choose good anchors
+        self.all_clade_seq_index.add_sequences(all_clade_seq_list)
+        for clade, seq_list in clade_to_seq_list_dict.items():
+            self.clade_to_seq_index_dict[clade].add_sequences(seq_list)
+        print(f'Indexed {len(self.all_clade_ref_seq_uid_list)} ReferenceSequence objects')
+
+    def __getstate__(self):
+        # The lock cannot be pickled (e.g. when the index is passed to a worker process)
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self.all_clade_ref_seq_uid_list)
+
+    def add_ref_seq(self, ref_seq):
+        """Add a newly created ReferenceSequence object to the index."""
+        with self._lock:
+            # The uids are added before the sequences so that a position found in a sequence index
+            # always has a uid
+            self.all_clade_ref_seq_uid_list.append(ref_seq.id)
+            self.clade_to_ref_seq_uid_list_dict[ref_seq.clade].append(ref_seq.id)
+            self.ref_seq_uid_to_ref_seq_name_dict[ref_seq.id] = str(ref_seq)
+            self.all_clade_seq_index.add(ref_seq.sequence)
+            self.clade_to_seq_index_dict[ref_seq.clade].add(ref_seq.sequence)
+            self.ref_seq_sequence_to_ref_seq_id_dict[ref_seq.sequence] = ref_seq.id
+
+    def get_sub_or_super_string_match_uid(self, sequence, clade=None):
+        """Return the uid of the ReferenceSequence that is an exact match to sequence or else the first
+        ReferenceSequence that is a sub or super string of sequence. If clade is given only ReferenceSequences
+        of that clade are considered. Returns None if there is no match."""
+        with self._lock:
+            if clade is None:
+                seq_index = self.all_clade_seq_index
+                ref_seq_uid_list = self.all_clade_ref_seq_uid_list
+            else:
+                seq_index = self.clade_to_seq_index_dict[clade]
+                ref_seq_uid_list = self.clade_to_ref_seq_uid_list_dict[clade]
+            pos = seq_index.first_match_pos(sequence)
+            if pos is None:
+                return None
+            return ref_seq_uid_list[pos]
+
+
+class PreMEDSequenceAbundanceStore:
+    """The absolute abundances of the pre-MED sequences of each clade in each DataSetSample of a DataSet.
+    The sequences of each clade are interned to integer ids (in the order that they are first added) and
+    a (sequence id, DataSetSample uid, abundance) entry for each sequence of each sample is held in three
+    compact arrays per clade, rather than holding a dict of DataSetSample to abundance for every sequence."""
+    def __init__(self):
+        # The keys of these dicts are the clades in the order that they were first added
+        self.clade_to_seq_to_seq_id_dict = {}
+        self.clade_to_seq_list_dict = {}
+        self.clade_to_seq_id_array_dict = {}
+        self.clade_to_data_set_sample_uid_array_dict = {}
+        self.clade_to_abundance_array_dict = {}
+
+    def add_sample_seqs(self, clade, data_set_sample_uid, seq_list, abundance_list):
+        if clade not in self.clade_to_seq_list_dict:
+            self.clade_to_seq_to_seq_id_dict[clade] = {}
+            self.clade_to_seq_list_dict[clade] = []
+            self.clade_to_seq_id_array_dict[clade] = array('I')
+            self.clade_to_data_set_sample_uid_array_dict[clade] = array('I')
+            self.clade_to_abundance_array_dict[clade] = array('I')
+        seq_to_seq_id_dict = self.clade_to_seq_to_seq_id_dict[clade]
+        clade_seq_list = self.clade_to_seq_list_dict[clade]
+        seq_id_array = self.clade_to_seq_id_array_dict[clade]
+        for seq in seq_list:
+            try:
+                seq_id_array.append(seq_to_seq_id_dict[seq])
+            except KeyError:
+                seq_to_seq_id_dict[seq] = len(clade_seq_list)
+                seq_id_array.append(len(clade_seq_list))
+                clade_seq_list.append(seq)
+        self.clade_to_data_set_sample_uid_array_dict[clade].extend([data_set_sample_uid] * len(seq_list))
+        self.clade_to_abundance_array_dict[clade].extend(abundance_list)
+
+    def get_clades(self):
+        return list(self.clade_to_seq_list_dict.keys())
+
+    def get_seq_to_sample_uid_and_abund_dict(self, clade):
+        """Return a dict of the sequences of the clade (in the order that they were first added) to a
+        dict of DataSetSample uid to the absolute abundance of the sequence in that DataSetSample"""
+        clade_seq_list = self.clade_to_seq_list_dict[clade]
+        seq_to_sample_uid_and_abund_dict = {}
+        for seq_id, data_set_sample_uid, abundance in zip(
+                self.clade_to_seq_id_array_dict[clade], self.clade_to_data_set_sample_uid_array_dict[clade],
+                self.clade_to_abundance_array_dict[clade]):
+            try:
+                seq_to_sample_uid_and_abund_dict[clade_seq_list[seq_id]][data_set_sample_uid] = abundance
+            except KeyError:
+                seq_to_sample_uid_and_abund_dict[clade_seq_list[seq_id]] = {data_set_sample_uid: abundance}
+        return seq_to_sample_uid_and_abund_dict
+
+    def remove_clade(self, clade):
+        for clade_dict in [
+            self.clade_to_seq_to_seq_id_dict, self.clade_to_seq_list_dict, self.clade_to_seq_id_array_dict,
+            self.clade_to_data_set_sample_uid_array_dict, self.clade_to_abundance_array_dict
+        ]:
+            del clade_dict[clade]
+
+
 class FastDataSetSampleSequencePMCreator:
     def __init__(
-            self, pre_med_sequence_output_directory_path, dataset_object, num_proc,
-            path_to_seq_match_executable, temp_working_directory):
-        # dictionaries to save us having to do lots of database look ups
-        self.path_to_seq_match_executable = path_to_seq_match_executable
+            self, pre_med_sequence_output_directory_path, dataset_object, ref_seq_match_index, num_proc=1,
+            multiprocess=False):
         self.pre_med_sequence_output_directory_path = pre_med_sequence_output_directory_path
-        self.thread_safe_general = ThreadSafeGeneral()
+        # The number of workers (and whether they are processes or threads) used to read the pre-MED sequences
+        # of the samples and to make the consolidation paths
         self.num_proc = num_proc
+        self.multiprocess = multiprocess
+        self.thread_safe_general = ThreadSafeGeneral()
         self.dataset_object = dataset_object
-        clades = list('ABCDEFGHI')
-        self.ref_seq_sequence_to_ref_seq_obj_dict = {}
-        for clade in clades:
-            self.ref_seq_sequence_to_ref_seq_obj_dict[clade] = {
-                ref_seq.sequence: ref_seq for ref_seq in ReferenceSequence.objects.filter(clade=clade)}
+        # The RefSeqMatchIndex shared with the DataSetSampleSequence creation
+        self.ref_seq_match_index = ref_seq_match_index
         self.list_of_pre_med_sample_dirs = self._populate_list_of_pre_med_sample_dirs()
-        # This is a dict that will have three levels.
-        # The first set of keys will be the clades.
-        # The second set of keys will be nucleotide sequences
-        # The third set of keys will be DataSetSample objects and the
-        # absolute abundnace of the sequence as the value.
-        self.consolidated_sequence_to_sample_and_abund_dict = dict()
-        self._populated_consolidated_seq_to_sample_and_abund_dict()
-        # Now work through the consolidated dictionary matching sequences to reference sequences
-        # sequences for which reference sequences have been found will be represented in a new dictionary
-        # for which the key will be a reference sequence object that the match was found and the value
-        # will be the same dict value that was in the original consolidated dicitonary
-        # If a match is not found, then move these sequences into a second dictionary for the non matches
-        # This is the dictionary where the matched sequence info will go
-        # Each of these two dictionaries will be set within a layer of clade keys
-        self.ref_seq_match_obj_to_seq_sample_abundance_dict = defaultdict(dict)
-        # This is the dictionary where the non matched sequences will be put
-        self.no_match_consolidated_seq_to_sample_and_abund_dict = defaultdict(dict)
-        self.temp_working_directory = temp_working_directory
+        # The abundances of the pre-MED sequences of each clade in each of the DataSetSamples
+        self.pre_med_sequence_abundance_store = PreMEDSequenceAbundanceStore()
+        self._populate_pre_med_sequence_abundance_store()
 
     def _populate_list_of_pre_med_sample_dirs(self):
         return self.thread_safe_general.return_list_of_directory_paths_in_directory(
             self.pre_med_sequence_output_directory_path)
 
-    def _populated_consolidated_seq_to_sample_and_abund_dict(self):
-        """Go through the list_of_pre_med_sample_dirs. There will be one per sample.
-        Get the list of sequences and their abundances using the fasta and name file pairs.
-        Get the sample from the fasta name. Get the current dictionary represented by the sequence key
-        and add the sample in question-abunance k, v pairing to it. Then move on to next sample."""
-        count = 0
+    def _populate_pre_med_sequence_abundance_store(self):
+        """The sample directories (one per sample) are read by num_proc workers. Each worker gets the
+        list of sequences and their abundances of each clade of a sample using the fasta and name file pairs.
+        The samples are added to the PreMEDSequenceAbundanceStore as they are read, but in the order of
+        list_of_pre_med_sample_dirs so that the sequences are in the same order as if the samples had been read
+        one after the other. The DataSetSample uids are got with a single query."""
         num_samples_to_process = len(self.list_of_pre_med_sample_dirs)
-        print('Populating the consolidated sequence to sample and abundance dictionary'
-              'for pre-MED sequence processing')
-        for sample_pm_dir in self.list_of_pre_med_sample_dirs:
-            count += 1
-            print(f'Processing pre-MED seqs for sample {count} of {num_samples_to_process}')
-            current_dss_obj = None
-            # get list of the fasta files (one per clade) that we will need to process
-            # we can deduce the .names file from the fasta file simply by changing the extension
-            sample_list_of_fasta_file_paths = [
-                f_path for f_path in self.thread_safe_general.return_list_of_file_paths_in_directory(sample_pm_dir) if
-                '.fasta' in f_path]
-            for f_path in sample_list_of_fasta_file_paths:
-                fasta_dict = self.thread_safe_general.create_dict_from_fasta(fasta_path=f_path)
-                names_dict = self.thread_safe_general.create_seq_name_to_abundance_dict_from_name_file(
-                    name_file_path=f_path.replace('.fasta', '.names'))
-                clade = f_path.split('/')[-1].split('_')[3]
-                # we only need to get the datasetsample object if we haven't already
-                if current_dss_obj is None:
-                    sample_name = '_'.join(f_path.split('/')[-1].split('_')[4:]).replace('.fasta', '')
-                    current_dss_obj = DataSetSample.objects.get(
-                        data_submission_from=self.dataset_object, name=sample_name)
-                # Check to see whether a dictionary entry already exists for this clade
-                # and if not create a default dict to use
-                if clade not in self.consolidated_sequence_to_sample_and_abund_dict.keys():
-                    self.consolidated_sequence_to_sample_and_abund_dict[clade] = defaultdict(dict)
-                # for each sequence of the fasta log it in the consolidated dictionary
-                clade_dict_to_add_to = self.consolidated_sequence_to_sample_and_abund_dict[clade]
-                for seq_name, seq_seq in fasta_dict.items():
-                    clade_dict_to_add_to[seq_seq][current_dss_obj] = names_dict[seq_name]
+        print('Populating the pre-MED sequence abundance store for pre-MED sequence processing')
+        sample_name_to_data_set_sample_uid_dict = self._get_sample_name_to_data_set_sample_uid_dict()
+
+        if self.multiprocess:
+            sample_dir_input_queue = mp_Queue()
+            sample_seqs_output_queue = mp_Queue()
+        else:
+            sample_dir_input_queue = mt_Queue()
+            sample_seqs_output_queue = mt_Queue()
+        for sample_index, sample_pm_dir in enumerate(self.list_of_pre_med_sample_dirs):
+            sample_dir_input_queue.put((sample_index, sample_pm_dir))
+        num_workers = min(self.num_proc, num_samples_to_process)
+        for n in range(num_workers):
+            sample_dir_input_queue.put('STOP')
+
+        all_processes = []
+        if self.multiprocess:
+            db.connections.close_all()
+        for n in range(num_workers):
+            if self.multiprocess:
+                p = Process(target=self._pre_med_sample_dir_worker, args=(
+                    sample_dir_input_queue, sample_seqs_output_queue))
+            else:
+                p = Thread(target=self._pre_med_sample_dir_worker, args=(
+                    sample_dir_input_queue, sample_seqs_output_queue))
+            all_processes.append(p)
+            p.start()
+
+        # We must empty the output queue before joining the processes else the join may hang.
+        # key = sample index, value = the output of the worker for samples that were read before
+        # one or more of the samples that come before them.
+        # A worker that raises an error puts the error (as a formatted traceback) followed by its 'DONE'.
+        pending_sample_index_to_sample_seqs_dict = {}
+        next_sample_index = 0
+        worker_error_list = []
+        done_count = 0
+        while done_count < num_workers:
+            worker_output = sample_seqs_output_queue.get()
+            if worker_output == 'DONE':
+                done_count += 1
+                continue
+            if worker_output[0] == 'ERROR':
+                worker_error_list.append(worker_output[1])
+                continue
+            sample_index, sample_name, clade_seq_list_abundance_list_tuples = worker_output
+            pending_sample_index_to_sample_seqs_dict[sample_index] = (sample_name, clade_seq_list_abundance_list_tuples)
+            while next_sample_index in pending_sample_index_to_sample_seqs_dict:
+                sample_name, clade_seq_list_abundance_list_tuples = pending_sample_index_to_sample_seqs_dict.pop(
+                    next_sample_index)
+                next_sample_index += 1
+                print(f'Processing pre-MED seqs for sample {next_sample_index} of {num_samples_to_process}')
+                for clade, seq_list, abundance_list in clade_seq_list_abundance_list_tuples:
+                    self.pre_med_sequence_abundance_store.add_sample_seqs(
+                        clade=clade, data_set_sample_uid=sample_name_to_data_set_sample_uid_dict[sample_name],
+                        seq_list=seq_list, abundance_list=abundance_list)
+
+        for p in all_processes:
+            p.join()
+
+        if worker_error_list or next_sample_index != num_samples_to_process:
+            raise RuntimeError(
+                f'Only {next_sample_index} of the {num_samples_to_process} pre-MED sample directories were read. '
+                f'The worker errors were:\n' + '\n'.join(worker_error_list))
+
+    def _get_sample_name_to_data_set_sample_uid_dict(self):
+        """The pre-MED sequences of a sample are associated to its DataSetSample by name, so the names must be
+        unique within the DataSet (as DataSetSample.objects.get by name would require)."""
+        sample_name_to_data_set_sample_uid_dict = {}
+        duplicate_sample_name_set = set()
+        for sample_name, data_set_sample_uid in DataSetSample.objects.filter(
+                data_submission_from=self.dataset_object).values_list('name', 'id'):
+            if sample_name in sample_name_to_data_set_sample_uid_dict:
+                duplicate_sample_name_set.add(sample_name)
+            sample_name_to_data_set_sample_uid_dict[sample_name] = data_set_sample_uid
+        if duplicate_sample_name_set:
+            raise RuntimeError(
+                f'DataSet {self.dataset_object.id} has more than one DataSetSample with the name(s) '
+                f'{", ".join(sorted(duplicate_sample_name_set))}. '
+                f'The pre-MED sequences cannot be associated to their DataSetSamples.')
+        return sample_name_to_data_set_sample_uid_dict
+
+    @staticmethod
+    def _pre_med_sample_dir_worker(in_q, out_q):
+        thread_safe_general = ThreadSafeGeneral()
+        try:
+            for sample_index, sample_pm_dir in iter(in_q.get, 'STOP'):
+                sample_name = None
+                clade_seq_list_abundance_list_tuples = []
+                # get list of the fasta files (one per clade) that we will need to process
+                # we can deduce the .names file from the fasta file simply by changing the extension
+                sample_list_of_fasta_file_paths = [
+                    f_path for f_path in thread_safe_general.return_list_of_file_paths_in_directory(sample_pm_dir)
+                    if '.fasta' in f_path]
+                for f_path in sample_list_of_fasta_file_paths:
+                    fasta_dict = thread_safe_general.create_dict_from_fasta(fasta_path=f_path)
+                    names_dict = thread_safe_general.create_seq_name_to_abundance_dict_from_name_file(
+                        name_file_path=f_path.replace('.fasta', '.names'))
+                    clade = f_path.split('/')[-1].split('_')[3]
+                    if sample_name is None:
+                        sample_name = '_'.join(f_path.split('/')[-1].split('_')[4:]).replace('.fasta', '')
+                    clade_seq_list_abundance_list_tuples.append(
+                        (clade, list(fasta_dict.values()),
+                         [names_dict[seq_name] for seq_name in fasta_dict.keys()]))
+                out_q.put((sample_index, sample_name, clade_seq_list_abundance_list_tuples))
+        except Exception:
+            out_q.put(('ERROR', traceback.format_exc()))
+        finally:
+            out_q.put('DONE')
 
     def make_data_set_sample_pm_objects(self):
         print('\nProcessing pre-MED seqs for each clade')
-        for clade, seq_dict in self.consolidated_sequence_to_sample_and_abund_dict.items():
+        for clade in self.pre_med_sequence_abundance_store.get_clades():
             print(f'\nProcessing clade {clade}')
+            # The sequences of only one clade are held as a dict at any one time
+            seq_dict = self.pre_med_sequence_abundance_store.get_seq_to_sample_uid_and_abund_dict(clade)
+            self.pre_med_sequence_abundance_store.remove_clade(clade)
             seq_matcher = self.SeqMatcher(
-                clade=clade, seq_dict=seq_dict, rs_dict=self.ref_seq_sequence_to_ref_seq_obj_dict[clade],
-                match_dict=self.ref_seq_match_obj_to_seq_sample_abundance_dict[clade],
-                non_match_dict=self.no_match_consolidated_seq_to_sample_and_abund_dict[clade],
-                num_proc=self.num_proc, path_to_seq_match_executable=self.path_to_seq_match_executable,
-                temp_working_directory=self.temp_working_directory
+                clade=clade, seq_dict=seq_dict, ref_seq_match_index=self.ref_seq_match_index,
+                match_dict=dict(), non_match_dict=dict(), num_proc=self.num_proc, multiprocess=self.multiprocess
             )
             seq_matcher.match_and_make_ref_seqs()
 
     class SeqMatcher:
         def __init__(
-                self, clade, rs_dict, seq_dict, match_dict, non_match_dict,
-                num_proc, path_to_seq_match_executable, temp_working_directory):
+                self, clade, ref_seq_match_index, seq_dict, match_dict, non_match_dict, num_proc=1,
+                multiprocess=False):
             # The current clade we are working with
             self.clade = clade
-            # Dict of nucleotide sequence to ref seq obj for all ref seq objs of this clade
-            self.rs_dict = rs_dict
+            # The RefSeqMatchIndex that we will match the sequences of this clade against
+            self.ref_seq_match_index = ref_seq_match_index
             # dict of sequences as keys and dictionaries as value where dict
-            # is DataSetSample object as key and the absolute abundance of the sequence as value
+            # is DataSetSample uid as key and the absolute abundance of the sequence as value
             self.seq_dict = seq_dict
-            # This dict will be ref seq object to the DataSetSample abundance info from self.seq_dict
+            # This dict will be ref seq uid to the DataSetSample abundance info from self.seq_dict
             self.match_dict = match_dict
             # This dict will be the same structure as self.seq_dict but for the no matches
             self.non_match_dict = non_match_dict
             # The consolidation path that we will follow to consolidate the non refseq match sequences
             self.consolidation_path_list = []
-            self.thread_safe_general = ThreadSafeGeneral()
             self.num_proc = num_proc
-            self.path_to_seq_match_executable = path_to_seq_match_executable
-            self.temp_working_directory = temp_working_directory
+            self.multiprocess = multiprocess
+            self.thread_safe_general = ThreadSafeGeneral()
 
         def match_and_make_ref_seqs(self):
-            self._assign_sequence_to_match_or_non_match_dicts_mp()
+            self._assign_sequence_to_match_or_non_match_dicts()
             # Assess whether this has helped us out of the bottle neck or not
             if self.non_match_dict:
                 self._consolidate_non_match_seqs()
                 self._make_new_reference_sequences_and_populate_match_dict()
             self._create_data_set_sample_sequence_pm_objects()
 
-        @staticmethod
-        def _make_seq_match_dicts(
-                pre_med_seq_chunk_path, rs_dict_path, path_to_seq_match_executable, match_dict_out_path):
-            print(f'Starting match seq_match with thread {get_ident()}')
-            subprocess.run(
-                [path_to_seq_match_executable, pre_med_seq_chunk_path, rs_dict_path, match_dict_out_path], check=True)
-            print(f'seq_match execution complete for thread {get_ident()}')
-
-        def _assign_sequence_to_match_or_non_match_dicts_mp(self):
+        def _assign_sequence_to_match_or_non_match_dicts(self):
             matching_start_time = time.time()
             print('Attempting to match sequences to ReferenceSequence objects')
-            # A generator that returns self.seq_dict, split up into chunks
-            seqs_to_match = len(self.seq_dict)
-            # We add the one so that we always have slightly more sequences per chunk, so that we don't use
-            # more than self.num_proc number of sequence
-            print(f'Chunking in to {int(1 + (len(self.seq_dict)/self.num_proc))} sequence chunks for {self.num_proc} threads')
-            pre_med_seq_chunks = self.thread_safe_general.chunks(self.seq_dict.keys(), n=int(1 + (len(self.seq_dict)/self.num_proc)))
-            all_processes = []
-            # A digit to make path names unique
-            count = 0
-            output_dict_paths = []
-            print('Multithreading match finding. This make take some time...')
-            # Rather than dumping the self.rs_dict that contains ReferenceSequence objects
-            # we will work with a list of the ReferenceSequence nucleotide sequences and we will match to these
-            # This way we don't have to import Django settings and models for a second time and this will hopefully
-            # help us avoid the problems with the multiprocessing and the Django testing framework
-            # This will mean that we need to do a further look up to connect the matched sequence back to a
-            # ReferenceSequence, but this should still be much faster than the serial way we were doing it before
-            # as we can split up the many to many searches across the threads.
-            rs_set_to_dump = list(self.rs_dict.keys())
-            rs_set_path = os.path.join(self.temp_working_directory, f'rs_set_seqs')
-            print(f'Writing out {rs_set_path}')
-            with open(rs_set_path, 'w') as f:
-                json.dump(rs_set_to_dump, f)
-            
-            print('Done')
-            for pre_med_seq_chunk in pre_med_seq_chunks:
-                # Dump out the dictionaries that will be read in by the executable
-                # Make the names unique to prevent any need for Lock.
-                pre_med_seq_chunk_path = os.path.join(self.temp_working_directory, f'pre_med_seq_chunk_{count}')
-
-                match_dict_out_path = os.path.join(self.temp_working_directory, f'pre_med_match_dict_{count}')
-                output_dict_paths.append(match_dict_out_path)
-                print(f'Writing out {pre_med_seq_chunk_path}')
-                with open(pre_med_seq_chunk_path, 'w') as f:
-                    json.dump(pre_med_seq_chunk, f)
-                
-                print('Done')
-
-
-                p = Thread(target=self._make_seq_match_dicts,
-                            args=(
-                                pre_med_seq_chunk_path, rs_set_path,
-                                self.path_to_seq_match_executable, match_dict_out_path)
-                            )
-
-                all_processes.append(p)
-                print(f'Starting thread {count}')
-                p.start()
-                count += 1
-
-            print('All threads started.\nCollecting threads.')
-            for p in all_processes:
-                p.join()
-                print('Collected a thread')
-
-            print('Processing thread outputs.')
-            match_dict = {}
-            non_match_list = []
-            for output_dict_path in output_dict_paths:
-                with open(output_dict_path, 'r') as f:
-                    sub_match_dict = json.load(f)
-                with open(output_dict_path.replace('match_dict', 'non_match_list'), 'r') as f:
-                    sub_non_match_list = json.load(f)
-
-                match_dict.update(sub_match_dict)
-                non_match_list.extend(sub_non_match_list)
-            assert (seqs_to_match == (len(match_dict) + len(non_match_list)))
-            # Here we now know exatly which pre_med seqs had a match and which did not
-            # For each of the seqs that had a match, we need to now log the match
-
-            print("Logging matches\n")
+            # The sequences are matched against the RefSeqMatchIndex so we no longer need to compare
+            # every sequence to every ReferenceSequence.
             match_count = 0
-            tot_matches = len(match_dict)
-            for nuc_seq, matching_ref_seq in match_dict.items():
-                sys.stdout.write(f'\rprocessing {match_count} out of {tot_matches} matches.')
-                self._log_match(nuc_seq, self.rs_dict[matching_ref_seq])
-                match_count += 1
-
-            # For those that did not have a match add them to the non_match_dict
-            print("\nLogging non_matches\n")
             non_match_count = 0
-            tot_non_matches = len(non_match_list)
-            for nuc_seq in non_match_list:
-                sys.stdout.write(f'\rprocessing {non_match_count} out of {tot_non_matches} matches.')
-                self.non_match_dict[nuc_seq] = self.seq_dict[nuc_seq]
-                non_match_count += 1
+            tot_seqs = len(self.seq_dict)
+            for seq_count, nuc_seq in enumerate(self.seq_dict.keys()):
+                if seq_count % 1000 == 0:
+                    sys.stdout.write(f'\rprocessing {seq_count} out of {tot_seqs} sequences.')
+                matching_ref_seq_uid = self.ref_seq_match_index.get_sub_or_super_string_match_uid(
+                    nuc_seq, clade=self.clade)
+                if matching_ref_seq_uid is not None:
+                    self._log_match(nuc_seq, matching_ref_seq_uid)
+                    match_count += 1
+                else:
+                    self.non_match_dict[nuc_seq] = self.seq_dict[nuc_seq]
+                    non_match_count += 1
+            print(f'\n{match_count} sequences matched and {non_match_count} did not match')
 
             matching_finish_time = time.time() - matching_start_time
             logging.info(f'pre-MED to ReferenceSequence matching took {matching_finish_time}s to complete '
-                         f'using multithreading for clade {self.clade}')
-
-            # Now clean up the files
-            for output_dict_path in output_dict_paths:
-                os.remove(output_dict_path)
-                os.remove(output_dict_path.replace('match_dict', 'non_match_list'))
+                         f'for clade {self.clade}')
 
-        def _log_match(self, nuc_seq, rs_obj):
-            # Check to see if the rs_obj is already representing in the match
+        def _log_match(self, nuc_seq, rs_uid):
+            # Check to see if the rs_uid is already representing in the match
             # dict, and if so combine the value dictionaries
             try:
                 # We need to be careful here as it could be that the same DataSetSample
                 # object could have had both sequenecs that we are dealing with here.
                 # In this case we will need to add together the abundance for that sample
-                current_match_dict = self.match_dict[rs_obj]
+                current_match_dict = self.match_dict[rs_uid]
                 seq_dict_to_add = self.seq_dict[nuc_seq]
                 new_combined_dict = dict()
-                for dss_obj, abundance in seq_dict_to_add.items():
+                for dss_uid, abundance in seq_dict_to_add.items():
                     try:
-                        # If the DataSetSample object is in both dicts, then combine the abundances
-                        # and a sincle k, v pair of the DataSetSample object and new abunance
+                        # If the DataSetSample uid is in both dicts, then combine the abundances
+                        # and a sincle k, v pair of the DataSetSample uid and new abunance
                         # to the match dict
-                        new_abund = current_match_dict[dss_obj] + abundance
-                        new_combined_dict[dss_obj] = new_abund
+                        new_abund = current_match_dict[dss_uid] + abundance
+                        new_combined_dict[dss_uid] = new_abund
                     except KeyError:
-                        # If the DataSetSample objects is not in both dicts then simply
+                        # If the DataSetSample uid is not in both dicts then simply
                         # add the current k, v pair
-                        new_combined_dict[dss_obj] = abundance
+                        new_combined_dict[dss_uid] = abundance
                 # finally we will need to add the k,v pairs in the current_match_dict
-                self.match_dict[rs_obj] = {
+                self.match_dict[rs_uid] = {
                     **new_combined_dict,
                     **{k: v for k, v in current_match_dict.items() if k not in seq_dict_to_add}
                 }
             except KeyError:
-                # If the rs_obj is not already representing then we can simply
-                # add the seq_dict info as the value to the rs_obj key in the match dict
-                self.match_dict[rs_obj] = self.seq_dict[nuc_seq]
+                # If the rs_uid is not already representing then we can simply
+                # add the seq_dict info as the value to the rs_uid key in the match dict
+                self.match_dict[rs_uid] = self.seq_dict[nuc_seq]
 
         def _consolidate_non_match_seqs(self):
             """Here we are going to make what I am calling a consolidation path.
@@ -1749,10 +1936,10 @@ class FastDataSetSampleSequencePMCreator:
             When we have created all of these matches we will then be able to follow this path of tuples
             to do the consolidation.
 
-            This should be multiprocessable. (We can give copies of the dictionaries and assign different n
-            values to each of the threads. We can then put together the list of tuples for each n in order of asscending
-            n values to create the consolidation path.)
-            However, I don't think it is necessary to implement this. It already seems to be quite fast."""
+            The super sequences of each sequence are looked up in a SequenceContainmentIndex of all of the non_match
+            sequences rather than by checking every longer sequence in turn, and the n values are shared out
+            between num_proc workers. The tuples of each n are put together in order of ascending n
+            values to create the consolidation path so that the path is the same as if it were made serially."""
 
             self._make_consolidation_path()
 
@@ -1763,58 +1950,122 @@ class FastDataSetSampleSequencePMCreator:
         def _make_consolidation_path(self):
             # First get a list of the sequences to work with sorted by order of length
             seq_list = sorted(list(self.non_match_dict.keys()), key=len)
-            # len of the shortest element
-            start_n = len(seq_list[0])
+            # The number of DataSetSamples that each sequence was found in (in the same order as seq_list)
+            num_data_set_samples_list = [len(self.non_match_dict[seq].keys()) for seq in seq_list]
             # len of the longest element
             finish_n = len(seq_list[-1])
-            # Go from smallest n to largest n-1
+            # The positions in seq_list of the sequences of each length (n) from the smallest n to largest n-1
+            n_to_query_pos_list_dict = defaultdict(list)
+            for pos, seq in enumerate(seq_list):
+                if len(seq) < finish_n:
+                    n_to_query_pos_list_dict[len(seq)].append(pos)
             print('\nMaking consolidation path for non-ReferenceSequence matching sequences')
-            for n in range(start_n, finish_n):
-                small_query_seqs = [seq for seq in seq_list if len(seq) == n]
-                super_seqs = [seq for seq in seq_list if len(seq) > n]
-                count = 0
-                tot = len(small_query_seqs)
-                for q_seq in small_query_seqs:
-                    count += 1
-                    sys.stdout.write(f'\rseq {count} out of {tot} for level n={n} of {finish_n}')
-                    matches = []
-                    for super_seq in super_seqs:
-                        if (q_seq in super_seq) or ('A' + q_seq in super_seq):
-                            matches.append(super_seq)
-                    if matches:
-                        if len(matches) > 1:
-                            # Here we create a list of tuples where the match sequence and the number of
-                            # DataSetSamples that contained that sample.
-                            # We then sort it according to the number of DataSetSamples
-                            # so that we can get the sequences that was found in the maximum number of DataSetSamples
-                            # Finally, we use this sequences as the consolidation representative for the
-                            # consolidation path
-                            representative_seq = sorted(
-                                [(match_seq, len(self.non_match_dict[match_seq].keys())) for match_seq in matches],
-                                key=lambda x: x[1], reverse=True)[0][0]
-                            self.consolidation_path_list.append((q_seq, representative_seq))
-                        else:
-                            self.consolidation_path_list.append((q_seq, matches[0]))
-                    else:
+            if not n_to_query_pos_list_dict:
+                return
+            seq_index = SequenceContainmentIndex(seq_list)
+
+            if self.multiprocess:
+                n_input_queue = mp_Queue()
+                consolidation_path_output_queue = mp_Queue()
+            else:
+                n_input_queue = mt_Queue()
+                consolidation_path_output_queue = mt_Queue()
+            # Largest levels first so that a worker isn't left with a large level at the end
+            for n in sorted(n_to_query_pos_list_dict.keys(), key=lambda n: len(n_to_query_pos_list_dict[n]),
+                            reverse=True):
+                n_input_queue.put((n, n_to_query_pos_list_dict[n]))
+            num_workers = min(self.num_proc, len(n_to_query_pos_list_dict))
+            for n in range(num_workers):
+                n_input_queue.put('STOP')
+
+            all_processes = []
+            if self.multiprocess:
+                db.connections.close_all()
+            for n in range(num_workers):
+                if self.multiprocess:
+                    p = Process(target=self._consolidation_path_worker, args=(
+                        n_input_queue, consolidation_path_output_queue, seq_index, num_data_set_samples_list))
+                else:
+                    p = Thread(target=self._consolidation_path_worker, args=(
+                        n_input_queue, consolidation_path_output_queue, seq_index, num_data_set_samples_list))
+                all_processes.append(p)
+                p.start()
+
+            # We must empty the output queue before joining the processes else the join may hang.
+            # A worker that raises an error puts the error (as a formatted traceback) followed by its 'DONE'.
+            n_to_consolidation_path_list_dict = {}
+            worker_error_list = []
+            done_count = 0
+            while done_count < num_workers:
+                worker_output = consolidation_path_output_queue.get()
+                if worker_output == 'DONE':
+                    done_count += 1
+                    continue
+                if worker_output[0] == 'ERROR':
+                    worker_error_list.append(worker_output[1])
+                    continue
+                n, n_consolidation_path_list = worker_output
+                n_to_consolidation_path_list_dict[n] = n_consolidation_path_list
+                sys.stdout.write(f'\rconsolidation path made for level n={n} of {finish_n}')
+
+            for p in all_processes:
+                p.join()
+
+            if worker_error_list or len(n_to_consolidation_path_list_dict) != len(n_to_query_pos_list_dict):
+                raise RuntimeError(
+                    f'The consolidation path was only made for {len(n_to_consolidation_path_list_dict)} of the '
+                    f'{len(n_to_query_pos_list_dict)} sequence lengths. The worker errors were:\n' +
+                    '\n'.join(worker_error_list))
+
+            for n in sorted(n_to_query_pos_list_dict.keys()):
+                self.consolidation_path_list.extend(n_to_consolidation_path_list_dict[n])
+
+        @staticmethod
+        def _consolidation_path_worker(in_q, out_q, seq_index, num_data_set_samples_list):
+            """For the sequences of each level n, find the sequences that are longer than them and that contain
+            them (or 'A' + them, which can only be found in a sequence that contains them).
+            A short sequence may match multiple longer sequences. We chose to match the longer sequence
+            that is associated with the greatest number of DataSetSample objects, and of those, the first
+            in order of length."""
+            try:
+                for n, query_pos_list in iter(in_q.get, 'STOP'):
+                    n_consolidation_path_list = []
+                    for query_pos in query_pos_list:
+                        q_seq = seq_index.seq_list[query_pos]
+                        representative_pos = None
+                        # The superstrings are yielded in ascending order of position, i.e. in order of length
+                        for super_pos in seq_index.iter_superstring_pos(q_seq):
+                            if len(seq_index.seq_list[super_pos]) == n:
+                                # q_seq itself
+                                continue
+                            if representative_pos is None or num_data_set_samples_list[super_pos] > \
+                                    num_data_set_samples_list[representative_pos]:
+                                representative_pos = super_pos
+                        if representative_pos is not None:
+                            n_consolidation_path_list.append((q_seq, seq_index.seq_list[representative_pos]))
                         # If there are no matches then there is no entry required in the consolidation path
-                        pass
+                    out_q.put((n, n_consolidation_path_list))
+            except Exception:
+                out_q.put(('ERROR', traceback.format_exc()))
+            finally:
+                out_q.put('DONE')
 
         def _consolidate_non_match_seqs_using_consolidation_path(self):
             for small_seq, super_seq in self.consolidation_path_list:
                 small_seq_dict = self.non_match_dict[small_seq]
                 super_seq_dict = self.non_match_dict[super_seq]
                 new_combined_dict = dict()
-                for dss_obj, abundance in small_seq_dict.items():
+                for dss_uid, abundance in small_seq_dict.items():
                     try:
-                        # If the DataSetSample object is in both dicts, then combine the abundances
-                        # and a single k, v pair of the DataSetSample object and new abunance
+                        # If the DataSetSample uid is in both dicts, then combine the abundances
+                        # and a single k, v pair of the DataSetSample uid and new abunance
                         # to the match dict
-                        new_abund = super_seq_dict[dss_obj] + abundance
-                        new_combined_dict[dss_obj] = new_abund
+                        new_abund = super_seq_dict[dss_uid] + abundance
+                        new_combined_dict[dss_uid] = new_abund
                     except KeyError:
-                        # If the DataSetSample objects is not in both dicts then simply
+                        # If the DataSetSample uid is not in both dicts then simply
                         # add the current k, v pair
-                        new_combined_dict[dss_obj] = abundance
+                        new_combined_dict[dss_uid] = abundance
 
                 # finally update the k,v dict for the super_seq and delete the entry for the
                 self.non_match_dict[super_seq] = {
@@ -1850,13 +2101,11 @@ class FastDataSetSampleSequencePMCreator:
             new_rs_list = []
             for c_seq in self.non_match_dict.keys():
                 if testing:
-                    if (c_seq in self.rs_dict) or ('A' + c_seq in self.rs_dict):
+                    # NB an exact match or a match to 'A' + c_seq is also a sub or super string match
+                    if self.ref_seq_match_index.get_sub_or_super_string_match_uid(
+                            c_seq, clade=self.clade) is not None:
                         raise RuntimeError(
                             'Consolidated sequence is already found in the ReferenceSequence object collection')
-                    for rs_seq in self.rs_dict.keys():
-                        if (c_seq in rs_seq) or (rs_seq in c_seq):
-                            raise RuntimeError(
-                                'Consolidated sequence is already found in the ReferenceSequence object collection')
                 # Create the new reference sequence.
                 new_rs_list.append(ReferenceSequence(clade=self.clade, sequence=c_seq))
 
@@ -1866,23 +2115,26 @@ class FastDataSetSampleSequencePMCreator:
 
             # Now get the newly create ref seq objects back and create a dict form them
             # with rs sequence as key and the rs object itself as the value
-            new_rs_seq_to_obj_dict = {
-                rs.sequence: rs for rs in ReferenceSequence.objects.filter(
-                    sequence__in=list(self.non_match_dict.keys()))}
+            # We also add them to the RefSeqMatchIndex so that it stays in sync with the database
+            new_rs_seq_to_obj_dict = {}
+            for rs in ReferenceSequence.objects.filter(
+                    clade=self.clade, sequence__in=list(self.non_match_dict.keys())).order_by('id'):
+                new_rs_seq_to_obj_dict[rs.sequence] = rs
+                self.ref_seq_match_index.add_ref_seq(rs)
             # Now go back through the no match dict and use this dictionary to poulate the match dictionary
             for c_seq in self.non_match_dict.keys():
-                self.match_dict[new_rs_seq_to_obj_dict[c_seq]] = self.non_match_dict[c_seq]
+                self.match_dict[new_rs_seq_to_obj_dict[c_seq].id] = self.non_match_dict[c_seq]
 
         def _create_data_set_sample_sequence_pm_objects(self):
             """Finally now that we have a reference sqeuence object representing
             each of the initial sequences that were found in the DataSetSample objects
             we can create the DataSetSamplePM objects."""
             data_set_sample_sequence_pre_med_list = []
-            for rs_rep_obj, dss_abund_dict in self.match_dict.items():
-                for dss_obj, abundance in dss_abund_dict.items():
-                    dsspm = DataSetSampleSequencePM(reference_sequence_of=rs_rep_obj,
+            for rs_rep_uid, dss_abund_dict in self.match_dict.items():
+                for dss_uid, abundance in dss_abund_dict.items():
+                    dsspm = DataSetSampleSequencePM(reference_sequence_of_id=rs_rep_uid,
                                                     abundance=abundance,
-                                                    data_set_sample_from=dss_obj)
+                                                    data_set_sample_from_id=dss_uid)
                     data_set_sample_sequence_pre_med_list.append(dsspm)
             print(f'\ncreating {len(data_set_sample_sequence_pre_med_list)} '
                   f'new DataSetSampleSequencePM objects in bulk for clade {self.clade}')
@@ -2212,29 +2464,31 @@ class PotentialSymTaxScreeningHandler:
     """
     def __init__(
             self, samples_that_caused_errors_in_qc_list,
-            checked_samples_list, list_of_samples_names, num_proc, multiprocess):
+            checked_samples_list, list_of_samples_names, num_proc, multiprocess, dedup_blast=True,
+            use_classification_cache=False):
         self.multiprocess = multiprocess
+        # If True, the unique sequences of all of the samples to be screened are blasted together
+        # (see DeduplicatedSymCladeBlastHandler) before the workers run, rather than each worker blasting
+        # the sequences of its sample.
+        self.dedup_blast = dedup_blast
+        self.use_classification_cache = use_classification_cache
+        # Rather than sharing managed dicts and lists between the workers (every access of which is a round trip
+        # to the manager process), each worker accumulates its results locally and puts them into the
+        # output queue once it has finished. The results are merged into the below once all workers are done.
         if self.multiprocess:
             self.input_queue = mp_Queue()
-            self.manager = Manager()
-            self.sub_evalue_sequence_to_num_sampes_found_in_mp_dict = self.manager.dict()
-            self.sub_evalue_nucleotide_sequence_to_clade_mp_dict = self.manager.dict()
-            self.error_samples_mp_list = self.manager.list(samples_that_caused_errors_in_qc_list)
-            self.checked_samples_mp_list = self.manager.list(checked_samples_list)
-            self.list_of_sample_names = list_of_samples_names
-            self.num_proc = num_proc
-            self._load_input_queue()
-            self.lock = mp_Lock()
+            self.output_queue = mp_Queue()
         else:
             self.input_queue = mt_Queue()
-            self.sub_evalue_sequence_to_num_sampes_found_in_mp_dict = {}
-            self.sub_evalue_nucleotide_sequence_to_clade_mp_dict = {}
-            self.error_samples_mp_list = samples_that_caused_errors_in_qc_list
-            self.checked_samples_mp_list = checked_samples_list
-            self.list_of_sample_names = list_of_samples_names
-            self.num_proc = num_proc
-            self._load_input_queue()
-            self.lock = mt_Lock()
+            self.output_queue = mt_Queue()
+        # key = nucleotide sequence, value = number of samples it was found in as a sub_evalue sequence
+        self.sub_evalue_sequence_to_num_samples_found_in_counter = Counter()
+        self.sub_evalue_nucleotide_sequence_to_clade_dict = {}
+        self.error_samples_list = list(samples_that_caused_errors_in_qc_list)
+        self.checked_samples_list = list(checked_samples_list)
+        self.list_of_sample_names = list_of_samples_names
+        self.num_proc = num_proc
+        self._load_input_queue()
 
     def _load_input_queue(self):
         # load up the input q
@@ -2245,114 +2499,386 @@ class PotentialSymTaxScreeningHandler:
             self.input_queue.put('STOP')
 
     def execute_potential_sym_tax_screening(
-            self, data_loading_temp_working_directory, data_loading_path_to_symclade_db, data_loading_debug):
+            self, data_loading_temp_working_directory, data_loading_path_to_symclade_db, data_loading_debug,
+            data_loading_path_to_symclade_fasta=None):
+        """data_loading_path_to_symclade_db is the blast database to blast against (the symClade database or the
+        alias of it and its delta). data_loading_path_to_symclade_fasta is the symClade.fa that the classification
+        cache is associated with."""
+        if data_loading_path_to_symclade_fasta is None:
+            data_loading_path_to_symclade_fasta = data_loading_path_to_symclade_db
         all_processes = []
         # http://stackoverflow.com/questions/8242837/django-multiprocessing-and-database-connections
         db.connections.close_all()
         logging.info(f'Performing potential sym tax screening QC.')
+        if self.use_classification_cache:
+            # Empty the cache here (rather than in the workers) if symClade.fa has changed since it was made
+            SequenceClassificationCache(symclade_db_path=data_loading_path_to_symclade_fasta).close()
+        if self.dedup_blast:
+            DeduplicatedSymCladeBlastHandler(
+                list_of_sample_names=[
+                    sample_name for sample_name in self.list_of_sample_names if
+                    sample_name not in self.error_samples_list and sample_name not in self.checked_samples_list],
+                wkd=data_loading_temp_working_directory, path_to_symclade_db=data_loading_path_to_symclade_db,
+                num_proc=self.num_proc, multiprocess=self.multiprocess, debug=data_loading_debug,
+                use_classification_cache=self.use_classification_cache,
+                path_to_symclade_fasta=data_loading_path_to_symclade_fasta
+            ).execute_deduplicated_blast()
         for n in range(self.num_proc):
             if self.multiprocess:
                 p = Process(
                     target=self._potential_sym_tax_screening_worker,
                     args=(
-                        self.input_queue, 
-                        self.error_samples_mp_list,
-                        self.checked_samples_mp_list,
-                        self.sub_evalue_sequence_to_num_sampes_found_in_mp_dict, 
-                        self.sub_evalue_nucleotide_sequence_to_clade_mp_dict,
+                        self.input_queue, self.output_queue,
+                        self.error_samples_list,
+                        self.checked_samples_list,
                         data_loading_temp_working_directory,
                         data_loading_path_to_symclade_db,
-                        data_loading_debug, self.lock
+                        data_loading_debug, self.dedup_blast, self.use_classification_cache,
+                        data_loading_path_to_symclade_fasta
                         ))
             else:
                 p = Thread(
                 target=self._potential_sym_tax_screening_worker,
                 args=(
-                    self.input_queue, 
-                    self.error_samples_mp_list,
-                    self.checked_samples_mp_list,
-                    self.sub_evalue_sequence_to_num_sampes_found_in_mp_dict, 
-                    self.sub_evalue_nucleotide_sequence_to_clade_mp_dict,
+                    self.input_queue, self.output_queue,
+                    self.error_samples_list,
+                    self.checked_samples_list,
                     data_loading_temp_working_directory,
                     data_loading_path_to_symclade_db,
-                    data_loading_debug, self.lock
+                    data_loading_debug, self.dedup_blast, self.use_classification_cache,
+                    data_loading_path_to_symclade_fasta
                     ))
 
             all_processes.append(p)
             p.start()
+
+        self._collect_and_merge_worker_results()
+
         for p in all_processes:
             p.join()
 
+    def _collect_and_merge_worker_results(self):
+        # We must empty the output queue before joining the processes else the join may hang.
+        # Each worker puts its results followed by a 'DONE'. A worker that fails still puts the 'DONE'
+        # (but not its results) so that we don't wait forever for it.
+        done_count = 0
+        results_count = 0
+        while done_count < self.num_proc:
+            worker_results = self.output_queue.get()
+            if worker_results == 'DONE':
+                done_count += 1
+                continue
+            results_count += 1
+            sub_evalue_sequence_counter, sub_evalue_sequence_to_clade_dict, checked_samples_list = worker_results
+            self.sub_evalue_sequence_to_num_samples_found_in_counter.update(sub_evalue_sequence_counter)
+            for nucleotide_sequence, clade in sub_evalue_sequence_to_clade_dict.items():
+                # The clade of a sequence is that of its best symClade match and so is the same in every worker
+                self.sub_evalue_nucleotide_sequence_to_clade_dict.setdefault(nucleotide_sequence, clade)
+            self.checked_samples_list.extend(checked_samples_list)
+        if results_count != self.num_proc:
+            raise RuntimeError(
+                f'{self.num_proc - results_count} of the potential sym tax screening workers failed. '
+                f'See the errors above.')
+
     @staticmethod
     def _potential_sym_tax_screening_worker(
-            in_q, 
-            error_samples_mp_list, 
-            checked_samples_mp_list, 
-            sub_evalue_sequence_to_num_sampes_found_in_mp_dict, 
-            sub_evalue_nucleotide_sequence_to_clade_mp_dict, 
+            in_q, out_q,
+            error_samples_list, 
+            checked_samples_list, 
             data_loading_temp_working_directory, 
             data_loading_path_to_symclade_db, 
-            data_loading_debug, lock):
+            data_loading_debug, blast_out_already_made=False, use_classification_cache=False,
+            data_loading_path_to_symclade_fasta=None):
         """
         input_q: The multiprocessing queue that holds a list of the sample names
-        e_val_collection_dict: This is a managed dictionary where key is a nucleotide sequence that has:
-        1 - provided a match in the blast analysis
-        2 - is of suitable size
-        3 - but has an evalue match below the cuttof
-        the value of the dict is an int that represents how many samples this nucleotide sequence was found in
-        err_smpl_list: This is a managed list containing sample names of the samples that had errors during the
+        out_q: The queue that the worker puts its results into once it has processed all of its samples:
+        a tuple of
+        1 - a Counter where key is a nucleotide sequence that has:
+            1 - provided a match in the blast analysis
+            2 - is of suitable size
+            3 - but has an evalue match below the cuttof
+            the value is an int that represents how many of the worker's samples this nucleotide sequence was found in
+        2 - a dict of those nucleotide sequences to the clade of their match
+        3 - a list of the names of the worker's samples that were found to contain only Symbiodinium sequences
+        followed by a 'DONE'. If the worker raises an error only the 'DONE' is put.
+        error_samples_list: A list containing sample names of the samples that had errors during the
         initial mothur qc and therefore don't require taxonomic screening performed on them
-        checked_samples: This is a list of sample names for samples that were found to contain only
+        checked_samples_list: This is a list of sample names for samples that were found to contain only
         Symbiodinium sequences or have already had all potential Symbiodinium sequences screened and so don't
         require any further taxonomic screening
-        Whilst this doesn't return anything a number of objects are picked out in each of the local
+        A number of objects are picked out in each of the local
         working directories for use in the workers that follow this one.
+        blast_out_already_made: if True, the blast.out of each sample has already been written by the
+        DeduplicatedSymCladeBlastHandler and the worker does not run blastn.
+        use_classification_cache: if True, the worker uses the cached blast results of the sample's sequences
+        (SequenceClassificationCache) and only runs blastn for the sequences that are not in the cache.
+        data_loading_path_to_symclade_fasta: the symClade.fa that the classification cache is associated with.
         """
-        for sample_name in iter(in_q.get, 'STOP'):
+        sub_evalue_sequence_counter = Counter()
+        sub_evalue_sequence_to_clade_dict = {}
+        newly_checked_samples_list = []
+        try:
+            for sample_name in iter(in_q.get, 'STOP'):
 
-            # If the sample gave an error during the inital mothur then we don't consider it here.
-            if sample_name in error_samples_mp_list:
-                continue
+                # If the sample gave an error during the inital mothur then we don't consider it here.
+                if sample_name in error_samples_list:
+                    continue
 
-            # A sample will be in this list if we have already performed this worker on it and none of its sequences
-            # gave matches to the symClade database at below the evalue threshold
-            if sample_name in checked_samples_mp_list:
-                continue
+                # A sample will be in this list if we have already performed this worker on it and none of its
+                # sequences gave matches to the symClade database at below the evalue threshold
+                if sample_name in checked_samples_list:
+                    continue
 
-            taxonomic_screening_worker = PotentialSymTaxScreeningWorker(
-                sample_name=sample_name, wkd=data_loading_temp_working_directory,
-                path_to_symclade_db=data_loading_path_to_symclade_db, debug=data_loading_debug,
-                checked_samples_mp_list=checked_samples_mp_list,
-                e_val_collection_mp_dict=sub_evalue_sequence_to_num_sampes_found_in_mp_dict,
-                sub_evalue_nucleotide_sequence_to_clade_mp_dict=sub_evalue_nucleotide_sequence_to_clade_mp_dict,
-                lock=lock)
+                taxonomic_screening_worker = PotentialSymTaxScreeningWorker(
+                    sample_name=sample_name, wkd=data_loading_temp_working_directory,
+                    path_to_symclade_db=data_loading_path_to_symclade_db, debug=data_loading_debug,
+                    checked_samples_list=newly_checked_samples_list,
+                    e_val_collection_counter=sub_evalue_sequence_counter,
+                    sub_evalue_nucleotide_sequence_to_clade_dict=sub_evalue_sequence_to_clade_dict,
+                    blast_out_already_made=blast_out_already_made,
+                    use_classification_cache=use_classification_cache,
+                    path_to_symclade_fasta=data_loading_path_to_symclade_fasta)
+
+                taxonomic_screening_worker.execute_tax_screening()
+
+            out_q.put((sub_evalue_sequence_counter, sub_evalue_sequence_to_clade_dict, newly_checked_samples_list))
+        finally:
+            out_q.put('DONE')
+
+
+class DeduplicatedSymCladeBlastHandler:
+    """The same ITS2 sequences are found in many of the samples of a DataSet. Rather than blasting the sequences of
+    each sample against the symClade database separately (and so blasting the common sequences once per sample),
+    we collect the unique sequences of all of the samples, blast these once (in one batch per processor)
+    and then write out the blast.out file of each sample from the results.
+    The results of blastn for a query do not depend on the other queries in the input, so by writing the
+    results of each sample's sequences in the order of the sample's fasta (and the hits of each sequence in the
+    order returned by blastn) the blast.out files are identical to those made by blasting each sample separately.
+    In the later rounds of the iterative screening, only the sequences of a sample that failed the previous round
+    (listed in its seq_names_to_rescreen.txt) are blasted again.
+    """
+    output_format_string = "6 qseqid sseqid staxids evalue pident qcovs"
+    seq_names_to_rescreen_file_name = 'seq_names_to_rescreen.txt'
 
-            taxonomic_screening_worker.execute_tax_screening()
+    def __init__(
+            self, list_of_sample_names, wkd, path_to_symclade_db, num_proc, multiprocess, debug,
+            use_classification_cache=False, path_to_symclade_fasta=None):
+        self.thread_safe_general = ThreadSafeGeneral()
+        self.use_classification_cache = use_classification_cache
+        self.list_of_sample_names = list_of_sample_names
+        self.wkd = wkd
+        self.path_to_symclade_db = path_to_symclade_db
+        # The symClade.fa that the classification cache is associated with
+        self.path_to_symclade_fasta = path_to_symclade_fasta if path_to_symclade_fasta else path_to_symclade_db
+        self.multiprocess = multiprocess
+        self.debug = debug
+        self.dedup_blast_dir = os.path.join(self.wkd, 'dedup_blast')
+        # key = sample name, value = list of the names of the sample's sequences in the order of the sample's fasta
+        self.sample_name_to_seq_name_list_dict = {}
+        # key = sample name, value = dict of sequence name to unique sequence name for the sequences being blasted
+        self.sample_name_to_seq_name_to_unique_name_dict_dict = {}
+        # key = sample name, value = dict of sequence name to the blast results kept from the previous round
+        self.sample_name_to_previous_seq_name_to_blast_result_list_dict_dict = {}
+        # key = nucleotide sequence, value = the name given to the unique sequence
+        self.nucleotide_sequence_to_unique_name_dict = {}
+        self.num_seqs_total = 0
+        self.num_proc = max(1, min(num_proc, len(self.list_of_sample_names)))
+        # key = unique sequence name, value = list of the blast.out lines (excluding the qseqid) for the sequence
+        self.unique_name_to_blast_result_list_dict = defaultdict(list)
+
+    def execute_deduplicated_blast(self):
+        if not self.list_of_sample_names:
+            return
+        self._collect_unique_seqs_of_samples()
+        nucleotide_sequences_to_blast = self._get_cached_blast_results_and_seqs_to_blast()
+        print(f'Blasting {len(nucleotide_sequences_to_blast)} unique sequences '
+              f'(from {self.num_seqs_total} sequences in {len(self.list_of_sample_names)} samples; '
+              f'{len(self.nucleotide_sequence_to_unique_name_dict) - len(nucleotide_sequences_to_blast)} '
+              f'unique sequences were cached) against the symClade database')
+        if nucleotide_sequences_to_blast:
+            batch_fasta_path_list = self._write_out_batch_fastas(nucleotide_sequences_to_blast)
+            self._blast_batch_fastas(batch_fasta_path_list)
+            self._read_batch_blast_outputs(batch_fasta_path_list)
+            self._add_blast_results_to_cache(nucleotide_sequences_to_blast)
+        self._write_out_sample_blast_outputs()
+        shutil.rmtree(self.dedup_blast_dir, ignore_errors=True)
+
+    def _get_cached_blast_results_and_seqs_to_blast(self):
+        """Populate self.unique_name_to_blast_result_list_dict from the classification cache and return the list
+        of the nucleotide sequences that were not cached"""
+        if not self.use_classification_cache:
+            return list(self.nucleotide_sequence_to_unique_name_dict.keys())
+        classification_cache = SequenceClassificationCache(
+            symclade_db_path=self.path_to_symclade_fasta, check_fingerprint=False)
+        sequence_to_blast_result_list_dict = classification_cache.get_blast_results(
+            self.nucleotide_sequence_to_unique_name_dict.keys())
+        classification_cache.close()
+        for nucleotide_sequence, blast_result_list in sequence_to_blast_result_list_dict.items():
+            self.unique_name_to_blast_result_list_dict[
+                self.nucleotide_sequence_to_unique_name_dict[nucleotide_sequence]] = blast_result_list
+        return [nucleotide_sequence for nucleotide_sequence in self.nucleotide_sequence_to_unique_name_dict if
+                nucleotide_sequence not in sequence_to_blast_result_list_dict]
+
+    def _add_blast_results_to_cache(self, nucleotide_sequences_blasted):
+        if not self.use_classification_cache:
+            return
+        classification_cache = SequenceClassificationCache(
+            symclade_db_path=self.path_to_symclade_fasta, check_fingerprint=False)
+        classification_cache.add_blast_results({
+            nucleotide_sequence: self.unique_name_to_blast_result_list_dict.get(
+                self.nucleotide_sequence_to_unique_name_dict[nucleotide_sequence], []) for
+            nucleotide_sequence in nucleotide_sequences_blasted})
+        classification_cache.close()
+
+    def _collect_unique_seqs_of_samples(self):
+        for sample_name in self.list_of_sample_names:
+            sample_dir = os.path.join(self.wkd, sample_name)
+            fasta_dict = self.thread_safe_general.create_dict_from_fasta(
+                fasta_path=os.path.join(sample_dir, 'fasta_file_for_tax_screening.fasta'))
+            self.sample_name_to_seq_name_list_dict[sample_name] = list(fasta_dict.keys())
+            seq_names_to_blast, previous_seq_name_to_blast_result_list_dict = \
+                self.get_seq_names_to_blast_and_previous_blast_results(sample_dir, fasta_dict)
+            self.sample_name_to_previous_seq_name_to_blast_result_list_dict_dict[sample_name] = \
+                previous_seq_name_to_blast_result_list_dict
+            seq_name_to_unique_name_dict = {}
+            for seq_name in seq_names_to_blast:
+                nucleotide_sequence = fasta_dict[seq_name]
+                try:
+                    unique_name = self.nucleotide_sequence_to_unique_name_dict[nucleotide_sequence]
+                except KeyError:
+                    unique_name = f'unique_seq_{len(self.nucleotide_sequence_to_unique_name_dict)}'
+                    self.nucleotide_sequence_to_unique_name_dict[nucleotide_sequence] = unique_name
+                seq_name_to_unique_name_dict[seq_name] = unique_name
+            self.sample_name_to_seq_name_to_unique_name_dict_dict[sample_name] = seq_name_to_unique_name_dict
+            self.num_seqs_total += len(seq_name_to_unique_name_dict)
+
+    @staticmethod
+    def get_seq_names_to_blast_and_previous_blast_results(sample_dir, fasta_dict):
+        """Return the names of the sequences of a sample that need to be blasted, and a dict of sequence name
+        to the blast results (excluding the qseqid) of the previous round of screening of the sequences that do not.
+        In the first round all of the sequences are blasted. In later rounds (i.e. when the previous round has
+        written out the seq_names_to_rescreen.txt file) only those sequences that failed the previous round."""
+        seq_names_to_rescreen_path = os.path.join(
+            sample_dir, DeduplicatedSymCladeBlastHandler.seq_names_to_rescreen_file_name)
+        if not os.path.exists(seq_names_to_rescreen_path):
+            return list(fasta_dict.keys()), {}
+        seq_names_to_rescreen_set = set(ThreadSafeGeneral.read_defined_file_to_list(seq_names_to_rescreen_path))
+        previous_seq_name_to_blast_result_list_dict = defaultdict(list)
+        for blast_out_line in ThreadSafeGeneral.read_defined_file_to_list(os.path.join(sample_dir, 'blast.out')):
+            seq_name, blast_result = blast_out_line.split('\t', 1)
+            if seq_name not in seq_names_to_rescreen_set:
+                previous_seq_name_to_blast_result_list_dict[seq_name].append(blast_result)
+        return [seq_name for seq_name in fasta_dict if seq_name in seq_names_to_rescreen_set], \
+            previous_seq_name_to_blast_result_list_dict
+
+    @staticmethod
+    def write_blast_out(blast_out_path, seq_name_list, seq_name_to_blast_result_list_dict):
+        """Write the blast results of the sequences in the order of seq_name_list as blastn would have"""
+        with open(blast_out_path, 'w') as f:
+            for seq_name in seq_name_list:
+                for blast_result in seq_name_to_blast_result_list_dict.get(seq_name, []):
+                    f.write(f'{seq_name}\t{blast_result}\n')
+
+    def _write_out_batch_fastas(self, nucleotide_sequences_to_blast):
+        os.makedirs(self.dedup_blast_dir, exist_ok=True)
+        unique_seq_list = [
+            (nucleotide_sequence, self.nucleotide_sequence_to_unique_name_dict[nucleotide_sequence]) for
+            nucleotide_sequence in nucleotide_sequences_to_blast]
+        num_batches = max(1, min(self.num_proc, len(unique_seq_list)))
+        batch_size = math.ceil(len(unique_seq_list) / num_batches)
+        batch_fasta_path_list = []
+        for batch_index in range(num_batches):
+            batch_fasta_path = os.path.join(self.dedup_blast_dir, f'batch_{batch_index}.fasta')
+            with open(batch_fasta_path, 'w') as f:
+                for nucleotide_sequence, unique_name in \
+                        unique_seq_list[batch_index * batch_size:(batch_index + 1) * batch_size]:
+                    f.write(f'>{unique_name}\n{nucleotide_sequence}\n')
+            batch_fasta_path_list.append(batch_fasta_path)
+        return batch_fasta_path_list
+
+    def _blast_batch_fastas(self, batch_fasta_path_list):
+        if self.multiprocess:
+            batch_input_queue = mp_Queue()
+        else:
+            batch_input_queue = mt_Queue()
+        for batch_fasta_path in batch_fasta_path_list:
+            batch_input_queue.put(batch_fasta_path)
+        for n in range(len(batch_fasta_path_list)):
+            batch_input_queue.put('STOP')
+
+        all_processes = []
+        for n in range(len(batch_fasta_path_list)):
+            if self.multiprocess:
+                p = Process(target=self._dedup_blast_worker, args=(
+                    batch_input_queue, self.path_to_symclade_db, self.debug))
+            else:
+                p = Thread(target=self._dedup_blast_worker, args=(
+                    batch_input_queue, self.path_to_symclade_db, self.debug))
+            all_processes.append(p)
+            p.start()
+        for p in all_processes:
+            p.join()
+
+    @staticmethod
+    def _dedup_blast_worker(in_q, path_to_symclade_db, debug):
+        for batch_fasta_path in iter(in_q.get, 'STOP'):
+            blastn_analysis = BlastnAnalysis(
+                input_file_path=batch_fasta_path,
+                output_file_path=batch_fasta_path.replace('.fasta', '.blast.out'), db_path=path_to_symclade_db,
+                output_format_string=DeduplicatedSymCladeBlastHandler.output_format_string)
+            blastn_analysis.execute_blastn_analysis(pipe_stdout_sterr=not debug)
+            logging.info(f'BLAST complete: {batch_fasta_path}.')
+
+    def _read_batch_blast_outputs(self, batch_fasta_path_list):
+        for batch_fasta_path in batch_fasta_path_list:
+            for blast_out_line in self.thread_safe_general.read_defined_file_to_list(
+                    batch_fasta_path.replace('.fasta', '.blast.out')):
+                unique_name, blast_result = blast_out_line.split('\t', 1)
+                self.unique_name_to_blast_result_list_dict[unique_name].append(blast_result)
+
+    def _write_out_sample_blast_outputs(self):
+        for sample_name, seq_name_list in self.sample_name_to_seq_name_list_dict.items():
+            seq_name_to_blast_result_list_dict = dict(
+                self.sample_name_to_previous_seq_name_to_blast_result_list_dict_dict[sample_name])
+            for seq_name, unique_name in self.sample_name_to_seq_name_to_unique_name_dict_dict[sample_name].items():
+                seq_name_to_blast_result_list_dict[seq_name] = self.unique_name_to_blast_result_list_dict.get(
+                    unique_name, [])
+            self.write_blast_out(
+                os.path.join(self.wkd, sample_name, 'blast.out'), seq_name_list, seq_name_to_blast_result_list_dict)
 
 
 class PotentialSymTaxScreeningWorker:
     def __init__(
-            self, sample_name, wkd, path_to_symclade_db, debug, e_val_collection_mp_dict,
-            checked_samples_mp_list, sub_evalue_nucleotide_sequence_to_clade_mp_dict, lock):
+            self, sample_name, wkd, path_to_symclade_db, debug, e_val_collection_counter,
+            checked_samples_list, sub_evalue_nucleotide_sequence_to_clade_dict,
+            blast_out_already_made=False, use_classification_cache=False, path_to_symclade_fasta=None):
         self.thread_safe_general = ThreadSafeGeneral()
+        self.blast_out_already_made = blast_out_already_made
+        self.use_classification_cache = use_classification_cache
         self.sample_name = sample_name
         self.cwd = os.path.join(wkd, self.sample_name)
         self.fasta_file_path = os.path.join(self.cwd, 'fasta_file_for_tax_screening.fasta')
+        self.blast_out_path = os.path.join(self.cwd, 'blast.out')
+        # The sequences that failed this round of screening and so will need blasting again in the next round
+        self.seq_names_to_rescreen_path = os.path.join(
+            self.cwd, DeduplicatedSymCladeBlastHandler.seq_names_to_rescreen_file_name)
+        # The symClade.fa that the classification cache is associated with
+        self.path_to_symclade_fasta = path_to_symclade_fasta if path_to_symclade_fasta else path_to_symclade_db
         self.fasta_dict = self.thread_safe_general.create_dict_from_fasta(fasta_path=self.fasta_file_path)
         self.name_file_path = os.path.join(self.cwd, 'name_file_for_tax_screening.names')
         self.name_dict = {
             a.split('\t')[0]: a for a in self.thread_safe_general.read_defined_file_to_list(self.name_file_path)}
         self.path_to_symclade_db = path_to_symclade_db
         self.debug = debug
-        # This is a managed dictionary where key is a nucleotide sequence that has:
+        # This is the Counter of the calling worker process where key is a nucleotide sequence that has:
         # 1 - provided a match in the blast analysis
         # 2 - is of suitable size
         # 3 - but has an evalue match below the cuttof
-        # the value of the dict is an int that represents how many samples this nucleotide sequence was found in
-        self.e_val_collection_mp_dict = e_val_collection_mp_dict
+        # the value is an int that represents how many samples this nucleotide sequence was found in
+        self.e_val_collection_counter = e_val_collection_counter
         # This dictionary will be used outside of the multiprocessing to append the clade of a given sequences
         # that is being added to the symClade reference database
-        self.sub_evalue_nucleotide_sequence_to_clade_mp_dict = sub_evalue_nucleotide_sequence_to_clade_mp_dict
+        self.sub_evalue_nucleotide_sequence_to_clade_dict = sub_evalue_nucleotide_sequence_to_clade_dict
         # The potential_non_symbiodiniaceae_sequences_list is used to see if there are any samples, that don't have
         # any potential non symbiodnium sequences. i.e. only definite symbiodiniaceae sequences.
         # These samples are added to
@@ -2361,27 +2887,17 @@ class PotentialSymTaxScreeningWorker:
         self.sequence_name_to_clade_dict = None
         self.blast_output_as_list = None
         self.already_processed_blast_seq_result = []
-        # this is a managed list that holds the names of samples from which no sequences were thrown out from
-        # it will be used in downstream processes.
-        self.checked_samples_mp_list = checked_samples_mp_list
-        self.lock = lock
+        # this is the list of the calling worker process that holds the names of samples from which no
+        # sequences were thrown out from. It will be used in downstream processes.
+        self.checked_samples_list = checked_samples_list
 
     def execute_tax_screening(self):
         logging.info(f'{self.sample_name}: verifying seqs are Symbiodinium and determining clade.')
 
-        blastn_analysis = BlastnAnalysis(
-            input_file_path=self.fasta_file_path,
-            output_file_path=os.path.join(self.cwd, 'blast.out'), db_path=self.path_to_symclade_db,
-            output_format_string="6 qseqid sseqid staxids evalue pident qcovs")
+        if not self.blast_out_already_made:
+            self._blast_seqs_and_write_blast_out()
 
-        if self.debug:
-            blastn_analysis.execute_blastn_analysis(pipe_stdout_sterr=False)
-        else:
-            blastn_analysis.execute_blastn_analysis(pipe_stdout_sterr=True)
-
-        logging.info(f'BLAST complete: Sample {self.sample_name}.')
-
-        self.blast_output_as_list = blastn_analysis.return_blast_output_as_list()
+        self.blast_output_as_list = self.thread_safe_general.read_defined_file_to_list(self.blast_out_path)
 
         self._if_debug_warn_if_blast_out_empty_or_low_seqs()
 
@@ -2397,7 +2913,78 @@ class PotentialSymTaxScreeningWorker:
         self._identify_and_allocate_non_sym_and_sub_e_seqs()
 
         if not self.potential_non_symbiodiniaceae_sequences_list:
-            self.checked_samples_mp_list.append(self.sample_name)
+            self.checked_samples_list.append(self.sample_name)
+
+        self.thread_safe_general.write_list_to_destination(
+            self.seq_names_to_rescreen_path, self.potential_non_symbiodiniaceae_sequences_list)
+
+    def _blast_seqs_and_write_blast_out(self):
+        """Blast the sample's sequences against the symClade database and write out the blast.out file.
+        In later rounds of the screening only the sequences that failed the previous round are blasted again.
+        Sequences whose blast results are in the classification cache are not blasted."""
+        seq_names_to_blast, seq_name_to_blast_result_list_dict = \
+            DeduplicatedSymCladeBlastHandler.get_seq_names_to_blast_and_previous_blast_results(
+                self.cwd, self.fasta_dict)
+        seq_name_to_blast_result_list_dict = dict(seq_name_to_blast_result_list_dict)
+
+        sequence_to_cached_blast_result_list_dict = {}
+        if self.use_classification_cache:
+            classification_cache = SequenceClassificationCache(
+                symclade_db_path=self.path_to_symclade_fasta, check_fingerprint=False)
+            sequence_to_cached_blast_result_list_dict = classification_cache.get_blast_results(
+                set(self.fasta_dict[seq_name] for seq_name in seq_names_to_blast))
+            classification_cache.close()
+        seq_names_not_cached = []
+        for seq_name in seq_names_to_blast:
+            if self.fasta_dict[seq_name] in sequence_to_cached_blast_result_list_dict:
+                seq_name_to_blast_result_list_dict[seq_name] = sequence_to_cached_blast_result_list_dict[
+                    self.fasta_dict[seq_name]]
+            else:
+                seq_names_not_cached.append(seq_name)
+
+        if seq_names_not_cached:
+            seq_name_to_blast_result_list_dict.update(self._blast_seqs(seq_names_not_cached))
+        else:
+            logging.info(f'Cached BLAST results used: Sample {self.sample_name}.')
+
+        DeduplicatedSymCladeBlastHandler.write_blast_out(
+            self.blast_out_path, list(self.fasta_dict.keys()), seq_name_to_blast_result_list_dict)
+
+    def _blast_seqs(self, seq_names_to_blast):
+        """Blast the given sequences of the sample and return a dict of sequence name to its blast results
+        (excluding the qseqid). The results are added to the classification cache."""
+        if len(seq_names_to_blast) == len(self.fasta_dict):
+            input_fasta_path = self.fasta_file_path
+        else:
+            input_fasta_path = os.path.join(self.cwd, 'fasta_file_for_tax_rescreening.fasta')
+            with open(input_fasta_path, 'w') as f:
+                for seq_name in seq_names_to_blast:
+                    f.write(f'>{seq_name}\n{self.fasta_dict[seq_name]}\n')
+        blastn_analysis = BlastnAnalysis(
+            input_file_path=input_fasta_path,
+            output_file_path=os.path.join(self.cwd, 'blast_of_seqs_to_blast.out'), db_path=self.path_to_symclade_db,
+            output_format_string=DeduplicatedSymCladeBlastHandler.output_format_string)
+
+        if self.debug:
+            blastn_analysis.execute_blastn_analysis(pipe_stdout_sterr=False)
+        else:
+            blastn_analysis.execute_blastn_analysis(pipe_stdout_sterr=True)
+
+        logging.info(f'BLAST complete: Sample {self.sample_name}.')
+
+        seq_name_to_blast_result_list_dict = {seq_name: [] for seq_name in seq_names_to_blast}
+        for blast_out_line in blastn_analysis.return_blast_output_as_list():
+            seq_name, blast_result = blast_out_line.split('\t', 1)
+            seq_name_to_blast_result_list_dict[seq_name].append(blast_result)
+
+        if self.use_classification_cache:
+            classification_cache = SequenceClassificationCache(
+                symclade_db_path=self.path_to_symclade_fasta, check_fingerprint=False)
+            classification_cache.add_blast_results({
+                self.fasta_dict[seq_name]: blast_result_list for
+                seq_name, blast_result_list in seq_name_to_blast_result_list_dict.items()})
+            classification_cache.close()
+        return seq_name_to_blast_result_list_dict
 
     def _identify_and_allocate_non_sym_and_sub_e_seqs(self):
         for line in self.blast_output_as_list:
@@ -2444,14 +3031,11 @@ class PotentialSymTaxScreeningWorker:
             # incorporate the size cutoff here that would normally happen in the further mothur qc later in the code
             self.potential_non_symbiodiniaceae_sequences_list.append(name_of_current_sequence)
             if 184 < len(self.fasta_dict[name_of_current_sequence]) < 310:
-                with self.lock:
-                    if self.fasta_dict[name_of_current_sequence] in self.e_val_collection_mp_dict.keys():
-                        self.e_val_collection_mp_dict[self.fasta_dict[name_of_current_sequence]] += 1
-                    else:
-                        self.e_val_collection_mp_dict[self.fasta_dict[name_of_current_sequence]] = 1
-                        self.sub_evalue_nucleotide_sequence_to_clade_mp_dict[
-                            self.fasta_dict[name_of_current_sequence]
-                        ] = self.sequence_name_to_clade_dict[name_of_current_sequence]
+                self.e_val_collection_counter[self.fasta_dict[name_of_current_sequence]] += 1
+                if self.fasta_dict[name_of_current_sequence] not in self.sub_evalue_nucleotide_sequence_to_clade_dict:
+                    self.sub_evalue_nucleotide_sequence_to_clade_dict[
+                        self.fasta_dict[name_of_current_sequence]
+                    ] = self.sequence_name_to_clade_dict[name_of_current_sequence]
 
     def _add_seqs_with_no_blast_match_to_non_sym_list(self):
         sequences_with_no_blast_match_as_set = set(self.fasta_dict.keys()) - \
@@ -2918,45 +3502,85 @@ class SymNonSymTaxScreeningWorker:
 
 
 class PerformMEDHandler:
-    def __init__(self, data_loading_temp_working_directory, data_loading_num_proc, multiprocess):
+    """MED is run in process (see lib/med_decompose/med_api.py) by num_proc workers. The results of the
+    decompositions are passed back through an output queue and held in med_output_directory_to_med_result_dict
+    keyed by the directory that the MED output files would have been written to. The output files are only
+    written (to that directory) when running in debug mode. If a med_cache_dir is given, the results of
+    decompositions of identical inputs are taken from (and added to) the MEDResultCache in that directory.
+    When running with processes and there are fewer samples than num_proc, the nodes of each level of the
+    decomposition of a sample are also analyzed in parallel (see Decomposer._analyze_nodes_in_parallel), with the
+    num_proc processes split between the samples, so that the cores that have no sample to decompose are used."""
+    def __init__(self, data_loading_temp_working_directory, data_loading_num_proc, multiprocess, med_cache_dir=None):
         # need to get list of the directories in which to perform the MED
         # we want to get a list of the .
         self.multiprocess = multiprocess
         self.temp_working_directory = data_loading_temp_working_directory
         self.num_proc = data_loading_num_proc
+        self.med_cache_dir = med_cache_dir
         self.list_of_redundant_fasta_paths = []
         self._populate_list_of_redundant_fasta_paths()
+        self.med_raw_topology_processes = self._get_med_raw_topology_processes()
         if self.multiprocess:
             self.input_queue_of_redundant_fasta_paths = mp_Queue()
+            self.output_queue_of_med_results = mp_Queue()
         else:
             self.input_queue_of_redundant_fasta_paths = mt_Queue()
+            self.output_queue_of_med_results = mt_Queue()
         self._populate_input_queue_of_redundant_fasta_paths()
         self.list_of_med_result_dirs = [
             os.path.join(os.path.dirname(path_to_redundant_fasta), 'MEDOUT') for
             path_to_redundant_fasta in self.list_of_redundant_fasta_paths]
+        # key = MED output directory, value = MEDResult (None if the decomposition failed)
+        self.med_output_directory_to_med_result_dict = {}
         
-    def execute_perform_med_worker(
-            self, data_loading_debug, data_loading_path_to_med_padding_executable,
-            data_loading_path_to_med_decompose_executable):
+    def execute_perform_med_worker(self, data_loading_debug):
         all_processes = []
 
         for n in range(self.num_proc):
             if self.multiprocess:
                 p = Process(target=self._perform_med_worker, args=(
-                    self.input_queue_of_redundant_fasta_paths, data_loading_debug,
-                    data_loading_path_to_med_padding_executable,
-                    data_loading_path_to_med_decompose_executable))
+                    self.input_queue_of_redundant_fasta_paths, self.output_queue_of_med_results,
+                    data_loading_debug, self.med_cache_dir, self.med_raw_topology_processes))
             else:
                 p = Thread(target=self._perform_med_worker, args=(
-                self.input_queue_of_redundant_fasta_paths, data_loading_debug,
-                data_loading_path_to_med_padding_executable,
-                data_loading_path_to_med_decompose_executable))
+                self.input_queue_of_redundant_fasta_paths, self.output_queue_of_med_results,
+                data_loading_debug, self.med_cache_dir, None))
             all_processes.append(p)
             p.start()
 
+        # We must empty the output queue before joining the processes else the join may hang.
+        # A worker that raises an error puts the error (as a formatted traceback) followed by its 'DONE'.
+        worker_error_list = []
+        done_count = 0
+        while done_count < self.num_proc:
+            med_output = self.output_queue_of_med_results.get()
+            if med_output == 'DONE':
+                done_count += 1
+                continue
+            if med_output[0] == 'ERROR':
+                worker_error_list.append(med_output[1])
+                continue
+            med_output_directory, med_result = med_output
+            self.med_output_directory_to_med_result_dict[med_output_directory] = med_result
+
         for p in all_processes:
             p.join()
 
+        if worker_error_list:
+            raise RuntimeError(
+                f'MED failed for {len(worker_error_list)} of the {len(self.list_of_redundant_fasta_paths)} '
+                f'fasta files. The worker errors were:\n' + '\n'.join(worker_error_list))
+
+    def _get_med_raw_topology_processes(self):
+        """The number of processes that each worker can analyze the nodes of a decomposition in without the workers
+        using more than num_proc processes between them. None if the nodes should be analyzed in the worker."""
+        if not self.multiprocess:
+            # forking is only safe from the worker processes, not from worker threads
+            return None
+        num_busy_workers = max(1, min(self.num_proc, len(self.list_of_redundant_fasta_paths)))
+        med_raw_topology_processes = self.num_proc // num_busy_workers
+        return med_raw_topology_processes if med_raw_topology_processes > 1 else None
+
     def _populate_list_of_redundant_fasta_paths(self):
         for dirpath, dirnames, files in os.walk(self.temp_working_directory):
             for file_name in files:
@@ -2970,61 +3594,56 @@ class PerformMEDHandler:
             self.input_queue_of_redundant_fasta_paths.put('STOP')
 
     @staticmethod
-    def _perform_med_worker(
-            in_q, data_loading_debug, data_loading_path_to_med_padding_executable,
-            data_loading_path_to_med_decompose_executable):
-        for redundant_fata_path in iter(in_q.get, 'STOP'):
-            perform_med_worker_instance = PerformMEDWorker(
-                redundant_fasta_path=redundant_fata_path, data_loading_debug=data_loading_debug,
-                data_loading_path_to_med_padding_executable=data_loading_path_to_med_padding_executable,
-                data_loading_path_to_med_decompose_executable=data_loading_path_to_med_decompose_executable)
+    def _perform_med_worker(in_q, out_q, data_loading_debug, med_cache_dir, med_raw_topology_processes):
+        try:
+            for redundant_fata_path in iter(in_q.get, 'STOP'):
+                perform_med_worker_instance = PerformMEDWorker(
+                    redundant_fasta_path=redundant_fata_path, data_loading_debug=data_loading_debug,
+                    med_cache_dir=med_cache_dir, med_raw_topology_processes=med_raw_topology_processes)
 
-            perform_med_worker_instance.do_decomposition()
+                med_result = perform_med_worker_instance.do_decomposition()
+                out_q.put((perform_med_worker_instance.med_output_dir, med_result))
+        except Exception:
+            out_q.put(('ERROR', traceback.format_exc()))
+        finally:
+            out_q.put('DONE')
 
 
 class PerformMEDWorker:
-    def __init__(
-            self, redundant_fasta_path, data_loading_path_to_med_padding_executable, data_loading_debug,
-            data_loading_path_to_med_decompose_executable):
+    def __init__(self, redundant_fasta_path, data_loading_debug, med_cache_dir=None, med_raw_topology_processes=None):
         self.thread_safe_general = ThreadSafeGeneral()
         self.redundant_fasta_path_unpadded = redundant_fasta_path
-        self.redundant_fasta_path_padded = self.redundant_fasta_path_unpadded.replace('.fasta', '.padded.fasta')
         self.cwd = os.path.dirname(self.redundant_fasta_path_unpadded)
         self.sample_name = self.cwd.split('/')[-2]
         self.debug = data_loading_debug
-        self.path_to_med_padding_executable = data_loading_path_to_med_padding_executable
-        self.path_to_med_decompose_executable = data_loading_path_to_med_decompose_executable
+        self.med_cache_dir = med_cache_dir
+        self.med_raw_topology_processes = med_raw_topology_processes
         self.med_output_dir = os.path.join(os.path.dirname(self.redundant_fasta_path_unpadded), 'MEDOUT')
-        os.makedirs(self.med_output_dir, exist_ok=True)
+        # key = nucleotide sequence, value = the number of reads of the sequence in the redundant fasta
+        self.sequence_to_frequency_counter = Counter(
+            self.thread_safe_general.read_defined_file_to_list(self.redundant_fasta_path_unpadded)[1::2])
         self.med_m_value = self._get_med_m_value()
 
     def do_decomposition(self):
+        """Return the MEDResult of the decomposition or None if the decomposition failed
+        (we are expecting some to fail when there are too few sequences)."""
         sys.stdout.write(f'{self.sample_name}: starting MED analysis\n')
-        sys.stdout.write(f'{self.sample_name}: padding sequences\n')
-        subprocess.run([
-            self.path_to_med_padding_executable,
-            '-o', self.redundant_fasta_path_padded,
-            self.redundant_fasta_path_unpadded], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         sys.stdout.write(f'{self.sample_name}: decomposing\n')
-        self._do_the_decomposition()
+        if self.debug:
+            # The MED output files are only written when debugging
+            os.makedirs(self.med_output_dir, exist_ok=True)
+        try:
+            med_result = med_decompose(
+                sequences=list(self.sequence_to_frequency_counter.keys()),
+                frequencies=list(self.sequence_to_frequency_counter.values()), M=self.med_m_value,
+                sample_name=self.sample_name, output_directory=self.med_output_dir if self.debug else None,
+                verbose=self.debug, cache_dir=self.med_cache_dir,
+                raw_topology_processes=self.med_raw_topology_processes)
+        except Exception as e:
+            sys.stdout.write(f'{self.sample_name}: MED analysis failed: {e}\n')
+            return None
         sys.stdout.write(f'{self.sample_name}: MED analysis complete\n')
-
-    def _do_the_decomposition(self):
-        # We cannot add check=True to the subprocess calls as we are expecting some of them to fail
-        # when there are too few sequences
-        if not self.debug:
-            subprocess.run(
-                [self.path_to_med_decompose_executable, '-M', str(self.med_m_value), '--skip-gexf-files',
-                 '--skip-gen-figures',
-                 '--skip-gen-html', '--skip-check-input', '-T', '-o',
-                 self.med_output_dir, self.redundant_fasta_path_padded], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        elif self.debug:
-            subprocess.run(
-                [self.path_to_med_decompose_executable, '-M', str(self.med_m_value), '--skip-gexf-files',
-                 '--skip-gen-figures',
-                 '--skip-gen-html',
-                 '--skip-check-input', '-T', '-o',
-                 self.med_output_dir, self.redundant_fasta_path_padded])
+        return med_result
 
     def _get_med_m_value(self):
         # Define MED M value dynamically.
@@ -3034,35 +3653,73 @@ class PerformMEDWorker:
         # calculated when working with a modelling project where I was subsampling to 1000 sequences. In this
         # scenario the M was set to 4.
         # We should also take care that M doesn't go below 4, so we should use a max choice for the M
-        num_of_seqs_to_decompose = len(
-            self.thread_safe_general.read_defined_file_to_list(self.redundant_fasta_path_unpadded)) / 2
+        num_of_seqs_to_decompose = sum(self.sequence_to_frequency_counter.values())
         return max(4, int(0.004 * num_of_seqs_to_decompose))
 
 
 class DataSetSampleSequenceCreatorWorker:
     """This class will be responsible for handling a set of med outputs. Objects will be things like the directory,
-    the count table, number of samples, number of nodes, these sorts of things."""
-    def __init__(self, med_output_directory,
-                 data_set_sample_creator_handler_ref_seq_sequence_to_ref_seq_id_dict,
-                 data_set_sample_creator_handler_ref_seq_uid_to_ref_seq_name_dict, data_loading_dataset_obj):
+    the count table, number of samples, number of nodes, these sorts of things.
+
+    The work is done in two stages so that the first can be run in parallel.
+    match_med_nodes_to_existing_ref_seqs parses the MED output and matches the nodes to the existing
+    ReferenceSequences. It makes no use of the database.
+    make_data_set_sample_sequences then creates any new ReferenceSequences required, and the DataSetSampleSequence
+    and CladeCollection objects. This stage must be run for the MED outputs one at a time and in a fixed order.
+
+    The nodes and their abundances are taken from the MEDResult of the in process decomposition if given,
+    else they are read from the MED output files in med_output_directory.
+    """
+    def __init__(self, med_output_directory, med_result=None):
         self.thread_safe_general = ThreadSafeGeneral()
         self.output_directory = med_output_directory
+        self.med_result = med_result
         self.sample_name = self.output_directory.split('/')[-3]
         self.clade = self.output_directory.split('/')[-2]
         self.nodes_list_of_nucleotide_sequences = []
         self._populate_nodes_list_of_nucleotide_sequences()
         self.num_med_nodes = len(self.nodes_list_of_nucleotide_sequences)
         self.node_sequence_name_to_ref_seq_id = {}
-        self.ref_seq_sequence_to_ref_seq_id_dict = data_set_sample_creator_handler_ref_seq_sequence_to_ref_seq_id_dict
-        self.ref_seq_uid_to_ref_seq_name_dict = data_set_sample_creator_handler_ref_seq_uid_to_ref_seq_name_dict
-        self.node_abundance_df = pd.read_csv(
-            os.path.join(self.output_directory, 'MATRIX-COUNT.txt'), delimiter='\t', header=0, index_col=0)
+        # The names of the nodes that were matched to the exact sequence (or the exact sequence + A)
+        # of a ReferenceSequence. These associations cannot be changed by the creation of new ReferenceSequences.
+        self.exactly_matched_node_names = set()
+        # The number of ReferenceSequences that were in the RefSeqMatchIndex when the nodes were matched
+        self.num_ref_seqs_at_matching = None
+        self.ref_seq_match_index = None
+        self.ref_seq_sequence_to_ref_seq_id_dict = None
+        self.ref_seq_uid_to_ref_seq_name_dict = None
+        self.node_abundance_df = self._get_node_abundance_df()
         self.total_num_sequences = sum(self.node_abundance_df.iloc[0])
-        self.dataset_sample_object = DataSetSample.objects.get(
-            data_submission_from=data_loading_dataset_obj, name=self.sample_name)
+        self.dataset_sample_object = None
         self.clade_collection_object = None
 
+    def attach_ref_seq_match_index(self, ref_seq_match_index):
+        self.ref_seq_match_index = ref_seq_match_index
+        self.ref_seq_sequence_to_ref_seq_id_dict = self.ref_seq_match_index.ref_seq_sequence_to_ref_seq_id_dict
+        self.ref_seq_uid_to_ref_seq_name_dict = self.ref_seq_match_index.ref_seq_uid_to_ref_seq_name_dict
+
+    def detach_ref_seq_match_index(self):
+        """So that the worker can be passed back from a worker process without the index."""
+        self.ref_seq_match_index = None
+        self.ref_seq_sequence_to_ref_seq_id_dict = None
+        self.ref_seq_uid_to_ref_seq_name_dict = None
+
+    def _get_node_abundance_df(self):
+        if self.med_result is not None:
+            return pd.DataFrame(
+                [[self.med_result.node_count_dict[node_name] for node_name in self.med_result.node_names]],
+                index=[self.med_result.sample_name], columns=self.med_result.node_names)
+        return pd.read_csv(
+            os.path.join(self.output_directory, 'MATRIX-COUNT.txt'), delimiter='\t', header=0, index_col=0)
+
     def _populate_nodes_list_of_nucleotide_sequences(self):
+        if self.med_result is not None:
+            for node_name in self.med_result.node_names:
+                self.nodes_list_of_nucleotide_sequences.append(NucleotideSequence(
+                    name=node_name, abundance=self.med_result.node_size_dict[node_name],
+                    sequence=self.med_result.node_representative_dict[node_name].replace('-', '')))
+            return
+
         node_file_path = os.path.join(self.output_directory, 'NODE-REPRESENTATIVES.fasta')
         try:
             node_file_as_list = self.thread_safe_general.read_defined_file_to_list(node_file_path)
@@ -3076,7 +3733,17 @@ class DataSetSampleSequenceCreatorWorker:
             self.nodes_list_of_nucleotide_sequences.append(
                 NucleotideSequence(name=node_seq_name, abundance=node_seq_abundance, sequence=node_seq_sequence))
 
-    def make_data_set_sample_sequences(self):
+    def match_med_nodes_to_existing_ref_seqs(self, ref_seq_match_index):
+        self.attach_ref_seq_match_index(ref_seq_match_index)
+        self.num_ref_seqs_at_matching = len(self.ref_seq_match_index)
+        for node_nucleotide_sequence_object in self.nodes_list_of_nucleotide_sequences:
+            self._assign_node_sequence_to_existing_ref_seq(node_nucleotide_sequence_object)
+
+    def make_data_set_sample_sequences(self, ref_seq_match_index, data_loading_dataset_obj):
+        self.attach_ref_seq_match_index(ref_seq_match_index)
+        self.dataset_sample_object = DataSetSample.objects.get(
+            data_submission_from=data_loading_dataset_obj, name=self.sample_name)
+
         self._associate_med_nodes_to_ref_seq_objs()
 
         if self._two_or_more_nodes_associated_to_the_same_reference_sequence():
@@ -3089,8 +3756,16 @@ class DataSetSampleSequenceCreatorWorker:
         self._create_data_set_sample_sequences()
 
     def _associate_med_nodes_to_ref_seq_objs(self):
+        # If ReferenceSequences have been created since the nodes were matched (for the MED outputs processed
+        # before this one, or for the nodes of this output that come before the node in question), then the nodes
+        # that were not exactly matched need matching again as one of the new ReferenceSequences may now
+        # be their match. This is checked node by node as the nodes of this output create ReferenceSequences too.
         for node_nucleotide_sequence_object in self.nodes_list_of_nucleotide_sequences:
-            if not self._assign_node_sequence_to_existing_ref_seq(node_nucleotide_sequence_object):
+            if len(self.ref_seq_match_index) != self.num_ref_seqs_at_matching and \
+                    node_nucleotide_sequence_object.name not in self.exactly_matched_node_names:
+                self.node_sequence_name_to_ref_seq_id.pop(node_nucleotide_sequence_object.name, None)
+                self._assign_node_sequence_to_existing_ref_seq(node_nucleotide_sequence_object)
+            if node_nucleotide_sequence_object.name not in self.node_sequence_name_to_ref_seq_id:
                 self._assign_node_sequence_to_new_ref_seq(node_nucleotide_sequence_object)
 
     def _create_data_set_sample_sequences(self):
@@ -3103,9 +3778,8 @@ class DataSetSampleSequenceCreatorWorker:
         data_set_sample_sequence_list = []
         for node_nucleotide_sequence_object in self.nodes_list_of_nucleotide_sequences:
             associated_ref_seq_id = self.node_sequence_name_to_ref_seq_id[node_nucleotide_sequence_object.name]
-            associated_ref_seq_object = ReferenceSequence.objects.get(id=associated_ref_seq_id)
             df_index_label = self.node_abundance_df.index.values.tolist()[0]
-            dss = DataSetSampleSequence(reference_sequence_of=associated_ref_seq_object,
+            dss = DataSetSampleSequence(reference_sequence_of_id=associated_ref_seq_id,
                                         abundance=self.node_abundance_df.at[
                                             df_index_label, node_nucleotide_sequence_object.name],
                                         data_set_sample_from=self.dataset_sample_object)
@@ -3119,10 +3793,9 @@ class DataSetSampleSequenceCreatorWorker:
         for node_nucleotide_sequence_object in self.nodes_list_of_nucleotide_sequences:
             associated_ref_seq_id = self.node_sequence_name_to_ref_seq_id[node_nucleotide_sequence_object.name]
             associated_ref_seq_uid_as_str_list.append(str(associated_ref_seq_id))
-            associated_ref_seq_object = ReferenceSequence.objects.get(id=associated_ref_seq_id)
             df_index_label = self.node_abundance_df.index.values.tolist()[0]
             dss = DataSetSampleSequence(
-                reference_sequence_of=associated_ref_seq_object,
+                reference_sequence_of_id=associated_ref_seq_id,
                 clade_collection_found_in=self.clade_collection_object,
                 abundance=self.node_abundance_df.at[df_index_label, node_nucleotide_sequence_object.name],
                 data_set_sample_from=self.dataset_sample_object)
@@ -3239,21 +3912,20 @@ class DataSetSampleSequenceCreatorWorker:
     def _search_for_super_set_match_and_associate_if_found_else_return_false(self, node_nucleotide_sequence_object):
         # or if the seq in question is bigger than a refseq sequence and is a super set of it
         # In either of these cases we should consider this a match and use the refseq matched to.
-        # This might be very coputationally expensive but lets give it a go
-        for ref_seq_sequence in self.ref_seq_sequence_to_ref_seq_id_dict.keys():
-            if node_nucleotide_sequence_object.sequence in ref_seq_sequence or \
-                    ref_seq_sequence in node_nucleotide_sequence_object.sequence:
-                # Then this is a match
-                self.node_sequence_name_to_ref_seq_id[node_nucleotide_sequence_object.name] = \
-                    self.ref_seq_sequence_to_ref_seq_id_dict[ref_seq_sequence]
-                name_of_reference_sequence = self.ref_seq_uid_to_ref_seq_name_dict[
-                    self.ref_seq_sequence_to_ref_seq_id_dict[ref_seq_sequence]]
-                self._print_succesful_association_details_to_stdout(node_nucleotide_sequence_object,
-                                                                    name_of_reference_sequence)
-                return True
+        # The RefSeqMatchIndex saves us from having to compare the seq in question to every refseq.
+        matching_ref_seq_uid = self.ref_seq_match_index.get_sub_or_super_string_match_uid(
+            node_nucleotide_sequence_object.sequence)
+        if matching_ref_seq_uid is not None:
+            # Then this is a match
+            self.node_sequence_name_to_ref_seq_id[node_nucleotide_sequence_object.name] = matching_ref_seq_uid
+            name_of_reference_sequence = self.ref_seq_uid_to_ref_seq_name_dict[matching_ref_seq_uid]
+            self._print_succesful_association_details_to_stdout(node_nucleotide_sequence_object,
+                                                                name_of_reference_sequence)
+            return True
         return False
 
     def _associate_node_seq_to_ref_seq_by_adenine_match_and_return_true(self, node_nucleotide_sequence_object):
+        self.exactly_matched_node_names.add(node_nucleotide_sequence_object.name)
         self.node_sequence_name_to_ref_seq_id[
             node_nucleotide_sequence_object.name] = self.ref_seq_sequence_to_ref_seq_id_dict[
             'A' + node_nucleotide_sequence_object.sequence]
@@ -3263,6 +3935,7 @@ class DataSetSampleSequenceCreatorWorker:
         return True
 
     def _associate_node_seq_to_ref_seq_by_exact_match_and_return_true(self, node_nucleotide_sequence_object):
+        self.exactly_matched_node_names.add(node_nucleotide_sequence_object.name)
         self.node_sequence_name_to_ref_seq_id[
             node_nucleotide_sequence_object.name] = self.ref_seq_sequence_to_ref_seq_id_dict[
             node_nucleotide_sequence_object.sequence]
@@ -3280,9 +3953,9 @@ class DataSetSampleSequenceCreatorWorker:
     def _assign_node_sequence_to_new_ref_seq(self, node_nucleotide_sequence_object):
         new_ref_seq = ReferenceSequence(clade=self.clade, sequence=node_nucleotide_sequence_object.sequence)
         new_ref_seq.save()
-        self.ref_seq_sequence_to_ref_seq_id_dict[new_ref_seq.sequence] = new_ref_seq.id
+        self.ref_seq_match_index.add_ref_seq(new_ref_seq)
         self.node_sequence_name_to_ref_seq_id[node_nucleotide_sequence_object.name] = new_ref_seq.id
-        self.ref_seq_uid_to_ref_seq_name_dict[new_ref_seq.id] = str(new_ref_seq)
+        self.exactly_matched_node_names.add(node_nucleotide_sequence_object.name)
 
         sys.stdout.write(f'\r{self.sample_name} clade {self.clade}: '
                          f'Assigning MED node {node_nucleotide_sequence_object.name} '
@@ -3291,36 +3964,145 @@ class DataSetSampleSequenceCreatorWorker:
 
 class DataSetSampleCreatorHandler:
     """This class will be where we run the code for creating reference sequences, data set sample sequences and
-    clade collections."""
-    def __init__(self):
-        # dictionaries to save us having to do lots of database look ups
-        self.ref_seq_uid_to_ref_seq_name_dict = {
-            ref_seq.id: str(ref_seq) for ref_seq in ReferenceSequence.objects.all()}
-        self.ref_seq_sequence_to_ref_seq_id_dict = {
-            ref_seq.sequence: ref_seq.id for ref_seq in ReferenceSequence.objects.all()}
+    clade collections.
+
+    If num_proc > 1 the MED outputs are parsed and matched to the existing ReferenceSequences by num_proc workers.
+    The matched outputs are passed back to this process where they are written to the database, one at a time, in the
+    order of the list of MED output directories. This way the ReferenceSequences that get created, and the
+    associations that are made, are the same as when the MED outputs are processed serially."""
+    def __init__(self, ref_seq_match_index, num_proc=1, multiprocess=True):
+        # The RefSeqMatchIndex that is shared with the pre-MED sequence processing
+        self.ref_seq_match_index = ref_seq_match_index
+        self.num_proc = num_proc
+        self.multiprocess = multiprocess
 
     def execute_data_set_sample_creation(
-            self, data_loading_list_of_med_output_directories, data_loading_debug, data_loading_dataset_object):
-        for med_output_directory in data_loading_list_of_med_output_directories:
-            try:
-                data_set_sample_sequence_creator_worker = DataSetSampleSequenceCreatorWorker(
-                    med_output_directory=med_output_directory,
-                    data_loading_dataset_obj=data_loading_dataset_object,
-                    data_set_sample_creator_handler_ref_seq_sequence_to_ref_seq_id_dict=
-                    self.ref_seq_sequence_to_ref_seq_id_dict,
-                    data_set_sample_creator_handler_ref_seq_uid_to_ref_seq_name_dict=
-                    self.ref_seq_uid_to_ref_seq_name_dict)
-            except RuntimeError as e:
-                non_existant_med_output_dir = e.args[0]['med_output_directory']
-                print(f'{non_existant_med_output_dir}: File not found during DataSetSample creation.')
+            self, data_loading_list_of_med_output_directories, data_loading_debug, data_loading_dataset_object,
+            data_loading_med_output_directory_to_med_result_dict=None):
+        """data_loading_med_output_directory_to_med_result_dict holds the MEDResults of the in process
+        decompositions. The MED output files are read for any directory that is not in it (or has a None result)."""
+        if data_loading_med_output_directory_to_med_result_dict is None:
+            data_loading_med_output_directory_to_med_result_dict = {}
+        if self.num_proc > 1 and len(data_loading_list_of_med_output_directories) > 1:
+            self._execute_data_set_sample_creation_parallel(
+                data_loading_list_of_med_output_directories, data_loading_debug, data_loading_dataset_object,
+                data_loading_med_output_directory_to_med_result_dict)
+        else:
+            for med_output_directory in data_loading_list_of_med_output_directories:
+                try:
+                    data_set_sample_sequence_creator_worker = DataSetSampleSequenceCreatorWorker(
+                        med_output_directory=med_output_directory,
+                        med_result=data_loading_med_output_directory_to_med_result_dict.get(med_output_directory))
+                except RuntimeError as e:
+                    non_existant_med_output_dir = e.args[0]['med_output_directory']
+                    print(f'{non_existant_med_output_dir}: File not found during DataSetSample creation.')
+                    continue
+                data_set_sample_sequence_creator_worker.match_med_nodes_to_existing_ref_seqs(
+                    ref_seq_match_index=self.ref_seq_match_index)
+                self._make_data_set_sample_sequences_of_worker(
+                    data_set_sample_sequence_creator_worker, data_loading_debug, data_loading_dataset_object)
+
+    def _execute_data_set_sample_creation_parallel(
+            self, data_loading_list_of_med_output_directories, data_loading_debug, data_loading_dataset_object,
+            data_loading_med_output_directory_to_med_result_dict):
+        if self.multiprocess:
+            med_output_directory_input_queue = mp_Queue()
+            worker_output_queue = mp_Queue()
+        else:
+            med_output_directory_input_queue = mt_Queue()
+            worker_output_queue = mt_Queue()
+        num_workers = min(self.num_proc, len(data_loading_list_of_med_output_directories))
+        for med_output_index, med_output_directory in enumerate(data_loading_list_of_med_output_directories):
+            med_output_directory_input_queue.put((
+                med_output_index, med_output_directory,
+                data_loading_med_output_directory_to_med_result_dict.get(med_output_directory)))
+        for n in range(num_workers):
+            med_output_directory_input_queue.put('STOP')
+
+        all_processes = []
+        # http://stackoverflow.com/questions/8242837/django-multiprocessing-and-database-connections
+        db.connections.close_all()
+        sys.stdout.write(f'\nMatching MED nodes to ReferenceSequences using {num_workers} workers\n')
+        for n in range(num_workers):
+            if self.multiprocess:
+                p = Process(target=self._data_set_sample_sequence_creator_worker, args=(
+                    med_output_directory_input_queue, worker_output_queue, self.ref_seq_match_index,
+                    self.multiprocess))
+            else:
+                p = Thread(target=self._data_set_sample_sequence_creator_worker, args=(
+                    med_output_directory_input_queue, worker_output_queue, self.ref_seq_match_index,
+                    self.multiprocess))
+            all_processes.append(p)
+            p.start()
+
+        # Write the matched MED outputs to the database in the order of the MED output directories
+        # holding any that are returned out of order until their turn comes.
+        # A worker that raises an error puts the error (as a formatted traceback) followed by its 'DONE'.
+        done_count = 0
+        next_med_output_index = 0
+        med_output_index_to_worker_dict = {}
+        worker_error_list = []
+        while done_count < num_workers:
+            worker_output = worker_output_queue.get()
+            if worker_output == 'DONE':
+                done_count += 1
                 continue
-            if data_loading_debug:
-                if data_set_sample_sequence_creator_worker.num_med_nodes < 10:
-                    print(
-                        f'{med_output_directory}: '
-                        f'WARNING node file contains only '
-                        f'{data_set_sample_sequence_creator_worker.num_med_nodes} sequences.')
-            sys.stdout.write(
-                f'\n\nPopulating {data_set_sample_sequence_creator_worker.sample_name} with '
-                f'clade {data_set_sample_sequence_creator_worker.clade} sequences\n')
-            data_set_sample_sequence_creator_worker.make_data_set_sample_sequences()
\ No newline at end of file
+            if worker_output[0] == 'ERROR':
+                worker_error_list.append(worker_output[1])
+                continue
+            med_output_index, data_set_sample_sequence_creator_worker, med_output_directory = worker_output
+            med_output_index_to_worker_dict[med_output_index] = (
+                data_set_sample_sequence_creator_worker, med_output_directory)
+            while next_med_output_index in med_output_index_to_worker_dict:
+                data_set_sample_sequence_creator_worker, med_output_directory = med_output_index_to_worker_dict.pop(
+                    next_med_output_index)
+                next_med_output_index += 1
+                if data_set_sample_sequence_creator_worker is None:
+                    print(f'{med_output_directory}: File not found during DataSetSample creation.')
+                    continue
+                self._make_data_set_sample_sequences_of_worker(
+                    data_set_sample_sequence_creator_worker, data_loading_debug, data_loading_dataset_object)
+
+        for p in all_processes:
+            p.join()
+
+        if worker_error_list or next_med_output_index != len(data_loading_list_of_med_output_directories):
+            raise RuntimeError(
+                f'Only {next_med_output_index} of the {len(data_loading_list_of_med_output_directories)} '
+                f'MED outputs were matched to ReferenceSequences. The worker errors were:\n' +
+                '\n'.join(worker_error_list))
+
+    @staticmethod
+    def _data_set_sample_sequence_creator_worker(in_q, out_q, ref_seq_match_index, multiprocess):
+        try:
+            for med_output_index, med_output_directory, med_result in iter(in_q.get, 'STOP'):
+                try:
+                    data_set_sample_sequence_creator_worker = DataSetSampleSequenceCreatorWorker(
+                        med_output_directory=med_output_directory, med_result=med_result)
+                except RuntimeError as e:
+                    out_q.put((med_output_index, None, e.args[0]['med_output_directory']))
+                    continue
+                data_set_sample_sequence_creator_worker.match_med_nodes_to_existing_ref_seqs(
+                    ref_seq_match_index=ref_seq_match_index)
+                if multiprocess:
+                    # We don't want to send the whole index back through the queue
+                    data_set_sample_sequence_creator_worker.detach_ref_seq_match_index()
+                out_q.put((med_output_index, data_set_sample_sequence_creator_worker, med_output_directory))
+        except Exception:
+            out_q.put(('ERROR', traceback.format_exc()))
+        finally:
+            out_q.put('DONE')
+
+    def _make_data_set_sample_sequences_of_worker(
+            self, data_set_sample_sequence_creator_worker, data_loading_debug, data_loading_dataset_object):
+        if data_loading_debug:
+            if data_set_sample_sequence_creator_worker.num_med_nodes < 10:
+                print(
+                    f'{data_set_sample_sequence_creator_worker.output_directory}: '
+                    f'WARNING node file contains only '
+                    f'{data_set_sample_sequence_creator_worker.num_med_nodes} sequences.')
+        sys.stdout.write(
+            f'\n\nPopulating {data_set_sample_sequence_creator_worker.sample_name} with '
+            f'clade {data_set_sample_sequence_creator_worker.clade} sequences\n')
+        data_set_sample_sequence_creator_worker.make_data_set_sample_sequences(
+            ref_seq_match_index=self.ref_seq_match_index, data_loading_dataset_obj=data_loading_dataset_object)
\ No newline at end of file
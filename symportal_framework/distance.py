@@ -1,14 +1,13 @@
-import itertools
 import math
 import os
+import shutil
 import subprocess
 import sys
 import logging
 import numpy as np
 import pandas as pd
-from scipy.spatial.distance import braycurtis
 from skbio.diversity import beta_diversity
-from skbio.stats.ordination import pcoa
+from skbio.stats.ordination import pcoa, OrdinationResults
 from skbio.tree import TreeNode
 import django_general
 from general import ThreadSafeGeneral
@@ -16,6 +15,29 @@ from dbApp.models import (
     ReferenceSequence, DataSetSampleSequence, AnalysisType, DataSetSample,
     CladeCollection, CladeCollectionType)
 from exceptions import InsufficientSequencesInAlignment, EigenValsTooSmallError
+from braycurtis import SparseBrayCurtisCalculator
+from distance_memmap import MemmapDistanceMatrix
+from randomised_pcoa import RandomisedPCoA
+from tree_cache import UniFracTreeCache
+
+
+def compute_pcoa(dist_data, pcoa_method='eigh', pcoa_dimensions=10, block_size=None):
+    """Return the skbio OrdinationResults of the PCoA of the square distance array dist_data.
+    pcoa_method 'eigh' is the full eigendecomposition of skbio.
+    pcoa_method 'randomised' computes only the first pcoa_dimensions axes (see randomised_pcoa.RandomisedPCoA),
+    reading dist_data (that may be a memmap) block_size rows at a time."""
+    if pcoa_method == 'eigh':
+        return pcoa(dist_data)
+    randomised_pcoa = RandomisedPCoA(
+        dist_matrix=dist_data, num_dimensions=pcoa_dimensions, block_size=block_size or 1000).compute()
+    if randomised_pcoa.degenerate:
+        logging.warning('The distances were all (close to) 0. The PCoA coordinates have been set to 0.')
+    axis_labels = [f'PC{i + 1}' for i in range(randomised_pcoa.num_dimensions)]
+    return OrdinationResults(
+        short_method_name='PCoA', long_method_name='Principal Coordinate Analysis',
+        eigvals=pd.Series(randomised_pcoa.eigvals, index=axis_labels),
+        samples=pd.DataFrame(randomised_pcoa.coordinates, columns=axis_labels),
+        proportion_explained=pd.Series(randomised_pcoa.proportion_explained, index=axis_labels))
 
 
 class BaseUnifracDistPCoACreator:
@@ -25,9 +47,19 @@ class BaseUnifracDistPCoACreator:
     def __init__(
             self, num_proc, output_dir, data_set_uid_list, js_output_path_dict,
             html_dir, data_set_sample_uid_list, cct_set_uid_list,
-            date_time_str):
+            date_time_str, dist_block_size=None, pcoa_method='eigh', pcoa_dimensions=10, tree_cache_dir=None):
         self.thread_safe_general = ThreadSafeGeneral()
         self.num_proc = num_proc
+        # The directory of the persistent cache of the alignments and trees (see tree_cache.UniFracTreeCache)
+        # None if the cache should not be used
+        self.tree_cache_dir = tree_cache_dir
+        # Either 'eigh' (full eigendecomposition) or 'randomised' (only the first pcoa_dimensions axes)
+        self.pcoa_method = pcoa_method
+        self.pcoa_dimensions = pcoa_dimensions
+        # If set, the UniFrac distances are computed in tiles of dist_block_size x dist_block_size objects
+        # that are streamed to memory mapped float32 matrices on disk (MemmapDistanceMatrix)
+        # rather than being held in memory.
+        self.dist_block_size = dist_block_size
         self.output_dir = output_dir
         self.data_set_sample_uid_list, self.clade_col_uid_list = self._set_data_set_sample_uid_list(
             data_set_sample_uid_list=data_set_sample_uid_list, data_set_uid_list=data_set_uid_list,
@@ -49,6 +81,8 @@ class BaseUnifracDistPCoACreator:
         self.pc_availabaility_dict_no_sqrt = {}
         self.js_file_path = os.path.join(self.html_dir, 'study_data.js')
         self.js_output_path_dict = js_output_path_dict
+        # The MemmapDistanceMatrix instances of the clade being processed (only if self.dist_block_size is set)
+        self.clade_memmap_dist_matrix_list = []
 
     def _set_data_set_sample_uid_list(self, data_set_sample_uid_list, data_set_uid_list, cct_set_uid_list):
         if data_set_sample_uid_list:
@@ -142,6 +176,9 @@ class BaseUnifracDistPCoACreator:
         # work through the magnitudes of order and see what the bigest scaler we can work with is
         # whilst still remaining below 1
         # Return the scaler by which we should multiply
+        if max_val == 0 and min_val == 0:
+            # There is nothing to scale (and we would never find a magnitude that max_val is greater than)
+            return 1
         query = 0.1
         scaler = 10
         while 1:
@@ -167,14 +204,70 @@ class BaseUnifracDistPCoACreator:
         # now scale the df by the scaler unless it is 1
         return scaler
 
+    def _perform_unifrac_of_clade(self, clade_abund_df, tree, clade_in_question, sqrt):
+        if self.dist_block_size:
+            return self._perform_unifrac_blocked(clade_abund_df, tree, clade_in_question, sqrt)
+        return self._perform_unifrac(clade_abund_df, tree)
+
+    def _perform_unifrac_blocked(self, clade_abund_df, tree, clade_in_question, sqrt):
+        """Compute the weighted UniFrac distances tile by tile. The distance between two objects only
+        depends on the two objects so each tile is computed from the abundances of only the objects of its
+        rows and columns. The tiles are written to a MemmapDistanceMatrix that is returned in place
+        of the skbio DistanceMatrix."""
+        print('Performing blocked unifrac calculations')
+        ids = [str(_) for _ in list(clade_abund_df.index)]
+        otu_ids = [str(_) for _ in list(clade_abund_df.columns)]
+        counts = clade_abund_df.to_numpy()
+        sqrt_str = 'sqrt' if sqrt else 'no_sqrt'
+        dist_matrix = MemmapDistanceMatrix(
+            path=os.path.join(
+                self.clade_output_dir, f'{self.date_time_str}_unifrac_distances_{clade_in_question}_{sqrt_str}.npy'),
+            ids=ids, block_size=self.dist_block_size)
+        self.clade_memmap_dist_matrix_list.append(dist_matrix)
+        block_start_stop_list = dist_matrix.get_block_start_stop_list()
+        for row_block_index, (row_start, row_stop) in enumerate(block_start_stop_list):
+            sys.stdout.write(f'\rComputing UniFrac distances: {row_stop} of {len(ids)} objects')
+            for col_start, col_stop in block_start_stop_list[row_block_index:]:
+                if col_start == row_start:
+                    tile_indices = list(range(row_start, row_stop))
+                else:
+                    tile_indices = list(range(row_start, row_stop)) + list(range(col_start, col_stop))
+                tile_wu = beta_diversity(
+                    metric='weighted_unifrac', counts=counts[tile_indices],
+                    ids=[ids[i] for i in tile_indices], tree=tree, otu_ids=otu_ids)
+                num_rows = row_stop - row_start
+                if col_start == row_start:
+                    tile = tile_wu.data
+                else:
+                    tile = tile_wu.data[:num_rows, num_rows:]
+                dist_matrix.write_tile(row_start, row_stop, col_start, col_stop, tile)
+        dist_matrix.flush()
+        return dist_matrix
+
+    def _delete_clade_memmap_dist_matrices(self):
+        for dist_matrix in self.clade_memmap_dist_matrix_list:
+            dist_matrix.delete()
+        self.clade_memmap_dist_matrix_list = []
+
     def _scale_and_compute_pcoa(self, wu):
-        dist_array_scaler = self._rescale_array(max_val=wu.data.max(), min_val=wu.data.min())
-        wu_data = wu.data * dist_array_scaler
-        pcoa_output = pcoa(wu_data)
+        if isinstance(wu, MemmapDistanceMatrix):
+            # Scale in place and let the PCoA read the distances from the memory mapped matrix
+            wu.scale_in_place(self._rescale_array(max_val=wu.max(), min_val=wu.min()))
+            try:
+                pcoa_output = compute_pcoa(
+                    wu.data, pcoa_method=self.pcoa_method, pcoa_dimensions=self.pcoa_dimensions,
+                    block_size=self.dist_block_size)
+            finally:
+                wu.delete()
+        else:
+            dist_array_scaler = self._rescale_array(max_val=wu.data.max(), min_val=wu.data.min())
+            wu_data = wu.data * dist_array_scaler
+            pcoa_output = compute_pcoa(wu_data, pcoa_method=self.pcoa_method, pcoa_dimensions=self.pcoa_dimensions)
         # When the pcoa calculation converts very small eigen values to 0
         # In doing this, if there were not large enougher eigen values,
         # the sum of the eigen values will add to 0. This will cause a TrueDivide error.
-        if pcoa_output.eigvals.sum() == 0:
+        # The randomised PCoA instead returns coordinates (and proportions explained) of 0.
+        if pcoa_output.eigvals.sum() == 0 and self.pcoa_method != 'randomised':
             raise EigenValsTooSmallError
         pcoa_scaler = self._rescale_array(max_val=pcoa_output.samples.max().max(),
                                           min_val=pcoa_output.samples.min().min())
@@ -191,14 +284,16 @@ class TypeUnifracDistPCoACreator(BaseUnifracDistPCoACreator):
     def __init__(
             self, num_processors, data_analysis_obj, js_output_path_dict, html_dir,
             output_dir, date_time_str=None, data_set_uid_list=None, data_set_sample_uid_list=None,
-            cct_set_uid_list=None, local_abunds_only=False):
+            cct_set_uid_list=None, local_abunds_only=False, dist_block_size=None, pcoa_method='eigh',
+            pcoa_dimensions=10, tree_cache_dir=None):
 
         super().__init__(
             num_proc=num_processors, output_dir=output_dir,
             data_set_uid_list=data_set_uid_list, data_set_sample_uid_list=data_set_sample_uid_list,
             cct_set_uid_list=cct_set_uid_list,
             date_time_str=date_time_str, js_output_path_dict=js_output_path_dict,
-            html_dir=html_dir)
+            html_dir=html_dir, dist_block_size=dist_block_size, pcoa_method=pcoa_method,
+            pcoa_dimensions=pcoa_dimensions, tree_cache_dir=tree_cache_dir)
 
         self.thread_safe_general = ThreadSafeGeneral()
         self.data_analysis_obj = data_analysis_obj
@@ -239,6 +334,8 @@ class TypeUnifracDistPCoACreator(BaseUnifracDistPCoACreator):
 
     def compute_unifrac_dists_and_pcoa_coords(self):
         for clade_in_question in self.clades_for_dist_calcs:
+            # Remove any memory mapped distance matrices left by a clade that did not complete
+            self._delete_clade_memmap_dist_matrices()
 
             print(f'Calculating UniFrac Distances for clade: {clade_in_question}')
 
@@ -275,8 +372,9 @@ class TypeUnifracDistPCoACreator(BaseUnifracDistPCoACreator):
             wu_no_sqrt = None
             wu_sqrt = None
             try:
-                wu_no_sqrt = self._perform_unifrac(clade_abund_df_no_sqrt, tree)
-                wu_sqrt = self._perform_unifrac(clade_abund_df_sqrt, tree)
+                wu_no_sqrt = self._perform_unifrac_of_clade(
+                    clade_abund_df_no_sqrt, tree, clade_in_question, sqrt=False)
+                wu_sqrt = self._perform_unifrac_of_clade(clade_abund_df_sqrt, tree, clade_in_question, sqrt=True)
             except ValueError as e:
                 if 'must be rooted' in str(e):
                     logging.error('a tree rooting error occured')
@@ -318,6 +416,7 @@ class TypeUnifracDistPCoACreator(BaseUnifracDistPCoACreator):
             self.js_output_path_dict[
                 f"btwn_profile_unifrac_{clade_in_question}_pcoa_sqrt"] = clade_pcoa_file_path_sqrt
 
+        self._delete_clade_memmap_dist_matrices()
         self._write_out_js_objects()
         self._write_output_paths_to_stdout()
 
@@ -422,12 +521,6 @@ class TypeUnifracDistPCoACreator(BaseUnifracDistPCoACreator):
     def _write_out_dist_df(self, clade_abund_df, wu, clade_in_question, sqrt):
         # get the names of the at types to ouput in the df so that the user can relate distances
         ordered_at_names = list(self.at_id_to_at_name[at_id] for at_id in clade_abund_df.index)
-        # create df from the numpy 2d array
-        dist_df = pd.DataFrame(data=wu.data, columns=ordered_at_names, index=ordered_at_names)
-        # add in the uids of the profiles
-        dist_df['profile_uid'] = clade_abund_df.index.values.tolist()
-        dist_df = dist_df[list(dist_df)[-1:] + list(dist_df)[:-1]]
-        # write out the df
         if sqrt:
             clade_dist_file_path = os.path.join(
                 self.clade_output_dir,
@@ -436,6 +529,16 @@ class TypeUnifracDistPCoACreator(BaseUnifracDistPCoACreator):
             clade_dist_file_path = os.path.join(
                 self.clade_output_dir,
                 f'{self.date_time_str}_unifrac_profile_distances_{clade_in_question}_no_sqrt.dist')
+        if isinstance(wu, MemmapDistanceMatrix):
+            # stream the rows from the memory mapped matrix rather than building a df
+            wu.write_dist_file(clade_dist_file_path, ordered_at_names, clade_abund_df.index.values.tolist())
+            return clade_dist_file_path, ordered_at_names
+        # create df from the numpy 2d array
+        dist_df = pd.DataFrame(data=wu.data, columns=ordered_at_names, index=ordered_at_names)
+        # add in the uids of the profiles
+        dist_df['profile_uid'] = clade_abund_df.index.values.tolist()
+        dist_df = dist_df[list(dist_df)[-1:] + list(dist_df)[:-1]]
+        # write out the df
         dist_df.to_csv(header=False, index=True, path_or_buf=clade_dist_file_path, sep='\t')
         return clade_dist_file_path, ordered_at_names
 
@@ -455,7 +558,8 @@ class TypeUnifracDistPCoACreator(BaseUnifracDistPCoACreator):
             f'sequences found in its2 type profiles of clade: {clade_in_question}')
 
         tree_creator = TreeCreatorForUniFrac(
-            parent=self, set_of_ref_seq_uids=set_of_ref_seq_uids, clade=clade_in_question)
+            parent=self, set_of_ref_seq_uids=set_of_ref_seq_uids, clade=clade_in_question,
+            tree_cache_dir=self.tree_cache_dir)
 
         tree_creator.make_tree()
         tree = tree_creator.rooted_tree
@@ -623,12 +727,14 @@ class SampleUnifracDistPCoACreator(BaseUnifracDistPCoACreator):
 
     def __init__(
             self, num_processors, html_dir, js_output_path_dict, output_dir, date_time_str,
-            data_set_uid_list=None, data_set_sample_uid_list=None):
+            data_set_uid_list=None, data_set_sample_uid_list=None, dist_block_size=None, pcoa_method='eigh',
+            pcoa_dimensions=10, tree_cache_dir=None):
         super().__init__(
             num_proc=num_processors, output_dir=output_dir,
             data_set_uid_list=data_set_uid_list, data_set_sample_uid_list=data_set_sample_uid_list,
             date_time_str=date_time_str, cct_set_uid_list=None, html_dir=html_dir,
-            js_output_path_dict=js_output_path_dict)
+            js_output_path_dict=js_output_path_dict, dist_block_size=dist_block_size, pcoa_method=pcoa_method,
+            pcoa_dimensions=pcoa_dimensions, tree_cache_dir=tree_cache_dir)
 
         self.clade_collections_from_data_set_samples = self._chunk_query_set_cc_obj_from_dss_uids()
         self.cc_id_to_sample_name_dict = {
@@ -649,6 +755,8 @@ class SampleUnifracDistPCoACreator(BaseUnifracDistPCoACreator):
 
     def compute_unifrac_dists_and_pcoa_coords(self):
         for clade_in_question in self.clades_for_dist_calcs:
+            # Remove any memory mapped distance matrices left by a clade that did not complete
+            self._delete_clade_memmap_dist_matrices()
 
             print(f'Calculating UniFrac Distances for clade: {clade_in_question}')
 
@@ -684,8 +792,9 @@ class SampleUnifracDistPCoACreator(BaseUnifracDistPCoACreator):
                 continue
 
             try:
-                wu_no_sqrt = self._perform_unifrac(clade_abund_df_no_sqrt, tree)
-                wu_sqrt = self._perform_unifrac(clade_abund_df_sqrt, tree)
+                wu_no_sqrt = self._perform_unifrac_of_clade(
+                    clade_abund_df_no_sqrt, tree, clade_in_question, sqrt=False)
+                wu_sqrt = self._perform_unifrac_of_clade(clade_abund_df_sqrt, tree, clade_in_question, sqrt=True)
             except ValueError as e:
                 if 'must be rooted' in str(e):
                     logging.error('a tree rooting error occured')
@@ -726,6 +835,7 @@ class SampleUnifracDistPCoACreator(BaseUnifracDistPCoACreator):
             self.js_output_path_dict[
                 f"btwn_sample_unifrac_{clade_in_question}_pcoa_sqrt"] = clade_pcoa_file_path_sqrt
 
+        self._delete_clade_memmap_dist_matrices()
         self._write_out_js_objects()
         self._write_output_paths_to_stdout()
 
@@ -802,11 +912,6 @@ class SampleUnifracDistPCoACreator(BaseUnifracDistPCoACreator):
         # to ouput in the df so that the user can relate distances
         ordered_sample_names = list(self.cc_id_to_sample_name_dict[cc_uid] for cc_uid in clade_abund_df.index)
         ordered_sample_uids = list(self.cc_id_to_sample_id[cc_uid] for cc_uid in clade_abund_df.index)
-        # create df from the numpy 2d array
-        dist_df = pd.DataFrame(data=wu.data, columns=ordered_sample_names, index=ordered_sample_names)
-        dist_df['sample_uid'] = ordered_sample_uids
-        dist_df = dist_df[list(dist_df)[-1:] + list(dist_df)[:-1]]
-        # write out the df
         if sqrt:
             clade_dist_file_path = os.path.join(
                 self.clade_output_dir,
@@ -815,6 +920,15 @@ class SampleUnifracDistPCoACreator(BaseUnifracDistPCoACreator):
             clade_dist_file_path = os.path.join(
                 self.clade_output_dir,
                 f'{self.date_time_str}_unifrac_sample_distances_{clade_in_question}_no_sqrt.dist')
+        if isinstance(wu, MemmapDistanceMatrix):
+            # stream the rows from the memory mapped matrix rather than building a df
+            wu.write_dist_file(clade_dist_file_path, ordered_sample_names, ordered_sample_uids)
+            return clade_dist_file_path, ordered_sample_names
+        # create df from the numpy 2d array
+        dist_df = pd.DataFrame(data=wu.data, columns=ordered_sample_names, index=ordered_sample_names)
+        dist_df['sample_uid'] = ordered_sample_uids
+        dist_df = dist_df[list(dist_df)[-1:] + list(dist_df)[:-1]]
+        # write out the df
         dist_df.to_csv(header=False, index=True, path_or_buf=clade_dist_file_path, sep='\t')
         return clade_dist_file_path, ordered_sample_names
 
@@ -832,7 +946,8 @@ class SampleUnifracDistPCoACreator(BaseUnifracDistPCoACreator):
             f'Generating phylogentic tree from {len(set_of_ref_seq_uids)} its2 '
             f'sequences found in CladeCollections of clade: {clade_in_question}')
         tree_creator = TreeCreatorForUniFrac(
-            parent=self, set_of_ref_seq_uids=set_of_ref_seq_uids, clade=clade_in_question)
+            parent=self, set_of_ref_seq_uids=set_of_ref_seq_uids, clade=clade_in_question,
+            tree_cache_dir=self.tree_cache_dir)
         tree_creator.make_tree()
         tree = tree_creator.rooted_tree
         return tree
@@ -913,20 +1028,29 @@ class SampleUnifracDistPCoACreator(BaseUnifracDistPCoACreator):
 
 class TreeCreatorForUniFrac:
     """Class responsible for generating a tree using iqtree to use in the calculation of weighted unifrac
-    distances for both between sample and between its2 type profile sequences."""
-    def __init__(self, parent, set_of_ref_seq_uids, clade):
+    distances for both between sample and between its2 type profile sequences.
+    If a tree_cache_dir is given, the alignments and rooted trees are cached (see tree_cache.UniFracTreeCache) by
+    the ReferenceSequence uids and sequences so that they are only made once for a given set of sequences. If a
+    cached tree is missing only a few of the sequences, the sequences are added to its alignment and the tree is
+    remade using its model and constrained to its topology."""
+    def __init__(self, parent, set_of_ref_seq_uids, clade, tree_cache_dir=None):
         self.parent = parent
         self.clade = clade
         self.ref_seq_objs = self.parent._chunk_query_distinct_rs_objs_from_rs_uids(rs_uid_list=set_of_ref_seq_uids)
         self.num_seqs = len(self.ref_seq_objs)
+        self.uid_to_seq_dict = {ref_seq_obj.id: ref_seq_obj.sequence for ref_seq_obj in self.ref_seq_objs}
         self.fasta_unaligned_path = os.path.join(
             self.parent.clade_output_dir, f'clade_{self.clade}_seqs.unaligned.fasta')
         self.fasta_aligned_path = self.fasta_unaligned_path.replace('unaligned', 'aligned')
+        # the sequences that are not in the cached tree being added to
+        self.fasta_new_unaligned_path = self.fasta_unaligned_path.replace('unaligned', 'new.unaligned')
         # self.iqtree = local['iqtree']
         self.tree_out_path_unrooted = self.fasta_aligned_path + '.treefile'
         self.tree_out_path_rooted = self.tree_out_path_unrooted.replace('.treefile', '.rooted.treefile')
+        self.iqtree_report_path = self.fasta_aligned_path + '.iqtree'
         self.rooted_tree = None
         self.thread_safe_general = ThreadSafeGeneral()
+        self.tree_cache = UniFracTreeCache(cache_dir=tree_cache_dir) if tree_cache_dir is not None else None
 
     def make_tree(self):
 
@@ -937,6 +1061,40 @@ class TreeCreatorForUniFrac:
         if len(self.thread_safe_general.read_defined_file_to_list(self.fasta_unaligned_path)) < 5:
             raise InsufficientSequencesInAlignment
 
+        if self.tree_cache is None:
+            base_entry_dir = None
+        else:
+            cache_entry_dir = self.tree_cache.get_entry_dir(self.uid_to_seq_dict)
+            if cache_entry_dir is not None:
+                print(f'Using the cached alignment and tree of these {self.num_seqs} sequences')
+                self._copy_alignment_and_trees_from_cache(cache_entry_dir)
+                self.rooted_tree = TreeNode.read(self.tree_out_path_rooted)
+                return
+            base_entry_dir, base_uid_to_seq_dict = self.tree_cache.find_base_entry(self.uid_to_seq_dict)
+
+        if base_entry_dir is not None:
+            self._add_seqs_to_cached_alignment_and_make_tree(base_entry_dir, base_uid_to_seq_dict)
+        else:
+            self._align_seqs_and_make_tree()
+
+        # root the tree
+        print('Tree creation complete')
+        print('Rooting the tree at midpoint')
+        self.rooted_tree = TreeNode.read(self.tree_out_path_unrooted).root_at_midpoint()
+        self.rooted_tree.write(self.tree_out_path_rooted)
+
+        if self.tree_cache is None:
+            return
+        model = self._get_model_from_iqtree_report()
+        if model is None:
+            print(f'Unable to find the substitution model in {self.iqtree_report_path}. The tree will not be cached.')
+            return
+        self.tree_cache.add_entry(
+            uid_to_seq_dict=self.uid_to_seq_dict, aligned_fasta_path=self.fasta_aligned_path,
+            unrooted_tree_path=self.tree_out_path_unrooted, rooted_tree_path=self.tree_out_path_rooted,
+            model=model)
+
+    def _align_seqs_and_make_tree(self):
         # align the sequences
         print(f'Aligning {self.num_seqs} sequences')
         self.thread_safe_general.mafft_align_fasta(
@@ -949,11 +1107,41 @@ class TreeCreatorForUniFrac:
         subprocess.run(
             ['iqtree', '-T', 'AUTO', '--threads-max', '2', '-s', f'{self.fasta_aligned_path}'])
 
-        # root the tree
-        print('Tree creation complete')
-        print('Rooting the tree at midpoint')
-        self.rooted_tree = TreeNode.read(self.tree_out_path_unrooted).root_at_midpoint()
-        self.rooted_tree.write(self.tree_out_path_rooted)
+    def _add_seqs_to_cached_alignment_and_make_tree(self, base_entry_dir, base_uid_to_seq_dict):
+        new_ref_seq_objs = [rs for rs in self.ref_seq_objs if rs.id not in base_uid_to_seq_dict]
+        print(f'Adding {len(new_ref_seq_objs)} sequences to the cached alignment of '
+              f'{len(base_uid_to_seq_dict)} sequences')
+        django_general.write_ref_seq_objects_to_fasta(
+            path=self.fasta_new_unaligned_path, list_of_ref_seq_objs=new_ref_seq_objs, identifier='id')
+        self.thread_safe_general.mafft_add_to_alignment(
+            existing_alignment_path=os.path.join(base_entry_dir, self.tree_cache.aligned_fasta_file_name),
+            new_seqs_path=self.fasta_new_unaligned_path, output_path=self.fasta_aligned_path,
+            num_proc=self.parent.num_proc)
+
+        # make the tree using the model of the cached tree (i.e. without model testing) and constrained
+        # to the topology of the cached tree
+        print('Making phylogenetic tree constrained to the cached tree')
+        subprocess.run(
+            ['iqtree', '-T', 'AUTO', '--threads-max', '2', '-s', f'{self.fasta_aligned_path}',
+             '-m', self.tree_cache.read_entry_model(base_entry_dir),
+             '-g', os.path.join(base_entry_dir, self.tree_cache.unrooted_tree_file_name)])
+
+    def _copy_alignment_and_trees_from_cache(self, cache_entry_dir):
+        # The files are made available in the output directory as they would be if they had been made in this run
+        shutil.copyfile(
+            os.path.join(cache_entry_dir, self.tree_cache.aligned_fasta_file_name), self.fasta_aligned_path)
+        shutil.copyfile(
+            os.path.join(cache_entry_dir, self.tree_cache.unrooted_tree_file_name), self.tree_out_path_unrooted)
+        shutil.copyfile(
+            os.path.join(cache_entry_dir, self.tree_cache.rooted_tree_file_name), self.tree_out_path_rooted)
+
+    def _get_model_from_iqtree_report(self):
+        if not os.path.exists(self.iqtree_report_path):
+            return None
+        for line in self.thread_safe_general.read_defined_file_to_list(self.iqtree_report_path):
+            if line.startswith('Model of substitution:'):
+                return line.split(':', 1)[1].strip()
+        return None
 
     def _write_out_unaligned_seqs(self):
         django_general.write_ref_seq_objects_to_fasta(
@@ -962,8 +1150,18 @@ class TreeCreatorForUniFrac:
 
 # BrayCurtis classes
 class BaseBrayCurtisDistPCoACreator:
-    def __init__(self, date_time_str, profiles_or_samples, js_output_path_dict, html_dir):
+    def __init__(self, date_time_str, profiles_or_samples, js_output_path_dict, html_dir, num_processors=1,
+                 multiprocess=True, dist_block_size=None, pcoa_method='eigh', pcoa_dimensions=10):
         self.date_time_str = date_time_str
+        # Either 'eigh' (full eigendecomposition) or 'randomised' (only the first pcoa_dimensions axes)
+        self.pcoa_method = pcoa_method
+        self.pcoa_dimensions = pcoa_dimensions
+        # Used to compute the blocks of the distance matrices concurrently
+        self.num_processors = num_processors
+        self.multiprocess = multiprocess
+        # If set, the distance matrices are computed dist_block_size rows at a time and streamed to
+        # memory mapped float32 matrices on disk (MemmapDistanceMatrix) rather than being held in memory.
+        self.dist_block_size = dist_block_size
         self.output_path_list = []
         self.clade_output_dir = None
         # path to the .csv file that will hold the PCoA coordinates
@@ -982,8 +1180,12 @@ class BaseBrayCurtisDistPCoACreator:
         self.objs_of_clade = None
         self.clade_rs_uid_to_normalised_abund_clade_dict_sqrt = {}
         self.clade_rs_uid_to_normalised_abund_clade_dict_no_sqrt = {}
-        self.clade_within_clade_distances_dict_no_sqrt = {}
-        self.clade_within_clade_distances_dict_sqrt = {}
+        # The full distance matrices in the order of self.objs_of_clade
+        # either numpy arrays or, if self.dist_block_size is set, MemmapDistanceMatrix instances
+        self.clade_dist_matrix_no_sqrt = None
+        self.clade_dist_matrix_sqrt = None
+        # The names of the objects in the order of self.objs_of_clade (only used if self.dist_block_size is set)
+        self.clade_obj_name_list = None
         self.js_output_path_dict = js_output_path_dict
         self.html_dir = html_dir
         self.genera_annotation_dict = {
@@ -1006,35 +1208,57 @@ class BaseBrayCurtisDistPCoACreator:
             self.clade_pcoa_coord_file_path_sqrt = os.path.join(
                 self.clade_output_dir,
                 f'{self.date_time_str}_braycurtis_{self.profiles_or_samples}_PCoA_coords_{clade}_sqrt.csv')
-            raw_dist_file = self.thread_safe_general.read_defined_file_to_list(self.clade_dist_file_path_sqrt)
         else:
             self.clade_pcoa_coord_file_path_no_sqrt = os.path.join(
                 self.clade_output_dir,
                 f'{self.date_time_str}_braycurtis_{self.profiles_or_samples}_PCoA_coords_{clade}_no_sqrt.csv')
-            raw_dist_file = self.thread_safe_general.read_defined_file_to_list(self.clade_dist_file_path_no_sqrt)
 
-        temp_two_d_list = []
-        object_names_from_dist_matrix = []
-        object_ids_from_dist_matrix = []
-        for line in raw_dist_file:
-            temp_elements = line.split('\t')
-            object_names_from_dist_matrix.append(temp_elements[0].replace(' ', ''))
-            object_ids_from_dist_matrix.append(int(temp_elements[1]))
-            temp_two_d_list.append([float(a) for a in temp_elements[2:]])
+        if self.dist_block_size:
+            # Read the distances from the memory mapped matrix rather than parsing the .dist file
+            memmap_dist_matrix = self.clade_dist_matrix_sqrt if sqrt else self.clade_dist_matrix_no_sqrt
+            object_names_from_dist_matrix = [obj_name.replace(' ', '') for obj_name in self.clade_obj_name_list]
+            object_ids_from_dist_matrix = list(memmap_dist_matrix.ids)
 
-        dist_as_np_array = np.array(temp_two_d_list)
+            sys.stdout.write('\rcalculating PCoA coordinates')
 
-        sys.stdout.write('\rcalculating PCoA coordinates')
+            memmap_dist_matrix.scale_in_place(
+                self._rescale_array(max_val=memmap_dist_matrix.max(), min_val=memmap_dist_matrix.min()))
+            try:
+                pcoa_output = compute_pcoa(
+                    memmap_dist_matrix.data, pcoa_method=self.pcoa_method, pcoa_dimensions=self.pcoa_dimensions,
+                    block_size=self.dist_block_size)
+            finally:
+                memmap_dist_matrix.delete()
+        else:
+            if sqrt:
+                raw_dist_file = self.thread_safe_general.read_defined_file_to_list(self.clade_dist_file_path_sqrt)
+            else:
+                raw_dist_file = self.thread_safe_general.read_defined_file_to_list(self.clade_dist_file_path_no_sqrt)
+
+            temp_two_d_list = []
+            object_names_from_dist_matrix = []
+            object_ids_from_dist_matrix = []
+            for line in raw_dist_file:
+                temp_elements = line.split('\t')
+                object_names_from_dist_matrix.append(temp_elements[0].replace(' ', ''))
+                object_ids_from_dist_matrix.append(int(temp_elements[1]))
+                temp_two_d_list.append([float(a) for a in temp_elements[2:]])
+
+            dist_as_np_array = np.array(temp_two_d_list)
 
-        dist_array_scaler = self._rescale_array(max_val=dist_as_np_array.max(), min_val=dist_as_np_array.min())
+            sys.stdout.write('\rcalculating PCoA coordinates')
 
-        dist_as_np_array = dist_as_np_array * dist_array_scaler
+            dist_array_scaler = self._rescale_array(max_val=dist_as_np_array.max(), min_val=dist_as_np_array.min())
 
-        pcoa_output = pcoa(dist_as_np_array)
+            dist_as_np_array = dist_as_np_array * dist_array_scaler
+
+            pcoa_output = compute_pcoa(
+                dist_as_np_array, pcoa_method=self.pcoa_method, pcoa_dimensions=self.pcoa_dimensions)
         # When the pcoa calculation converts very small eigen values to 0
         # In doing this, if there were not large enougher eigen values,
         # the sum of the eigen values will add to 0. This will cause a TrueDivide error.
-        if pcoa_output.eigvals.sum() == 0:
+        # The randomised PCoA instead returns coordinates (and proportions explained) of 0.
+        if pcoa_output.eigvals.sum() == 0 and self.pcoa_method != 'randomised':
             raise EigenValsTooSmallError
         pcoa_scaler = self._rescale_array(max_val=pcoa_output.samples.max().max(),
                                           min_val=pcoa_output.samples.min().min())
@@ -1067,6 +1291,9 @@ class BaseBrayCurtisDistPCoACreator:
         # work through the magnitudes of order and see what the bigest scaler we can work with is
         # whilst still remaining below 1
         # Return the scaler by which we should multiply
+        if max_val == 0 and min_val == 0:
+            # There is nothing to scale (and we would never find a magnitude that max_val is greater than)
+            return 1
         query = 0.1
         scaler = 10
         while 1:
@@ -1165,68 +1392,52 @@ class BaseBrayCurtisDistPCoACreator:
         return data_set_samples_of_output
 
     def _compute_braycurtis_btwn_obj_pairs(self, sqrt):
-        for obj_one, obj_two in itertools.combinations(list(self.objs_of_clade), 2):
-            # let's work to a virtual subsample of 100 000
-            if sqrt:
-                obj_one_seq_rel_abundance_dict = self.clade_rs_uid_to_normalised_abund_clade_dict_sqrt[
-                    obj_one.id]
-                obj_two_seq_rel_abundance_dict = self.clade_rs_uid_to_normalised_abund_clade_dict_sqrt[
-                    obj_two.id]
-            else:
-                obj_one_seq_rel_abundance_dict = self.clade_rs_uid_to_normalised_abund_clade_dict_no_sqrt[
-                    obj_one.id]
-                obj_two_seq_rel_abundance_dict = self.clade_rs_uid_to_normalised_abund_clade_dict_no_sqrt[
-                    obj_two.id]
-
-            # for each comparison. Get a set of all of the sequence and convert this to a list.
-            set_of_rs_uids = set(list(obj_one_seq_rel_abundance_dict.keys()))
-            set_of_rs_uids.update(list(obj_two_seq_rel_abundance_dict.keys()))
-            list_of_rs_uids = list(set_of_rs_uids)
-
-            # then iter through the list to get the rel abundances for each of the samples, putting 0 if not found in
-            # the sample.
-            rs_abundance_list_one = []
-            rs_abundance_list_two = []
-            for rs_uid in list_of_rs_uids:
-                # populate the abundance list cc one
-                if rs_uid in obj_one_seq_rel_abundance_dict:
-                    rs_abundance_list_one.append(obj_one_seq_rel_abundance_dict[rs_uid])
-                else:
-                    rs_abundance_list_one.append(0)
-
-                # populate the abundance list cc two
-                if rs_uid in obj_two_seq_rel_abundance_dict:
-                    rs_abundance_list_two.append(obj_two_seq_rel_abundance_dict[rs_uid])
-                else:
-                    rs_abundance_list_two.append(0)
-
-            # once you have this we should simply be able to crunch the bray-curtis.
-            distance = braycurtis(rs_abundance_list_one, rs_abundance_list_two)
+        """Compute the full Bray-Curtis distance matrix of the objects of the clade in one batched computation.
+        The rows and columns of the matrix are in the order of self.objs_of_clade."""
+        if sqrt:
+            obj_uid_to_rs_uid_to_normalised_abund_dict = self.clade_rs_uid_to_normalised_abund_clade_dict_sqrt
+        else:
+            obj_uid_to_rs_uid_to_normalised_abund_dict = self.clade_rs_uid_to_normalised_abund_clade_dict_no_sqrt
+        obj_uid_list = [obj.id for obj in self.objs_of_clade]
+        braycurtis_calculator = SparseBrayCurtisCalculator(
+            obj_uid_list=obj_uid_list,
+            obj_uid_to_rs_uid_to_abund_dict_dict=obj_uid_to_rs_uid_to_normalised_abund_dict,
+            num_proc=self.num_processors, multiprocess=self.multiprocess, block_size=self.dist_block_size)
+        if self.dist_block_size:
+            dist_file_path = self.clade_dist_file_path_sqrt if sqrt else self.clade_dist_file_path_no_sqrt
+            dist_matrix = MemmapDistanceMatrix(
+                path=f'{dist_file_path}.npy', ids=obj_uid_list, block_size=self.dist_block_size)
+            for start, stop, block in braycurtis_calculator.iter_blocks():
+                sys.stdout.write(f'\rComputing Bray-Curtis distances: {stop} of {len(obj_uid_list)} objects')
+                dist_matrix.write_row_block(start, stop, block)
+            dist_matrix.flush()
+        else:
+            dist_matrix = braycurtis_calculator.compute_distance_matrix()
+        if sqrt:
+            self.clade_dist_matrix_sqrt = dist_matrix
+        else:
+            self.clade_dist_matrix_no_sqrt = dist_matrix
 
-            # these distances can be stored in a dictionary by the 'id1/id2' and 'id2/id1'
-            if sqrt:
-                self.clade_within_clade_distances_dict_sqrt[frozenset({obj_one.id, obj_two.id})] = distance
-            else:
-                self.clade_within_clade_distances_dict_no_sqrt[frozenset({obj_one.id, obj_two.id})] = distance
+    def _delete_clade_memmap_dist_matrices(self):
+        for dist_matrix in (self.clade_dist_matrix_sqrt, self.clade_dist_matrix_no_sqrt):
+            if isinstance(dist_matrix, MemmapDistanceMatrix):
+                dist_matrix.delete()
 
     def _generate_distance_file(self, sqrt):
+        if self.dist_block_size:
+            # The distance file is streamed from the memory mapped matrix in _add_obj_uids_to_dist_file_and_write
+            return
         if sqrt:
             self.clade_dist_file_as_list_sqrt = []
+            dist_matrix = self.clade_dist_matrix_sqrt
         else:
             self.clade_dist_file_as_list_no_sqrt = []
-        for obj_outer in self.objs_of_clade:
+            dist_matrix = self.clade_dist_matrix_no_sqrt
+        for i, obj_outer in enumerate(self.objs_of_clade):
             temp_at_string = [obj_outer.id]
-
-            for obj_inner in self.objs_of_clade:
-                if obj_outer == obj_inner:
-                    temp_at_string.append(0)
-                else:
-                    if sqrt:
-                        temp_at_string.append(
-                            self.clade_within_clade_distances_dict_sqrt[frozenset({obj_outer.id, obj_inner.id})])
-                    else:
-                        temp_at_string.append(
-                            self.clade_within_clade_distances_dict_no_sqrt[frozenset({obj_outer.id, obj_inner.id})])
+            temp_at_string.extend(dist_matrix[i].tolist())
+            # The distance of an object to itself is written as 0
+            temp_at_string[i + 1] = 0
             if sqrt:
                 self.clade_dist_file_as_list_sqrt.append(
                     '\t'.join([str(distance_item) for distance_item in temp_at_string]))
@@ -1237,6 +1448,9 @@ class BaseBrayCurtisDistPCoACreator:
     def _add_obj_uids_to_dist_file_and_write(self, sqrt):
         # for the output version lets also append the sample name to each line so that we can see which sample it is
         # it is important that we otherwise work eith the sample ID as the sample names may not be unique.
+        if self.dist_block_size:
+            self._write_dist_file_from_memmap(sqrt)
+            return
         if sqrt:
             dist_with_obj_name = []
             list_of_obj_uids = [int(line.split('\t')[0]) for line in self.clade_dist_file_as_list_sqrt]
@@ -1262,6 +1476,21 @@ class BaseBrayCurtisDistPCoACreator:
             self.clade_dist_file_as_list_no_sqrt = dist_with_obj_name
             self.thread_safe_general.write_list_to_destination(self.clade_dist_file_path_no_sqrt, self.clade_dist_file_as_list_no_sqrt)
 
+    def _write_dist_file_from_memmap(self, sqrt):
+        list_of_obj_uids = [obj.id for obj in self.objs_of_clade]
+        if self.profiles_or_samples == 'samples':
+            objs_of_outputs = self._chunk_query_dss_objs_from_dss_uids(list_of_obj_uids)
+        else:  # 'profiles'
+            objs_of_outputs = self._chunk_query_at_obj_from_at_uids(list_of_obj_uids)
+        dict_of_obj_id_to_obj_name = {obj.id: obj.name for obj in objs_of_outputs}
+        self.clade_obj_name_list = [dict_of_obj_id_to_obj_name[obj_uid] for obj_uid in list_of_obj_uids]
+        if sqrt:
+            self.clade_dist_matrix_sqrt.write_dist_file(
+                self.clade_dist_file_path_sqrt, self.clade_obj_name_list, list_of_obj_uids, diagonal_str='0')
+        else:
+            self.clade_dist_matrix_no_sqrt.write_dist_file(
+                self.clade_dist_file_path_no_sqrt, self.clade_obj_name_list, list_of_obj_uids, diagonal_str='0')
+
     @staticmethod
     def _append_obj_name_to_dist_line(dict_of_obj_id_to_obj_name, dist_with_obj_name, line):
         temp_list = []
@@ -1316,10 +1545,13 @@ class SampleBrayCurtisDistPCoACreator(BaseBrayCurtisDistPCoACreator):
     def __init__(
             self, js_output_path_dict, html_dir, output_dir, date_time_str=None,
             data_set_sample_uid_list=None,
-            data_set_uid_list=None, cct_set_uid_list=None):
+            data_set_uid_list=None, cct_set_uid_list=None, num_processors=1, multiprocess=True,
+            dist_block_size=None, pcoa_method='eigh', pcoa_dimensions=10):
         super().__init__(
             date_time_str=date_time_str,
-            profiles_or_samples='samples', js_output_path_dict=js_output_path_dict, html_dir=html_dir)
+            profiles_or_samples='samples', js_output_path_dict=js_output_path_dict, html_dir=html_dir,
+            num_processors=num_processors, multiprocess=multiprocess, dist_block_size=dist_block_size,
+            pcoa_method=pcoa_method, pcoa_dimensions=pcoa_dimensions)
 
         self.data_set_sample_uid_list, self.clade_col_uid_list = self._set_data_set_sample_uid_list(
             data_set_sample_uid_list=data_set_sample_uid_list, data_set_uid_list=data_set_uid_list,
@@ -1362,6 +1594,7 @@ class SampleBrayCurtisDistPCoACreator(BaseBrayCurtisDistPCoACreator):
                 logging.error(f"The eigenvalues for the clade {clade_in_question} PCoA were too small and were "
                               f"converted to 0s by skbio's implementation of PCoA.")
                 logging.error(f"Between sample Bray-Curtis distances cannot be calculated for clade {clade_in_question}")
+                self._delete_clade_memmap_dist_matrices()
                 continue
 
             self._populate_js_output_objects(clade_in_question, pcoa_coords_df_sqrt, sqrt=True)
@@ -1484,10 +1717,13 @@ class TypeBrayCurtisDistPCoACreator(BaseBrayCurtisDistPCoACreator):
     def __init__(
             self, data_analysis_obj, js_output_path_dict, html_dir, output_dir,
             date_time_str, data_set_sample_uid_list=None,
-            data_set_uid_list=None, cct_set_uid_list=None, local_abunds_only=False):
+            data_set_uid_list=None, cct_set_uid_list=None, local_abunds_only=False, num_processors=1,
+            multiprocess=True, dist_block_size=None, pcoa_method='eigh', pcoa_dimensions=10):
         super().__init__(
             date_time_str=date_time_str,
-            profiles_or_samples='profiles', js_output_path_dict=js_output_path_dict, html_dir=html_dir)
+            profiles_or_samples='profiles', js_output_path_dict=js_output_path_dict, html_dir=html_dir,
+            num_processors=num_processors, multiprocess=multiprocess, dist_block_size=dist_block_size,
+            pcoa_method=pcoa_method, pcoa_dimensions=pcoa_dimensions)
 
         self.data_set_sample_uid_list, self.clade_col_uid_list = self._set_data_set_sample_uid_list(
             data_set_sample_uid_list=data_set_sample_uid_list, data_set_uid_list=data_set_uid_list,
@@ -1548,6 +1784,7 @@ class TypeBrayCurtisDistPCoACreator(BaseBrayCurtisDistPCoACreator):
                 logging.error(f"The eigenvalues for the clade {clade_in_question} PCoA were too small and were "
                               f"converted to 0s by skbio's implementation of PCoA.")
                 logging.error(f"Between profile Bray-Curtis distances cannot be calculated for clade {clade_in_question}")
+                self._delete_clade_memmap_dist_matrices()
                 continue
 
 
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+A square distance matrix held as float32 in a memory mapped .npy file rather than in RAM, so that the distances
+between very large numbers of objects can be computed (and written out) a block at a time.
+"""
+import os
+import numpy as np
+
+
+class MemmapDistanceMatrix:
+    def __init__(self, path, ids, block_size):
+        """
+        :param path: the path of the .npy file that the matrix will be memory mapped to. Any existing file is
+        overwritten.
+        :param ids: the ids of the objects in the order of the rows (and columns) of the matrix. Available as
+        self.ids so that this can be used in place of a skbio DistanceMatrix.
+        :param block_size: the number of rows that are read or written at once when working through the matrix
+        """
+        self.path = path
+        self.ids = tuple(ids)
+        self.num_objs = len(self.ids)
+        self.block_size = max(1, block_size)
+        self.data = np.lib.format.open_memmap(
+            self.path, mode='w+', dtype=np.float32, shape=(self.num_objs, self.num_objs))
+
+    def get_block_start_stop_list(self):
+        return [(start, min(start + self.block_size, self.num_objs)) for
+                start in range(0, self.num_objs, self.block_size)]
+
+    def write_row_block(self, start, stop, block):
+        """Write the distances between rows start:stop and all of the objects"""
+        self.data[start:stop] = block
+
+    def write_tile(self, row_start, row_stop, col_start, col_stop, tile):
+        """Write a tile of distances and its transpose so that the matrix stays symmetric"""
+        self.data[row_start:row_stop, col_start:col_stop] = tile
+        self.data[col_start:col_stop, row_start:row_stop] = tile.T
+
+    def flush(self):
+        self.data.flush()
+
+    def max(self):
+        return max(float(self.data[start:stop].max()) for start, stop in self.get_block_start_stop_list())
+
+    def min(self):
+        return min(float(self.data[start:stop].min()) for start, stop in self.get_block_start_stop_list())
+
+    def scale_in_place(self, scaler):
+        if scaler == 1:
+            return
+        for start, stop in self.get_block_start_stop_list():
+            self.data[start:stop] *= scaler
+        self.flush()
+
+    def write_dist_file(self, dist_file_path, row_name_list, row_uid_list, diagonal_str=None):
+        """Write the matrix out in the .dist format (name, uid and then the distances, tab separated)
+        one row at a time. If diagonal_str is given it is written in place of the distance of each
+        object to itself."""
+        with open(dist_file_path, 'w') as f:
+            for start, stop in self.get_block_start_stop_list():
+                block = self.data[start:stop]
+                for i in range(start, stop):
+                    distance_str_list = [str(distance) for distance in block[i - start]]
+                    if diagonal_str is not None:
+                        distance_str_list[i] = diagonal_str
+                    f.write('\t'.join([str(row_name_list[i]), str(row_uid_list[i])] + distance_str_list) + '\n')
+
+    def delete(self):
+        """Release the memory map and remove the file from disk. Safe to call more than once."""
+        self.data = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
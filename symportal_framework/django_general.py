@@ -10,6 +10,7 @@ import sys
 from collections import Counter
 from numpy import NaN
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import connection
 from datetime import datetime
 from general import check_lat_lon
 
@@ -30,6 +31,27 @@ def write_ref_seq_objects_to_fasta(path, list_of_ref_seq_objs, identifier='name'
                 f.write(f'>{ref_seq_obj.id}\n')
             f.write(f'{ref_seq_obj.sequence}\n')
 
+class DBQueryCounter:
+    """Context manager that counts the number of queries made to the database within its context.
+    We use an execute wrapper rather than connection.queries so that the count is available
+    irrespective of settings.DEBUG."""
+    def __init__(self):
+        self.count = 0
+        self._execute_wrapper = None
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        self._execute_wrapper = connection.execute_wrapper(self)
+        self._execute_wrapper.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return self._execute_wrapper.__exit__(exc_type, exc_val, exc_tb)
+
+
 class ApplyDatasheetToDataSetSamples:
     """Class responsible for allowing us to apply a datasheet to a given set of DataSetSample objects
     that belong to a given DataSet. For the time being we will just be working with single DataSets. In the
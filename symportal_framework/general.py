@@ -211,6 +211,14 @@ class ThreadSafeGeneral:
                  '--ep', '0', '--genafpair', input_path] > output_path)()
         print(f'Writing to {output_path}')
 
+    @staticmethod
+    def mafft_add_to_alignment(existing_alignment_path, new_seqs_path, output_path, mafft_exec_string='mafft', num_proc=1):
+        # Add the unaligned sequences of new_seqs_path to an existing alignment without realigning it
+        print(f'Adding {new_seqs_path} to {existing_alignment_path}')
+        mafft = local[f'{mafft_exec_string}']
+        (mafft['--thread', f'{num_proc}', '--add', new_seqs_path, existing_alignment_path] > output_path)()
+        print(f'Writing to {output_path}')
+
     @staticmethod
     def remove_gaps_from_fasta(fasta_as_list):
         gapless_fasta = []
@@ -353,25 +361,30 @@ class ThreadSafeGeneral:
     def write_out_js_file_to_return_python_objs_as_js_objs(list_of_func_obj_dicts, js_outpath):
         '''This function writes out a javascript file that will the javascript version of one or more
         python objects. The list_of_func_obj_dicts should ab a list of dictionaries, where each dictionary
-        has a key of function_name and python_obj, the values of these keys will be used below.'''
-        temp_js_file_as_list = []
-        for python_obj_dict in list_of_func_obj_dicts:
-            obj_as_json = json.dumps(python_obj_dict['python_obj'])
-
-            temp_js_file_as_list.append('function ' + python_obj_dict['function_name'] + '(){')
-            temp_js_file_as_list.append("\treturn " + obj_as_json + ';')
-            temp_js_file_as_list.append("}")
-
-        if os.path.isfile(js_outpath):
-            # study_data.js already exists so append to it
-            with open(js_outpath, 'a') as f:
-                for line in temp_js_file_as_list:
-                    f.write(f'{line}\n')
+        has a key of function_name and python_obj, the values of these keys will be used below.
+        The objects are streamed to the file an item at a time so that the json of a whole (potentially very large)
+        object is never held in memory. If study_data.js doesn't exist yet it is created.'''
+        with open(js_outpath, 'a') as f:
+            for python_obj_dict in list_of_func_obj_dicts:
+                f.write('function ' + python_obj_dict['function_name'] + '(){\n')
+                f.write('\treturn ')
+                ThreadSafeGeneral._write_out_json_streamed(python_obj_dict['python_obj'], f)
+                f.write(';\n}\n')
+
+    @staticmethod
+    def _write_out_json_streamed(python_obj, f):
+        '''Write out the same json as json.dumps(python_obj) but, for dicts and lists, one item at a time.'''
+        if isinstance(python_obj, dict) and python_obj and all(
+                isinstance(k, str) or (isinstance(k, int) and not isinstance(k, bool)) for k in python_obj):
+            for i, (k, v) in enumerate(python_obj.items()):
+                f.write(('{' if i == 0 else ', ') + json.dumps(str(k)) + ': ' + json.dumps(v))
+            f.write('}')
+        elif isinstance(python_obj, list) and python_obj:
+            for i, v in enumerate(python_obj):
+                f.write(('[' if i == 0 else ', ') + json.dumps(v))
+            f.write(']')
         else:
-            # study_data.js doesn't exist yet so create and write to it
-            with open(js_outpath, 'w') as f:
-                for line in temp_js_file_as_list:
-                    f.write(f'{line}\n')
+            f.write(json.dumps(python_obj))
 
     @staticmethod
     def make_json_object_array_from_python_dictionary(p_dict):
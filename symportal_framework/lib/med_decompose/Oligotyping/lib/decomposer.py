@@ -18,6 +18,7 @@ import numpy
 import shutil
 import pickle
 import logging
+import multiprocessing
 
 import Oligotyping as o
 from Oligotyping.lib import fastalib as u
@@ -62,6 +63,16 @@ class Decomposer:
         self.skip_gexf_files = False
         self.skip_basic_analyses = False
         self.quick = False
+        # the unique reads to decompose can be given in memory (see med_api.decompose) rather than
+        # read from the alignment file. skip_output_files then skips writing the results into the
+        # output directory (the output directory is still used for logs and temporary BLAST files).
+        self.read_objects = None
+        self.skip_output_files = False
+        # the number of processes in which the nodes of each level of the raw topology are analyzed.
+        # levels with fewer unique reads than min_unique_reads_for_parallel_raw_topology_level are
+        # analyzed serially.
+        self.raw_topology_processes = None
+        self.min_unique_reads_for_parallel_raw_topology_level = 5000
          
         if args:
             self.alignment = args.alignment
@@ -168,6 +179,9 @@ class Decomposer:
 
 
     def check_input_files(self):
+        if self.read_objects is not None:
+            return
+
         if (not os.path.exists(self.alignment)) or (not os.access(self.alignment, os.R_OK)):
             raise utils.ConfigError("Alignment file is not accessible: '%s'" % self.alignment)
 
@@ -215,7 +229,10 @@ class Decomposer:
 
         self.topology.nodes_output_directory = self.nodes_directory
         
-        reads = utils.get_read_objects_from_file(self.alignment)
+        if self.read_objects is not None:
+            reads = self.read_objects
+        else:
+            reads = utils.get_read_objects_from_file(self.alignment)
         
         self.root = self.topology.add_new_node('root', reads, root = True)
         
@@ -332,6 +349,11 @@ class Decomposer:
         if self.relocate_outliers:
             self._relocate_all_outliers()
 
+        if self.skip_output_files:
+            self.logger.info('fin.')
+            self.run.quit()
+            return
+
         self._generate_samples_dict()
         self._get_unit_counts_and_percents()
 
@@ -387,7 +409,7 @@ class Decomposer:
 
     def _generate_raw_topology(self):
         self.progress.new('Raw Topology')
-        # main loop
+        # main loop
         while 1:
 
             if not len(self.node_ids_to_analyze):
@@ -395,12 +417,18 @@ class Decomposer:
                 break
             self.decomposition_depth += 1
             # following for loop will go through all nodes that are stored in
-            # self.node_ids_to_analyze list. while those nodes are being decomposed,
+            # self.node_ids_to_analyze list. while those nodes are being decomposed,
             # new nodes will appear and need to be analyzed next round. following
             # variable will keep track of the new nodes that emerge, and replace
             # self.node_ids_to_analyze for the next cycle of the main loop.
             new_node_ids_to_analyze = []
 
+            # the nodes of a level are independent of each other. when there are enough reads in the level
+            # they are analyzed in parallel first (see _analyze_nodes_in_parallel), otherwise each node is
+            # analyzed just before its results are merged into the topology. either way the results are merged
+            # in the order of self.node_ids_to_analyze so that the new node ids are always the same.
+            node_id_to_analysis_dict = self._analyze_nodes_in_parallel(self.node_ids_to_analyze)
+
             for node_id in self.node_ids_to_analyze:
   
                 node = self.topology.nodes[node_id]
@@ -415,144 +443,47 @@ class Decomposer:
                 self.logger.info('analyzing node id: %s (%d)' % (node_id, node.size))
                 self.progress.update(p)
 
-                # if the most abundant unique read in a node is smaller than self.min_actual_abundance kill the node
-                # and store read information into self.topology.outliers
-                if node.reads[0].frequency < self.min_substantive_abundance:
-                    if node.node_id == 'root':
+                if node_id_to_analysis_dict is None:
+                    analysis = self._analyze_node(node)
+                else:
+                    try:
+                        analysis = node_id_to_analysis_dict[node_id]
+                    except KeyError:
                         self.progress.end()
-                        raise utils.ConfigError("Number of unique reads in the root node (%d) is less than the declared minimum (%d)." \
-                                                % (node.reads[0].frequency,
-                                                   self.min_substantive_abundance))
+                        raise RuntimeError('The analysis of node %s failed in its worker process' % node_id)
+                    for attribute_name, value in analysis['node_attributes'].items():
+                        setattr(node, attribute_name, value)
 
-                    else:
-                        # remove the node and store its content.
-                        self.logger.info('remove node (MSA): %s' % node_id)
-                        self.topology.remove_node(node.node_id, True, 'min_substantive_abundance_reason')
-                        continue
+                for log_message in analysis['log_messages']:
+                    self.logger.info(log_message)
 
-                if node.size < self.min_actual_abundance:
-                    # remove the node and store its content.
-                    self.topology.remove_node(node.node_id, True, 'min_actual_abundance_reason')                    
-                    self.logger.info('remove node (MAA): %s' % node_id)
-                    continue
-                
-                # competing_unique_sequences_ratio refers to the ratio between the most abundant unique
-                # read count and the second most abundant unique read count in a node. smaller the number,
-                # better the level of decomposition. however it is important to consider that one organism
-                # might be overprinting, increasing the ratio over a closely related organism that trapped
-                # in the same node.
-                #
-                # 'node density' refers to the ratio of most abundant unique read count to all reads
-                # that are accumulated in the node. higher the number, lower the variation within the
-                # node.
-                node.do_competing_unique_sequences_ratio_and_density()
-
-                p += ' / CUSR: %.2f / D: %.2f' % (node.competing_unique_sequences_ratio, node.density)
-                self.progress.update(p)
+                if analysis['outcome'] == 'root_below_min_substantive_abundance':
+                    self.progress.end()
+                    raise utils.ConfigError("Number of unique reads in the root node (%d) is less than the declared minimum (%d)." \
+                                            % (node.reads[0].frequency,
+                                               self.min_substantive_abundance))
 
-                if node.competing_unique_sequences_ratio < 0.0005 or node.density > 0.85:
-                    # Finalize this node.
-                    self.logger.info('finalize node (CUSR/ND): %s' % node_id)
+                if analysis['outcome'] == 'remove':
+                    # remove the node and store its content.
+                    self.topology.remove_node(node.node_id, True, analysis['reason'])
                     continue
 
-                # find out about the entropy distribution in the given node:
-                node.do_entropy()
-                
-                # normalize m if the user hasn't opted out.
-                if self.normalize_m:
-                    node.set_normalized_m(self.min_entropy, self.topology.frequency_of_the_most_abundant_read)
-                    self.logger.info('normalized m (NM) for %s: %.3f ' % (node_id, node.normalized_m))
-
-                p += ' / ME: %.2f / AE: %.2f / NM: %s' % (max(node.entropy),
-                                                          node.average_entropy,
-                                                          ('%.3f' % node.normalized_m) if self.normalize_m else None)
+                p += analysis['progress']
                 self.progress.update(p)
-                
-                # IF the abundance of the second most abundant unique read in the node is smaller than 
-                # the self.min_substantive_abundance criteria, there is no need to further decompose
-                # this node. because anything spawns from here, will end up in the outlier bin except
-                # the most abundant unique read. of course by not decomposing any further we are losing
-                # the opportunity to 'purify' this node further, but we are not worried about it,
-                # because 'max_allowed_variation' outliers will be removed from this node later on.  
-                # UPDATE: Well, this causes some serious purity issues. For instance a node with,
-                # 
-                # >Read_1|frequency:957
-                # >Read_2|frequency:120
-                # >Read_3|frequency:57
-                # >Read_4|frequency:7
-                #
-                # is finalized due to SMA < MSA although the entropy looked like this:
-                #
-                #    http://i.imgur.com/ctFnJE2.png
-                #
-                # when M = 300. This begs for a FIXME.
-                #
-                if node.reads[1].frequency < self.min_substantive_abundance:
-                    # we are done with this node.
-                    self.logger.info('finalize node (SMA < MSA): %s' % node_id)
-                    continue
 
-                # discriminants for this node are being selected from the list of entropy tuples:
-                # entropy_tpls look like this:
-                #
-                #   [(125, 2.0464393446710156), (131, 1.895461844238322), (118, 1.8954618442383218), ... ]
-                #
-                # Probably a function should be called here to make sure discriminants are not high entropy
-                # locations driven by homopolymer region associated indels, or dynamicaly set the number of 
-                # discriminants for a given node. for instance, if there is one base left in a node that is
-                # to define two different organisms, this process should be able to *overwrite* the parameter
-                # self.number_of_discriminants.
-                if self.normalize_m:
-                    node.discriminants = [d[0] for d in node.entropy_tpls[0:self.number_of_discriminants] if d[1] > node.normalized_m]
-                else:
-                    node.discriminants = [d[0] for d in node.entropy_tpls[0:self.number_of_discriminants] if d[1] > self.min_entropy]
-
-                if not len(node.discriminants):
-                    # FIXME: Finalize this node.
-                    self.logger.info('finalize node (ND): %s' % node_id)
+                if analysis['outcome'] == 'finalize':
                     continue
-                else:
-                    self.logger.info('using %d D (%s) to decompose: %s'\
-                                     % (len(node.discriminants),
-                                        ','.join([str(d) for d in node.discriminants]),
-                                        node_id))
-                
-                # before we go through the parent reads to find new set of nodes, we need a variable to keep
-                # track of them:
-                new_nodes_dict = {}
-
-                # go through the parent reads
-                counter = 0
-                while 1:
-                    counter += 1
-                    if counter % 1000 == 0 or counter == node.size - 1:
-                        self.progress.update(p + ' / %.1f%%' % (counter * 100.0 / node.size))
-                    
-                    if not node.reads:
-                        # all reads were processed, break while loop.
-                        break
-                    
-                    read = node.reads.pop()
 
-                    oligo = ''.join([read.seq[d] for d in node.discriminants])
-                   
-                    if oligo in new_nodes_dict:
-                        new_nodes_dict[oligo]['reads'].append(read)
-                    else:
-                        new_node_id = self.topology.get_new_node_id()
-                        new_nodes_dict[oligo] = {}
-                        new_nodes_dict[oligo]['node_id'] = new_node_id
-                        new_nodes_dict[oligo]['reads'] = [read]
-                
-                
                 # all reads in the parent node are analyzed. time to add spawned nodes into the topology.
-                oligos = list(new_nodes_dict.keys())
-                len_oligos = len(oligos)
+                # the ids of the new nodes are given in the order that their oligos were first seen.
+                parent_reads = node.reads
+                node.reads = []
+                len_oligos = len(analysis['new_node_read_indices'])
                 for i in range(0, len_oligos):
                     self.progress.update(p + ' / new nodes %d of %d ' % (i + 1, len_oligos))
 
-                    new_node = self.topology.add_new_node(new_nodes_dict[oligos[i]]['node_id'],
-                                                          new_nodes_dict[oligos[i]]['reads'],
+                    new_node = self.topology.add_new_node(self.topology.get_new_node_id(),
+                                                          [parent_reads[j] for j in analysis['new_node_read_indices'][i]],
                                                           parent_id = node.node_id)
 
                     new_node_ids_to_analyze.append(new_node.node_id)
@@ -571,6 +502,177 @@ class Decomposer:
         # fin.
 
 
+    def _analyze_node(self, node):
+        """Decide what to do with a node of the raw topology without changing the topology: returns a dict with
+           the 'outcome' ('remove', 'finalize', 'decompose' or 'root_below_min_substantive_abundance'), the
+           'log_messages' to write, the 'progress' to report, and for the nodes to decompose the 'new_node_read_indices' (the indices of the
+           reads of the node that go into each new node, in the order that the oligos of the new nodes were first
+           seen). The attributes of the node that are computed here are also returned as 'node_attributes' so that
+           they can be set on the node when the analysis is done in another process."""
+        analysis = {'outcome': None, 'reason': None, 'log_messages': [], 'progress': '', 'new_node_read_indices': None}
+
+        # if the most abundant unique read in a node is smaller than self.min_actual_abundance kill the node
+        # and store read information into self.topology.outliers
+        if node.reads[0].frequency < self.min_substantive_abundance:
+            if node.node_id == 'root':
+                analysis['outcome'] = 'root_below_min_substantive_abundance'
+            else:
+                analysis['outcome'] = 'remove'
+                analysis['reason'] = 'min_substantive_abundance_reason'
+                analysis['log_messages'].append('remove node (MSA): %s' % node.node_id)
+            return self._add_node_attributes_to_analysis(node, analysis)
+
+        if node.size < self.min_actual_abundance:
+            analysis['outcome'] = 'remove'
+            analysis['reason'] = 'min_actual_abundance_reason'
+            analysis['log_messages'].append('remove node (MAA): %s' % node.node_id)
+            return self._add_node_attributes_to_analysis(node, analysis)
+
+        # competing_unique_sequences_ratio refers to the ratio between the most abundant unique
+        # read count and the second most abundant unique read count in a node. smaller the number,
+        # better the level of decomposition. however it is important to consider that one organism
+        # might be overprinting, increasing the ratio over a closely related organism that trapped
+        # in the same node.
+        #
+        # 'node density' refers to the ratio of most abundant unique read count to all reads
+        # that are accumulated in the node. higher the number, lower the variation within the
+        # node.
+        node.do_competing_unique_sequences_ratio_and_density()
+
+        analysis['progress'] += ' / CUSR: %.2f / D: %.2f' % (node.competing_unique_sequences_ratio, node.density)
+
+        if node.competing_unique_sequences_ratio < 0.0005 or node.density > 0.85:
+            # Finalize this node.
+            analysis['outcome'] = 'finalize'
+            analysis['log_messages'].append('finalize node (CUSR/ND): %s' % node.node_id)
+            return self._add_node_attributes_to_analysis(node, analysis)
+
+        # find out about the entropy distribution in the given node:
+        node.do_entropy()
+        
+        # normalize m if the user hasn't opted out.
+        if self.normalize_m:
+            node.set_normalized_m(self.min_entropy, self.topology.frequency_of_the_most_abundant_read)
+            analysis['log_messages'].append('normalized m (NM) for %s: %.3f ' % (node.node_id, node.normalized_m))
+
+        analysis['progress'] += ' / ME: %.2f / AE: %.2f / NM: %s' % (max(node.entropy),
+                                                                     node.average_entropy,
+                                                                     ('%.3f' % node.normalized_m) if self.normalize_m else None)
+
+        # IF the abundance of the second most abundant unique read in the node is smaller than 
+        # the self.min_substantive_abundance criteria, there is no need to further decompose
+        # this node. because anything spawns from here, will end up in the outlier bin except
+        # the most abundant unique read. of course by not decomposing any further we are losing
+        # the opportunity to 'purify' this node further, but we are not worried about it,
+        # because 'max_allowed_variation' outliers will be removed from this node later on.  
+        # UPDATE: Well, this causes some serious purity issues. For instance a node with,
+        # 
+        # >Read_1|frequency:957
+        # >Read_2|frequency:120
+        # >Read_3|frequency:57
+        # >Read_4|frequency:7
+        #
+        # is finalized due to SMA < MSA although the entropy looked like this:
+        #
+        #    http://i.imgur.com/ctFnJE2.png
+        #
+        # when M = 300. This begs for a FIXME.
+        #
+        if node.reads[1].frequency < self.min_substantive_abundance:
+            # we are done with this node.
+            analysis['outcome'] = 'finalize'
+            analysis['log_messages'].append('finalize node (SMA < MSA): %s' % node.node_id)
+            return self._add_node_attributes_to_analysis(node, analysis)
+
+        # discriminants for this node are being selected from the list of entropy tuples:
+        # entropy_tpls look like this:
+        #
+        #   [(125, 2.0464393446710156), (131, 1.895461844238322), (118, 1.8954618442383218), ... ]
+        #
+        # Probably a function should be called here to make sure discriminants are not high entropy
+        # locations driven by homopolymer region associated indels, or dynamicaly set the number of 
+        # discriminants for a given node. for instance, if there is one base left in a node that is
+        # to define two different organisms, this process should be able to *overwrite* the parameter
+        # self.number_of_discriminants.
+        if self.normalize_m:
+            node.discriminants = [d[0] for d in node.entropy_tpls[0:self.number_of_discriminants] if d[1] > node.normalized_m]
+        else:
+            node.discriminants = [d[0] for d in node.entropy_tpls[0:self.number_of_discriminants] if d[1] > self.min_entropy]
+
+        if not len(node.discriminants):
+            # FIXME: Finalize this node.
+            analysis['outcome'] = 'finalize'
+            analysis['log_messages'].append('finalize node (ND): %s' % node.node_id)
+            return self._add_node_attributes_to_analysis(node, analysis)
+        else:
+            analysis['log_messages'].append('using %d D (%s) to decompose: %s'\
+                                            % (len(node.discriminants),
+                                               ','.join([str(d) for d in node.discriminants]),
+                                               node.node_id))
+
+        # go through the parent reads (from the last to the first, as they used to be popped from the node)
+        # and keep track of the reads of each new node. the index of a new node in the list is the order
+        # in which its oligo was first seen.
+        oligo_to_new_node_index_dict = {}
+        new_node_read_indices = []
+        for read_index in range(len(node.reads) - 1, -1, -1):
+            read = node.reads[read_index]
+
+            oligo = ''.join([read.seq[d] for d in node.discriminants])
+
+            if oligo in oligo_to_new_node_index_dict:
+                new_node_read_indices[oligo_to_new_node_index_dict[oligo]].append(read_index)
+            else:
+                oligo_to_new_node_index_dict[oligo] = len(new_node_read_indices)
+                new_node_read_indices.append([read_index])
+
+        analysis['outcome'] = 'decompose'
+        analysis['new_node_read_indices'] = new_node_read_indices
+        return self._add_node_attributes_to_analysis(node, analysis)
+
+
+    @staticmethod
+    def _add_node_attributes_to_analysis(node, analysis):
+        analysis['node_attributes'] = {attribute_name: getattr(node, attribute_name) for attribute_name in
+                                       ['competing_unique_sequences_ratio', 'density', 'entropy', 'entropy_tpls',
+                                        'max_entropy', 'average_entropy', 'normalized_m', 'discriminants']}
+        return analysis
+
+
+    def _analyze_nodes_in_parallel(self, node_ids):
+        """Analyze the nodes of a level of the raw topology in raw_topology_processes worker processes.
+           Returns a dict of node id to the analysis of the node (see _analyze_node), or None if the level
+           should be analyzed serially (no parallelism requested, a single node in the level, too few reads
+           in the level for the parallelism to pay off, or processes cannot be forked)."""
+        if not self.raw_topology_processes or self.raw_topology_processes < 2 or len(node_ids) < 2:
+            return None
+
+        if sum([len(self.topology.nodes[node_id].reads) for node_id in node_ids]) < \
+                self.min_unique_reads_for_parallel_raw_topology_level:
+            return None
+
+        # the worker processes read the nodes from the topology that they inherit when they are forked
+        # rather than being sent the reads of the nodes.
+        if multiprocessing.get_start_method() != 'fork':
+            return None
+
+        def worker(data_chunk, shared_node_id_to_analysis_dict):
+            for node_id in data_chunk:
+                shared_node_id_to_analysis_dict[node_id] = self._analyze_node(self.topology.nodes[node_id])
+
+        mp = utils.Multiprocessing(worker, min(self.raw_topology_processes, len(node_ids)))
+        shared_node_id_to_analysis_dict = mp.get_empty_shared_dict()
+        for chunk in mp.get_data_chunks(node_ids, spiral = True):
+            mp.run((chunk, shared_node_id_to_analysis_dict))
+
+        for process in mp.processes:
+            process.join()
+
+        node_id_to_analysis_dict = dict(shared_node_id_to_analysis_dict)
+        mp.manager.shutdown()
+        return node_id_to_analysis_dict
+
+
     def _refresh_topology(self):
         self.progress.new('Refreshing the topology')
         self.progress.update('Updating final nodes...')
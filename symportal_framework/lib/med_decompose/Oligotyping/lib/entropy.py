@@ -64,6 +64,45 @@ def entropy(l, l_qual = None, expected_qual_score = 40, amino_acid_sequences = F
         return -(sum(E_Cs))
 
 
+def encode_sequences(sequences):
+    """Encode equal length sequences as a uint8 matrix with one row per sequence"""
+    return numpy.frombuffer(''.join(sequences).encode('ascii'), dtype=numpy.uint8).reshape(len(sequences), -1)
+
+
+def weighted_column_entropies(seq_matrix, frequencies, amino_acid_sequences = False, rows_per_chunk = 10000):
+    """Returns the entropy of every column of seq_matrix (see encode_sequences) where each row (unique
+       sequence) is weighted by its frequency. The result for a column is identical to calling entropy()
+       on a column string in which the character of each row is repeated frequency times, but without
+       building that string: the weighted character counts of all columns are found with one bincount
+       pass over the matrix (in chunks of rows to bound the memory used). Columns made of a single
+       character get 0.0, as they do in the callers of entropy()."""
+    num_rows, num_columns = seq_matrix.shape
+    frequencies = numpy.asarray(frequencies, dtype=numpy.float64)
+    column_offsets = numpy.arange(num_columns, dtype=numpy.int64) * 256
+    # the counts are sums of integers and so are exact as long as the column length is below 2 ** 53
+    counts = numpy.zeros(num_columns * 256)
+    for start in range(0, num_rows, rows_per_chunk):
+        chunk = seq_matrix[start:start + rows_per_chunk]
+        counts += numpy.bincount((chunk + column_offsets).ravel(),
+                                 weights = numpy.repeat(frequencies[start:start + rows_per_chunk], num_columns),
+                                 minlength = num_columns * 256)
+    counts = counts.reshape(num_columns, 256)
+    column_lengths = counts.sum(axis = 1)
+
+    # we follow the order of operations of entropy() so that the results are bit-for-bit the same
+    valid_chars = VALID_CHARS['amino_acid'] if amino_acid_sequences else VALID_CHARS['nucleotide']
+    sum_E_Cs = numpy.zeros(num_columns)
+    for char in valid_chars:
+        # entropy() upper cases the column
+        char_counts = counts[:, ord(char)] + counts[:, ord(char.lower())] if char.isalpha() else counts[:, ord(char)]
+        P_C = (char_counts * 1.0 / column_lengths) + 0.0000000000000000001
+        sum_E_Cs = sum_E_Cs + P_C * log(P_C)
+    entropies = -sum_E_Cs
+
+    entropies[(counts > 0).sum(axis = 1) == 1] = 0.0
+    return entropies
+
+
 def entropy_analysis(alignment_path, output_file = None, verbose = True, uniqued = False, freq_from_defline = None, weighted = False, qual_stats_dict = None, amino_acid_sequences = False):
     if freq_from_defline == None:
         freq_from_defline = lambda x: int([t.split(':')[1] for t in x.split('|') if t.startswith('freq')][0])
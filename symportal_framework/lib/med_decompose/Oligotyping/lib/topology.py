@@ -14,7 +14,7 @@ import numpy
 import operator
 
 from Oligotyping.lib import fastalib as u
-from Oligotyping.lib.entropy import entropy
+from Oligotyping.lib.entropy import encode_sequences, weighted_column_entropies
 from Oligotyping.utils.utils import ConfigError
 
 class Topology:
@@ -332,19 +332,20 @@ class Node:
 
 
     def do_entropy(self):
+        # the unique reads of the node are encoded once, and the entropies of all positions computed
+        # together weighting each read by its frequency, rather than building a column string as long as
+        # the node size for every position.
+        column_entropies = weighted_column_entropies(encode_sequences([read.seq for read in self.reads]),
+                                                     [read.frequency for read in self.reads])
+
         self.entropy_tpls = []
         for position in range(0, len(self.representative_seq)):
-            column = ''.join([read.seq[position] * read.frequency for read in self.reads])
-            
-            if len(set(column)) == 1:
+            e = column_entropies[position]
+
+            if e < 0.00001:
                 self.entropy_tpls.append((position, 0.0),)
             else:
-                e = entropy(column)
-
-                if e < 0.00001:
-                    self.entropy_tpls.append((position, 0.0),)
-                else:
-                    self.entropy_tpls.append((position, e),)
+                self.entropy_tpls.append((position, e),)
 
         self.entropy = [t[1] for t in self.entropy_tpls]
         self.entropy_tpls = sorted(self.entropy_tpls, key=operator.itemgetter(1), reverse=True)
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+An in-process interface to the MED decomposition so that it can be run without starting a python interpreter
+for o_pad_with_gaps.py and decompose.py and without writing and re-reading the intermediate fasta files and
+the output files of each decomposition.
+
+decompose takes the (unaligned) sequences of a sample and clade and their frequencies, pads them with gaps
+to the length of the longest sequence (as o_pad_with_gaps.py does), orders the unique sequences as
+decompose.py does when reading them from a fasta file and runs the Decomposer with the settings that SymPortal
+has always used:
+    -M <M> --skip-gexf-files --skip-gen-figures --skip-gen-html --skip-check-input -T
+The results (the representative sequence and the number of reads of each final node) are returned as a
+MEDResult. The decomposition still needs a directory for its logs and for the temporary files of the BLAST
+outlier removal. A temporary directory is used and deleted unless an output_directory is given, in which case
+the complete set of MED output files is also written there (e.g. for debugging).
+
+Where the outcome of the decomposition is known without running it, the Decomposer is not run:
+    if the most abundant unique sequence has fewer than M reads the decomposition fails (as decompose.py does).
+    if there is only one unique sequence it is the representative of the only node ('root').
+The results of decompositions can also be cached (MEDResultCache) by the hash of the padded unique sequences,
+their frequencies and M, so that identical inputs (e.g. when the same fastq files are loaded again) are not
+decomposed again.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+# The Oligotyping package imports itself absolutely (i.e. 'from Oligotyping.lib import ...')
+if os.path.dirname(os.path.abspath(__file__)) not in sys.path:
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from Oligotyping.lib.decomposer import Decomposer
+from Oligotyping.utils import parsers
+from Oligotyping.utils.utils import ConfigError
+
+# Change this whenever the MED settings (or the Decomposer) change so that old cache entries are not used
+MED_CACHE_VERSION = 'med_M_skip_check_input_no_threading_v1'
+
+
+class MEDRead:
+    """A unique read as used by the Decomposer (see Oligotyping.utils.utils.UniqueFASTAEntry).
+    The ids of the reads are only needed when writing the output files and so are only made if asked for."""
+    def __init__(self, seq, frequency, sample_name, first_read_number):
+        self.seq = seq
+        self.frequency = frequency
+        self.md5id = hashlib.md5(self.seq.encode('utf-8')).hexdigest()
+        self.sample_name = sample_name
+        self.first_read_number = first_read_number
+
+    @property
+    def ids(self):
+        # MED infers the sample name of a read from its id, as the part before the last '_'
+        return [f'{self.sample_name}_{i}' for i in range(
+            self.first_read_number, self.first_read_number + self.frequency)]
+
+
+class MEDResult:
+    def __init__(self, sample_name, node_names, node_representative_dict, node_size_dict, node_count_dict):
+        self.sample_name = sample_name
+        # the names of the final nodes in the order that decompose.py writes them
+        self.node_names = node_names
+        # key = node name, value = representative sequence of the node (padded with gaps)
+        self.node_representative_dict = node_representative_dict
+        # key = node name, value = the size of the node (as written to NODE-REPRESENTATIVES.fasta)
+        self.node_size_dict = node_size_dict
+        # key = node name, value = the number of reads of the sample in the node (as written to MATRIX-COUNT.txt)
+        self.node_count_dict = node_count_dict
+
+
+class MEDResultCache:
+    """A content addressed cache of MEDResults. Each entry is a json file named by the sha256 of the padded
+    unique sequences (in the order they are decomposed), their frequencies and M. Failed decompositions are
+    cached too. An entry is written to a temporary file and then renamed into place so that the entries
+    are always complete, even if several SymPortal instances share the cache."""
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def get_key(med_read_objects, M):
+        hasher = hashlib.sha256(f'{MED_CACHE_VERSION}\t{M}'.encode())
+        for read in med_read_objects:
+            hasher.update(f'\n{read.seq}\t{read.frequency}'.encode())
+        return hasher.hexdigest()
+
+    def get_entry_path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.json')
+
+    def get(self, key, sample_name):
+        """Return the MEDResult of the entry, or None if there is no entry.
+        Raises ConfigError if the cached decomposition failed."""
+        try:
+            with open(self.get_entry_path(key), 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if 'error' in entry:
+            raise ConfigError(entry['error'])
+        return MEDResult(
+            sample_name=sample_name, node_names=entry['node_names'],
+            node_representative_dict=dict(zip(entry['node_names'], entry['node_representatives'])),
+            node_size_dict=dict(zip(entry['node_names'], entry['node_sizes'])),
+            node_count_dict=dict(zip(entry['node_names'], entry['node_counts'])))
+
+    def add(self, key, med_result=None, error=None):
+        if med_result is not None:
+            entry = {
+                'node_names': med_result.node_names,
+                'node_representatives': [
+                    med_result.node_representative_dict[node_name] for node_name in med_result.node_names],
+                'node_sizes': [med_result.node_size_dict[node_name] for node_name in med_result.node_names],
+                'node_counts': [med_result.node_count_dict[node_name] for node_name in med_result.node_names]}
+        else:
+            entry = {'error': error}
+        temp_file_descriptor, temp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp_', suffix='.json')
+        with os.fdopen(temp_file_descriptor, 'w') as f:
+            json.dump(entry, f)
+        os.replace(temp_path, self.get_entry_path(key))
+
+
+def get_med_read_objects(sequences, frequencies, sample_name):
+    """Pad the sequences with gaps to the length of the longest sequence and return the MEDReads of the
+    unique sequences in the order that decompose.py reads them from a fasta file (most abundant first, ties
+    broken by the sha1 of the sequence in reverse order)"""
+    longest_sequence_length = max(len(sequence) for sequence in sequences)
+    sequence_to_frequency_dict = {}
+    for sequence, frequency in zip(sequences, frequencies):
+        padded_sequence = (sequence + '-' * (longest_sequence_length - len(sequence))).upper()
+        sequence_to_frequency_dict[padded_sequence] = sequence_to_frequency_dict.get(padded_sequence, 0) + frequency
+    sorted_sequences = [t[2] for t in sorted(
+        [(frequency, hashlib.sha1(sequence.encode('utf-8')).hexdigest(), sequence) for
+         sequence, frequency in sequence_to_frequency_dict.items()], reverse=True)]
+    med_read_objects = []
+    first_read_number = 0
+    for sequence in sorted_sequences:
+        med_read_objects.append(
+            MEDRead(sequence, sequence_to_frequency_dict[sequence], sample_name, first_read_number))
+        first_read_number += sequence_to_frequency_dict[sequence]
+    return med_read_objects
+
+
+def decompose(
+        sequences, frequencies, M, sample_name='sample', output_directory=None, verbose=False, cache_dir=None,
+        raw_topology_processes=None):
+    """Run MED on the sequences (with the given frequencies) of a sample and return a MEDResult.
+    :param M: the minimum substantive abundance (-M)
+    :param output_directory: if given, the MED output files are written here as decompose.py would
+    (and neither the fast paths nor the cache are used)
+    :param verbose: whether the Decomposer should write its progress to the console
+    :param cache_dir: if given, the directory of the MEDResultCache to use
+    :param raw_topology_processes: if given, the number of processes in which the nodes of each level of the
+    raw topology are analyzed (for large inputs, see Decomposer._analyze_nodes_in_parallel). The results are the
+    same as those of the serial decomposition.
+    Raises Oligotyping.utils.utils.ConfigError, as decompose.py does, if the sequences cannot be decomposed
+    (e.g. there are too few of them).
+    """
+    med_read_objects = get_med_read_objects(sequences, frequencies, sample_name)
+    if output_directory:
+        return _run_decomposer(
+            med_read_objects, M, sample_name, output_directory, verbose, raw_topology_processes)
+
+    if med_read_objects[0].frequency < M:
+        raise ConfigError("Number of unique reads in the root node (%d) is less than the declared minimum (%d)." \
+                          % (med_read_objects[0].frequency, M))
+    if len(med_read_objects) == 1:
+        return MEDResult(
+            sample_name=sample_name, node_names=['root'],
+            node_representative_dict={'root': med_read_objects[0].seq},
+            node_size_dict={'root': med_read_objects[0].frequency},
+            node_count_dict={'root': med_read_objects[0].frequency})
+
+    if not cache_dir:
+        return _run_decomposer(
+            med_read_objects, M, sample_name, output_directory, verbose, raw_topology_processes)
+
+    med_result_cache = MEDResultCache(cache_dir)
+    key = med_result_cache.get_key(med_read_objects, M)
+    med_result = med_result_cache.get(key, sample_name)
+    if med_result is not None:
+        return med_result
+    try:
+        med_result = _run_decomposer(
+            med_read_objects, M, sample_name, output_directory, verbose, raw_topology_processes)
+    except ConfigError as e:
+        med_result_cache.add(key, error=e.e)
+        raise
+    med_result_cache.add(key, med_result=med_result)
+    return med_result
+
+
+def _run_decomposer(med_read_objects, M, sample_name, output_directory, verbose, raw_topology_processes):
+    scratch_directory = output_directory if output_directory else tempfile.mkdtemp(prefix='med_')
+    args = parsers.decomposer().parse_args([
+        '-M', str(M), '--skip-gexf-files', '--skip-gen-figures', '--skip-gen-html', '--skip-check-input', '-T',
+        '-o', scratch_directory, 'reads_in_memory'])
+    decomposer = Decomposer(args)
+    decomposer.read_objects = med_read_objects
+    decomposer.skip_output_files = output_directory is None
+    decomposer.raw_topology_processes = raw_topology_processes
+    decomposer.run.verbose = verbose
+    decomposer.progress.verbose = verbose
+    try:
+        decomposer.decompose()
+        node_names = list(decomposer.topology.final_nodes)
+        return MEDResult(
+            sample_name=sample_name, node_names=node_names,
+            node_representative_dict={
+                node_name: decomposer.topology.nodes[node_name].representative_seq for node_name in node_names},
+            node_size_dict={
+                node_name: decomposer.topology.nodes[node_name].size for node_name in node_names},
+            node_count_dict={
+                node_name: sum(read.frequency for read in decomposer.topology.nodes[node_name].reads) for
+                node_name in node_names})
+    finally:
+        # The Decomposer adds a handler for its log file to the module level 'decomposer' logger
+        decomposer_logger = logging.getLogger('decomposer')
+        for handler in list(decomposer_logger.handlers):
+            if decomposer.log_file_path and \
+                    getattr(handler, 'baseFilename', None) == os.path.abspath(decomposer.log_file_path):
+                decomposer_logger.removeHandler(handler)
+                handler.close()
+        if not output_directory:
+            shutil.rmtree(scratch_directory, ignore_errors=True)
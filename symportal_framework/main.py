@@ -34,7 +34,8 @@ from django.core.wsgi import get_wsgi_application
 
 application = get_wsgi_application()
 # Your application specific imports
-from dbApp.models import DataSet, DataAnalysis, DataSetSample, Study, User, Citation
+from dbApp.models import (
+    DataSet, DataAnalysis, DataSetSample, Study, User, Citation, ReferenceSequence, AnalysisType)
 ############################################
 
 
@@ -53,6 +54,7 @@ if sp_config.system_type == 'remote':
     import re
 import data_analysis
 from general import ThreadSafeGeneral
+from output_manifest import OutputManifest
 from django_general import CreateStudyAndAssociateUsers
 import django_general
 from shutil import which
@@ -73,6 +75,9 @@ class SymPortalWorkFlowManager:
         self.dbbackup_dir = os.path.join(self.symportal_root_directory, 'dbBackUp')
         os.makedirs(self.dbbackup_dir, exist_ok=True)
         self.date_time_str = datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+        # The directory of the persistent cache of the UniFrac alignments and trees. None if it should not be used.
+        self.unifrac_tree_cache_dir = os.path.join(
+            self.symportal_root_directory, 'unifrac_tree_cache') if self.args.unifrac_tree_cache else None
         self.submitting_user = sp_config.user_name
         self.submitting_user_email = sp_config.user_email
         self.number_of_samples = None
@@ -92,6 +97,8 @@ class SymPortalWorkFlowManager:
         self.data_analysis_object = None
         self.sp_data_analysis = None
         self.output_type_count_table_obj = None
+        # The order of the DataSetSamples in the ITS2 type profile output (and so in all of the outputs)
+        self.type_output_sorted_sample_uid_list = None
         self.type_stacked_bar_plotter = None
         # If the shortcut function analyse_next has been used
         # look up the uids of the last analysis and use this plus what has been
@@ -107,6 +114,10 @@ class SymPortalWorkFlowManager:
         # Variables that will hold the distance class objects
         self.unifrac_distance_object = None
         self.braycurtis_distance_object = None
+        # For the incremental regeneration of outputs
+        # The manifest of the current output and that of the previous output of the same DataAnalysis
+        self.output_manifest = None
+        self.previous_output_manifest = None
 
     def _redefine_arg_analyse(self):
         """
@@ -188,6 +199,60 @@ class SymPortalWorkFlowManager:
         parser.add_argument('--multiprocess', help="When passed, concurrency will be acheived using "
                                                    "multiprocessing rather than multithreading.",
                             action='store_true', default=False)
+        parser.add_argument('--distance_block_size', type=int,
+                            help="When passed, between sample and between profile distance matrices are computed "
+                                 "this many samples (or profiles) at a time and streamed to a memory mapped "
+                                 "matrix on disk rather than being held in memory. The PCoA reads the distances from "
+                                 "the memory mapped matrix. Use for very large numbers of samples. Distances are "
+                                 "held as float32 in this mode. [None]", default=None)
+        parser.add_argument('--per_sample_blast', action='store_true',
+                            help="When passed, the sequences of each sample are blasted against the symClade "
+                                 "database separately during the taxonomic screening of a data loading. By default, "
+                                 "the unique sequences of all samples are blasted together once. The results "
+                                 "are the same.")
+        parser.add_argument('--classification_cache', action='store_true',
+                            help="When passed, a persistent cache of the symClade blast results of sequences "
+                                 "screened in previous data loadings is used (and added to) so that they are not "
+                                 "blasted again. The cache is emptied whenever the symClade database changes. It is "
+                                 "held in symportal_framework/symbiodiniaceaeDB/"
+                                 "symClade_classification_cache.sqlite and is not size limited. Delete the file to "
+                                 "clear it. [False]")
+        parser.add_argument('--med_cache', action='store_true',
+                            help="When passed, a persistent cache of MED decomposition results is used (and added "
+                                 "to) so that a sample/clade whose sequences and abundances are identical to those "
+                                 "of a previously decomposed sample/clade is not decomposed again. The results are "
+                                 "the same. The cache holds one file per sample/clade in symportal_framework/"
+                                 "med_cache and is not size limited. Delete the directory to clear it. [False]")
+        parser.add_argument('--unifrac_tree_cache', action='store_true',
+                            help="When passed, a persistent cache of the alignments and trees made for the UniFrac "
+                                 "distances is used (and added to) so that the tree of a set of sequences is only "
+                                 "made once. The cache holds one directory per set of sequences in "
+                                 "symportal_framework/unifrac_tree_cache and is not size limited. Delete the "
+                                 "directory to clear it. [False]")
+        parser.add_argument('--sparse_count_tables', action='store_true',
+                            help="When passed, the post-MED sequence and ITS2 type profile abundances are also "
+                                 "output as sparse count tables (.sparse.npz). These are binary, compressed sparse "
+                                 "row matrices, with the sample and sequence/profile uids and names, that can be "
+                                 "read (and memory mapped) much faster than the tab delimited count tables. "
+                                 "They can be read with scipy.sparse.load_npz or sparse_count_table.py.")
+        parser.add_argument('--incremental_output', action='store_true',
+                            help="When passed with --print_output_types, --print_output_types_sample_set or "
+                                 "--output_study_from_analysis, the artefacts (count tables, distances, PCoAs and "
+                                 "their plots) of the most recent previous output of the same DataAnalysis (and "
+                                 "Study) are reused rather than remade if the inputs they were made from (the "
+                                 "DataSetSamples, their meta information, the DataAnalysis and the methods) have not "
+                                 "changed. The inputs of each artefact are recorded in the output_manifest.json of "
+                                 "every output.")
+        parser.add_argument('--pcoa_method', choices=['eigh', 'randomised'],
+                            help="The method used to compute the PCoA coordinates from the between sample and "
+                                 "between profile distances. 'eigh' performs a full eigendecomposition (all axes). "
+                                 "'randomised' computes only the first --pcoa_dimensions axes using randomised "
+                                 "subspace iteration and can be used for very large numbers of samples. "
+                                 "In this mode, a clade whose distances are all (close to) 0 is output with "
+                                 "coordinates of 0 rather than being skipped. [eigh]", default='eigh')
+        parser.add_argument('--pcoa_dimensions', type=int,
+                            help="The number of principal coordinates computed when --pcoa_method is "
+                                 "'randomised'. [10]", default=10)
         parser.add_argument('--force_basal_lineage_separation',
                             help="When passed, cladocopium profiles sequences from the C3, C15 and C1 radiations "
                                  "will not be allowed to occur together in profiles.",
@@ -449,7 +514,8 @@ class SymPortalWorkFlowManager:
             no_pre_med_seqs=self.args.no_pre_med_seqs,
             ordered_seq_list=self.output_seq_count_table_obj.clade_abundance_ordered_ref_seq_list,
             date_time_str=self.output_seq_count_table_obj.date_time_str,
-            seq_relative_abund_df_pre_med=self.output_seq_count_table_obj.output_df_relative_pre_med)
+            seq_relative_abund_df_pre_med=self.output_seq_count_table_obj.output_df_relative_pre_med,
+            seq_count_table_sparse_path=self.output_seq_count_table_obj.path_to_seq_output_sparse_absolute)
         self.seq_stacked_bar_plotter.plot_stacked_bar_seqs()
 
     def _plot_type_stacked_bar_from_type_output_table(self):
@@ -554,7 +620,7 @@ class SymPortalWorkFlowManager:
     def _do_data_analysis_output(self):
         self._make_data_analysis_output_type_tables()
         self._make_data_analysis_output_seq_tables()
-        self.number_of_samples = len(self.output_type_count_table_obj.sorted_list_of_vdss_uids_to_output)
+        self.number_of_samples = len(self.type_output_sorted_sample_uid_list)
 
         if not self.args.no_figures:
             self._plot_if_not_too_many_samples(self._plot_type_stacked_bar_from_type_output_table)
@@ -569,14 +635,19 @@ class SymPortalWorkFlowManager:
         self.seq_stacked_bar_plotter = plotting.SeqStackedBarPlotter(
             output_directory=self.output_seq_count_table_obj.output_dir,
             seq_relative_abund_count_table_path_post_med=self.output_seq_count_table_obj.path_to_seq_output_abund_and_meta_df_absolute,
-            ordered_sample_uid_list=self.output_type_count_table_obj.sorted_list_of_vdss_uids_to_output,
+            ordered_sample_uid_list=self.type_output_sorted_sample_uid_list,
             no_pre_med_seqs=self.args.no_pre_med_seqs,
             ordered_seq_list=self.output_seq_count_table_obj.clade_abundance_ordered_ref_seq_list,
             date_time_str=self.output_seq_count_table_obj.date_time_str,
-            seq_relative_abund_df_pre_med=self.output_seq_count_table_obj.output_df_relative_pre_med)
+            seq_relative_abund_df_pre_med=self.output_seq_count_table_obj.output_df_relative_pre_med,
+            seq_count_table_sparse_path=self.output_seq_count_table_obj.path_to_seq_output_sparse_absolute)
         self.seq_stacked_bar_plotter.plot_stacked_bar_seqs()
 
     def _do_data_analysis_ordinations(self):
+        self._do_data_analysis_type_ordinations()
+        self._do_data_analysis_sample_ordinations()
+
+    def _do_data_analysis_type_ordinations(self):
         self._perform_data_analysis_type_distances()
         if not self.args.no_figures:
             if self.args.distance_method == 'both':
@@ -591,6 +662,7 @@ class SymPortalWorkFlowManager:
                 self._plot_if_not_too_many_samples(
                     lambda: self._plot_type_distances_from_distance_object(self.braycurtis_distance_object))
 
+    def _do_data_analysis_sample_ordinations(self):
         self._perform_data_analysis_sample_distances()
         if not self.args.no_figures:
             if self.args.distance_method == 'both':
@@ -619,17 +691,22 @@ class SymPortalWorkFlowManager:
 
     def _start_analysis_unifrac_sample_distances(self):
         self.unifrac_distance_object = distance.SampleUnifracDistPCoACreator(
+            dist_block_size=self.args.distance_block_size, tree_cache_dir=self.unifrac_tree_cache_dir,
+            pcoa_method=self.args.pcoa_method, pcoa_dimensions=self.args.pcoa_dimensions,
             num_processors=self.args.num_proc,
             date_time_str=self.date_time_str,
-            data_set_sample_uid_list=self.output_type_count_table_obj.sorted_list_of_vdss_uids_to_output,
+            data_set_sample_uid_list=self.type_output_sorted_sample_uid_list,
             output_dir=self.output_dir,
             html_dir=self.html_dir, js_output_path_dict=self.js_output_path_dict)
         self.unifrac_distance_object.compute_unifrac_dists_and_pcoa_coords()
 
     def _start_analysis_braycurtis_sample_distances(self):
         self.braycurtis_distance_object = distance.SampleBrayCurtisDistPCoACreator(
+            dist_block_size=self.args.distance_block_size,
+            pcoa_method=self.args.pcoa_method, pcoa_dimensions=self.args.pcoa_dimensions,
+            num_processors=self.args.num_proc, multiprocess=self.args.multiprocess,
             date_time_str=self.date_time_str,
-            data_set_sample_uid_list=self.output_type_count_table_obj.sorted_list_of_vdss_uids_to_output,
+            data_set_sample_uid_list=self.type_output_sorted_sample_uid_list,
             output_dir=self.output_dir,
             html_dir=self.html_dir, js_output_path_dict=self.js_output_path_dict)
         self.braycurtis_distance_object.compute_braycurtis_dists_and_pcoa_coords()
@@ -648,10 +725,12 @@ class SymPortalWorkFlowManager:
 
     def _start_analysis_unifrac_type_distances(self):
         self.unifrac_distance_object = distance.TypeUnifracDistPCoACreator(
+            dist_block_size=self.args.distance_block_size, tree_cache_dir=self.unifrac_tree_cache_dir,
+            pcoa_method=self.args.pcoa_method, pcoa_dimensions=self.args.pcoa_dimensions,
             num_processors=self.args.num_proc,
             data_analysis_obj=self.data_analysis_object,
             date_time_str=self.date_time_str,
-            data_set_sample_uid_list=self.output_type_count_table_obj.sorted_list_of_vdss_uids_to_output,
+            data_set_sample_uid_list=self.type_output_sorted_sample_uid_list,
             output_dir=self.output_dir,
             local_abunds_only=self.args.local,
             html_dir=self.html_dir, js_output_path_dict=self.js_output_path_dict)
@@ -659,9 +738,12 @@ class SymPortalWorkFlowManager:
 
     def _start_analysis_braycurtis_type_distances(self):
         self.braycurtis_distance_object = distance.TypeBrayCurtisDistPCoACreator(
+            dist_block_size=self.args.distance_block_size,
+            pcoa_method=self.args.pcoa_method, pcoa_dimensions=self.args.pcoa_dimensions,
+            num_processors=self.args.num_proc, multiprocess=self.args.multiprocess,
             data_analysis_obj=self.data_analysis_object,
             date_time_str=self.date_time_str,
-            data_set_sample_uid_list=self.output_type_count_table_obj.sorted_list_of_vdss_uids_to_output,
+            data_set_sample_uid_list=self.type_output_sorted_sample_uid_list,
             output_dir=self.output_dir,
             local_abunds_only=self.args.local,
             html_dir=self.html_dir, js_output_path_dict=self.js_output_path_dict)
@@ -674,11 +756,12 @@ class SymPortalWorkFlowManager:
             no_pre_med_seqs=self.args.no_pre_med_seqs,
             ds_uids_output_str=self.data_analysis_object.list_of_data_set_uids,
             output_dir=self.output_dir,
-            sorted_sample_uid_list=self.output_type_count_table_obj.sorted_list_of_vdss_uids_to_output,
+            sorted_sample_uid_list=self.type_output_sorted_sample_uid_list,
             analysis_obj=self.data_analysis_object,
             date_time_str=self.date_time_str,
             html_dir=self.html_dir, js_output_path_dict=self.js_output_path_dict, multiprocess=self.args.multiprocess,
-            call_type='analysis')
+            call_type='analysis',
+            sparse_count_tables=self.args.sparse_count_tables)
         self.output_seq_count_table_obj.make_seq_output_tables()
 
     def _make_data_analysis_output_type_tables(self):
@@ -690,8 +773,10 @@ class SymPortalWorkFlowManager:
             virtual_object_manager=self.sp_data_analysis.virtual_object_manager,
             data_analysis_obj=self.sp_data_analysis.data_analysis_obj,
             output_dir=self.output_dir, html_dir=self.html_dir, js_output_path_dict=self.js_output_path_dict,
-            date_time_str=self.date_time_str, force_basal_lineage_separation=self.args.force_basal_lineage_separation)
+            date_time_str=self.date_time_str, force_basal_lineage_separation=self.args.force_basal_lineage_separation,
+            sparse_count_tables=self.args.sparse_count_tables)
         self.output_type_count_table_obj.output_types()
+        self.type_output_sorted_sample_uid_list = self.output_type_count_table_obj.sorted_list_of_vdss_uids_to_output
 
     def create_new_data_analysis_obj(self):
         logging.info(f'Creating a new DataAnalysis object: {self.args.name}.')
@@ -720,7 +805,10 @@ class SymPortalWorkFlowManager:
                 distance_method=self.args.distance_method,
                 no_pre_med_seqs=self.args.no_pre_med_seqs, debug=self.args.debug, multiprocess=self.args.multiprocess,
                 start_time=self.start_time, date_time_str=self.date_time_str,
-                is_cron_loading=True,
+                is_cron_loading=True, dedup_blast=not self.args.per_sample_blast,
+                use_classification_cache=self.args.classification_cache,
+                use_med_cache=self.args.med_cache, sparse_count_tables=self.args.sparse_count_tables,
+                unifrac_tree_cache_dir=self.unifrac_tree_cache_dir,
                 study_name=self.args.study_name, study_user_string=self.args.study_user_string)
         else:
             self.data_loading_object = data_loading.DataLoading(
@@ -730,7 +818,10 @@ class SymPortalWorkFlowManager:
                 distance_method=self.args.distance_method,
                 no_pre_med_seqs=self.args.no_pre_med_seqs, debug=self.args.debug, multiprocess=self.args.multiprocess,
                 start_time=self.start_time, date_time_str=self.date_time_str,
-                is_cron_loading=False)
+                is_cron_loading=False, dedup_blast=not self.args.per_sample_blast,
+                use_classification_cache=self.args.classification_cache,
+                use_med_cache=self.args.med_cache, sparse_count_tables=self.args.sparse_count_tables,
+                unifrac_tree_cache_dir=self.unifrac_tree_cache_dir)
 
         self.data_loading_object.load_data()
 
@@ -788,6 +879,9 @@ class SymPortalWorkFlowManager:
         if self.args.print_output_seqs:
             # then we are working with a data set input
             braycurtis_dist_pcoa_creator = distance.SampleBrayCurtisDistPCoACreator(
+                dist_block_size=self.args.distance_block_size,
+                pcoa_method=self.args.pcoa_method, pcoa_dimensions=self.args.pcoa_dimensions,
+                num_processors=self.args.num_proc, multiprocess=self.args.multiprocess,
                 date_time_str=self.date_time_str,
                 data_set_uid_list=[int(_) for _ in self.args.print_output_seqs.split(',')],
                 output_dir=self.output_dir, html_dir=self.html_dir,
@@ -795,6 +889,9 @@ class SymPortalWorkFlowManager:
         elif self.args.print_output_seqs_sample_set:
             # then we are working with a data set sample input
             braycurtis_dist_pcoa_creator = distance.SampleBrayCurtisDistPCoACreator(
+                dist_block_size=self.args.distance_block_size,
+                pcoa_method=self.args.pcoa_method, pcoa_dimensions=self.args.pcoa_dimensions,
+                num_processors=self.args.num_proc, multiprocess=self.args.multiprocess,
                 date_time_str=self.date_time_str,
                 data_set_sample_uid_list=[int(_) for _ in self.args.print_output_seqs_sample_set.split(',')],
                 output_dir=self.output_dir, html_dir=self.html_dir,
@@ -819,6 +916,8 @@ class SymPortalWorkFlowManager:
 
     def _do_unifrac_dist_pcoa(self):
         unifrac_dict_pcoa_creator = distance.SampleUnifracDistPCoACreator(
+            dist_block_size=self.args.distance_block_size, tree_cache_dir=self.unifrac_tree_cache_dir,
+            pcoa_method=self.args.pcoa_method, pcoa_dimensions=self.args.pcoa_dimensions,
             date_time_str=self.date_time_str, output_dir=self.output_dir,
             data_set_uid_list=[int(_) for _ in self.args.print_output_seqs.split(',')],
             num_processors=self.args.num_proc, html_dir=self.html_dir, js_output_path_dict=self.js_output_path_dict)
@@ -856,7 +955,8 @@ class SymPortalWorkFlowManager:
             no_pre_med_seqs=self.args.no_pre_med_seqs,
             ds_uids_output_str=self.args.print_output_seqs,
             num_proc=self.args.num_proc, output_dir=self.output_dir, date_time_str=self.date_time_str,
-            html_dir=self.html_dir, js_output_path_dict=self.js_output_path_dict, multiprocess=self.args.multiprocess)
+            html_dir=self.html_dir, js_output_path_dict=self.js_output_path_dict, multiprocess=self.args.multiprocess,
+            sparse_count_tables=self.args.sparse_count_tables)
         self.output_seq_count_table_obj.make_seq_output_tables()
 
     def _stand_alone_sequence_output_data_set_sample(self):
@@ -865,7 +965,8 @@ class SymPortalWorkFlowManager:
             no_pre_med_seqs=self.args.no_pre_med_seqs,
             dss_uids_output_str=self.args.print_output_seqs_sample_set,
             num_proc=self.args.num_proc, html_dir=self.html_dir, js_output_path_dict=self.js_output_path_dict,
-            output_dir=self.output_dir, date_time_str=self.date_time_str, multiprocess=self.args.multiprocess)
+            output_dir=self.output_dir, date_time_str=self.date_time_str, multiprocess=self.args.multiprocess,
+            sparse_count_tables=self.args.sparse_count_tables)
         self.output_seq_count_table_obj.make_seq_output_tables()
 
     # STAND_ALONE TYPE OUTPUT
@@ -902,20 +1003,23 @@ class SymPortalWorkFlowManager:
             self.symportal_root_directory, 'outputs', 'analyses', str(self.data_analysis_object.id), self.date_time_str)
         self._set_html_dir_and_js_out_path_from_output_dir()
         os.makedirs(self.html_dir, exist_ok=True)
-        if self.args.print_output_types_sample_set:
-            self._stand_alone_type_output_data_set_sample()
-            self._stand_alone_seq_output_from_type_output_data_set_sample()
-        else:
-            self._stand_alone_type_output_data_set()
-            self._stand_alone_seq_output_from_type_output_data_set()
-        if not self.args.no_figures:
-            self.number_of_samples = len(self.output_seq_count_table_obj.sorted_sample_uid_list)
-            self._plot_if_not_too_many_samples(self._plot_sequence_stacked_bar_with_ordered_dss_uids_from_type_output)
-            self._plot_if_not_too_many_samples(self._plot_type_stacked_bar_from_type_output_table)
-        else:
+        # Each of the artefacts of the output is either made or, if --incremental_output was passed and
+        # it was made from the same inputs in the previous output, reused.
+        output_fingerprints = self._plan_stand_alone_type_output()
+        type_output_state = self._run_or_reuse_output_artefact(
+            'type_output', output_fingerprints['type_output'], self._stand_alone_type_output_artefact)
+        self.type_output_sorted_sample_uid_list = type_output_state['sorted_sample_uid_list']
+        self.number_of_samples = len(self.type_output_sorted_sample_uid_list)
+        self._run_or_reuse_output_artefact(
+            'seq_output', output_fingerprints['seq_output'], self._stand_alone_seq_output_artefact)
+        if self.args.no_figures:
             print('\nFigure plotting skipped at user\'s request')
         if not self.args.no_ordinations:
-            self._do_data_analysis_ordinations()
+            self._run_or_reuse_output_artefact(
+                'type_distances', output_fingerprints['type_distances'], self._do_data_analysis_type_ordinations)
+            self._run_or_reuse_output_artefact(
+                'sample_distances', output_fingerprints['sample_distances'],
+                self._do_data_analysis_sample_ordinations)
         self._output_js_output_path_dict()
 
         if sp_config.system_type == 'remote' and self.args.output_study_from_analysis:
@@ -925,6 +1029,124 @@ class SymPortalWorkFlowManager:
                 print(e)
         self._print_all_outputs_complete()
 
+    def _plan_stand_alone_type_output(self):
+        """Return the fingerprints of the inputs of each of the artefacts of the output, and set the manifest
+        of the output. If --incremental_output was passed, also set the manifest of the most recent previous output
+        of the DataAnalysis (of the same Study for --output_study_from_analysis) so that the artefacts whose inputs
+        have not changed can be reused rather than remade."""
+        if self.args.print_output_types_sample_set:
+            dss_uid_list = [int(dss_uid_str) for dss_uid_str in self.args.print_output_types_sample_set.split(',')]
+        else:
+            ds_of_output = self._chunk_query_ds_objs_from_ds_uids(
+                [int(ds_uid_str) for ds_uid_str in self.args.print_output_types.split(',')])
+            dss_uid_list = [dss.id for dss in self._chunk_query_dss_objs_from_ds_uids(ds_of_output)]
+        samples_hash, meta_info_hash = self._get_output_sample_hashes(dss_uid_list)
+        ref_seqs_hash, profiles_hash = self._get_output_name_hashes(dss_uid_list)
+        # The inputs common to all of the artefacts
+        inputs = {'data_analysis_uid': self.data_analysis_object.id, 'samples': samples_hash,
+                  'figures': not self.args.no_figures}
+        # The names of the ReferenceSequences and ITS2 type profiles are written into the tables, plots and
+        # study_data.js, and can change between outputs (e.g. when DIVs are named)
+        output_fingerprints = {
+            'type_output': {
+                **inputs, 'ref_seqs': ref_seqs_hash, 'profiles': profiles_hash,
+                'within_clade_cutoff': self.within_clade_cutoff,
+                'force_basal_lineage_separation': self.args.force_basal_lineage_separation,
+                'sparse_count_tables': self.args.sparse_count_tables},
+            # The sequence count tables hold the meta information of the samples
+            'seq_output': {
+                **inputs, 'ref_seqs': ref_seqs_hash, 'meta_info': meta_info_hash,
+                'no_pre_med_seqs': self.args.no_pre_med_seqs, 'sparse_count_tables': self.args.sparse_count_tables},
+            # The blocked distance computation holds the distances as float32
+            'type_distances': {
+                **inputs, 'profiles': profiles_hash, 'distance_method': self.args.distance_method,
+                'distance_block_size': self.args.distance_block_size, 'pcoa_method': self.args.pcoa_method,
+                'pcoa_dimensions': self.args.pcoa_dimensions, 'local': self.args.local},
+            'sample_distances': {
+                **inputs, 'distance_method': self.args.distance_method,
+                'distance_block_size': self.args.distance_block_size, 'pcoa_method': self.args.pcoa_method,
+                'pcoa_dimensions': self.args.pcoa_dimensions}
+        }
+
+        if sp_config.system_type == 'remote' and self.args.output_study_from_analysis:
+            output_key = f'study_{self.study.id}'
+        else:
+            output_key = 'stand_alone'
+        self.output_manifest = OutputManifest(
+            output_dir=self.output_dir, js_file_path=self.js_file_path, output_key=output_key,
+            date_time_str=self.date_time_str)
+        if self.args.incremental_output:
+            self.previous_output_manifest = OutputManifest.find_previous(
+                outputs_dir=os.path.dirname(self.output_dir), output_key=output_key,
+                exclude_output_dir=self.output_dir)
+            if self.previous_output_manifest is None:
+                print('\nNo previous output to reuse artefacts from. All artefacts will be made.')
+        return output_fingerprints
+
+    def _get_output_sample_hashes(self, dss_uid_list):
+        """Return a hash of the uids and names of the DataSetSamples of the output and a hash of their
+        meta information"""
+        samples = []
+        meta_info = []
+        for uid_list in self.thread_safe_general.chunks(sorted(dss_uid_list)):
+            for dss_values in DataSetSample.objects.filter(id__in=uid_list).order_by('id').values_list(
+                    'id', 'name', *output.SequenceCountTablePivot.user_supplied_stats):
+                samples.append(dss_values[:2])
+                meta_info.append(dss_values)
+        return OutputManifest.hash_of(samples), OutputManifest.hash_of(meta_info)
+
+    def _get_output_name_hashes(self, dss_uid_list):
+        """Return a hash of the uids and names of the ReferenceSequences found in the DataSetSamples of the output
+        (pre- or post-MED) and a hash of the uids and names of the AnalysisTypes of the DataAnalysis found in them"""
+        ref_seq_uid_to_name_dict = {}
+        analysis_type_uid_to_name_dict = {}
+        for uid_list in self.thread_safe_general.chunks(sorted(dss_uid_list)):
+            ref_seq_uid_to_name_dict.update(ReferenceSequence.objects.filter(
+                datasetsamplesequence__data_set_sample_from__id__in=uid_list).values_list('id', 'name'))
+            ref_seq_uid_to_name_dict.update(ReferenceSequence.objects.filter(
+                datasetsamplesequencepm__data_set_sample_from__id__in=uid_list).values_list('id', 'name'))
+            analysis_type_uid_to_name_dict.update(AnalysisType.objects.filter(
+                data_analysis_from=self.data_analysis_object,
+                cladecollectiontype__clade_collection_found_in__data_set_sample_from__id__in=uid_list
+            ).values_list('id', 'name'))
+        return (OutputManifest.hash_of(sorted(ref_seq_uid_to_name_dict.items())),
+                OutputManifest.hash_of(sorted(analysis_type_uid_to_name_dict.items())))
+
+    def _run_or_reuse_output_artefact(self, name, fingerprint, output_function):
+        """If the artefact of the previous output was made from the same inputs, reuse it. Else, make it with
+        output_function. Either way, the artefact is recorded in the output manifest. Return the state of the
+        artefact."""
+        if self.previous_output_manifest is not None:
+            if self.previous_output_manifest.is_fresh(name, fingerprint):
+                print(f'\nReusing the {name} of {self.previous_output_manifest.output_dir} (inputs unchanged)')
+                return self.output_manifest.reuse_artefact(
+                    previous_manifest=self.previous_output_manifest, name=name,
+                    js_output_path_dict=self.js_output_path_dict)
+            print(f'\nMaking the {name} (inputs changed since the previous output)')
+        self.output_manifest.begin_artefact(
+            name=name, fingerprint=fingerprint, js_output_path_dict=self.js_output_path_dict)
+        state = output_function()
+        self.output_manifest.end_artefact(name=name, js_output_path_dict=self.js_output_path_dict, state=state)
+        return state
+
+    def _stand_alone_type_output_artefact(self):
+        if self.args.print_output_types_sample_set:
+            self._stand_alone_type_output_data_set_sample()
+        else:
+            self._stand_alone_type_output_data_set()
+        self.number_of_samples = len(self.type_output_sorted_sample_uid_list)
+        if not self.args.no_figures:
+            self._plot_if_not_too_many_samples(self._plot_type_stacked_bar_from_type_output_table)
+        return {'sorted_sample_uid_list': [int(dss_uid) for dss_uid in self.type_output_sorted_sample_uid_list]}
+
+    def _stand_alone_seq_output_artefact(self):
+        if self.args.print_output_types_sample_set:
+            self._stand_alone_seq_output_from_type_output_data_set_sample()
+        else:
+            self._stand_alone_seq_output_from_type_output_data_set()
+        if not self.args.no_figures:
+            self._plot_if_not_too_many_samples(self._plot_sequence_stacked_bar_with_ordered_dss_uids_from_type_output)
+
     def _output_study_output_info_items(self):
         """
         Produce the study_output_info.json file in the output directory
@@ -965,10 +1187,11 @@ class SymPortalWorkFlowManager:
             no_pre_med_seqs=self.args.no_pre_med_seqs,
             ds_uids_output_str=self.args.print_output_types,
             output_dir=self.output_dir,
-            sorted_sample_uid_list=self.output_type_count_table_obj.sorted_list_of_vdss_uids_to_output,
+            sorted_sample_uid_list=self.type_output_sorted_sample_uid_list,
             analysis_obj=self.data_analysis_object,
             date_time_str=self.date_time_str, html_dir=self.html_dir, js_output_path_dict=self.js_output_path_dict,
-            multiprocess=self.args.multiprocess)
+            multiprocess=self.args.multiprocess,
+            sparse_count_tables=self.args.sparse_count_tables)
         self.output_seq_count_table_obj.make_seq_output_tables()
 
     def _stand_alone_seq_output_from_type_output_data_set_sample(self):
@@ -979,10 +1202,11 @@ class SymPortalWorkFlowManager:
             no_pre_med_seqs=self.args.no_pre_med_seqs,
             dss_uids_output_str=self.args.print_output_types_sample_set,
             output_dir=self.output_dir,
-            sorted_sample_uid_list=self.output_type_count_table_obj.sorted_list_of_vdss_uids_to_output,
+            sorted_sample_uid_list=self.type_output_sorted_sample_uid_list,
             analysis_obj=self.data_analysis_object,
             date_time_str=self.date_time_str, html_dir=self.html_dir, js_output_path_dict=self.js_output_path_dict,
-            multiprocess=self.args.multiprocess)
+            multiprocess=self.args.multiprocess,
+            sparse_count_tables=self.args.sparse_count_tables)
         self.output_seq_count_table_obj.make_seq_output_tables()
 
     def _stand_alone_type_output_data_set(self):
@@ -993,8 +1217,10 @@ class SymPortalWorkFlowManager:
             call_type='stand_alone', date_time_str=self.date_time_str,
             data_set_uids_to_output=set(ds_uid_list), data_analysis_obj=self.data_analysis_object,
             output_dir=self.output_dir, html_dir=self.html_dir, js_output_path_dict=self.js_output_path_dict,
-            force_basal_lineage_separation=self.args.force_basal_lineage_separation)
+            force_basal_lineage_separation=self.args.force_basal_lineage_separation,
+            sparse_count_tables=self.args.sparse_count_tables)
         self.output_type_count_table_obj.output_types()
+        self.type_output_sorted_sample_uid_list = self.output_type_count_table_obj.sorted_list_of_vdss_uids_to_output
 
     def _check_ds_were_part_of_analysis(self, ds_uid_list):
         for ds_uid in ds_uid_list:
@@ -1010,8 +1236,10 @@ class SymPortalWorkFlowManager:
             call_type='stand_alone', output_dir=self.output_dir, html_dir=self.html_dir,
             js_output_path_dict=self.js_output_path_dict, date_time_str=self.date_time_str,
             data_set_sample_uid_set_to_output=set(dss_uid_list), data_analysis_obj=self.data_analysis_object,
-            force_basal_lineage_separation=self.args.force_basal_lineage_separation)
+            force_basal_lineage_separation=self.args.force_basal_lineage_separation,
+            sparse_count_tables=self.args.sparse_count_tables)
         self.output_type_count_table_obj.output_types()
+        self.type_output_sorted_sample_uid_list = self.output_type_count_table_obj.sorted_list_of_vdss_uids_to_output
 
     def _check_dss_were_part_of_analysis(self, dss_uid_list):
         ds_uid_list_for_query = [int(a) for a in self.data_analysis_object.list_of_data_set_uids.split(',')]
@@ -1101,6 +1329,9 @@ class SymPortalWorkFlowManager:
     # BRAYCURTIS between its2 type profile distance methods
     def _start_type_braycurtis_cct_set(self):
         self.braycurtis_distance_object = distance.TypeBrayCurtisDistPCoACreator(
+            dist_block_size=self.args.distance_block_size,
+            pcoa_method=self.args.pcoa_method, pcoa_dimensions=self.args.pcoa_dimensions,
+            num_processors=self.args.num_proc, multiprocess=self.args.multiprocess,
             data_analysis_obj=self.data_analysis_object,
             date_time_str=self.date_time_str,
             cct_set_uid_list=[int(cct_uid_str) for cct_uid_str in self.args.between_type_distances_cct_set.split(',')],
@@ -1111,6 +1342,9 @@ class SymPortalWorkFlowManager:
 
     def _start_type_braycurtis_data_sets(self):
         self.braycurtis_distance_object = distance.TypeBrayCurtisDistPCoACreator(
+            dist_block_size=self.args.distance_block_size,
+            pcoa_method=self.args.pcoa_method, pcoa_dimensions=self.args.pcoa_dimensions,
+            num_processors=self.args.num_proc, multiprocess=self.args.multiprocess,
             data_analysis_obj=self.data_analysis_object,
             date_time_str=self.date_time_str,
             data_set_uid_list=[int(ds_uid_str) for ds_uid_str in self.args.between_type_distances.split(',')],
@@ -1121,6 +1355,9 @@ class SymPortalWorkFlowManager:
 
     def _start_type_braycurtis_data_set_samples(self):
         self.braycurtis_distance_object = distance.TypeBrayCurtisDistPCoACreator(
+            dist_block_size=self.args.distance_block_size,
+            pcoa_method=self.args.pcoa_method, pcoa_dimensions=self.args.pcoa_dimensions,
+            num_processors=self.args.num_proc, multiprocess=self.args.multiprocess,
             data_analysis_obj=self.data_analysis_object,
             date_time_str=self.date_time_str,
             data_set_sample_uid_list=[int(ds_uid_str) for ds_uid_str in
@@ -1133,6 +1370,8 @@ class SymPortalWorkFlowManager:
     # UNIFRAC between its2 type profile distance methods
     def _start_type_unifrac_cct_set(self):
         self.unifrac_distance_object = distance.TypeUnifracDistPCoACreator(
+            dist_block_size=self.args.distance_block_size, tree_cache_dir=self.unifrac_tree_cache_dir,
+            pcoa_method=self.args.pcoa_method, pcoa_dimensions=self.args.pcoa_dimensions,
             data_analysis_obj=self.data_analysis_object,
             date_time_str=self.date_time_str,
             num_processors=self.args.num_proc,
@@ -1146,6 +1385,8 @@ class SymPortalWorkFlowManager:
 
     def _start_type_unifrac_data_sets(self):
         self.unifrac_distance_object = distance.TypeUnifracDistPCoACreator(
+            dist_block_size=self.args.distance_block_size, tree_cache_dir=self.unifrac_tree_cache_dir,
+            pcoa_method=self.args.pcoa_method, pcoa_dimensions=self.args.pcoa_dimensions,
             data_analysis_obj=self.data_analysis_object,
             date_time_str=self.date_time_str,
             num_processors=self.args.num_proc,
@@ -1158,6 +1399,8 @@ class SymPortalWorkFlowManager:
 
     def _start_type_unifrac_data_set_samples(self):
         self.unifrac_distance_object = distance.TypeUnifracDistPCoACreator(
+            dist_block_size=self.args.distance_block_size, tree_cache_dir=self.unifrac_tree_cache_dir,
+            pcoa_method=self.args.pcoa_method, pcoa_dimensions=self.args.pcoa_dimensions,
             data_analysis_obj=self.data_analysis_object,
             date_time_str=self.date_time_str,
             num_processors=self.args.num_proc,
@@ -1217,6 +1460,8 @@ class SymPortalWorkFlowManager:
     def _start_sample_unifrac_data_set_samples(self):
         dss_uid_list = [int(ds_uid_str) for ds_uid_str in self.args.between_sample_distances_sample_set.split(',')]
         self.unifrac_distance_object = distance.SampleUnifracDistPCoACreator(
+            dist_block_size=self.args.distance_block_size, tree_cache_dir=self.unifrac_tree_cache_dir,
+            pcoa_method=self.args.pcoa_method, pcoa_dimensions=self.args.pcoa_dimensions,
             data_set_sample_uid_list=dss_uid_list,
             num_processors=self.args.num_proc,
             output_dir=self.output_dir,
@@ -1226,6 +1471,8 @@ class SymPortalWorkFlowManager:
     def _start_sample_unifrac_data_sets(self):
         ds_uid_list = [int(ds_uid_str) for ds_uid_str in self.args.between_sample_distances.split(',')]
         self.unifrac_distance_object = distance.SampleUnifracDistPCoACreator(
+            dist_block_size=self.args.distance_block_size, tree_cache_dir=self.unifrac_tree_cache_dir,
+            pcoa_method=self.args.pcoa_method, pcoa_dimensions=self.args.pcoa_dimensions,
             data_set_uid_list=ds_uid_list,
             num_processors=self.args.num_proc,
             output_dir=self.output_dir,
@@ -1235,6 +1482,9 @@ class SymPortalWorkFlowManager:
     def _start_sample_braycurtis_data_set_samples(self):
         dss_uid_list = [int(ds_uid_str) for ds_uid_str in self.args.between_sample_distances_sample_set.split(',')]
         self.braycurtis_distance_object = distance.SampleBrayCurtisDistPCoACreator(
+            dist_block_size=self.args.distance_block_size,
+            pcoa_method=self.args.pcoa_method, pcoa_dimensions=self.args.pcoa_dimensions,
+            num_processors=self.args.num_proc, multiprocess=self.args.multiprocess,
             date_time_str=self.date_time_str,
             data_set_sample_uid_list=dss_uid_list,
             output_dir=self.output_dir, html_dir=self.html_dir,
@@ -1244,6 +1494,9 @@ class SymPortalWorkFlowManager:
     def _start_sample_braycurtis_data_sets(self):
         ds_uid_list = [int(ds_uid_str) for ds_uid_str in self.args.between_sample_distances.split(',')]
         self.braycurtis_distance_object = distance.SampleBrayCurtisDistPCoACreator(
+            dist_block_size=self.args.distance_block_size,
+            pcoa_method=self.args.pcoa_method, pcoa_dimensions=self.args.pcoa_dimensions,
+            num_processors=self.args.num_proc, multiprocess=self.args.multiprocess,
             date_time_str=self.date_time_str,
             data_set_uid_list=ds_uid_list,
             output_dir=self.output_dir, html_dir=self.html_dir,
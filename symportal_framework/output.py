@@ -1,18 +1,19 @@
 from dbApp.models import (DataSet, ReferenceSequence, DataSetSampleSequence, AnalysisType, DataSetSample,
                           DataAnalysis, DataSetSampleSequencePM, CladeCollectionType)
-from multiprocessing import Queue as mp_Queue, Process, Manager, Lock as mp_Lock
-from queue import Queue as mt_Queue
-from threading import Thread, Lock as mt_Lock
 import sys
 from django import db
 import os
 import json
 from collections import defaultdict
+from array import array
 import pandas as pd
 import numpy as np
 import sp_config
 import virtual_objects
 from general import ThreadSafeGeneral
+from sparse_count_table import SparseCountTable
+from rect_array import RectArray
+from study_data_chunks import StudyDataChunkWriter
 from exceptions import NoDataSetSampleSequencePMObjects
 
 
@@ -21,8 +22,10 @@ class OutputProfileCountTable:
             self, num_proc, within_clade_cutoff, call_type, output_dir, html_dir, js_output_path_dict, date_time_str,
             force_basal_lineage_separation,
             data_set_uids_to_output=None, data_set_sample_uid_set_to_output=None,
-            data_analysis_obj=None, data_analysis_uid=None, virtual_object_manager=None):
+            data_analysis_obj=None, data_analysis_uid=None, virtual_object_manager=None, sparse_count_tables=False):
         self.force_basal_lineage_separation = force_basal_lineage_separation
+        # If True, the abundances are also output as SparseCountTables (.sparse.npz)
+        self.sparse_count_tables = sparse_count_tables
         self.thread_safe_general = ThreadSafeGeneral()
         self.data_set_uid_set_to_output, self.data_set_sample_uid_set_to_output = self._init_dss_and_ds_uids(
             data_set_sample_uid_set_to_output, data_set_uids_to_output)
@@ -111,6 +114,18 @@ class OutputProfileCountTable:
         self.js_output_path_dict[
             "profile_additional_info_file"] = self.path_to_additional_info_file
 
+        self.path_to_absolute_sparse_count_table_profiles = None
+        self.path_to_relative_sparse_count_table_profiles = None
+        if self.sparse_count_tables:
+            self.path_to_absolute_sparse_count_table_profiles = os.path.join(
+                self.profiles_output_dir, f'{self.data_analysis_obj.id}_'
+                                          f'{self.data_analysis_obj.name}_'
+                                          f'{self.date_time_str}.profiles.absolute.sparse.npz')
+            self.path_to_relative_sparse_count_table_profiles = os.path.join(
+                self.profiles_output_dir, f'{self.data_analysis_obj.id}_'
+                                          f'{self.data_analysis_obj.name}_'
+                                          f'{self.date_time_str}.profiles.relative.sparse.npz')
+
     def _set_vcc_uids_to_output(self):
         list_of_sets_of_vcc_uids_in_vdss = [
             self.virtual_object_manager.vdss_manager.vdss_dict[vdss_uid].set_of_cc_uids for vdss_uid in
@@ -165,6 +180,9 @@ class OutputProfileCountTable:
 
         abund_row_indices = self._write_out_abund_only_dfs_profiles()
 
+        if self.sparse_count_tables:
+            self._write_out_sparse_count_tables_profiles()
+
         prof_meta_only = self._write_out_meta_only_dfs_profiles(abund_row_indices)
 
         self._write_out_js_profiles_data_file(prof_meta_only)
@@ -374,6 +392,23 @@ class OutputProfileCountTable:
         print(self.path_to_relative_count_table_profiles_abund_only)
         return abundance_row_indices
 
+    def _write_out_sparse_count_tables_profiles(self):
+        vats_of_output = self.clade_sorted_list_of_vats_to_output
+        sample_names = [
+            self.virtual_object_manager.vdss_manager.vdss_dict[vdss_uid].name for
+            vdss_uid in self.sorted_list_of_vdss_uids_to_output]
+        for abund_output_df, path, dtype in [
+                (self.abs_abund_output_df, self.path_to_absolute_sparse_count_table_profiles, np.int64),
+                (self.rel_abund_output_df, self.path_to_relative_sparse_count_table_profiles, np.float64)]:
+            SparseCountTable.from_dense(
+                values=abund_output_df.loc[
+                    self.sorted_list_of_vdss_uids_to_output, [vat.id for vat in vats_of_output]].to_numpy(),
+                sample_uids=self.sorted_list_of_vdss_uids_to_output, sample_names=sample_names,
+                column_uids=[vat.id for vat in vats_of_output], column_names=[vat.name for vat in vats_of_output],
+                dtype=dtype).write(path)
+            print(path)
+            self.output_path_list.append(path)
+
     def _write_out_abund_and_meta_dfs_profiles(self):
         # write out the abund_and_meta dfs
         print('\n\nITS2 type profile count tables output to:')
@@ -855,8 +890,10 @@ class SequenceCountTableCreator:
     def __init__(
             self, symportal_root_dir, call_type, num_proc, html_dir, js_output_path_dict, date_time_str,
             no_pre_med_seqs, multiprocess, dss_uids_output_str=None, ds_uids_output_str=None, output_dir=None,
-            sorted_sample_uid_list=None, analysis_obj=None):
+            sorted_sample_uid_list=None, analysis_obj=None, sparse_count_tables=False):
         self.multiprocess = multiprocess
+        # If True, the post-MED abundances are also output as SparseCountTables (.sparse.npz)
+        self.sparse_count_tables = sparse_count_tables
         self.thread_safe_general = ThreadSafeGeneral()
         self._init_core_vars(
             symportal_root_dir, analysis_obj, call_type, dss_uids_output_str, ds_uids_output_str, num_proc,
@@ -960,17 +997,13 @@ class SequenceCountTableCreator:
 
 
     def _init_seq_abundance_collection_objects(self):
-        """Output objects from first worker to be used by second worker"""
-        self.dss_id_to_list_of_dsss_objects_dict_mp_dict = None
-        self.dss_id_to_list_of_abs_and_rel_abund_of_contained_dsss_dicts_mp_dict = None
-        self.dss_id_to_list_of_abs_and_rel_abund_clade_summaries_of_noname_seqs_mp_dict = None
-        # this is the list that we will use the self.annotated_dss_name_to_cummulative_rel_abund_mp_dict to create
+        """The SequenceCountTablePivot of the DataSetSampleSequence abundances that the dataframes are made from"""
+        self.seq_count_table_pivot = None
         # it is a list of the ref_seqs_ordered first by clade then by abundance.
         self.clade_abundance_ordered_ref_seq_list = []
 
     def _init_vars_for_putting_together_the_dfs(self):
         # variables concerned with putting together the dataframes
-        self.dss_id_to_pandas_series_results_list_dict = None
         self.output_df_absolute_post_med = None
         self.output_df_relative_post_med = None
         self.output_df_relative_pre_med = None
@@ -995,6 +1028,14 @@ class SequenceCountTableCreator:
         self.pre_med_absolute_df_path = None
         self.pre_med_relative_df_path = None
         self.pre_med_fasta_out_path = None
+        self.path_to_seq_output_sparse_absolute = None
+        self.path_to_seq_output_sparse_relative = None
+        if self.sparse_count_tables:
+            # next to the abund_only tables, i.e. <base>.seqs.absolute.sparse.npz
+            self.path_to_seq_output_sparse_absolute = self.path_to_seq_output_abund_only_df_absolute.replace(
+                '.abund_only.txt', '.sparse.npz')
+            self.path_to_seq_output_sparse_relative = self.path_to_seq_output_abund_only_df_relative.replace(
+                '.abund_only.txt', '.sparse.npz')
 
     def _set_non_analysis_seq_table_output_paths(self):
         self._set_non_analysis_abs_count_tab_output_paths()
@@ -1108,9 +1149,7 @@ class SequenceCountTableCreator:
         print('\n\nOutputting sequence abundance count tables\n')
         self._collect_abundances_for_creating_the_output()
 
-        self._generate_sample_output_series()
-
-        self._create_ordered_output_dfs_from_series()
+        self._create_ordered_output_dfs()
 
         self._add_uids_for_seqs_to_dfs()
 
@@ -1125,6 +1164,9 @@ class SequenceCountTableCreator:
 
         self._write_out_abund_only_dfs_seqs()
 
+        if self.sparse_count_tables:
+            self._write_out_sparse_count_tables_seqs()
+
         self._write_out_meta_only_dfs_seqs()
 
         self._write_out_seq_fasta_for_loading()
@@ -1166,6 +1208,14 @@ class SequenceCountTableCreator:
         df_rel_abund_only.to_csv(self.path_to_seq_output_abund_only_df_relative, sep="\t", index_label='sample_uid')
         self.output_paths_list.append(self.path_to_seq_output_abund_only_df_relative)
 
+    def _write_out_sparse_count_tables_seqs(self):
+        # made directly from the cells of the SequenceCountTablePivot rather than from the dataframes
+        for relative, path in [
+                (False, self.path_to_seq_output_sparse_absolute), (True, self.path_to_seq_output_sparse_relative)]:
+            self.seq_count_table_pivot.make_sparse_count_table(
+                self.sorted_sample_uid_list, relative=relative).write(path)
+            self.output_paths_list.append(path)
+
     def _write_out_abund_and_meta_dfs_seqs(self):
         self.output_df_absolute_post_med.to_csv(self.path_to_seq_output_abund_and_meta_df_absolute, sep="\t", index_label='sample_uid')
         self.output_paths_list.append(self.path_to_seq_output_abund_and_meta_df_absolute)
@@ -1288,13 +1338,12 @@ class SequenceCountTableCreator:
 
     def _make_post_med_rect_array(self, index_of_first_seq):
         # now we need to create the rectangle array
-        post_med_rect_dict = {sample_uid: [] for sample_uid in self.df_abs_no_meta_rows.index.values.tolist()}
         # The sequences in the output df are ordered by clade and then abundance. We need to provide the
         # y_abs and y_rel properties of the rect objects in order of the most abundant sequences first.
         # We want this order to be independent of clade so we need to do a sorting.
-        abundance_dict = {}
-        for col in list(self.df_abs_no_meta_rows)[index_of_first_seq:]:
-            abundance_dict[col] = sum(self.df_abs_no_meta_rows[col])
+        seq_names = list(self.df_abs_no_meta_rows)[index_of_first_seq:]
+        abs_abunds = self.df_abs_no_meta_rows.iloc[:, index_of_first_seq:].to_numpy(dtype=np.int64)
+        abundance_dict = dict(zip(seq_names, abs_abunds.sum(axis=0).tolist()))
         # get the names of the sequences sorted according to their totalled abundance
         sorted_sorted_seq_names = list(abundance_dict.items())
         sorted_sorted_seq_names.sort(key=lambda x: x[0], reverse=True)
@@ -1308,45 +1357,23 @@ class SequenceCountTableCreator:
         with open(os.path.join(self.html_dir, 'color_dict_post_med.json'), 'w') as f:
             json.dump(fp=f, obj=seq_colour_dict)
 
-        max_cumulative_abs = self._populate_post_med_rect_dict(post_med_rect_dict, sorted_seq_names)
-        # now we have the dictionary that holds the rectangle arrays populated
-        # and we have the maximum abundance
-        # now write these out as js file and functions to return.
+        # The rectangle arrays are made from the abundances with the columns in the sorted order
+        # and written straight out to size bounded chunk files. study_data.js gets the index of the chunks.
+        seq_name_to_col_dict = {seq_name: col for col, seq_name in enumerate(seq_names)}
+        sorted_cols = [seq_name_to_col_dict[seq_name] for seq_name in sorted_seq_names]
+        rel_abunds = self.df_rel_no_meta_rows.iloc[:, index_of_first_seq:].to_numpy(dtype=np.float64)
+        rect_array = RectArray(
+            abs_abunds=abs_abunds[:, sorted_cols], rel_abunds=rel_abunds[:, sorted_cols],
+            sample_uids=self.df_abs_no_meta_rows.index.values.tolist(), seq_names=sorted_seq_names)
+        chunk_writer = StudyDataChunkWriter(html_dir=self.html_dir, function_name='getRectDataPostMEDBySample')
+        chunk_index = rect_array.write_out_chunks(chunk_writer)
         js_file_path = os.path.join(self.html_dir, 'study_data.js')
         self.thread_safe_general.write_out_js_file_to_return_python_objs_as_js_objs(
-            [{'function_name': 'getRectDataPostMEDBySample', 'python_obj': post_med_rect_dict},
-             {'function_name': 'getRectDataPostMEDBySampleMaxSeq', 'python_obj': max_cumulative_abs},
+            [{'function_name': chunk_writer.index_function_name, 'python_obj': chunk_index},
+             {'function_name': 'getRectDataPostMEDBySampleMaxSeq', 'python_obj': rect_array.max_cumulative_abs},
              {'function_name': 'getSeqColorPostMED', 'python_obj': seq_colour_dict}],
             js_outpath=js_file_path)
 
-    def _populate_post_med_rect_dict(self, post_med_rect_dict, sorted_seq_names):
-        max_cumulative_abs = 0
-        for sample_uid in self.df_abs_no_meta_rows.index:
-            new_rect_list = []
-            abs_series = self.df_abs_no_meta_rows.loc[sample_uid]
-            rel_series = self.df_rel_no_meta_rows.loc[sample_uid]
-            cumulative_count_abs = 0
-            cumulative_count_rel = 0
-
-            for seq in sorted_seq_names:
-                seq_abund_abs = abs_series.at[seq]
-                seq_abund_rel = rel_series.at[seq]
-                if seq_abund_abs:
-                    cumulative_count_abs += int(seq_abund_abs)
-                    cumulative_count_rel += float(seq_abund_rel)
-                    new_rect_list.append({
-                        "seq_name": seq,
-                        "y_abs": cumulative_count_abs,
-                        "y_rel": f'{cumulative_count_rel:.3f}',
-                        "height_rel": f'{float(seq_abund_rel):.3f}',
-                        "height_abs": int(seq_abund_abs),
-                    })
-
-            post_med_rect_dict[sample_uid] = new_rect_list
-            if cumulative_count_abs > max_cumulative_abs:
-                max_cumulative_abs = cumulative_count_abs
-        return max_cumulative_abs
-
     def _populate_sample_meta_info_dict(self):
         # first lets produce the meta information.
         # dictionary of where the sample UID is the key to a second dictionary that contains the other properties
@@ -1520,8 +1547,8 @@ class SequenceCountTableCreator:
         reference_sequences_in_data_sets_no_name = list(reference_sequences_in_data_sets_no_name_set)
         return reference_sequences_in_data_sets_no_name
 
-    def _create_ordered_output_dfs_from_series(self):
-        """Put together the pandas series that hold sequences abundance outputs for each sample in order of the samples
+    def _create_ordered_output_dfs(self):
+        """Put together the dataframes that hold sequences abundance outputs in order of the samples
         either according to a predefined ordered list or by an order that will be generated below.
         For the javascript outputs we want to capture these sample orders. Ideally it would be good
         to have both the profile-based order and the similarity order. If a sorted_sample_uid_list
@@ -1533,13 +1560,13 @@ class SequenceCountTableCreator:
             self.profile_based_sample_ordered_uids = self.sorted_sample_uid_list
             # even though we have the profile order of samples, still calculate the similarity order
             self.similarity_based_sample_ordered_uids = self._generate_ordered_sample_list()
-            self._create_ordered_output_dfs_from_series_with_sorted_sample_list()
+            self._create_ordered_output_dfs_with_sorted_sample_list()
 
         else:
             sys.stdout.write('\nGenerating ordered sample list and ordering dataframe accordingly\n')
             self.sorted_sample_uid_list = self._generate_ordered_sample_list()
             self.similarity_based_sample_ordered_uids = self.sorted_sample_uid_list
-            self._create_ordered_output_dfs_from_series_with_sorted_sample_list()
+            self._create_ordered_output_dfs_with_sorted_sample_list()
 
     def _generate_ordered_sample_list(self):
         """ Returns a list which is simply the ids of the samples ordered
@@ -1552,27 +1579,10 @@ class SequenceCountTableCreator:
         honestly I think we could perhaps get rid of this and just use the over all abundance of the sequences
         discounting clade. This is what we do for the clade order when plotting.
         """
-        output_df_relative = self._make_raw_relative_abund_df_from_series()
-        ordered_sample_list = self._get_sample_order_from_rel_seq_abund_df(output_df_relative)
-        return ordered_sample_list
-
-    def _make_raw_relative_abund_df_from_series(self):
-        output_df_relative = pd.concat(
-            [list_of_series[1] for list_of_series in self.dss_id_to_pandas_series_results_list_dict.values()],
-            axis=1)
-        output_df_relative = output_df_relative.T
-        # now remove the rest of the non abundance columns
-        cols_to_drop = [col for col in list(output_df_relative) if col not in self.clade_abundance_ordered_ref_seq_list]
-        output_df_relative.drop(columns=cols_to_drop, inplace=True)
-        return output_df_relative
-
-    def _get_sample_order_from_rel_seq_abund_df(self, sequence_only_df_relative):
-
-        max_seq_ddict, no_maj_samps, seq_to_samp_ddict = self._generate_most_abundant_sequence_dictionaries(
-            sequence_only_df_relative)
-
-        return self._generate_ordered_sample_list_from_most_abund_seq_dicts(max_seq_ddict, no_maj_samps,
-                                                                            seq_to_samp_ddict)
+        max_seq_ddict, no_maj_samps, seq_to_samp_ddict = \
+            self.seq_count_table_pivot.get_most_abundant_sequence_dictionaries()
+        return self._generate_ordered_sample_list_from_most_abund_seq_dicts(
+            max_seq_ddict, no_maj_samps, seq_to_samp_ddict)
 
     @staticmethod
     def _generate_ordered_sample_list_from_most_abund_seq_dicts(max_seq_ddict, no_maj_samps, seq_to_samp_ddict):
@@ -1611,59 +1621,9 @@ class SequenceCountTableCreator:
         ordered_sample_list_by_uid.extend(no_maj_samps)
         return ordered_sample_list_by_uid
 
-    def _generate_most_abundant_sequence_dictionaries(self, sequence_only_df_relative):
-        # {sequence_name_found_to_be_most_abund_in_sample: num_samples_it_was_found_to_be_most_abund_in}
-        max_seq_ddict = defaultdict(int)
-        # {most_abundant_seq_name: [(dss.id, rel_abund_of_most_abund_seq) for samples with that seq as most abund]}
-        seq_to_samp_ddict = defaultdict(list)
-        # a list to hold the names of samples in which there was no most abundant sequence identified
-        no_maj_samps = []
-        for sample_to_sort_uid in sequence_only_df_relative.index.values.tolist():
-            sys.stdout.write(f'\r{sample_to_sort_uid}: Getting maj seq for sample')
-            sample_series_as_float = self._get_sample_seq_abund_info_as_pd_series_float_type(
-                sample_to_sort_uid, sequence_only_df_relative)
-            max_rel_abund = self._get_rel_abund_of_most_abund_seq(sample_series_as_float)
-            if not max_rel_abund > 0:
-                no_maj_samps.append(sample_to_sort_uid)
-            else:
-                max_abund_seq = self._get_name_of_most_abundant_seq(sample_series_as_float)
-                # add a tup of sample name and rel abund of seq to the seq_to_samp_dict
-                seq_to_samp_ddict[max_abund_seq].append((sample_to_sort_uid, max_rel_abund))
-                # add this to the ddict count
-                max_seq_ddict[max_abund_seq] += 1
-        return max_seq_ddict, no_maj_samps, seq_to_samp_ddict
-
-    @staticmethod
-    def _get_sample_seq_abund_info_as_pd_series_float_type(sample_to_sort_uid, sequence_only_df_relative):
-        return sequence_only_df_relative.loc[sample_to_sort_uid].astype('float')
-
-    @staticmethod
-    def _get_rel_abund_of_most_abund_seq(sample_series_as_float):
-        return sample_series_as_float.max()
-
-    @staticmethod
-    def _get_name_of_most_abundant_seq(sample_series_as_float):
-        max_abund_seq = sample_series_as_float.idxmax()
-        return max_abund_seq
-
-    def _create_ordered_output_dfs_from_series_with_sorted_sample_list(self):
-        # NB I was originally performing the concat directly on the managedSampleOutputDict (i.e. the mp dict)
-        # but this was starting to produce errors. Starting to work on the dss_id_to_pandas_series_results_list_dict
-        #  (i.e. normal, not mp, dict) seems to not produce these errors.
-        sys.stdout.write('\rPopulating the absolute dataframe with series. This could take a while...')
-        output_df_absolute = pd.concat(
-            [list_of_series[0] for list_of_series in
-             self.dss_id_to_pandas_series_results_list_dict.values()], axis=1)
-        sys.stdout.write('\rPopulating the relative dataframe with series. This could take a while...')
-        output_df_relative = pd.concat(
-            [list_of_series[1] for list_of_series in
-             self.dss_id_to_pandas_series_results_list_dict.values()], axis=1)
-        # now transpose
-        output_df_absolute = output_df_absolute.T
-        output_df_relative = output_df_relative.T
-        # now make sure that the order is correct.
-        self.output_df_absolute_post_med = output_df_absolute.reindex(self.sorted_sample_uid_list)
-        self.output_df_relative_post_med = output_df_relative.reindex(self.sorted_sample_uid_list)
+    def _create_ordered_output_dfs_with_sorted_sample_list(self):
+        self.output_df_absolute_post_med, self.output_df_relative_post_med = \
+            self.seq_count_table_pivot.make_output_dfs(self.sorted_sample_uid_list)
 
     def _check_sorted_sample_list_is_valid(self):
         if len(self.sorted_sample_uid_list) != len(self.list_of_dss_objects):
@@ -1676,38 +1636,12 @@ class SequenceCountTableCreator:
         return list(
             set(self.sorted_sample_uid_list).difference(set([dss.id for dss in self.list_of_dss_objects])))
 
-    def _generate_sample_output_series(self):
-        """This generate a pandas series for each of the samples. It uses the ordered ReferenceSequence list created
-         in the previous method as well as the other two dictionaries made.
-         One df for absolute abundances and one for relative abundances. These series will be put together
-         and ordered to construct the output data frames that will be written out for the user.
-         These dataframes contain the sequence abundances and all of the sample meta information.
-        """
-        seq_count_table_output_series_generator_handler = SeqOutputSeriesGeneratorHandler(parent=self)
-        seq_count_table_output_series_generator_handler.execute_sequence_count_table_dataframe_contructor_handler()
-        self.dss_id_to_pandas_series_results_list_dict = \
-            dict(seq_count_table_output_series_generator_handler.dss_id_to_pandas_series_results_list_mp_dict)
-
     def _collect_abundances_for_creating_the_output(self):
-        seq_collection_handler = SequenceCountTableCollectAbundanceHandler(parent_seq_count_tab_creator=self)
-        seq_collection_handler.execute_sequence_count_table_ordered_seqs_worker()
-        # update the dictionaries that will be used in the second worker from the first worker
-        self.update_dicts_for_the_second_worker_from_first_worker(seq_collection_handler)
-
-    def update_dicts_for_the_second_worker_from_first_worker(self, seq_collection_handler):
-        self.dss_id_to_list_of_dsss_objects_dict_mp_dict = \
-            seq_collection_handler.dss_id_to_list_of_dsss_objects_mp_dict
-
-        self.dss_id_to_list_of_abs_and_rel_abund_of_contained_dsss_dicts_mp_dict = \
-            seq_collection_handler.\
-                dss_id_to_list_of_abs_and_rel_abund_of_contained_dsss_dicts_mp_dict
-
-        self.dss_id_to_list_of_abs_and_rel_abund_clade_summaries_of_noname_seqs_mp_dict = \
-            seq_collection_handler.\
-                dss_id_to_list_of_abs_and_rel_abund_clade_summaries_of_noname_seqs_mp_dict
-
-        self.clade_abundance_ordered_ref_seq_list = \
-            seq_collection_handler.clade_abundance_ordered_ref_seq_list
+        self.seq_count_table_pivot = SequenceCountTablePivot(
+            list_of_dss_objects=self.list_of_dss_objects, ref_seqs_in_datasets=self.ref_seqs_in_datasets,
+            ordered_list_of_clades_found=self.ordered_list_of_clades_found, ds_objs_to_output=self.ds_objs_to_output)
+        self.clade_abundance_ordered_ref_seq_list = self.seq_count_table_pivot.clade_abundance_ordered_ref_seq_list
+        self.number_of_meta_cols_added = self.seq_count_table_pivot.get_number_of_meta_cols()
 
     class PreMedSeqOutput:
         def __init__(self, parent):
@@ -1775,10 +1709,6 @@ class SequenceCountTableCreator:
 
         def _make_pre_med_rect_array(self):
             # now we need to create the rectangle array
-            pre_med_rect_dict = {sample_uid: [] for sample_uid in
-                                  self.abs_count_df.index.values.tolist()}
-
-
             # get the names of the sequences sorted according to their totalled abundance
             # NB these are already sorted purely by abundance in the premed df
             sorted_seq_names = list(self.abs_count_df)[1:]
@@ -1792,54 +1722,22 @@ class SequenceCountTableCreator:
             # merge the two colour dictionaries and add to the html output
             combi_color_dict = {**c_dict_post_med, **seq_colour_dict}
 
-            max_cumulative_abs = self._populate_pre_med_rect_dict(
-                pre_med_rect_dict, seq_colour_dict, sorted_seq_names)
-            # now we have the dictionary that holds the rectangle arrays populated
-            # and we have the maximum abundance
-            # now write these out as js file and functions to return.
+            # The rectangle arrays are made directly from the abundances (the columns are already in the sorted
+            # order) and written straight out to size bounded chunk files. study_data.js gets the index of the chunks.
+            # As the chunks are only fetched on demand, the pre-MED rectangles no longer bloat study_data.js.
+            rect_array = RectArray(
+                abs_abunds=self.abs_count_df.iloc[:, 1:].to_numpy(dtype=np.int64),
+                rel_abunds=self.rel_count_df.iloc[:, 1:].to_numpy(dtype=np.float64),
+                sample_uids=self.abs_count_df.index.values.tolist(), seq_names=sorted_seq_names)
+            chunk_writer = StudyDataChunkWriter(html_dir=self.html_dir, function_name='getRectDataPreMEDBySample')
+            chunk_index = rect_array.write_out_chunks(chunk_writer)
             js_file_path = os.path.join(self.html_dir, 'study_data.js')
-            # For the time being we are going to no longer output the pre_med_rect_dict data
-            # as it very slow to render online using d3 and takes up a huge amount of space.
-            # However, if we want to reimpleent its output in the future we can simply uncomment the below
-            # general.write_out_js_file_to_return_python_objs_as_js_objs(
-            #     [{'function_name': 'getRectDataPreMEDBySample', 'python_obj': pre_med_rect_dict},
-            #      {'function_name': 'getRectDataPreMEDBySampleMaxSeq', 'python_obj': max_cumulative_abs},
-            #      {'function_name': 'getSeqColor', 'python_obj': combi_color_dict}],
-            #     js_outpath=js_file_path)
             self.parent.thread_safe_general.write_out_js_file_to_return_python_objs_as_js_objs(
-                [{'function_name': 'getRectDataPreMEDBySampleMaxSeq', 'python_obj': max_cumulative_abs},
+                [{'function_name': chunk_writer.index_function_name, 'python_obj': chunk_index},
+                 {'function_name': 'getRectDataPreMEDBySampleMaxSeq', 'python_obj': rect_array.max_cumulative_abs},
                  {'function_name': 'getSeqColor', 'python_obj': combi_color_dict}],
                 js_outpath=js_file_path)
 
-        def _populate_pre_med_rect_dict(self, post_med_rect_dict, seq_colour_dict,
-                                         sorted_seq_names):
-            max_cumulative_abs = 0
-            for sample_uid in self.abs_count_df.index:
-                new_rect_list = []
-                abs_series = self.abs_count_df.loc[sample_uid]
-                rel_series = self.rel_count_df.loc[sample_uid]
-                cumulative_count_abs = 0
-                cumulative_count_rel = 0
-
-                for seq in sorted_seq_names:
-                    seq_abund_abs = abs_series.at[seq]
-                    seq_abund_rel = rel_series.at[seq]
-                    if seq_abund_abs:
-                        cumulative_count_abs += int(seq_abund_abs)
-                        cumulative_count_rel += float(seq_abund_rel)
-                        new_rect_list.append({
-                            "seq_name": seq,
-                            "y_abs": cumulative_count_abs,
-                            "y_rel": f'{cumulative_count_rel:.3f}',
-                            "height_rel": f'{float(seq_abund_rel):.3f}',
-                            "height_abs": int(seq_abund_abs),
-                        })
-
-                post_med_rect_dict[sample_uid] = new_rect_list
-                if cumulative_count_abs > max_cumulative_abs:
-                    max_cumulative_abs = cumulative_count_abs
-            return max_cumulative_abs
-
         def _output_pre_med_master_fasta(self):
 
             fasta_out = []
@@ -1925,626 +1823,297 @@ class SequenceCountTableCreator:
             print('\nPre-MED sequence counting complete')
 
 
-class SequenceCountTableCollectAbundanceHandler:
-    """The purpose of this handler and the associated worker is to populate three dictionaries that will be used
-    in making the count table output.
-    1 - dict(ref_seq_name : cumulative relative abundance for each sequence across all samples)
-    2 - sample_id : list(
-                         dict(ref_seq_of_sample_name:absolute_abundance_of_dsss_in_sample),
-                         dict(ref_seq_of_sample_name:relative_abundance_of_dsss_in_sample)
-                         )
-    3 - sample_id : list(
-                         dict(clade:total_abund_of_no_name_seqs_of_clade_in_q_),
-                         dict(clade:relative_abund_of_no_name_seqs_of_clade_in_q_)
-                         )
+class SequenceCountTablePivot:
+    """The abundance information of the post-MED sequence count tables as a sparse sample x sequence matrix.
+
+    The DataSetSampleSequences of all of the DataSetSamples of the output are collected with a single (chunked)
+    values_list query of (data_set_sample_from, reference_sequence_of, abundance) rather than as
+    DataSetSampleSequence objects per sample. The rows are held as numpy arrays and pivoted into the cells
+    (unique sample, sequence pairs) of the matrix in coordinate (COO) form. From these, with numpy rather than
+    per sample workers, dicts and pandas Series, we compute:
+    1 - the cumulative relative abundance of each sequence across all samples, and from this the names of the
+        sequences ordered first by clade and then by cumulative relative abundance
+        (clade_abundance_ordered_ref_seq_list)
+    2 - the absolute and relative abundances of the sequences in each sample
+    3 - the absolute and relative abundances of the no name sequences of each clade in each sample
+    The absolute and relative count table dataframes are then made in one go (make_output_dfs).
+    The values in the dataframes are the same python objects as when they were built from a pandas Series per
+    sample (e.g. an int 0 in the relative table for a sequence that was not found in a sample) so that the
+    tables are written out unchanged.
+
     Abbreviations:
     ds = DataSet
     dss = DataSetSample
     dsss = DataSetSampleSequence
     ref_seq = ReferenceSeqeunce
-    The end product of this method will be returned to the count table creator. The first dict will be used to create a
-    list of the ReferenceSequence objects of this output ordered first by clade and then by cumulative relative
-    abundance across all samples in the output.
     """
-    def __init__(self, parent_seq_count_tab_creator):
-        self.seq_count_table_creator = parent_seq_count_tab_creator
-        if self.seq_count_table_creator.multiprocess:
-            self.mp_manager = Manager()
-            self.input_dss_mp_queue = mp_Queue()
-            self._populate_input_dss_mp_queue()
-            self.ref_seq_names_clade_annotated = [
-                ref_seq.name if ref_seq.has_name else str(ref_seq) for
-                ref_seq in self.seq_count_table_creator.ref_seqs_in_datasets]
-            self.dss_id_to_list_of_dsss_objects_mp_dict = self.mp_manager.dict()
-            self._populate_dss_id_to_list_of_dsss_objects()
-            self.annotated_dss_name_to_cummulative_rel_abund_mp_dict = self.mp_manager.dict(
-            {refSeq_name: 0 for refSeq_name in self.ref_seq_names_clade_annotated})
-            self.lock = mp_Lock()
-            self.dss_id_to_list_of_abs_and_rel_abund_of_contained_dsss_dicts_mp_dict = self.mp_manager.dict()
-            self.dss_id_to_list_of_abs_and_rel_abund_clade_summaries_of_noname_seqs_mp_dict = self.mp_manager.dict()
-        else:
-            self.input_dss_mp_queue = mt_Queue()
-            self._populate_input_dss_mp_queue()
-            self.ref_seq_names_clade_annotated = [
-                ref_seq.name if ref_seq.has_name else str(ref_seq) for
-                ref_seq in self.seq_count_table_creator.ref_seqs_in_datasets]
-            self.dss_id_to_list_of_dsss_objects_mp_dict = {}
-            self._populate_dss_id_to_list_of_dsss_objects()
-            self.annotated_dss_name_to_cummulative_rel_abund_mp_dict = {refSeq_name: 0 for refSeq_name in self.ref_seq_names_clade_annotated}
-            self.lock = mt_Lock()
-            self.dss_id_to_list_of_abs_and_rel_abund_of_contained_dsss_dicts_mp_dict = {}
-            self.dss_id_to_list_of_abs_and_rel_abund_clade_summaries_of_noname_seqs_mp_dict = {}
-
-        # this is the list that we will use the self.annotated_dss_name_to_cummulative_rel_abund_mp_dict to create
-        # it is a list of the ref_seqs_ordered first by clade then by abundance.
-        self.clade_abundance_ordered_ref_seq_list = []
-
-    def execute_sequence_count_table_ordered_seqs_worker(self):
-        all_processes = []
-        
-        # close all connections to the db so that they are automatically recreated for each process
-        # http://stackoverflow.com/questions/8242837/django-multiprocessing-and-database-connections
-        db.connections.close_all()
-        for n in range(self.seq_count_table_creator.num_proc):
-            if self.seq_count_table_creator.multiprocess:
-                p = Process(target=self._sequence_count_table_ordered_seqs_worker, args=(
-                    self.input_dss_mp_queue, 
-                    self.dss_id_to_list_of_dsss_objects_mp_dict, 
-                    self.dss_id_to_list_of_abs_and_rel_abund_of_contained_dsss_dicts_mp_dict, 
-                    self.dss_id_to_list_of_abs_and_rel_abund_clade_summaries_of_noname_seqs_mp_dict,
-                    self.annotated_dss_name_to_cummulative_rel_abund_mp_dict, self.ref_seq_names_clade_annotated, self.lock))
-            else:
-                p = Thread(target=self._sequence_count_table_ordered_seqs_worker, args=(
-                    self.input_dss_mp_queue, 
-                    self.dss_id_to_list_of_dsss_objects_mp_dict, 
-                    self.dss_id_to_list_of_abs_and_rel_abund_of_contained_dsss_dicts_mp_dict, 
-                    self.dss_id_to_list_of_abs_and_rel_abund_clade_summaries_of_noname_seqs_mp_dict,
-                    self.annotated_dss_name_to_cummulative_rel_abund_mp_dict, self.ref_seq_names_clade_annotated, self.lock))
-            all_processes.append(p)
-            p.start()
-
-        for p in all_processes:
-            p.join()
-
-        self._generate_clade_abundance_ordered_ref_seq_list_from_seq_name_abund_dict()
-
-    @staticmethod
-    def _sequence_count_table_ordered_seqs_worker(
-        in_q, 
-        dss_id_to_list_of_dsss_objects_mp_dict, 
-        dss_id_to_list_of_abs_and_rel_abund_of_contained_dsss_dicts_mp_dict, 
-        dss_id_to_list_of_abs_and_rel_abund_clade_summaries_of_noname_seqs_mp_dict, 
-        annotated_dss_name_to_cummulative_rel_abund_mp_dict, ref_seq_names_clade_annotated, lock):
-        for dss in iter(in_q.get, 'STOP'):
-            sys.stdout.write(f'\r{dss.name}: collecting seq abundances')
-            sequence_count_table_ordered_seqs_worker_instance = SequenceCountTableCollectAbundanceWorker(
-                dss_id_to_list_of_dsss_objects_mp_dict=dss_id_to_list_of_dsss_objects_mp_dict,
-                dss_id_to_list_of_abs_and_rel_abund_of_contained_dsss_dicts_mp_dict=dss_id_to_list_of_abs_and_rel_abund_of_contained_dsss_dicts_mp_dict,
-                dss_id_to_list_of_abs_and_rel_abund_clade_summaries_of_noname_seqs_mp_dict=dss_id_to_list_of_abs_and_rel_abund_clade_summaries_of_noname_seqs_mp_dict,
-                annotated_dss_name_to_cummulative_rel_abund_mp_dict=annotated_dss_name_to_cummulative_rel_abund_mp_dict, 
-                ref_seq_names_clade_annotated=ref_seq_names_clade_annotated,
-                dss=dss, lock=lock)
-            sequence_count_table_ordered_seqs_worker_instance.start_seq_abund_collection()
-    
-    def _generate_clade_abundance_ordered_ref_seq_list_from_seq_name_abund_dict(self):
-        for i in range(len(self.seq_count_table_creator.ordered_list_of_clades_found)):
-            temp_within_clade_list_for_sorting = []
-            for seq_name, abund_val in self.annotated_dss_name_to_cummulative_rel_abund_mp_dict.items():
-                if seq_name.startswith(
-                        self.seq_count_table_creator.ordered_list_of_clades_found[i]) or seq_name[-2:] == \
-                        f'_{self.seq_count_table_creator.ordered_list_of_clades_found[i]}':
-                    # then this is a seq of the clade in Q and we should add to the temp list
-                    temp_within_clade_list_for_sorting.append((seq_name, abund_val))
-            # now sort the temp_within_clade_list_for_sorting and add to the cladeAbundanceOrderedRefSeqList
+    qc_stats = [
+        'raw_contigs', 'post_qc_absolute_seqs', 'post_qc_unique_seqs', 'post_taxa_id_absolute_symbiodiniaceae_seqs',
+        'post_taxa_id_unique_symbiodiniaceae_seqs', 'size_screening_violation_absolute',
+        'size_screening_violation_unique',
+        'post_taxa_id_absolute_non_symbiodiniaceae_seqs', 'post_taxa_id_unique_non_symbiodiniaceae_seqs',
+        'post_med_absolute',
+        'post_med_unique']
+    # The DataSetSample attributes of each of the qc_stats
+    qc_stat_attributes = [
+        'num_contigs', 'post_qc_absolute_num_seqs', 'post_qc_unique_num_seqs', 'absolute_num_sym_seqs',
+        'unique_num_sym_seqs', 'size_violation_absolute', 'size_violation_unique', 'non_sym_absolute_num_seqs',
+        'non_sym_unique_num_seqs', 'post_med_absolute', 'post_med_unique']
+    user_supplied_stats = [
+        'sample_type', 'host_phylum', 'host_class', 'host_order', 'host_family', 'host_genus', 'host_species',
+        'collection_latitude', 'collection_longitude', 'collection_date', 'collection_depth']
+
+    def __init__(self, list_of_dss_objects, ref_seqs_in_datasets, ordered_list_of_clades_found, ds_objs_to_output):
+        self.clade_list = list('ABCDEFGHI')
+        self.list_of_dss_objects = list_of_dss_objects
+        self.dss_uid_to_row_dict = {dss.id: row for row, dss in enumerate(self.list_of_dss_objects)}
+        self.ds_uid_to_ds_obj_dict = {ds.id: ds for ds in ds_objs_to_output}
+        self.num_samples = len(self.list_of_dss_objects)
+
+        # Per sample (row)
+        self.sample_seq_totals = np.array(
+            [sum([int(a) for a in json.loads(dss.cladal_seq_totals)]) for dss in self.list_of_dss_objects],
+            dtype=np.int64)
+        # Samples that had a problem in processing are output with 0s for their abundances
+        self.failed_sample_mask = np.array(
+            [bool(dss.error_in_processing) for dss in self.list_of_dss_objects], dtype=bool) | \
+            (self.sample_seq_totals == 0)
+
+        # Per sequence (column)
+        self.ref_seq_names_clade_annotated = [
+            ref_seq.name if ref_seq.has_name else str(ref_seq) for ref_seq in ref_seqs_in_datasets]
+        self.ref_seq_uid_to_col_dict = {ref_seq.id: col for col, ref_seq in enumerate(ref_seqs_in_datasets)}
+        self.col_ref_seq_uids = np.array([ref_seq.id for ref_seq in ref_seqs_in_datasets], dtype=np.int64)
+        self.num_seqs = len(ref_seqs_in_datasets)
+        self.col_has_name = np.array([ref_seq.has_name for ref_seq in ref_seqs_in_datasets], dtype=bool)
+        self.col_clade_indices = np.array(
+            [self.clade_list.index(ref_seq.clade) for ref_seq in ref_seqs_in_datasets], dtype=np.int64)
+        self.cumulative_rel_abunds = np.zeros(self.num_seqs, dtype=np.float64)
+
+        # The cells of the matrix in row major order
+        self.cell_rows = None
+        self.cell_cols = None
+        self.cell_abs_abunds = None
+        self.cell_rel_abunds = None
+
+        # The no name sequence summaries (sample x clade)
+        self.noname_clade_summary_abs_abunds = np.zeros((self.num_samples, len(self.clade_list)), dtype=np.int64)
+        self.noname_clade_summary_rel_abunds = np.zeros((self.num_samples, len(self.clade_list)), dtype=np.float64)
+        self.noname_clade_summary_num_seqs = np.zeros((self.num_samples, len(self.clade_list)), dtype=np.int64)
+
+        rows, cols, abundances = self._get_dsss_coordinates_from_db()
+        self._pivot(rows, cols, abundances)
+
+        # The names of the sequences ordered first by clade then by cumulative relative abundance,
+        # and the position in this list (i.e. the column of the count table) of each column of the matrix
+        self.clade_abundance_ordered_ref_seq_list = self._make_clade_abundance_ordered_ref_seq_list(
+            ordered_list_of_clades_found)
+        ref_seq_name_to_col_dict = {name: col for col, name in enumerate(self.ref_seq_names_clade_annotated)}
+        self.ordered_cols = np.array(
+            [ref_seq_name_to_col_dict[name] for name in self.clade_abundance_ordered_ref_seq_list], dtype=np.int64)
+        self.col_output_positions = np.full(self.num_seqs, -1, dtype=np.int64)
+        self.col_output_positions[self.ordered_cols] = np.arange(len(self.ordered_cols))
+
+    def _get_dsss_coordinates_from_db(self):
+        """Stream the (data_set_sample_from, reference_sequence_of, abundance) of the DataSetSampleSequences of
+        the output into the row, column and abundance arrays of the matrix"""
+        rows = array('q')
+        cols = array('q')
+        abundances = array('q')
+        for uid_list in ThreadSafeGeneral.chunks(self.dss_uid_to_row_dict.keys()):
+            sys.stdout.write(f'\rCollecting seq abundances: {len(rows)} DataSetSampleSequences')
+            for dss_uid, ref_seq_uid, abundance in DataSetSampleSequence.objects.filter(
+                    data_set_sample_from__in=uid_list).order_by('id').values_list(
+                    'data_set_sample_from', 'reference_sequence_of', 'abundance').iterator():
+                rows.append(self.dss_uid_to_row_dict[dss_uid])
+                cols.append(self.ref_seq_uid_to_col_dict[ref_seq_uid])
+                abundances.append(abundance)
+        sys.stdout.write(f'\rCollecting seq abundances: {len(rows)} DataSetSampleSequences\n')
+        return (
+            np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64), np.array(abundances, dtype=np.int64))
+
+    def _pivot(self, rows, cols, abundances):
+        """Sum the abundances of the DataSetSampleSequences into the cells of the matrix, the cumulative relative
+        abundances of the sequences and the no name clade summaries of the samples.
+        np.add.at accumulates in the order of the DataSetSampleSequences so that the sums are those that
+        were previously made sample by sample."""
+        totals = self.sample_seq_totals[rows]
+        rel_abundances = np.zeros(len(abundances), dtype=np.float64)
+        np.divide(abundances, totals, out=rel_abundances, where=totals > 0)
+
+        np.add.at(self.cumulative_rel_abunds, cols, rel_abundances)
+
+        num_cols = max(self.num_seqs, 1)
+        cell_linear_indices, cell_of_dsss = np.unique(rows * num_cols + cols, return_inverse=True)
+        self.cell_rows = cell_linear_indices // num_cols
+        self.cell_cols = cell_linear_indices % num_cols
+        self.cell_abs_abunds = np.zeros(len(cell_linear_indices), dtype=np.int64)
+        np.add.at(self.cell_abs_abunds, cell_of_dsss, abundances)
+        self.cell_rel_abunds = np.zeros(len(cell_linear_indices), dtype=np.float64)
+        np.add.at(self.cell_rel_abunds, cell_of_dsss, rel_abundances)
+
+        noname_mask = ~self.col_has_name[cols]
+        noname_coordinates = (rows[noname_mask], self.col_clade_indices[cols[noname_mask]])
+        np.add.at(self.noname_clade_summary_abs_abunds, noname_coordinates, abundances[noname_mask])
+        np.add.at(self.noname_clade_summary_rel_abunds, noname_coordinates, rel_abundances[noname_mask])
+        np.add.at(self.noname_clade_summary_num_seqs, noname_coordinates, 1)
+
+    def _make_clade_abundance_ordered_ref_seq_list(self, ordered_list_of_clades_found):
+        clade_abundance_ordered_ref_seq_list = []
+        seq_name_abund_tups = list(zip(self.ref_seq_names_clade_annotated, self.cumulative_rel_abunds.tolist()))
+        for clade in ordered_list_of_clades_found:
+            temp_within_clade_list_for_sorting = [
+                (seq_name, abund_val) for seq_name, abund_val in seq_name_abund_tups if
+                seq_name.startswith(clade) or seq_name[-2:] == f'_{clade}']
             # We want this sort order to be constant. To enusre this we should sort by both cummulative rel abund
             # and then by the seq name
-            # https://docs.python.org/3/howto/sorting.html
-            # The python8 docs say to sort by secondary parameter first then the primary parameter
             temp_within_clade_list_for_sorting.sort(key=lambda x: x[0], reverse=True)
             temp_within_clade_list_for_sorting.sort(key=lambda x: x[1], reverse=True)
-            sorted_within_clade = [a[0] for a in temp_within_clade_list_for_sorting]
-            self.clade_abundance_ordered_ref_seq_list.extend(sorted_within_clade)
-
-    def _populate_input_dss_mp_queue(self):
-        for dss in self.seq_count_table_creator.list_of_dss_objects:
-            self.input_dss_mp_queue.put(dss)
-
-        for N in range(self.seq_count_table_creator.num_proc):
-            self.input_dss_mp_queue.put('STOP')
-
-    def _populate_dss_id_to_list_of_dsss_objects(self):
-        for dss in self.seq_count_table_creator.list_of_dss_objects:
-            sys.stdout.write(f'\r{dss.name}')
-            self.dss_id_to_list_of_dsss_objects_mp_dict[dss.id] = list(
-                DataSetSampleSequence.objects.filter(data_set_sample_from=dss))
-
-
-class SequenceCountTableCollectAbundanceWorker:
-    def __init__(
-        self,
-        dss_id_to_list_of_dsss_objects_mp_dict, 
-        dss_id_to_list_of_abs_and_rel_abund_of_contained_dsss_dicts_mp_dict, 
-        dss_id_to_list_of_abs_and_rel_abund_clade_summaries_of_noname_seqs_mp_dict, 
-        annotated_dss_name_to_cummulative_rel_abund_mp_dict, ref_seq_names_clade_annotated,
-        dss, lock):
-        self.dss_id_to_list_of_dsss_objects_mp_dict = dss_id_to_list_of_dsss_objects_mp_dict
-        self.dss_id_to_list_of_abs_and_rel_abund_of_contained_dsss_dicts_mp_dict = dss_id_to_list_of_abs_and_rel_abund_of_contained_dsss_dicts_mp_dict
-        self.dss_id_to_list_of_abs_and_rel_abund_clade_summaries_of_noname_seqs_mp_dict = dss_id_to_list_of_abs_and_rel_abund_clade_summaries_of_noname_seqs_mp_dict
-        self.annotated_dss_name_to_cummulative_rel_abund_mp_dict = annotated_dss_name_to_cummulative_rel_abund_mp_dict
-        self.ref_seq_names_clade_annotated = ref_seq_names_clade_annotated
-        self.dss = dss
-        self.total_abundance_of_sequences_in_sample = sum([int(a) for a in json.loads(self.dss.cladal_seq_totals)])
-        self.lock = lock
-
-    def start_seq_abund_collection(self):
-        clade_summary_absolute_dict, clade_summary_relative_dict = \
-            self._generate_empty_noname_seq_abund_summary_by_clade_dicts()
-
-        smple_seq_count_aboslute_dict, smple_seq_count_relative_dict = self._generate_empty_seq_name_to_abund_dicts()
-
-        dsss_in_sample = self.dss_id_to_list_of_dsss_objects_mp_dict[self.dss.id]
-
-        for dsss in dsss_in_sample:
-            # determine what the name of the seq will be in the output
-            name_unit = self._determine_output_name_of_dsss_and_pop_noname_clade_dicts(
-                clade_summary_absolute_dict, clade_summary_relative_dict, dsss)
-
-            self._populate_abs_and_rel_abundances_for_dsss(dsss, name_unit, smple_seq_count_aboslute_dict,
-                                                           smple_seq_count_relative_dict)
-
-        self._associate_sample_abundances_to_mp_dicts(
-            clade_summary_absolute_dict,
-            clade_summary_relative_dict,
-            smple_seq_count_aboslute_dict,
-            smple_seq_count_relative_dict)
-
-    def _associate_sample_abundances_to_mp_dicts(self, clade_summary_absolute_dict, clade_summary_relative_dict,
-                                                 smple_seq_count_aboslute_dict, smple_seq_count_relative_dict):
-        with self.lock:
-            self.dss_id_to_list_of_abs_and_rel_abund_of_contained_dsss_dicts_mp_dict[self.dss.id] = [smple_seq_count_aboslute_dict,
-                                                                                                            smple_seq_count_relative_dict]
-            self.dss_id_to_list_of_abs_and_rel_abund_clade_summaries_of_noname_seqs_mp_dict[self.dss.id] = [
-                clade_summary_absolute_dict, clade_summary_relative_dict]
-
-    def _populate_abs_and_rel_abundances_for_dsss(self, dsss, name_unit, smple_seq_count_aboslute_dict,
-                                                  smple_seq_count_relative_dict):
-        rel_abund_of_dsss = dsss.abundance / self.total_abundance_of_sequences_in_sample
-        with self.lock:
-            self.annotated_dss_name_to_cummulative_rel_abund_mp_dict[name_unit] += rel_abund_of_dsss
-        smple_seq_count_aboslute_dict[name_unit] += dsss.abundance
-        smple_seq_count_relative_dict[name_unit] += rel_abund_of_dsss
-
-    def _determine_output_name_of_dsss_and_pop_noname_clade_dicts(
-            self, clade_summary_absolute_dict, clade_summary_relative_dict, dsss):
-        if not dsss.reference_sequence_of.has_name:
-            name_unit = str(dsss.reference_sequence_of.id) + f'_{dsss.reference_sequence_of.clade}'
-            # the clade summries are only for the noName seqs
-            clade_summary_absolute_dict[dsss.reference_sequence_of.clade] += dsss.abundance
-            clade_summary_relative_dict[
-                dsss.reference_sequence_of.clade] += dsss.abundance / self.total_abundance_of_sequences_in_sample
-        else:
-            name_unit = str(dsss.reference_sequence_of)
-        return name_unit
-
-    def _generate_empty_seq_name_to_abund_dicts(self):
-        smple_seq_count_aboslute_dict = {seq_name: 0 for seq_name in self.ref_seq_names_clade_annotated}
-        smple_seq_count_relative_dict = {seq_name: 0 for seq_name in self.ref_seq_names_clade_annotated}
-        return smple_seq_count_aboslute_dict, smple_seq_count_relative_dict
-
-    @staticmethod
-    def _generate_empty_noname_seq_abund_summary_by_clade_dicts():
-        clade_summary_absolute_dict = {clade: 0 for clade in list('ABCDEFGHI')}
-        clade_summary_relative_dict = {clade: 0 for clade in list('ABCDEFGHI')}
-        return clade_summary_absolute_dict, clade_summary_relative_dict
-
-
-class SeqOutputSeriesGeneratorHandler:
-    def __init__(self, parent):
-        self.seq_count_table_creator = parent
-        self.output_df_header = self._create_output_df_header()
-        if self.seq_count_table_creator.multiprocess:
-            self.worker_manager = Manager()
-            # dss.id : [pandas_series_for_absolute_abundace, pandas_series_for_absolute_abundace]
-            self.dss_id_to_pandas_series_results_list_mp_dict = self.worker_manager.dict()
-            self.dss_input_queue = mp_Queue()
-            self._populate_dss_input_queue()
-            self.lock = mp_Lock()
-        else:
-            # dss.id : [pandas_series_for_absolute_abundace, pandas_series_for_absolute_abundace]
-            self.dss_id_to_pandas_series_results_list_mp_dict = {}
-            self.dss_input_queue = mt_Queue()
-            self._populate_dss_input_queue()
-            self.lock = mt_Lock()
-
-    def execute_sequence_count_table_dataframe_contructor_handler(self):
-        all_processes = []
-        # close all connections to the db so that they are automatically recreated for each process
-        # http://stackoverflow.com/questions/8242837/django-multiprocessing-and-database-connections
-        db.connections.close_all()
+            clade_abundance_ordered_ref_seq_list.extend([a[0] for a in temp_within_clade_list_for_sorting])
+        return clade_abundance_ordered_ref_seq_list
+
+    def _get_output_cell_mask(self):
+        """The cells that appear in the count tables, i.e. those of successful samples
+        and of sequences in the clade_abundance_ordered_ref_seq_list"""
+        return (~self.failed_sample_mask[self.cell_rows]) & (self.col_output_positions[self.cell_cols] >= 0)
+
+    def get_most_abundant_sequence_dictionaries(self):
+        """Return the dictionaries used to order the samples by their most abundant sequence.
+        max_seq_ddict: {sequence_name_found_to_be_most_abund_in_sample: num_samples_it_was_found_to_be_most_abund_in}
+        seq_to_samp_ddict: {most_abundant_seq_name: [(dss.id, rel_abund_of_most_abund_seq) for samples with that
+        seq as most abund]}
+        no_maj_samps: the uids of the samples in which there was no most abundant sequence identified
+        On ties, the most abundant sequence of a sample is the first in the clade_abundance_ordered_ref_seq_list.
+        """
+        output_cell_mask = self._get_output_cell_mask()
+        rows = self.cell_rows[output_cell_mask]
+        positions = self.col_output_positions[self.cell_cols[output_cell_mask]]
+        rel_abunds = self.cell_rel_abunds[output_cell_mask]
+        # sort by sample, then by relative abundance (descending) then by position in the table so that the first
+        # cell of each sample is that of its most abundant sequence
+        order = np.lexsort((positions, -rel_abunds, rows))
+        rows, positions, rel_abunds = rows[order], positions[order], rel_abunds[order]
+        _, first_cell_indices = np.unique(rows, return_index=True)
+        row_to_max_position_and_rel_abund_dict = dict(zip(
+            rows[first_cell_indices].tolist(),
+            zip(positions[first_cell_indices].tolist(), rel_abunds[first_cell_indices].tolist())))
 
-        sys.stdout.write('\n\nOutputting seq data\n')
-        for n in range(self.seq_count_table_creator.num_proc):
-            if self.seq_count_table_creator.multiprocess:
-                p = Process(target=self._output_df_contructor_worker, args=(
-                    self.dss_input_queue,
-                    self.seq_count_table_creator.dss_id_to_list_of_abs_and_rel_abund_clade_summaries_of_noname_seqs_mp_dict,
-                    self.seq_count_table_creator.dss_id_to_list_of_abs_and_rel_abund_of_contained_dsss_dicts_mp_dict,
-                    self.seq_count_table_creator.clade_abundance_ordered_ref_seq_list,
-                    self.dss_id_to_pandas_series_results_list_mp_dict,
-                    self.output_df_header, self.lock))
+        max_seq_ddict = defaultdict(int)
+        seq_to_samp_ddict = defaultdict(list)
+        no_maj_samps = []
+        for row, dss in enumerate(self.list_of_dss_objects):
+            max_position, max_rel_abund = row_to_max_position_and_rel_abund_dict.get(row, (None, 0))
+            if not max_rel_abund > 0:
+                no_maj_samps.append(dss.id)
             else:
-                p = Thread(target=self._output_df_contructor_worker, args=(
-                self.dss_input_queue,
-                self.seq_count_table_creator.dss_id_to_list_of_abs_and_rel_abund_clade_summaries_of_noname_seqs_mp_dict,
-                self.seq_count_table_creator.dss_id_to_list_of_abs_and_rel_abund_of_contained_dsss_dicts_mp_dict,
-                self.seq_count_table_creator.clade_abundance_ordered_ref_seq_list,
-                self.dss_id_to_pandas_series_results_list_mp_dict,
-                self.output_df_header, self.lock))
-            all_processes.append(p)
-            p.start()
-
-        for p in all_processes:
-            p.join()
-
-    @staticmethod
-    def _output_df_contructor_worker(
-        in_q, 
-        dss_id_to_list_of_abs_and_rel_abund_clade_summaries_of_noname_seqs_mp_dict,
-        dss_id_to_list_of_abs_and_rel_abund_of_contained_dsss_dicts_mp_dict,
-        clade_abundance_ordered_ref_seq_list,
-        dss_id_to_pandas_series_results_list_mp_dict,
-        output_df_header, lock):
-        for dss in iter(in_q.get, 'STOP'):
-            seq_output_series_generator_worker = SeqOutputSeriesGeneratorWorker(
-                dss=dss,
-                list_of_abs_and_rel_abund_clade_summaries_of_noname_seqs=dss_id_to_list_of_abs_and_rel_abund_clade_summaries_of_noname_seqs_mp_dict[dss.id],
-                list_of_abs_and_rel_abund_of_contained_dsss_dicts=dss_id_to_list_of_abs_and_rel_abund_of_contained_dsss_dicts_mp_dict[dss.id],
-                clade_abundance_ordered_ref_seq_list=clade_abundance_ordered_ref_seq_list,
-                dss_id_to_pandas_series_results_list_mp_dict=dss_id_to_pandas_series_results_list_mp_dict,
-                output_df_header=output_df_header, lock=lock)
-            seq_output_series_generator_worker.make_series()
-
-    def _populate_dss_input_queue(self):
-        for dss in self.seq_count_table_creator.list_of_dss_objects:
-            self.dss_input_queue.put(dss)
-
-        for N in range(self.seq_count_table_creator.num_proc):
-            self.dss_input_queue.put('STOP')
-
-    def _create_output_df_header(self):
-        header_pre = self.seq_count_table_creator.clade_abundance_ordered_ref_seq_list
-        no_name_summary_strings = ['noName Clade {}'.format(cl) for cl in ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I']]
-        qc_stats = [
-            'raw_contigs', 'post_qc_absolute_seqs', 'post_qc_unique_seqs', 'post_taxa_id_absolute_symbiodiniaceae_seqs',
-            'post_taxa_id_unique_symbiodiniaceae_seqs', 'size_screening_violation_absolute',
-            'size_screening_violation_unique',
-            'post_taxa_id_absolute_non_symbiodiniaceae_seqs', 'post_taxa_id_unique_non_symbiodiniaceae_seqs',
-            'post_med_absolute',
-            'post_med_unique']
-        user_supplied_stats = [
-            'sample_type', 'host_phylum', 'host_class', 'host_order', 'host_family', 'host_genus', 'host_species',
-            'collection_latitude', 'collection_longitude', 'collection_date', 'collection_depth']
+                max_abund_seq = self.clade_abundance_ordered_ref_seq_list[max_position]
+                seq_to_samp_ddict[max_abund_seq].append((dss.id, max_rel_abund))
+                max_seq_ddict[max_abund_seq] += 1
+        return max_seq_ddict, no_maj_samps, seq_to_samp_ddict
 
-        # we add the plus one to take account of the 'sample_name' header
-        self.seq_count_table_creator.number_of_meta_cols_added = \
-            len(qc_stats) + len(no_name_summary_strings) + len(user_supplied_stats) + 1
+    def get_output_df_header(self):
+        no_name_summary_strings = [f'noName Clade {clade}' for clade in self.clade_list]
         return ['sample_name', 'fastq_fwd_file_name', 'fastq_fwd_sha256_file_hash', 'fastq_rev_file_name',
-                'fastq_rev_sha256_file_hash', 'data_set_uid', 'data_set_name'] + qc_stats + no_name_summary_strings + user_supplied_stats + header_pre
+                'fastq_rev_sha256_file_hash', 'data_set_uid', 'data_set_name'] + self.qc_stats + \
+            no_name_summary_strings + self.user_supplied_stats + self.clade_abundance_ordered_ref_seq_list
 
+    def get_number_of_meta_cols(self):
+        # we add the plus one to take account of the 'sample_name' header
+        return len(self.qc_stats) + len(self.clade_list) + len(self.user_supplied_stats) + 1
+
+    def make_output_dfs(self, sorted_sample_uid_list):
+        """Return the absolute and the relative abundance dataframes (sample meta information and sequence
+        abundances) with the samples in the order of sorted_sample_uid_list"""
+        sys.stdout.write('\rPopulating the absolute and relative dataframes\n')
+        output_rows = np.array(
+            [self.dss_uid_to_row_dict[dss_uid] for dss_uid in sorted_sample_uid_list], dtype=np.int64)
+        row_output_indices = np.full(self.num_samples, -1, dtype=np.int64)
+        row_output_indices[output_rows] = np.arange(len(output_rows))
+
+        meta_rows_absolute = []
+        meta_rows_relative = []
+        for row in output_rows.tolist():
+            meta_row_absolute, meta_row_relative = self._make_sample_meta_rows(row)
+            meta_rows_absolute.append(meta_row_absolute)
+            meta_rows_relative.append(meta_row_relative)
+
+        # Object arrays of python int 0s, populated with the (python) abundances of the cells
+        num_output_seqs = len(self.clade_abundance_ordered_ref_seq_list)
+        seq_abunds_absolute = np.zeros((len(output_rows), num_output_seqs), dtype=object)
+        seq_abunds_relative = np.zeros((len(output_rows), num_output_seqs), dtype=object)
+        output_cell_mask = self._get_output_cell_mask() & (row_output_indices[self.cell_rows] >= 0)
+        output_cell_coordinates = (
+            row_output_indices[self.cell_rows[output_cell_mask]],
+            self.col_output_positions[self.cell_cols[output_cell_mask]])
+        seq_abunds_absolute[output_cell_coordinates] = self.cell_abs_abunds[output_cell_mask]
+        seq_abunds_relative[output_cell_coordinates] = self.cell_rel_abunds[output_cell_mask]
+
+        output_df_header = self.get_output_df_header()
+        output_df_absolute = pd.DataFrame(
+            self._hstack_meta_and_seq_abunds(meta_rows_absolute, seq_abunds_absolute),
+            index=list(sorted_sample_uid_list), columns=output_df_header)
+        output_df_relative = pd.DataFrame(
+            self._hstack_meta_and_seq_abunds(meta_rows_relative, seq_abunds_relative),
+            index=list(sorted_sample_uid_list), columns=output_df_header)
+        return output_df_absolute, output_df_relative
+
+    def make_sparse_count_table(self, sorted_sample_uid_list, relative=False):
+        """Return the absolute or relative sequence abundances (as in the count tables) as a SparseCountTable
+        with the samples in the order of sorted_sample_uid_list and the sequences in the order of
+        clade_abundance_ordered_ref_seq_list"""
+        output_rows = np.array(
+            [self.dss_uid_to_row_dict[dss_uid] for dss_uid in sorted_sample_uid_list], dtype=np.int64)
+        row_output_indices = np.full(self.num_samples, -1, dtype=np.int64)
+        row_output_indices[output_rows] = np.arange(len(output_rows))
+        output_cell_mask = self._get_output_cell_mask() & (row_output_indices[self.cell_rows] >= 0)
+        return SparseCountTable.from_coordinates(
+            rows=row_output_indices[self.cell_rows[output_cell_mask]],
+            cols=self.col_output_positions[self.cell_cols[output_cell_mask]],
+            values=self.cell_rel_abunds[output_cell_mask] if relative else self.cell_abs_abunds[output_cell_mask],
+            sample_uids=sorted_sample_uid_list,
+            sample_names=[self.list_of_dss_objects[row].name for row in output_rows.tolist()],
+            column_uids=self.col_ref_seq_uids[self.ordered_cols],
+            column_names=self.clade_abundance_ordered_ref_seq_list,
+            dtype=np.float64 if relative else np.int64)
 
-class SeqOutputSeriesGeneratorWorker:
-    def __init__(
-            self, dss, list_of_abs_and_rel_abund_clade_summaries_of_noname_seqs,
-            list_of_abs_and_rel_abund_of_contained_dsss_dicts,
-            dss_id_to_pandas_series_results_list_mp_dict,
-            clade_abundance_ordered_ref_seq_list, output_df_header, lock
-    ):
-
-        self.dss = dss
-        # dss.id : [{dsss:absolute abundance in dss}, {dsss:relative abundance in dss}]
-        # dss.id : [{clade:total absolute abundance of no name seqs from that clade},
-        #           {clade:total relative abundance of no name seqs from that clade}
-        #          ]
-        self.list_of_abs_and_rel_abund_clade_summaries_of_noname_seqs = list_of_abs_and_rel_abund_clade_summaries_of_noname_seqs
-        self.list_of_abs_and_rel_abund_of_contained_dsss_dicts = list_of_abs_and_rel_abund_of_contained_dsss_dicts
-        self.dss_id_to_pandas_series_results_list_mp_dict = dss_id_to_pandas_series_results_list_mp_dict
-        self.clade_abundance_ordered_ref_seq_list = clade_abundance_ordered_ref_seq_list
-        self.output_df_header = output_df_header
-        self.sample_row_data_absolute = []
-        self.sample_row_data_relative = []
-        self.sample_seq_tot = sum([int(a) for a in json.loads(dss.cladal_seq_totals)])
-        self.lock = lock
-
-    def make_series(self):
-        sys.stdout.write(f'\r{self.dss.name}: Creating data ouput row')
-        ds = self.dss.data_submission_from
-        self.sample_row_data_absolute.append(self.dss.name)
-        self.sample_row_data_absolute.append(self.dss.fastq_fwd_file_name)
-        self.sample_row_data_absolute.append(self.dss.fastq_fwd_file_hash)
-        self.sample_row_data_absolute.append(self.dss.fastq_rev_file_name)
-        self.sample_row_data_absolute.append(self.dss.fastq_rev_file_hash)
-        self.sample_row_data_absolute.append(ds.id)
-        self.sample_row_data_absolute.append(ds.name)
-
-        self.sample_row_data_relative.append(self.dss.name)
-        self.sample_row_data_relative.append(self.dss.fastq_fwd_file_name)
-        self.sample_row_data_relative.append(self.dss.fastq_fwd_file_hash)
-        self.sample_row_data_relative.append(self.dss.fastq_rev_file_name)
-        self.sample_row_data_relative.append(self.dss.fastq_rev_file_hash)
-        self.sample_row_data_relative.append(ds.id)
-        self.sample_row_data_relative.append(ds.name)
-
-        if self._dss_had_problem_in_processing():
-
-            self._populate_quality_control_data_of_failed_sample()
-
-            self._output_the_failed_sample_pandas_series()
-            return
-
-        self._populate_quality_control_data_of_successful_sample()
-
-        self._output_the_successful_sample_pandas_series()
-
-    def _output_the_successful_sample_pandas_series(self):
-        sample_series_absolute = pd.Series(self.sample_row_data_absolute, index=self.output_df_header, name=self.dss.id)
-        sample_series_relative = pd.Series(self.sample_row_data_relative, index=self.output_df_header, name=self.dss.id)
-        with self.lock:
-            self.dss_id_to_pandas_series_results_list_mp_dict[self.dss.id] = [
-                sample_series_absolute, sample_series_relative]
-
-    def _populate_quality_control_data_of_successful_sample(self):
-        self._populate_qc_meta_successful_sample()
-
-        self._populate_no_name_seq_clade_summaries_successful_sample()
-
-        self._populate_user_supplied_meta()
-
-        self._populate_seq_abunds_successful_sample()
-
-    def _populate_seq_abunds_successful_sample(self):
-        # and append these abundances in order of cladeAbundanceOrderedRefSeqList to
-        # the sampleRowDataCounts and the sampleRowDataProps
-        for seq_name in self.clade_abundance_ordered_ref_seq_list:
-            sys.stdout.write('\rOutputting seq data for {}: sequence {}'.format(self.dss.name, seq_name))
-            self.sample_row_data_absolute.append(
-                self.list_of_abs_and_rel_abund_of_contained_dsss_dicts[0][seq_name])
-            self.sample_row_data_relative.append(
-                self.list_of_abs_and_rel_abund_of_contained_dsss_dicts[1][seq_name])
-
-    def _populate_no_name_seq_clade_summaries_successful_sample(self):
-        # now add the clade divided summaries of the clades
-        for clade in list('ABCDEFGHI'):
-            
-            self.sample_row_data_absolute.append(
-                self.list_of_abs_and_rel_abund_clade_summaries_of_noname_seqs[0][clade])
-            self.sample_row_data_relative.append(
-                self.list_of_abs_and_rel_abund_clade_summaries_of_noname_seqs[1][clade])
-
-    def _populate_qc_meta_successful_sample(self):
-        # Here we add in the post qc and post-taxa id counts
-        # For the absolute counts we will report the absolute seq number
-        # For the relative counts we will report these as proportions of the sampleSeqTot.
-        # I.e. we will have numbers larger than 1 for many of the values and the symbiodiniaceae seqs should be 1
-
-        # CONTIGS
-        # This is the absolute number of sequences after make.contigs
-        contig_num = self.dss.num_contigs
-        self.sample_row_data_absolute.append(contig_num)
-        self.sample_row_data_relative.append(contig_num / self.sample_seq_tot)
-        # POST-QC
-        # store the aboslute number of sequences after sequencing QC at this stage
-        post_qc_absolute = self.dss.post_qc_absolute_num_seqs
-        self.sample_row_data_absolute.append(post_qc_absolute)
-        self.sample_row_data_relative.append(post_qc_absolute / self.sample_seq_tot)
-        # This is the unique number of sequences after the sequencing QC
-        post_qc_unique = self.dss.post_qc_unique_num_seqs
-        self.sample_row_data_absolute.append(post_qc_unique)
-        self.sample_row_data_relative.append(post_qc_unique / self.sample_seq_tot)
-        # POST TAXA-ID
-        # Absolute number of sequences after sequencing QC and screening for Symbiodinium (i.e. Symbiodinium only)
-        tax_id_symbiodiniaceae_absolute = self.dss.absolute_num_sym_seqs
-        self.sample_row_data_absolute.append(tax_id_symbiodiniaceae_absolute)
-        self.sample_row_data_relative.append(tax_id_symbiodiniaceae_absolute / self.sample_seq_tot)
-        # Same as above but the number of unique seqs
-        tax_id_symbiodiniaceae_unique = self.dss.unique_num_sym_seqs
-        self.sample_row_data_absolute.append(tax_id_symbiodiniaceae_unique)
-        self.sample_row_data_relative.append(tax_id_symbiodiniaceae_unique / self.sample_seq_tot)
-        # store the absolute number of sequences lost to size cutoff violations
-        size_violation_aboslute = self.dss.size_violation_absolute
-        self.sample_row_data_absolute.append(size_violation_aboslute)
-        self.sample_row_data_relative.append(size_violation_aboslute / self.sample_seq_tot)
-        # store the unique size cutoff violations
-        size_violation_unique = self.dss.size_violation_unique
-        self.sample_row_data_absolute.append(size_violation_unique)
-        self.sample_row_data_relative.append(size_violation_unique / self.sample_seq_tot)
-        # store the abosolute number of sequenes that were not considered Symbiodinium
-        tax_id_non_symbiodinum_abosulte = self.dss.non_sym_absolute_num_seqs
-        self.sample_row_data_absolute.append(tax_id_non_symbiodinum_abosulte)
-        self.sample_row_data_relative.append(tax_id_non_symbiodinum_abosulte / self.sample_seq_tot)
-        # This is the number of unique sequences that were not considered Symbiodinium
-        tax_id_non_symbiodiniaceae_unique = self.dss.non_sym_unique_num_seqs
-        self.sample_row_data_absolute.append(tax_id_non_symbiodiniaceae_unique)
-        self.sample_row_data_relative.append(tax_id_non_symbiodiniaceae_unique / self.sample_seq_tot)
-        # Post MED absolute
-        post_med_absolute = self.dss.post_med_absolute
-        self.sample_row_data_absolute.append(post_med_absolute)
-        self.sample_row_data_relative.append(post_med_absolute / self.sample_seq_tot)
-        # Post MED unique
-        post_med_unique = self.dss.post_med_unique
-        self.sample_row_data_absolute.append(post_med_unique)
-        self.sample_row_data_relative.append(post_med_unique / self.sample_seq_tot)
-
-    def _output_the_failed_sample_pandas_series(self):
-        sample_series_absolute = pd.Series(self.sample_row_data_absolute, index=self.output_df_header, name=self.dss.id)
-        sample_series_relative = pd.Series(self.sample_row_data_relative, index=self.output_df_header, name=self.dss.id)
-        with self.lock:
-            self.dss_id_to_pandas_series_results_list_mp_dict[self.dss.id] = [sample_series_absolute,
-                                                                                    sample_series_relative]
-
-    def _populate_quality_control_data_of_failed_sample(self):
-        # Add in the qc totals if possible
-        # For the proportions we will have to add zeros as we cannot do proportions
-
-        self._populate_qc_meta_failed_sample()
-
-        self._populate_no_name_seq_clade_summaries_failed_sample()
-
-        self._populate_user_supplied_meta()
-
-        self._populate_seq_abunds_failed_sample()
-
-    def _populate_seq_abunds_failed_sample(self):
-        # All sequences get 0s
-        for _ in self.clade_abundance_ordered_ref_seq_list:
-            self.sample_row_data_absolute.append(0)
-            self.sample_row_data_relative.append(0)
-
-    def _populate_user_supplied_meta(self):
-        # insert the user supplied meta stats
-        # sample_type
-        self.sample_row_data_absolute.append(self.dss.sample_type)
-        self.sample_row_data_relative.append(self.dss.sample_type)
-
-        # host_phylum
-        self.sample_row_data_absolute.append(self.dss.host_phylum)
-        self.sample_row_data_relative.append(self.dss.host_phylum)
-
-        # host_class
-        self.sample_row_data_absolute.append(self.dss.host_class)
-        self.sample_row_data_relative.append(self.dss.host_class)
-
-        # host_order
-        self.sample_row_data_absolute.append(self.dss.host_order)
-        self.sample_row_data_relative.append(self.dss.host_order)
-
-        # host_family
-        self.sample_row_data_absolute.append(self.dss.host_family)
-        self.sample_row_data_relative.append(self.dss.host_family)
-
-        # host_genus
-        self.sample_row_data_absolute.append(self.dss.host_genus)
-        self.sample_row_data_relative.append(self.dss.host_genus)
-
-        # host_species
-        self.sample_row_data_absolute.append(self.dss.host_species)
-        self.sample_row_data_relative.append(self.dss.host_species)
-
-        # collection_latitude
-        self.sample_row_data_absolute.append(self.dss.collection_latitude)
-        self.sample_row_data_relative.append(self.dss.collection_latitude)
-
-        # collection_longitude
-        self.sample_row_data_absolute.append(self.dss.collection_longitude)
-        self.sample_row_data_relative.append(self.dss.collection_longitude)
-
-        # collection_date
-        self.sample_row_data_absolute.append(self.dss.collection_date)
-        self.sample_row_data_relative.append(self.dss.collection_date)
-
-        # collection_depth
-        self.sample_row_data_absolute.append(self.dss.collection_depth)
-        self.sample_row_data_relative.append(self.dss.collection_depth)
-
-
-    def _populate_no_name_seq_clade_summaries_failed_sample(self):
-        # no name clade summaries get 0.
-        for _ in list('ABCDEFGHI'):
-            self.sample_row_data_absolute.append(0)
-            self.sample_row_data_relative.append(0)
-
-    def _populate_qc_meta_failed_sample(self):
-        if self.dss.num_contigs:
-            contig_num = self.dss.num_contigs
-            self.sample_row_data_absolute.append(contig_num)
-            self.sample_row_data_relative.append(0)
-        else:
-            self.sample_row_data_absolute.append(0)
-            self.sample_row_data_relative.append(0)
-        # POST-QC
-        # store the aboslute number of sequences after sequencing QC at this stage
-        if self.dss.post_qc_absolute_num_seqs:
-            post_qc_absolute = self.dss.post_qc_absolute_num_seqs
-            self.sample_row_data_absolute.append(post_qc_absolute)
-            self.sample_row_data_relative.append(0)
-        else:
-            self.sample_row_data_absolute.append(0)
-            self.sample_row_data_relative.append(0)
-        # This is the unique number of sequences after the sequencing QC
-        if self.dss.post_qc_unique_num_seqs:
-            post_qc_unique = self.dss.post_qc_unique_num_seqs
-            self.sample_row_data_absolute.append(post_qc_unique)
-            self.sample_row_data_relative.append(0)
-        else:
-            self.sample_row_data_absolute.append(0)
-            self.sample_row_data_relative.append(0)
-        # POST TAXA-ID
-        # Absolute number of sequences after sequencing QC and screening for Symbiodinium (i.e. Symbiodinium only)
-        if self.dss.absolute_num_sym_seqs:
-            tax_id_symbiodiniaceae_absolute = self.dss.absolute_num_sym_seqs
-            self.sample_row_data_absolute.append(tax_id_symbiodiniaceae_absolute)
-            self.sample_row_data_relative.append(0)
-        else:
-            self.sample_row_data_absolute.append(0)
-            self.sample_row_data_relative.append(0)
-        # Same as above but the number of unique seqs
-        if self.dss.unique_num_sym_seqs:
-            tax_id_symbiodiniaceae_unique = self.dss.unique_num_sym_seqs
-            self.sample_row_data_absolute.append(tax_id_symbiodiniaceae_unique)
-            self.sample_row_data_relative.append(0)
-        else:
-            self.sample_row_data_absolute.append(0)
-            self.sample_row_data_relative.append(0)
-        # size violation absolute
-        if self.dss.size_violation_absolute:
-            size_viol_ab = self.dss.size_violation_absolute
-            self.sample_row_data_absolute.append(size_viol_ab)
-            self.sample_row_data_relative.append(0)
-        else:
-            self.sample_row_data_absolute.append(0)
-            self.sample_row_data_relative.append(0)
-        # size violation unique
-        if self.dss.size_violation_unique:
-            size_viol_uni = self.dss.size_violation_unique
-            self.sample_row_data_absolute.append(size_viol_uni)
-            self.sample_row_data_relative.append(0)
-        else:
-            self.sample_row_data_absolute.append(0)
-            self.sample_row_data_relative.append(0)
-        # store the abosolute number of sequenes that were not considered Symbiodinium
-        if self.dss.non_sym_absolute_num_seqs:
-            tax_id_non_symbiodinum_abosulte = self.dss.non_sym_absolute_num_seqs
-            self.sample_row_data_absolute.append(tax_id_non_symbiodinum_abosulte)
-            self.sample_row_data_relative.append(0)
-        else:
-            self.sample_row_data_absolute.append(0)
-            self.sample_row_data_relative.append(0)
-        # This is the number of unique sequences that were not considered Symbiodinium
-        if self.dss.non_sym_unique_num_seqs:
-            tax_id_non_symbiodiniaceae_unique = self.dss.non_sym_unique_num_seqs
-            self.sample_row_data_absolute.append(tax_id_non_symbiodiniaceae_unique)
-            self.sample_row_data_relative.append(0)
-        else:
-            self.sample_row_data_absolute.append(0)
-            self.sample_row_data_relative.append(0)
-        # post-med absolute
-        if self.dss.post_med_absolute:
-            post_med_abs = self.dss.post_med_absolute
-            self.sample_row_data_absolute.append(post_med_abs)
-            self.sample_row_data_relative.append(0)
-        else:
-            self.sample_row_data_absolute.append(0)
-            self.sample_row_data_relative.append(0)
-        # post-med absolute
-        if self.dss.post_med_unique:
-            post_med_uni = self.dss.post_med_unique
-            self.sample_row_data_absolute.append(post_med_uni)
-            self.sample_row_data_relative.append(0)
+    @staticmethod
+    def _hstack_meta_and_seq_abunds(meta_rows, seq_abunds):
+        meta_array = np.empty((len(meta_rows), len(meta_rows[0]) if meta_rows else 0), dtype=object)
+        for i, meta_row in enumerate(meta_rows):
+            meta_array[i, :] = meta_row
+        return np.hstack([meta_array, seq_abunds])
+
+    def _make_sample_meta_rows(self, row):
+        """The meta information (names, qc data, no name clade summaries and user supplied data) of the sample
+        for the absolute and relative dataframes. For samples that had a problem in processing, the relative qc
+        data and the no name clade summaries are 0."""
+        dss = self.list_of_dss_objects[row]
+        ds = self.ds_uid_to_ds_obj_dict[dss.data_submission_from_id]
+        sample_row_data = [
+            dss.name, dss.fastq_fwd_file_name, dss.fastq_fwd_file_hash, dss.fastq_rev_file_name,
+            dss.fastq_rev_file_hash, ds.id, ds.name]
+        sample_row_data_absolute = list(sample_row_data)
+        sample_row_data_relative = list(sample_row_data)
+
+        qc_values = [getattr(dss, qc_stat_attribute) for qc_stat_attribute in self.qc_stat_attributes]
+        if self.failed_sample_mask[row]:
+            sample_row_data_absolute.extend([qc_value if qc_value else 0 for qc_value in qc_values])
+            sample_row_data_relative.extend([0 for _ in qc_values])
+            sample_row_data_absolute.extend([0 for _ in self.clade_list])
+            sample_row_data_relative.extend([0 for _ in self.clade_list])
         else:
-            self.sample_row_data_absolute.append(0)
-            self.sample_row_data_relative.append(0)
-
-    def _dss_had_problem_in_processing(self):
-        return self.dss.error_in_processing or self.sample_seq_tot == 0
-
-
-
+            # For the relative counts we will report the qc data as proportions of the sample_seq_tot.
+            # I.e. we will have numbers larger than 1 for many of the values
+            sample_seq_tot = int(self.sample_seq_totals[row])
+            sample_row_data_absolute.extend(qc_values)
+            sample_row_data_relative.extend([qc_value / sample_seq_tot for qc_value in qc_values])
+            sample_row_data_absolute.extend(self.noname_clade_summary_abs_abunds[row].tolist())
+            sample_row_data_relative.extend([
+                rel_abund if num_seqs else 0 for rel_abund, num_seqs in zip(
+                    self.noname_clade_summary_rel_abunds[row].tolist(),
+                    self.noname_clade_summary_num_seqs[row].tolist())])
+
+        user_supplied_values = [getattr(dss, user_supplied_stat) for user_supplied_stat in self.user_supplied_stats]
+        sample_row_data_absolute.extend(user_supplied_values)
+        sample_row_data_relative.extend(user_supplied_values)
+        return sample_row_data_absolute, sample_row_data_relative
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+The manifest of the artefacts of a DataAnalysis output (output_manifest.json in the output directory).
+
+For every artefact (e.g. the ITS2 type profile count tables or the between sample distances) the manifest records
+the fingerprint of its inputs, the files it wrote, the section of study_data.js it appended (and a sha256 of it),
+the items it added to the js_output_path_dict and any state needed by the artefacts that follow it. When an output
+is regenerated, an artefact whose fingerprint matches that of the previous output, and whose files and section of
+study_data.js are intact, is reused (copied) rather than remade.
+
+The date time string of the previous output appears in the names of the files of its artefacts, in the text of
+those files (e.g. the 'output by ... on <date time>' meta lines) and in study_data.js. When an artefact is reused
+it is rewritten to the date time string of the new output: its files are renamed, its text files and its section
+of study_data.js are copied with the old date time string replaced by the new one and binary files (e.g. the .png
+and .npz files) are copied as they are.
+"""
+import os
+import json
+import glob
+import hashlib
+import shutil
+
+
+class OutputManifest:
+    manifest_file_name = 'output_manifest.json'
+    # The files of the artefacts whose contents are rewritten with the date time string of the new output on reuse
+    text_file_extensions = ('.txt', '.fasta', '.dist', '.csv', '.json', '.js')
+
+    def __init__(self, output_dir, js_file_path, output_key, date_time_str=None):
+        self.output_dir = output_dir
+        self.js_file_path = js_file_path
+        # The date time string of the output, used in the names and text of its files
+        self.date_time_str = date_time_str
+        # Identifies what was output (e.g. the Study) so that the manifest of a previous output of the same thing
+        # can be found
+        self.output_key = output_key
+        self.artefacts = {}
+        # The snapshot of the output directory and study_data.js at the start of the current artefact
+        self._current_artefact = None
+        self._files_before = None
+        self._js_size_before = None
+        self._js_output_path_keys_before = None
+
+    @staticmethod
+    def hash_of(python_obj):
+        """A sha256 of the json of python_obj (e.g. a list of sample uids or of sample metadata)"""
+        return hashlib.sha256(json.dumps(python_obj, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _get_output_files(self):
+        output_files = set()
+        for root, dirs, files in os.walk(self.output_dir):
+            for file in files:
+                output_files.add(os.path.relpath(os.path.join(root, file), self.output_dir))
+        output_files.discard(self.manifest_file_name)
+        output_files.discard(os.path.relpath(self.js_file_path, self.output_dir))
+        return output_files
+
+    def _get_js_size(self):
+        return os.path.getsize(self.js_file_path) if os.path.isfile(self.js_file_path) else 0
+
+    def _get_js_section_hash(self, js_start, js_end, block_size=65536):
+        """A sha256 of the bytes js_start:js_end of study_data.js"""
+        hasher = hashlib.sha256()
+        if js_end > js_start:
+            with open(self.js_file_path, 'rb') as f:
+                f.seek(js_start)
+                remaining = js_end - js_start
+                while remaining > 0:
+                    block = f.read(min(block_size, remaining))
+                    if not block:
+                        break
+                    hasher.update(block)
+                    remaining -= len(block)
+        return hasher.hexdigest()
+
+    def begin_artefact(self, name, fingerprint, js_output_path_dict):
+        self._current_artefact = name
+        self._files_before = self._get_output_files()
+        self._js_size_before = self._get_js_size()
+        self._js_output_path_keys_before = set(js_output_path_dict.keys())
+        self.artefacts[name] = {'fingerprint': fingerprint}
+
+    def end_artefact(self, name, js_output_path_dict, state=None):
+        if name != self._current_artefact:
+            raise RuntimeError(f'The output artefact {name} was not begun')
+        js_end = self._get_js_size()
+        self.artefacts[name].update({
+            'files': sorted(self._get_output_files() - self._files_before),
+            'js': [self._js_size_before, js_end],
+            'js_sha256': self._get_js_section_hash(self._js_size_before, js_end),
+            'js_output_paths': {
+                k: os.path.relpath(v, self.output_dir) for k, v in js_output_path_dict.items()
+                if k not in self._js_output_path_keys_before},
+            'state': state})
+        self._current_artefact = None
+        self.write()
+
+    def is_fresh(self, name, fingerprint):
+        """Whether the artefact was made from the same inputs and its files and its section of study_data.js are
+        all still there"""
+        if name not in self.artefacts or self.artefacts[name]['fingerprint'] != fingerprint:
+            return False
+        if 'files' not in self.artefacts[name]:
+            # The artefact was begun but never completed
+            return False
+        js_start, js_end = self.artefacts[name]['js']
+        if js_end > self._get_js_size() or \
+                self._get_js_section_hash(js_start, js_end) != self.artefacts[name].get('js_sha256'):
+            return False
+        return all(
+            os.path.isfile(os.path.join(self.output_dir, rel_path)) for rel_path in self.artefacts[name]['files'])
+
+    def _get_date_time_replacement(self, previous_manifest):
+        """The (old, new) date time strings to replace in a reused artefact, or None if there is nothing to replace"""
+        if previous_manifest.date_time_str and self.date_time_str and \
+                previous_manifest.date_time_str != self.date_time_str:
+            return previous_manifest.date_time_str, self.date_time_str
+        return None
+
+    def reuse_artefact(self, previous_manifest, name, js_output_path_dict):
+        """Copy a fresh artefact of a previous output into this output, rewritten to the date time string of this
+        output, and return its state"""
+        previous_artefact = previous_manifest.artefacts[name]
+        date_time_replacement = self._get_date_time_replacement(previous_manifest)
+
+        def rewrite(text):
+            return text.replace(*date_time_replacement) if date_time_replacement else text
+
+        files = []
+        for rel_path in previous_artefact['files']:
+            dest_rel_path = rewrite(rel_path)
+            dest_path = os.path.join(self.output_dir, dest_rel_path)
+            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+            src_path = os.path.join(previous_manifest.output_dir, rel_path)
+            if date_time_replacement and rel_path.endswith(self.text_file_extensions):
+                with open(src_path, 'r') as f_in, open(dest_path, 'w') as f_out:
+                    f_out.write(rewrite(f_in.read()))
+                shutil.copystat(src_path, dest_path)
+            else:
+                shutil.copy2(src_path, dest_path)
+            files.append(dest_rel_path)
+        js_start = self._get_js_size()
+        js_section_start, js_section_end = previous_artefact['js']
+        if js_section_end > js_section_start:
+            os.makedirs(os.path.dirname(self.js_file_path), exist_ok=True)
+            with open(previous_manifest.js_file_path, 'rb') as f_in, open(self.js_file_path, 'ab') as f_out:
+                f_in.seek(js_section_start)
+                js_section = f_in.read(js_section_end - js_section_start)
+                if date_time_replacement:
+                    js_section = js_section.replace(*[_.encode() for _ in date_time_replacement])
+                f_out.write(js_section)
+        js_output_paths = {k: rewrite(rel_path) for k, rel_path in previous_artefact['js_output_paths'].items()}
+        for k, rel_path in js_output_paths.items():
+            js_output_path_dict[k] = os.path.join(self.output_dir, rel_path)
+        js_end = self._get_js_size()
+        self.artefacts[name] = {
+            'fingerprint': previous_artefact['fingerprint'], 'files': sorted(files),
+            'js': [js_start, js_end], 'js_sha256': self._get_js_section_hash(js_start, js_end),
+            'js_output_paths': js_output_paths, 'state': previous_artefact['state']}
+        self.write()
+        return previous_artefact['state']
+
+    def write(self):
+        with open(os.path.join(self.output_dir, self.manifest_file_name), 'w') as f:
+            json.dump(
+                obj={'output_key': self.output_key, 'js_file_path': os.path.relpath(self.js_file_path, self.output_dir),
+                     'date_time_str': self.date_time_str, 'artefacts': self.artefacts}, fp=f, indent=1)
+
+    @classmethod
+    def read(cls, output_dir):
+        with open(os.path.join(output_dir, cls.manifest_file_name), 'r') as f:
+            manifest_dict = json.load(f)
+        manifest = cls(
+            output_dir=output_dir, js_file_path=os.path.join(output_dir, manifest_dict['js_file_path']),
+            output_key=manifest_dict['output_key'], date_time_str=manifest_dict.get('date_time_str'))
+        manifest.artefacts = manifest_dict['artefacts']
+        return manifest
+
+    @classmethod
+    def find_previous(cls, outputs_dir, output_key, exclude_output_dir=None):
+        """Return the manifest of the most recent output in outputs_dir (the output directories are named by their
+        date time strings) that has the same output_key, or None if there isn't one"""
+        manifest_paths = sorted(glob.glob(os.path.join(outputs_dir, '*', cls.manifest_file_name)), reverse=True)
+        for manifest_path in manifest_paths:
+            output_dir = os.path.dirname(manifest_path)
+            if exclude_output_dir and os.path.abspath(output_dir) == os.path.abspath(exclude_output_dir):
+                continue
+            try:
+                manifest = cls.read(output_dir)
+            except (ValueError, KeyError):
+                print(f'Unable to read the output manifest {manifest_path}')
+                continue
+            if manifest.output_key == output_key:
+                return manifest
+        return None
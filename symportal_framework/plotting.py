@@ -16,6 +16,7 @@ import numpy as np
 import sys
 from datetime import datetime
 from general import ThreadSafeGeneral
+from sparse_count_table import SparseCountTable
 import json
 plt.ioff()
 
@@ -477,7 +478,13 @@ class SeqStackedBarPlotter():
     """Class for plotting the sequence count table output"""
     def __init__(
             self, seq_relative_abund_count_table_path_post_med, seq_relative_abund_df_pre_med, output_directory,
-            no_pre_med_seqs, ordered_seq_list, date_time_str=None, ordered_sample_uid_list=None):
+            no_pre_med_seqs, ordered_seq_list, date_time_str=None, ordered_sample_uid_list=None,
+            seq_count_table_sparse_path=None):
+        """
+        :param seq_count_table_sparse_path: if given, the path of a SparseCountTable (.sparse.npz) of the post-MED
+        sequence abundances that is read (memory mapped) rather than the count table at
+        seq_relative_abund_count_table_path_post_med.
+        """
         self.seq_relative_abund_count_table_path_post_med = seq_relative_abund_count_table_path_post_med
         self.seq_relative_abund_df_pre_med = seq_relative_abund_df_pre_med
         self.ordered_seq_list = ordered_seq_list
@@ -490,11 +497,14 @@ class SeqStackedBarPlotter():
             self.date_time_str = str(datetime.utcnow()).split('.')[0].replace('-','').replace(' ','T').replace(':','')
         self.fig_output_base = os.path.join(self.post_med_output_directory, f'{self.date_time_str}')
         self.smp_uid_to_smp_name_dict = None
-        self.output_count_table_as_df = pd.read_csv(
-            self.seq_relative_abund_count_table_path_post_med,
-            sep='\t', lineterminator='\n', header=0, index_col=0
-        )
-        self._format_output_df_and_populate_smpl_id_to_smp_name_dict()
+        if seq_count_table_sparse_path:
+            self._read_sparse_count_table_and_populate_smpl_id_to_smp_name_dict(seq_count_table_sparse_path)
+        else:
+            self.output_count_table_as_df = pd.read_csv(
+                self.seq_relative_abund_count_table_path_post_med,
+                sep='\t', lineterminator='\n', header=0, index_col=0
+            )
+            self._format_output_df_and_populate_smpl_id_to_smp_name_dict()
         self.ordered_list_of_seqs_names = self._set_ordered_list_of_seqs_names()
         # legend parameters and vars
         self.max_n_cols = 8
@@ -652,6 +662,18 @@ class SeqStackedBarPlotter():
         # get the names of the sequences sorted according to their totalled abundance
         return [x[0] for x in sorted(abundance_dict.items(), key=lambda x: x[1], reverse=True)]
 
+    def _read_sparse_count_table_and_populate_smpl_id_to_smp_name_dict(self, seq_count_table_sparse_path):
+        """The equivalent of reading in and formatting the count table from a SparseCountTable. The table only
+        holds the sequence abundances, so there are no meta info rows or columns to drop. Only the columns of
+        ordered_seq_list are made dense, and they are made dense as floats (rather than as integers and then
+        converted)."""
+        sparse_count_table = SparseCountTable.read(seq_count_table_sparse_path, mmap_mode='r')
+        self.smp_uid_to_smp_name_dict = {
+            int(uid): smp_name for uid, smp_name in
+            zip(sparse_count_table.sample_uids.tolist(), sparse_count_table.sample_names)}
+        self.output_count_table_as_df = sparse_count_table.to_dataframe(
+            column_names=self.ordered_seq_list, dtype='float')
+
     def _format_output_df_and_populate_smpl_id_to_smp_name_dict(self):
         """Drop the QC columns from the SP output df and also drop the clade summation columns
         we will be left with just columns for each one of the sequences found in the samples
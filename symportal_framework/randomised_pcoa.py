@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+A principal coordinate analysis (PCoA) that computes only the first few axes using randomised subspace iteration
+(Halko, Martinsson & Tropp 2011) rather than a full eigendecomposition.
+
+The double centred matrix is never formed; it is only multiplied by thin matrices, reading the distance matrix
+(which may be memory mapped, see distance_memmap.py) a block of rows at a time. As for the 'fsvd' method of skbio,
+the proportion explained by each axis is its eigenvalue divided by the trace of the centred matrix.
+When the distances are (close to) all zero, the coordinates and proportions explained are returned as zeros.
+"""
+import numpy as np
+
+
+class RandomisedPCoA:
+    def __init__(self, dist_matrix, num_dimensions=10, block_size=1000, num_oversamples=10, num_power_iterations=4,
+                 seed=1234):
+        """
+        :param dist_matrix: square symmetric distance matrix. Any array like that supports row slicing
+        (e.g. a numpy memmap).
+        :param num_dimensions: the number of principal coordinates to compute
+        :param block_size: the number of rows of the distance matrix that are read at once
+        """
+        self.dist_matrix = dist_matrix
+        self.num_objs = dist_matrix.shape[0]
+        self.num_dimensions = min(num_dimensions, self.num_objs)
+        self.block_size = max(1, block_size)
+        self.num_oversamples = num_oversamples
+        self.num_power_iterations = num_power_iterations
+        self.random_state = np.random.RandomState(seed)
+        # The row means of the squared distances and their grand mean used to double centre
+        self.row_means = None
+        self.grand_mean = None
+        # results
+        self.eigvals = None
+        self.coordinates = None
+        self.proportion_explained = None
+        self.degenerate = False
+
+    def _iter_row_blocks(self):
+        for start in range(0, self.num_objs, self.block_size):
+            stop = min(start + self.block_size, self.num_objs)
+            yield start, stop, np.square(np.asarray(self.dist_matrix[start:stop], dtype=np.float64))
+
+    def _compute_row_means(self):
+        self.row_means = np.empty(self.num_objs, dtype=np.float64)
+        for start, stop, squared_block in self._iter_row_blocks():
+            self.row_means[start:stop] = squared_block.mean(axis=1)
+        self.grand_mean = self.row_means.mean()
+
+    def _centred_dot(self, x):
+        """Return B @ x without forming B"""
+        squared_dot = np.empty((self.num_objs, x.shape[1]), dtype=np.float64)
+        for start, stop, squared_block in self._iter_row_blocks():
+            squared_dot[start:stop] = squared_block @ x
+        col_sums = x.sum(axis=0)
+        return -0.5 * (squared_dot - np.outer(self.row_means, col_sums) - (self.row_means @ x)[None, :] +
+                       self.grand_mean * col_sums[None, :])
+
+    def compute(self):
+        self._compute_row_means()
+        # The trace of B and so the sum of all of its eigenvalues
+        trace = self.num_objs * self.grand_mean / 2
+        if not trace > np.finfo(np.float64).eps * max(self.num_objs, 1):
+            self._set_degenerate_results()
+            return self
+
+        num_samples = min(self.num_dimensions + self.num_oversamples, self.num_objs)
+        q, _ = np.linalg.qr(self._centred_dot(self.random_state.normal(size=(self.num_objs, num_samples))))
+        for _ in range(self.num_power_iterations):
+            q, _ = np.linalg.qr(self._centred_dot(q))
+        small_matrix = q.T @ self._centred_dot(q)
+        small_matrix = (small_matrix + small_matrix.T) / 2
+        eigvals, small_eigvecs = np.linalg.eigh(small_matrix)
+        # Descending order and keep the first num_dimensions axes
+        order = np.argsort(eigvals)[::-1][:self.num_dimensions]
+        eigvals = eigvals[order]
+        eigvecs = q @ small_eigvecs[:, order]
+        # Make the signs deterministic: the largest magnitude element of each eigenvector is positive
+        signs = np.sign(eigvecs[np.abs(eigvecs).argmax(axis=0), np.arange(eigvecs.shape[1])])
+        signs[signs == 0] = 1
+        eigvecs = eigvecs * signs
+        # Negative eigenvalues (non-euclidean distances) do not give real coordinates
+        eigvals[eigvals < 0] = 0
+        self.eigvals = eigvals
+        self.coordinates = eigvecs * np.sqrt(eigvals)
+        self.proportion_explained = eigvals / trace
+        return self
+
+    def _set_degenerate_results(self):
+        self.degenerate = True
+        self.eigvals = np.zeros(self.num_dimensions)
+        self.coordinates = np.zeros((self.num_objs, self.num_dimensions))
+        self.proportion_explained = np.zeros(self.num_dimensions)
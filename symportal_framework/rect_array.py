@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+The rectangle arrays of the sequence stacked bar plots of the html output (getRectDataPostMEDBySample and
+getRectDataPreMEDBySample).
+
+The non zero abundances are held as a CSR matrix with the sequences in plotting order, the y values are the
+cumulative sums of each row, and the arrays are formatted a sample at a time to the same text that json.dumps
+would have produced from a dict per rectangle.
+"""
+import json
+import numpy as np
+
+
+class RectArray:
+    # Key order and formatting as per json.dumps of the rectangle dicts
+    rect_template = '{"seq_name": %s, "y_abs": %d, "y_rel": "%.3f", "height_rel": "%.3f", "height_abs": %d}'
+
+    def __init__(self, abs_abunds, rel_abunds, sample_uids, seq_names):
+        """abs_abunds and rel_abunds are dense (samples x sequences) arrays of the abundances with the sequences in
+        the order in which they should be plotted (seq_names)"""
+        abs_abunds = np.asarray(abs_abunds, dtype=np.int64)
+        rel_abunds = np.asarray(rel_abunds, dtype=np.float64)
+        self.sample_uids = [int(uid) for uid in sample_uids]
+        if abs_abunds.shape != (len(self.sample_uids), len(seq_names)) or rel_abunds.shape != abs_abunds.shape:
+            raise RuntimeError(f'The abundances {abs_abunds.shape} do not match the number of samples '
+                               f'({len(self.sample_uids)}) and sequences ({len(seq_names)})')
+        self.seq_names_as_json = [json.dumps(str(seq_name)) for seq_name in seq_names]
+
+        # The sparse matrix, in row major order so that the cells of each row are in plotting order
+        rows, cols = np.nonzero(abs_abunds)
+        self.cols = cols
+        self.height_abs = abs_abunds[rows, cols]
+        self.height_rel = rel_abunds[rows, cols]
+        self.indptr = np.zeros(len(self.sample_uids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(self.sample_uids)), out=self.indptr[1:])
+
+        # The segmented cumulative sum of the absolute abundances (exact as integer)
+        cumulative_abs = np.concatenate(([0], np.cumsum(self.height_abs)))
+        self.y_abs = cumulative_abs[1:] - cumulative_abs[np.repeat(self.indptr[:-1], np.diff(self.indptr))]
+        sample_totals_abs = cumulative_abs[self.indptr[1:]] - cumulative_abs[self.indptr[:-1]]
+        self.max_cumulative_abs = int(sample_totals_abs.max()) if len(sample_totals_abs) else 0
+
+    def _get_y_rel(self, row):
+        # The relative abundances are summed per row (rather than as a segmented sum of the whole matrix)
+        # so that the floating point sums are those of summing the sequences of the sample in order
+        return np.cumsum(self.height_rel[self.indptr[row]:self.indptr[row + 1]])
+
+    def sample_rect_array_as_json(self, row):
+        start, stop = self.indptr[row], self.indptr[row + 1]
+        rects = zip(
+            [self.seq_names_as_json[col] for col in self.cols[start:stop].tolist()],
+            self.y_abs[start:stop].tolist(), self._get_y_rel(row).tolist(),
+            self.height_rel[start:stop].tolist(), self.height_abs[start:stop].tolist())
+        return '[' + ', '.join([self.rect_template % rect for rect in rects]) + ']'
+
+    def write_out_chunks(self, chunk_writer):
+        """Stream the rectangle array of each sample to a StudyDataChunkWriter and return the index of the chunks"""
+        for row, sample_uid in enumerate(self.sample_uids):
+            chunk_writer.add(sample_uid, self.sample_rect_array_as_json(row))
+        return chunk_writer.close()
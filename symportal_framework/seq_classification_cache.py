@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+A persistent cache of the results of blasting nucleotide sequences against the symClade database during the
+taxonomic screening of a data loading, so that sequences that were screened in a previous data loading
+do not need to be blasted again.
+
+The cache is a sqlite file that sits next to the symClade database (symClade.fa) and is keyed by the exact
+nucleotide sequence. For every sequence it holds the blast result lines of the sequence (excluding the qseqid) as
+output by blastn, so that the blast.out file of a sample can be written from the cache, and the classification
+of the sequence from its first result ('symbiodiniaceae', 'sub_evalue' or 'non_symbiodiniaceae') using the
+thresholds of the taxonomic screening. An empty string of results means that the sequence had no match.
+
+A fingerprint (the sha256 of symClade.fa) is stored with the cache, and the cache is emptied if the fingerprint
+does not match the current symClade.fa. When Symbiodiniaceae sequences are added to the symClade database during the
+taxonomic screening, only the sequences that were not classified as symbiodiniaceae (no match or a match below the
+evalue cut off) are removed, as they are the only sequences whose classification the added sequences can change.
+
+The cache is only used when a data loading is run with --classification_cache. It is not size limited and can be
+cleared by deleting the sqlite file.
+"""
+import hashlib
+import os
+import sqlite3
+
+
+class SequenceClassificationCache:
+    cache_file_name = 'symClade_classification_cache.sqlite'
+
+    def __init__(self, symclade_db_path, check_fingerprint=True):
+        """
+        :param symclade_db_path: path to the symClade.fa that the blast database was made from
+        :param check_fingerprint: if True, the cache is emptied if it was made with a different symClade.fa
+        """
+        self.symclade_db_path = symclade_db_path
+        self.cache_path = self.get_cache_path(symclade_db_path)
+        self.connection = sqlite3.connect(self.cache_path, timeout=60)
+        self._create_tables()
+        if check_fingerprint and self._get_stored_fingerprint() != self._compute_symclade_fingerprint():
+            self.invalidate()
+
+    @classmethod
+    def get_cache_path(cls, symclade_db_path):
+        return os.path.join(os.path.dirname(os.path.abspath(symclade_db_path)), cls.cache_file_name)
+
+    @classmethod
+    def exists(cls, symclade_db_path):
+        """Whether a cache has been made for the symClade.fa at symclade_db_path"""
+        return os.path.isfile(cls.get_cache_path(symclade_db_path))
+
+    def _create_tables(self):
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS classification ('
+                'sequence TEXT PRIMARY KEY, blast_results TEXT NOT NULL, classification TEXT NOT NULL)')
+
+    def _compute_symclade_fingerprint(self):
+        hasher = hashlib.sha256()
+        with open(self.symclade_db_path, 'rb') as f:
+            for block in iter(lambda: f.read(65536), b''):
+                hasher.update(block)
+        return hasher.hexdigest()
+
+    def _get_stored_fingerprint(self):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'symclade_fingerprint'").fetchone()
+        return row[0] if row else None
+
+    def invalidate(self):
+        """Empty the cache and record the fingerprint of the current symClade.fa"""
+        with self.connection:
+            self.connection.execute('DELETE FROM classification')
+            self._store_fingerprint()
+
+    def invalidate_failures(self):
+        """Remove the sequences that were not classified as symbiodiniaceae so that they are blasted again
+        against the symClade database that Symbiodiniaceae sequences have been added to"""
+        with self.connection:
+            self.connection.execute("DELETE FROM classification WHERE classification != 'symbiodiniaceae'")
+
+    def update_fingerprint(self):
+        """Record the fingerprint of the current symClade.fa without removing any sequences (e.g. when
+        the sequences of the delta database have been merged into symClade.fa)"""
+        with self.connection:
+            self._store_fingerprint()
+
+    def _store_fingerprint(self):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('symclade_fingerprint', ?)",
+            (self._compute_symclade_fingerprint(),))
+
+    def get_blast_results(self, nucleotide_sequence_list):
+        """Return a dict of nucleotide sequence to the list of its blast result lines (excluding the qseqid)
+        for the sequences that are in the cache"""
+        sequence_to_blast_result_list_dict = {}
+        nucleotide_sequence_list = list(nucleotide_sequence_list)
+        for i in range(0, len(nucleotide_sequence_list), 500):
+            chunk = nucleotide_sequence_list[i:i + 500]
+            for sequence, blast_results in self.connection.execute(
+                    f'SELECT sequence, blast_results FROM classification '
+                    f'WHERE sequence IN ({",".join("?" * len(chunk))})', chunk):
+                sequence_to_blast_result_list_dict[sequence] = blast_results.split('\n') if blast_results else []
+        return sequence_to_blast_result_list_dict
+
+    def add_blast_results(self, sequence_to_blast_result_list_dict):
+        """Add the blast result lines (excluding the qseqid) of each nucleotide sequence.
+        An empty list means the sequence had no match."""
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO classification (sequence, blast_results, classification) VALUES (?, ?, ?)',
+                [(sequence, '\n'.join(blast_result_list), self.classify(blast_result_list)) for
+                 sequence, blast_result_list in sequence_to_blast_result_list_dict.items()])
+
+    def close(self):
+        self.connection.close()
+
+    @staticmethod
+    def classify(blast_result_list):
+        """Return the classification of a sequence from its first blast result line
+        ('sseqid staxids evalue pident qcovs')"""
+        if not blast_result_list:
+            return 'non_symbiodiniaceae'
+        sseqid, staxids, evalue, identity, coverage = blast_result_list[0].split('\t')[:5]
+        try:
+            # The power of the evalue, e.g. 120 for 1e-120
+            evalue_power = int(evalue.split('-')[1])
+        except (IndexError, ValueError):
+            evalue_power = None
+        if (evalue_power is None or evalue_power < 100) and (float(identity) < 80 or float(coverage) < 95):
+            return 'sub_evalue'
+        return 'symbiodiniaceae'
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+An index for finding which of a list of sequences are sub or superstrings of a query sequence without scanning
+every sequence in turn.
+
+The index is built on (w, k) minimizers: if sequence a is contained in sequence b, every minimizer of a is also
+a minimizer of b (at a shifted offset). Superstrings of a query are therefore found by verifying the sequences in
+the shortest posting list of the query's minimizers, and substrings by looking up each indexed sequence under
+one anchor minimizer at the offset implied by the query. Sequences too short to have a minimizer are checked
+directly. All candidates are verified with a substring search and the order in which the sequences were added is
+kept, so that first_match returns exactly what a scan of the list in order would.
+
+The k-mers are hashed with crc32 rather than python's (per interpreter salted) hash so that an index that is
+pickled, e.g. to a spawned worker process, selects the same minimizers as the index it was copied from.
+"""
+from collections import defaultdict
+from zlib import crc32
+
+
+class SequenceContainmentIndex:
+    def __init__(self, sequences=None, k=16, w=8):
+        self.k = k
+        self.w = w
+        # The minimum length a sequence must be to have at least one minimizer
+        self.min_indexed_len = k + w - 1
+        # The sequences in the order that they were added. The position in this list is the uid used
+        # throughout the index.
+        self.seq_list = []
+        # Nucleotide sequence to the position of its first occurrence in self.seq_list
+        self.seq_to_pos_dict = {}
+        # minimizer k-mer to ascending list of positions of the sequences that contain the minimizer
+        self.minimizer_to_pos_list_dict = defaultdict(list)
+        # anchor minimizer k-mer to list of tuples of (position, offset of the k-mer in the sequence)
+        self.anchor_to_pos_offset_list_dict = defaultdict(list)
+        # positions of the sequences that are too short to be indexed
+        self.short_seq_pos_list = []
+        if sequences is not None:
+            self.add_sequences(sequences)
+
+    def __len__(self):
+        return len(self.seq_list)
+
+    def __contains__(self, seq):
+        return seq in self.seq_to_pos_dict
+
+    def add_sequences(self, sequences):
+        """Add the sequences in the order given. Anchors are chosen once all of the minimizers of the
+        sequences are known so that the anchors of a bulk load are as discriminating as possible."""
+        new_pos_minimizer_list = []
+        for seq in sequences:
+            pos = self._append_seq(seq)
+            minimizers = self._minimizers(seq)
+            if minimizers:
+                for kmer in {kmer for _, kmer in minimizers}:
+                    self.minimizer_to_pos_list_dict[kmer].append(pos)
+                new_pos_minimizer_list.append((pos, minimizers))
+            else:
+                self.short_seq_pos_list.append(pos)
+        for pos, minimizers in new_pos_minimizer_list:
+            self._add_anchor(pos, minimizers)
+
+    def add(self, seq):
+        """Add a single sequence to the end of the index and return its position."""
+        self.add_sequences([seq])
+        return len(self.seq_list) - 1
+
+    def first_match(self, query):
+        """Return the sequence that would be returned by checking, in order, for an exact match to the query
+        and then for the first sequence (in order of addition) that is either a superstring or a
+        substring of the query. Returns None if there is no match."""
+        pos = self.first_match_pos(query)
+        if pos is None:
+            return None
+        return self.seq_list[pos]
+
+    def first_match_pos(self, query):
+        if query in self.seq_to_pos_dict:
+            return self.seq_to_pos_dict[query]
+        query_minimizers = self._minimizers(query)
+        best_pos = None
+        for superstring_pos in self.iter_superstring_pos(query, query_minimizers=query_minimizers):
+            best_pos = superstring_pos
+            break
+        for substring_pos in self.iter_substring_pos(query, before=best_pos, query_minimizers=query_minimizers):
+            if best_pos is None or substring_pos < best_pos:
+                best_pos = substring_pos
+        return best_pos
+
+    def iter_superstring_pos(self, query, query_minimizers=None):
+        """Yield, in ascending order, the positions of the indexed sequences that contain the query."""
+        if query_minimizers is None:
+            query_minimizers = self._minimizers(query)
+        if not query_minimizers:
+            # The query is too short to be seeded so check every sequence
+            for pos, seq in enumerate(self.seq_list):
+                if query in seq:
+                    yield pos
+            return
+        shortest_pos_list = None
+        for _, kmer in query_minimizers:
+            pos_list = self.minimizer_to_pos_list_dict.get(kmer)
+            if not pos_list:
+                # No sequence contains this minimizer so no sequence can contain the query
+                return
+            if shortest_pos_list is None or len(pos_list) < len(shortest_pos_list):
+                shortest_pos_list = pos_list
+        for pos in shortest_pos_list:
+            if query in self.seq_list[pos]:
+                yield pos
+
+    def iter_substring_pos(self, query, before=None, query_minimizers=None):
+        """Yield the positions of the indexed sequences that are contained in the query. The positions are
+        not yielded in order. If before is given, only positions lower than before are considered."""
+        seq_list = self.seq_list
+        seen_pos = set()
+        for pos in self.short_seq_pos_list:
+            if before is not None and pos >= before:
+                break
+            if seq_list[pos] in query:
+                seen_pos.add(pos)
+                yield pos
+        if query_minimizers is None:
+            query_minimizers = self._minimizers(query)
+        for query_offset, kmer in query_minimizers:
+            for pos, anchor_offset in self.anchor_to_pos_offset_list_dict.get(kmer, ()):
+                if before is not None and pos >= before:
+                    continue
+                start = query_offset - anchor_offset
+                if start < 0 or pos in seen_pos:
+                    continue
+                if query.startswith(seq_list[pos], start):
+                    seen_pos.add(pos)
+                    yield pos
+
+    def _append_seq(self, seq):
+        pos = len(self.seq_list)
+        self.seq_list.append(seq)
+        if seq not in self.seq_to_pos_dict:
+            self.seq_to_pos_dict[seq] = pos
+        return pos
+
+    def _add_anchor(self, pos, minimizers):
+        # Use the minimizer that is shared by the fewest indexed sequences as the anchor
+        offset, kmer = min(minimizers, key=lambda m: (len(self.minimizer_to_pos_list_dict[m[1]]), m[0]))
+        self.anchor_to_pos_offset_list_dict[kmer].append((pos, offset))
+
+    def _minimizers(self, seq):
+        """Return a list of (offset, k-mer) tuples for the minimizers of seq in ascending offset order.
+        Ties within a window are broken by taking the left most k-mer."""
+        k = self.k
+        w = self.w
+        num_kmers = len(seq) - k + 1
+        if num_kmers < w:
+            return []
+        kmers = [seq[i:i + k] for i in range(num_kmers)]
+        hashes = [crc32(kmer.encode()) for kmer in kmers]
+        minimizers = []
+        last_offset = -1
+        for window_start in range(num_kmers - w + 1):
+            if last_offset >= window_start:
+                # The previous minimizer is still in the window so we only need to compare it to the new k-mer
+                new_offset = window_start + w - 1
+                if hashes[new_offset] < hashes[last_offset]:
+                    last_offset = new_offset
+                    minimizers.append((new_offset, kmers[new_offset]))
+            else:
+                window = hashes[window_start:window_start + w]
+                new_offset = window_start + window.index(min(window))
+                last_offset = new_offset
+                minimizers.append((new_offset, kmers[new_offset]))
+        return minimizers
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+A binary, sparse alternative to the tab delimited count tables for large outputs.
+
+The abundances are held as a CSR matrix (samples as rows) together with the uids and names of the samples and
+columns, and written to an uncompressed .npz file with the keys of scipy.sparse.save_npz plus the index arrays.
+As the members are not compressed, the CSR arrays can be memory mapped when read back
+(SparseCountTable.read(path, mmap_mode='r')).
+"""
+import struct
+import zipfile
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+
+class SparseCountTable:
+    csr_keys = ['data', 'indices', 'indptr']
+    index_keys = ['sample_uids', 'sample_names', 'column_uids', 'column_names']
+
+    def __init__(self, data, indices, indptr, shape, sample_uids, sample_names, column_uids, column_names):
+        self.data = data
+        self.indices = indices
+        self.indptr = indptr
+        self.shape = tuple(int(a) for a in shape)
+        self.sample_uids = np.asarray(sample_uids, dtype=np.int64)
+        self.sample_names = [str(name) for name in sample_names]
+        self.column_uids = np.asarray(column_uids, dtype=np.int64)
+        self.column_names = [str(name) for name in column_names]
+        if self.shape != (len(self.sample_uids), len(self.column_uids)):
+            raise RuntimeError(f'The shape {self.shape} of the count table does not match its index '
+                               f'({len(self.sample_uids)} samples, {len(self.column_uids)} columns)')
+
+    @classmethod
+    def from_coordinates(
+            cls, rows, cols, values, sample_uids, sample_names, column_uids, column_names, dtype=np.int64):
+        """Make the table from the row and column indices of its non zero values (in any order, no duplicates)"""
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        values = np.asarray(values, dtype=dtype)
+        nonzero = values != 0
+        rows, cols, values = rows[nonzero], cols[nonzero], values[nonzero]
+        order = np.lexsort((cols, rows))
+        indptr = np.zeros(len(sample_uids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(sample_uids)), out=indptr[1:])
+        return cls(
+            data=values[order], indices=cols[order].astype(np.int32), indptr=indptr,
+            shape=(len(sample_uids), len(column_uids)), sample_uids=sample_uids, sample_names=sample_names,
+            column_uids=column_uids, column_names=column_names)
+
+    @classmethod
+    def from_dense(cls, values, sample_uids, sample_names, column_uids, column_names, dtype=np.int64):
+        """Make the table from a dense (samples x columns) array of the abundances"""
+        values = np.asarray(values, dtype=dtype).reshape(len(sample_uids), len(column_uids))
+        rows, cols = np.nonzero(values)
+        return cls.from_coordinates(
+            rows=rows, cols=cols, values=values[rows, cols], sample_uids=sample_uids, sample_names=sample_names,
+            column_uids=column_uids, column_names=column_names, dtype=dtype)
+
+    def write(self, path):
+        with open(path, 'wb') as f:
+            np.savez(
+                f, data=np.asarray(self.data), indices=np.asarray(self.indices), indptr=np.asarray(self.indptr),
+                shape=np.array(self.shape, dtype=np.int64), format=np.array(b'csr'),
+                sample_uids=self.sample_uids, sample_names=np.array(self.sample_names, dtype=str),
+                column_uids=self.column_uids, column_names=np.array(self.column_names, dtype=str))
+
+    @classmethod
+    def read(cls, path, mmap_mode=None):
+        """Read a table written by write. If mmap_mode is given (e.g. 'r') the CSR arrays are memory mapped"""
+        with np.load(path, allow_pickle=False) as npz:
+            index_arrays = {key: npz[key] for key in cls.index_keys}
+            shape = npz['shape']
+            if mmap_mode:
+                csr_arrays = cls._memory_map_npz_arrays(path, cls.csr_keys, mmap_mode)
+            else:
+                csr_arrays = {key: npz[key] for key in cls.csr_keys}
+        return cls(
+            shape=shape, sample_names=index_arrays['sample_names'].tolist(),
+            column_names=index_arrays['column_names'].tolist(), sample_uids=index_arrays['sample_uids'],
+            column_uids=index_arrays['column_uids'], **csr_arrays)
+
+    @staticmethod
+    def _memory_map_npz_arrays(path, keys, mmap_mode):
+        """Memory map the .npy members of an uncompressed .npz file (as written by np.savez)"""
+        arrays = {}
+        with zipfile.ZipFile(path) as zip_file, open(path, 'rb') as f:
+            for key in keys:
+                zip_info = zip_file.getinfo(f'{key}.npy')
+                if zip_info.compress_type != zipfile.ZIP_STORED:
+                    raise RuntimeError(f'{path} is compressed and so cannot be memory mapped')
+                # The .npy data starts after the local file header (30 bytes, the file name and the extra field)
+                f.seek(zip_info.header_offset)
+                local_file_header = f.read(30)
+                file_name_length, extra_field_length = struct.unpack('<HH', local_file_header[26:30])
+                f.seek(zip_info.header_offset + 30 + file_name_length + extra_field_length)
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+                if not shape or 0 in shape:
+                    arrays[key] = np.zeros(shape, dtype=dtype)
+                else:
+                    arrays[key] = np.memmap(
+                        path, dtype=dtype, mode=mmap_mode, offset=f.tell(), shape=shape,
+                        order='F' if fortran_order else 'C')
+        return arrays
+
+    def to_csr_matrix(self):
+        return csr_matrix((self.data, self.indices, self.indptr), shape=self.shape)
+
+    def to_dataframe(self, column_names=None, dtype=None):
+        """The dense table as a pandas DataFrame (sample uids as index, column names as columns).
+        If column_names is given, only those columns (in that order) are taken from the sparse matrix and made dense.
+        If dtype is given, the values are converted to it before being made dense."""
+        csr = self.to_csr_matrix()
+        if column_names is None:
+            column_names = self.column_names
+        else:
+            column_name_to_index_dict = {name: i for i, name in enumerate(self.column_names)}
+            csr = csr[:, [column_name_to_index_dict[name] for name in column_names]]
+        if dtype is not None:
+            csr = csr.astype(dtype)
+        return pd.DataFrame(csr.toarray(), index=self.sample_uids.tolist(), columns=list(column_names))
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Size bounded JSON chunk files (in the study_data_chunks directory of the html directory) for the per sample
+objects that would otherwise make up most of study_data.js. The index of the chunks is written to study_data.js
+as <function_name>ChunkIndex so that the data explorer can fetch the chunks it needs.
+"""
+import os
+import glob
+
+
+class StudyDataChunkWriter:
+    chunk_dir_name = 'study_data_chunks'
+
+    def __init__(self, html_dir, function_name, max_chunk_bytes=2000000):
+        self.chunk_dir = os.path.join(html_dir, self.chunk_dir_name)
+        os.makedirs(self.chunk_dir, exist_ok=True)
+        self.function_name = function_name
+        self.index_function_name = f'{function_name}ChunkIndex'
+        self.max_chunk_bytes = max_chunk_bytes
+        # Remove any chunks of a previous output of the same object
+        for chunk_path in glob.glob(os.path.join(self.chunk_dir, f'{function_name}_*.json')):
+            os.remove(chunk_path)
+        self.chunk_file_names = []
+        self.sample_uid_to_chunk_dict = {}
+        self._chunk_file = None
+        self._chunk_bytes = 0
+
+    def add(self, sample_uid, value_as_json):
+        """Write the JSON (already serialised) value of a sample to the current chunk"""
+        entry = f'"{sample_uid}": {value_as_json}'
+        if self._chunk_file is not None and self._chunk_bytes + len(entry) > self.max_chunk_bytes:
+            self._close_chunk()
+        if self._chunk_file is None:
+            self._open_chunk()
+        else:
+            self._chunk_file.write(', ')
+        self._chunk_file.write(entry)
+        self._chunk_bytes += len(entry) + 2
+        self.sample_uid_to_chunk_dict[str(sample_uid)] = len(self.chunk_file_names) - 1
+
+    def _open_chunk(self):
+        chunk_file_name = f'{self.function_name}_{len(self.chunk_file_names)}.json'
+        self._chunk_file = open(os.path.join(self.chunk_dir, chunk_file_name), 'w')
+        self._chunk_file.write('{')
+        self._chunk_bytes = 1
+        self.chunk_file_names.append(chunk_file_name)
+
+    def _close_chunk(self):
+        self._chunk_file.write('}')
+        self._chunk_file.close()
+        self._chunk_file = None
+
+    def close(self):
+        """Close the last chunk and return the index of the chunks"""
+        if self._chunk_file is not None:
+            self._close_chunk()
+        return self.get_index()
+
+    def get_index(self):
+        return {'chunks': self.chunk_file_names, 'sample_chunks': self.sample_uid_to_chunk_dict}
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+A small 'delta' blast database of the sequences added to the symClade database during the iterative
+taxonomic screening, so that the symClade blast database does not have to be remade every time that a few
+sequences are added to it.
+
+A blast alias database lists the delta database followed by the symClade database and is blasted against in
+place of the symClade database while the delta exists, giving the results of a remade symClade database.
+The delta is compacted (merged into symClade.fa) when it becomes large and at the end of the taxonomic screening.
+"""
+import glob
+import os
+import subprocess
+from general import ThreadSafeGeneral
+
+
+class SymCladeDeltaDB:
+    def __init__(self, symclade_fasta_path, max_delta_seqs=1000, pipe_stdout_sterr=True):
+        """
+        :param symclade_fasta_path: path to the symClade.fa that the symClade blast database is made from
+        :param max_delta_seqs: the number of sequences in the delta above which it should be compacted
+        """
+        self.thread_safe_general = ThreadSafeGeneral()
+        self.symclade_fasta_path = symclade_fasta_path
+        self.symclade_db_directory_path = os.path.dirname(os.path.abspath(symclade_fasta_path))
+        self.delta_fasta_path = os.path.join(self.symclade_db_directory_path, 'symClade_delta.fa')
+        self.alias_db_path = os.path.join(self.symclade_db_directory_path, 'symClade_with_delta')
+        self.max_delta_seqs = max_delta_seqs
+        self.pipe_stdout_sterr = pipe_stdout_sterr
+
+    def has_delta(self):
+        return os.path.exists(self.delta_fasta_path)
+
+    def get_blast_db_path(self):
+        """The path of the blast database to blast against"""
+        if self.has_delta():
+            return self.alias_db_path
+        return self.symclade_fasta_path
+
+    def get_num_delta_seqs(self):
+        return len(self.read_delta_fasta_as_list()) // 2
+
+    def needs_compaction(self):
+        return self.get_num_delta_seqs() > self.max_delta_seqs
+
+    def read_delta_fasta_as_list(self):
+        if not self.has_delta():
+            return []
+        return self.thread_safe_general.read_defined_file_to_list(self.delta_fasta_path)
+
+    def add_seqs(self, new_fasta_as_list):
+        """Add the sequences of new_fasta_as_list before the current sequences of the delta, remake the
+        delta blast database and the alias database"""
+        self.thread_safe_general.write_list_to_destination(
+            self.delta_fasta_path, new_fasta_as_list + self.read_delta_fasta_as_list())
+        self.thread_safe_general.make_new_blast_db(
+            input_fasta_to_make_db_from=self.delta_fasta_path, db_title='symClade_delta',
+            pipe_stdout_sterr=self.pipe_stdout_sterr)
+        self._make_alias_db()
+
+    def _make_alias_db(self):
+        alias_command = [
+            'blastdb_aliastool', '-dblist', f'{self.delta_fasta_path} {self.symclade_fasta_path}',
+            '-dbtype', 'nucl', '-out', self.alias_db_path, '-title', 'symClade']
+        if self.pipe_stdout_sterr:
+            subprocess.run(alias_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        else:
+            subprocess.run(alias_command)
+
+    def delete(self):
+        """Remove the delta fasta, its blast database and the alias database.
+        To be called once the delta has been merged into symClade.fa"""
+        for path in glob.glob(f'{self.delta_fasta_path}*') + glob.glob(f'{self.alias_db_path}.nal'):
+            os.remove(path)
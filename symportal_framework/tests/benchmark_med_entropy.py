@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the per position entropy computation of a MED node (Oligotyping.lib.topology.Node.do_entropy).
+The previous implementation built a column string as long as the node size for every position of the alignment
+and called entropy() on it. The current implementation encodes the unique reads of the node once and computes
+the entropies of all positions in one weighted bincount pass.
+A synthetic node is generated from a few abundant unique sequences and many rare variants of them, as is the
+case for the nodes of the MED decomposition of an ITS2 clade.
+The entropies (and so the sorted entropy tuples, max and average entropy) are checked to be identical.
+"""
+
+import argparse
+import operator
+import os
+import random
+import sys
+import time
+import numpy
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lib', 'med_decompose'))
+from Oligotyping.lib.entropy import entropy
+from Oligotyping.lib.topology import Node
+
+
+class BenchmarkRead:
+    def __init__(self, seq, frequency):
+        self.seq = seq
+        self.frequency = frequency
+
+
+class MEDEntropyBenchmarker:
+    def __init__(self):
+        self.parser = argparse.ArgumentParser(
+            description='Benchmark the column string and vectorised MED node entropy computations')
+        self.parser.add_argument('--num_unique_seqs', type=int, default=5000, help='Number of unique reads.')
+        self.parser.add_argument('--node_size', type=int, default=2000000, help='Total number of reads.')
+        self.parser.add_argument('--seq_length', type=int, default=300, help='Length of the aligned reads.')
+        self.parser.add_argument('--seed', type=int, default=1234, help='Random seed.')
+        self.args = self.parser.parse_args()
+        self.random = random.Random(self.args.seed)
+        self.reads = self._make_reads()
+
+    def _make_reads(self):
+        parent_seqs = [
+            ''.join(self.random.choice('ACGT') for _ in range(self.args.seq_length)) for _ in range(5)]
+        seqs = set(parent_seqs)
+        while len(seqs) < self.args.num_unique_seqs:
+            seq = list(self.random.choice(parent_seqs))
+            for _ in range(self.random.randint(1, 4)):
+                seq[self.random.randrange(self.args.seq_length)] = self.random.choice('ACGT-')
+            seqs.add(''.join(seq))
+        seqs = list(seqs)
+        # Pareto distributed abundances so that a few unique sequences make up most of the node
+        weights = [self.random.paretovariate(1.0) for _ in seqs]
+        total_weight = sum(weights)
+        return [
+            BenchmarkRead(seq, max(1, int(weight / total_weight * self.args.node_size))) for
+            seq, weight in zip(seqs, weights)]
+
+    def _make_node(self):
+        node = Node('benchmark', output_directory='.')
+        node.reads = list(self.reads)
+        node.size = sum(read.frequency for read in node.reads)
+        node.set_representative()
+        return node
+
+    @staticmethod
+    def _column_string_do_entropy(node):
+        # The previous implementation of Node.do_entropy
+        node.entropy_tpls = []
+        for position in range(0, len(node.representative_seq)):
+            column = ''.join([read.seq[position] * read.frequency for read in node.reads])
+
+            if len(set(column)) == 1:
+                node.entropy_tpls.append((position, 0.0),)
+            else:
+                e = entropy(column)
+
+                if e < 0.00001:
+                    node.entropy_tpls.append((position, 0.0),)
+                else:
+                    node.entropy_tpls.append((position, e),)
+
+        node.entropy = [t[1] for t in node.entropy_tpls]
+        node.entropy_tpls = sorted(node.entropy_tpls, key=operator.itemgetter(1), reverse=True)
+        node.max_entropy = max(node.entropy)
+        node.average_entropy = numpy.mean([e for e in node.entropy if e > 0.05] or [0])
+
+    def run(self):
+        print(f'{len(self.reads)} unique reads, node size {sum(read.frequency for read in self.reads)}, '
+              f'length {self.args.seq_length}')
+
+        column_string_node = self._make_node()
+        start = time.time()
+        self._column_string_do_entropy(column_string_node)
+        column_string_time = time.time() - start
+        print(f'Column string entropy: {column_string_time:.2f}s')
+
+        vectorised_node = self._make_node()
+        start = time.time()
+        vectorised_node.do_entropy()
+        vectorised_time = time.time() - start
+        print(f'Vectorised entropy: {vectorised_time:.2f}s ({column_string_time / vectorised_time:.1f}x)')
+
+        identical = (
+                column_string_node.entropy == vectorised_node.entropy and
+                column_string_node.entropy_tpls == vectorised_node.entropy_tpls and
+                column_string_node.max_entropy == vectorised_node.max_entropy and
+                column_string_node.average_entropy == vectorised_node.average_entropy)
+        print(f'Entropies identical: {identical}')
+        if not identical:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    MEDEntropyBenchmarker().run()
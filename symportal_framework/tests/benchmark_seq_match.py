@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the brute force sub/superstring matching that was previously done in seq_match.py against
+the SequenceContainmentIndex now used.
+Synthetic ITS2-like sequences are generated from a common ancestor sequence so that, as in real data,
+the reference sequences share most of their k-mers.
+The match chosen for every query is checked to be identical between the two methods.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from seq_index import SequenceContainmentIndex
+
+
+class SeqMatchBenchmarker:
+    def __init__(self):
+        self.parser = argparse.ArgumentParser(
+            description='Benchmark the brute force and indexed sub/superstring sequence matching')
+        self.parser.add_argument(
+            '--num_ref_seqs', type=int, default=5000, help='Number of reference sequences to generate.')
+        self.parser.add_argument(
+            '--num_query_seqs', type=int, default=5000, help='Number of query sequences to generate.')
+        self.parser.add_argument('--seq_len', type=int, default=300, help='Length of the ancestral sequence.')
+        self.parser.add_argument('--seed', type=int, default=1234, help='Random seed.')
+        self.args = self.parser.parse_args()
+        self.random = random.Random(self.args.seed)
+        self.ancestor = ''.join(self.random.choice('ACGT') for _ in range(self.args.seq_len))
+        self.rs_list = [self._make_variant(self.ancestor) for _ in range(self.args.num_ref_seqs)]
+        self.query_list = [self._make_query() for _ in range(self.args.num_query_seqs)]
+
+    def _mutate(self, seq, num_subs):
+        seq = list(seq)
+        for _ in range(num_subs):
+            seq[self.random.randrange(len(seq))] = self.random.choice('ACGT')
+        return ''.join(seq)
+
+    def _make_variant(self, seq):
+        seq = self._mutate(seq, self.random.randint(1, 6))
+        # Trim the ends as happens with differing primer and QC behaviour
+        return seq[self.random.randint(0, 4):len(seq) - self.random.randint(0, 20)]
+
+    def _make_query(self):
+        rs_seq = self.random.choice(self.rs_list)
+        query_type = self.random.random()
+        if query_type < 0.2:
+            # exact match
+            return rs_seq
+        elif query_type < 0.4:
+            # substring of a reference sequence
+            return rs_seq[self.random.randint(1, 3):len(rs_seq) - self.random.randint(1, 10)]
+        elif query_type < 0.5:
+            # superstring of a reference sequence
+            return 'A' + rs_seq + ''.join(self.random.choice('ACGT') for _ in range(self.random.randint(1, 5)))
+        else:
+            # novel sequence that will likely not match
+            return self._make_variant(self.ancestor)
+
+    def _brute_force_match(self, nuc_seq, rs_set):
+        if nuc_seq in rs_set:
+            return nuc_seq
+        for rs_seq in self.rs_list:
+            if nuc_seq in rs_seq or rs_seq in nuc_seq:
+                return rs_seq
+        return None
+
+    def run(self):
+        print(f'{len(self.rs_list)} reference sequences; {len(self.query_list)} query sequences')
+
+        start = time.time()
+        rs_set = set(self.rs_list)
+        brute_force_matches = [self._brute_force_match(q, rs_set) for q in self.query_list]
+        brute_force_time = time.time() - start
+        print(f'brute force: {brute_force_time:.2f}s')
+
+        start = time.time()
+        rs_index = SequenceContainmentIndex(self.rs_list)
+        build_time = time.time() - start
+        indexed_matches = [rs_index.first_match(q) for q in self.query_list]
+        indexed_time = time.time() - start
+        print(f'indexed: {indexed_time:.2f}s (of which {build_time:.2f}s building the index)')
+
+        assert brute_force_matches == indexed_matches, 'indexed matches differ from the brute force matches'
+        num_matched = sum(1 for m in indexed_matches if m is not None)
+        print(f'{num_matched} of {len(self.query_list)} queries matched; matches are identical')
+        print(f'speedup: {brute_force_time / indexed_time:.1f}x')
+
+
+if __name__ == "__main__":
+    SeqMatchBenchmarker().run()
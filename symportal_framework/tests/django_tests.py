@@ -1,9 +1,16 @@
 #!/usr/bin/env python3
 from django.test import TransactionTestCase
 import os
+import json
+import random
+import tempfile
 import main
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings")
-from dbApp.models import DataSet, DataSetSample, DataAnalysis, CladeCollectionType
+from dbApp.models import (
+    DataSet, DataSetSample, DataAnalysis, CladeCollectionType, ReferenceSequence, DataSetSampleSequence)
+from data_loading import DataSetSampleCreatorHandler, RefSeqMatchIndex
+from output import SequenceCountTableCreator
+from lib.med_decompose.med_api import MEDResult
 
 
 class SPIntegrativeTestingJSONOnly(TransactionTestCase):
@@ -115,6 +122,47 @@ class SPIntegrativeTestingJSONOnly(TransactionTestCase):
         test_spwfm = main.SymPortalWorkFlowManager(custom_args_list)
         test_spwfm.start_work_flow()
 
+    # TEST ASSOCIATION OF MED NODES TO REFERENCE SEQUENCES
+    def test_med_nodes_shared_between_samples_are_assigned_one_reference_sequence(self):
+        """Two samples whose MED nodes share a novel sequence (and one of which has two nodes that are the same
+        sequence once the gaps are removed) must only create one ReferenceSequence for it, including when the
+        nodes are matched by parallel workers while the ReferenceSequences are being created."""
+        print('\n\nTesting: med_nodes_shared_between_samples_are_assigned_one_reference_sequence\n\n')
+        rand = random.Random(1234)
+        shared_seq = ''.join(rand.choice('ACGT') for _ in range(250))
+        unique_seq = ''.join(rand.choice('ACGT') for _ in range(250))
+        data_set = DataSet(name=self.name)
+        data_set.save()
+        sample_name_to_node_rep_dict = {
+            'shared_seq_sample_1': {
+                'node_1': shared_seq[:100] + '-' + shared_seq[100:],
+                'node_2': shared_seq[:200] + '-' + shared_seq[200:]},
+            'shared_seq_sample_2': {'node_1': shared_seq, 'node_2': unique_seq}}
+        with tempfile.TemporaryDirectory() as temp_dir:
+            med_output_directory_to_med_result_dict = {}
+            for sample_name, node_rep_dict in sample_name_to_node_rep_dict.items():
+                DataSetSample(
+                    data_submission_from=data_set, name=sample_name,
+                    cladal_seq_totals=json.dumps(['0' for _ in range(9)])).save()
+                med_output_directory = os.path.join(temp_dir, sample_name, 'C', '')
+                med_output_directory_to_med_result_dict[med_output_directory] = MEDResult(
+                    sample_name=sample_name, node_names=list(node_rep_dict.keys()),
+                    node_representative_dict=node_rep_dict, node_size_dict={name: 50 for name in node_rep_dict},
+                    node_count_dict={name: 50 for name in node_rep_dict})
+            for num_proc in [1, 2]:
+                DataSetSampleSequence.objects.filter(data_set_sample_from__data_submission_from=data_set).delete()
+                ReferenceSequence.objects.filter(sequence__in=[shared_seq, unique_seq]).delete()
+                DataSetSampleCreatorHandler(
+                    ref_seq_match_index=RefSeqMatchIndex(), num_proc=num_proc, multiprocess=False
+                ).execute_data_set_sample_creation(
+                    data_loading_list_of_med_output_directories=list(med_output_directory_to_med_result_dict.keys()),
+                    data_loading_debug=False, data_loading_dataset_object=data_set,
+                    data_loading_med_output_directory_to_med_result_dict=med_output_directory_to_med_result_dict)
+                shared_ref_seqs = ReferenceSequence.objects.filter(sequence=shared_seq)
+                self.assertEqual(shared_ref_seqs.count(), 1)
+                self.assertEqual(
+                    DataSetSampleSequence.objects.filter(reference_sequence_of=shared_ref_seqs[0]).count(), 2)
+
     # TEST ANNOTATION OF DATASET WITH DATASHEET
     def test_annotation_of_dataset_with_data_sheet_good(self):
         print('\n\nTesting: test_annotation_of_dataset_with_data_sheet_good')
@@ -196,6 +244,74 @@ class SPIntegrativeTestingJSONOnly(TransactionTestCase):
         test_spwfm = main.SymPortalWorkFlowManager(custom_args_list)
         test_spwfm.start_work_flow()
 
+    def test_sequence_count_tables_are_unchanged(self):
+        """The count tables made from the SequenceCountTablePivot must be the same as those that were made by
+        collecting the abundances sample by sample. The tables in data/seq_count_tables were output by the
+        per sample collection for the DataSet below, with the uids replaced by placeholders.
+        sample_2 has two equally abundant most abundant sequences, sample_4 failed in processing and
+        noname_c is a sequence without a name."""
+        print('\n\nTesting: sequence_count_tables_are_unchanged\n\n')
+        data_set = DataSet(name='count_table_testing', time_stamp='20240101T101010')
+        data_set.save()
+        uid_dict = {'data_set': data_set.id}
+        ref_seq_dict = {}
+        for ref_seq_name, clade, has_name in [
+                ('C3', 'C', True), ('C1', 'C', True), ('noname_c', 'C', False), ('D1', 'D', True),
+                ('A1', 'A', True)]:
+            ref_seq = ReferenceSequence(
+                name=ref_seq_name if has_name else 'noName', has_name=has_name, clade=clade,
+                sequence=ref_seq_name * 10)
+            ref_seq.save()
+            ref_seq_dict[ref_seq_name] = ref_seq
+            uid_dict[ref_seq_name] = ref_seq.id
+        for i, (sample_name, abundance_dict, error_in_processing) in enumerate([
+                ('sample_1', {'C3': 100, 'C1': 50, 'noname_c': 25, 'D1': 10}, False),
+                ('sample_2', {'C3': 60, 'C1': 60, 'D1': 30}, False),
+                ('sample_3', {'D1': 80, 'A1': 20}, False),
+                ('sample_4', {}, True),
+                ('sample_5', {'C1': 40, 'noname_c': 40}, False)]):
+            cladal_seq_totals = [
+                sum(abund for ref_seq_name, abund in abundance_dict.items()
+                    if ref_seq_dict[ref_seq_name].clade == clade) for clade in 'ABCDEFGHI']
+            data_set_sample = DataSetSample(
+                data_submission_from=data_set, name=sample_name, num_contigs=1000 + i,
+                post_qc_absolute_num_seqs=900 + i, post_qc_unique_num_seqs=300 + i,
+                absolute_num_sym_seqs=sum(abundance_dict.values()) + 7, unique_num_sym_seqs=len(abundance_dict) + 2,
+                non_sym_absolute_num_seqs=50 + i, non_sym_unique_num_seqs=5 + i, size_violation_absolute=3,
+                size_violation_unique=1, post_med_absolute=sum(abundance_dict.values()),
+                post_med_unique=len(abundance_dict), error_in_processing=error_in_processing,
+                error_reason='No Symbiodiniaceae sequences found' if error_in_processing else 'noError',
+                cladal_seq_totals=json.dumps([str(abund) for abund in cladal_seq_totals]))
+            data_set_sample.save()
+            uid_dict[sample_name] = data_set_sample.id
+            for ref_seq_name, abund in abundance_dict.items():
+                DataSetSampleSequence(
+                    data_set_sample_from=data_set_sample, reference_sequence_of=ref_seq_dict[ref_seq_name],
+                    abundance=abund).save()
+
+        expected_count_table_dir = os.path.join(self.symportal_testing_root_dir, 'data', 'seq_count_tables')
+        with tempfile.TemporaryDirectory() as temp_dir:
+            html_dir = os.path.join(temp_dir, 'html')
+            os.makedirs(html_dir)
+            sequence_count_table_creator = SequenceCountTableCreator(
+                symportal_root_dir=self.symportal_root_dir, call_type='stand_alone', num_proc=1, html_dir=html_dir,
+                js_output_path_dict={}, date_time_str='20240101T101010', no_pre_med_seqs=True, multiprocess=False,
+                ds_uids_output_str=str(data_set.id), output_dir=temp_dir)
+            sequence_count_table_creator.make_seq_output_tables()
+            for count_table_path in [
+                    sequence_count_table_creator.path_to_seq_output_abund_and_meta_df_absolute,
+                    sequence_count_table_creator.path_to_seq_output_abund_and_meta_df_relative,
+                    sequence_count_table_creator.path_to_seq_output_abund_only_df_absolute,
+                    sequence_count_table_creator.path_to_seq_output_abund_only_df_relative,
+                    sequence_count_table_creator.path_to_seq_output_meta_only_df_absolute,
+                    sequence_count_table_creator.path_to_seq_output_meta_only_df_relative]:
+                expected_count_table_path = os.path.join(
+                    expected_count_table_dir, os.path.basename(count_table_path).replace('20240101T101010.', ''))
+                with open(expected_count_table_path, 'r') as f:
+                    expected_count_table = f.read().format(**uid_dict)
+                with open(count_table_path, 'r') as f:
+                    self.assertEqual(f.read(), expected_count_table)
+
     def test_stand_alone_profile_outputs_data_set_input(self):
         print('\n\nTesting: stand_alone_profile_outputs_data_set_input\n\n')
         custom_args_list = ['--print_output_types', '1', '--data_analysis_id', '1', '--num_proc', str(self.num_proc),
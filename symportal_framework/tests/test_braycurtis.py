@@ -0,0 +1,77 @@
+"""
+Checks that the distances of the SparseBrayCurtisCalculator are those of the pair by pair
+scipy.spatial.distance.braycurtis computation that it replaced.
+"""
+import itertools
+import os
+import random
+import sys
+import numpy as np
+import pytest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from braycurtis import SparseBrayCurtisCalculator
+
+
+def _make_samples(num_samples, num_seqs, integer_abunds, seed=1234):
+    rand = random.Random(seed)
+    obj_uid_to_rs_uid_to_abund_dict_dict = {}
+    for obj_uid in range(1, num_samples + 1):
+        rs_uids = {int(rand.paretovariate(0.8)) % num_seqs + 1 for _ in range(rand.randint(1, 30))}
+        abundances = {rs_uid: rand.randint(1, 10000) for rs_uid in rs_uids}
+        total = sum(abundances.values())
+        if integer_abunds:
+            obj_uid_to_rs_uid_to_abund_dict_dict[obj_uid] = {
+                rs_uid: float(int(abund / total * 10000) + 1) for rs_uid, abund in abundances.items()}
+        else:
+            obj_uid_to_rs_uid_to_abund_dict_dict[obj_uid] = {
+                rs_uid: abund / total * 10000 for rs_uid, abund in abundances.items()}
+    # two objects with identical abundances must be exactly 0 apart
+    obj_uid_to_rs_uid_to_abund_dict_dict[num_samples + 1] = dict(obj_uid_to_rs_uid_to_abund_dict_dict[1])
+    return obj_uid_to_rs_uid_to_abund_dict_dict
+
+
+def _pairwise_distance(obj_one_dict, obj_two_dict):
+    braycurtis = pytest.importorskip('scipy.spatial.distance').braycurtis
+    list_of_rs_uids = list(set(obj_one_dict.keys()) | set(obj_two_dict.keys()))
+    return braycurtis(
+        [obj_one_dict.get(rs_uid, 0) for rs_uid in list_of_rs_uids],
+        [obj_two_dict.get(rs_uid, 0) for rs_uid in list_of_rs_uids])
+
+
+@pytest.mark.parametrize('integer_abunds', [False, True])
+@pytest.mark.parametrize('num_proc, block_size', [(1, None), (2, 7)])
+def test_sparse_distances_equal_the_pairwise_distances(integer_abunds, num_proc, block_size):
+    obj_uid_to_rs_uid_to_abund_dict_dict = _make_samples(
+        num_samples=60, num_seqs=200, integer_abunds=integer_abunds)
+    obj_uid_list = sorted(obj_uid_to_rs_uid_to_abund_dict_dict)
+    dist_matrix = SparseBrayCurtisCalculator(
+        obj_uid_list=obj_uid_list, obj_uid_to_rs_uid_to_abund_dict_dict=obj_uid_to_rs_uid_to_abund_dict_dict,
+        num_proc=num_proc, multiprocess=False, block_size=block_size).compute_distance_matrix()
+    assert np.array_equal(dist_matrix, dist_matrix.T)
+    assert not np.diag(dist_matrix).any()
+    for i, j in itertools.combinations(range(len(obj_uid_list)), 2):
+        pairwise_distance = _pairwise_distance(
+            obj_uid_to_rs_uid_to_abund_dict_dict[obj_uid_list[i]],
+            obj_uid_to_rs_uid_to_abund_dict_dict[obj_uid_list[j]])
+        if integer_abunds:
+            assert dist_matrix[i, j] == pairwise_distance
+        else:
+            assert dist_matrix[i, j] == pytest.approx(pairwise_distance, abs=1e-12)
+    assert dist_matrix[0, len(obj_uid_list) - 1] == 0
+
+
+class _FailingBrayCurtisCalculator(SparseBrayCurtisCalculator):
+    def compute_block(self, start, stop):
+        if start > 0:
+            raise ValueError(f'block {start} failed')
+        return super().compute_block(start, stop)
+
+
+def test_worker_errors_are_raised():
+    obj_uid_to_rs_uid_to_abund_dict_dict = _make_samples(num_samples=20, num_seqs=50, integer_abunds=True)
+    calculator = _FailingBrayCurtisCalculator(
+        obj_uid_list=sorted(obj_uid_to_rs_uid_to_abund_dict_dict),
+        obj_uid_to_rs_uid_to_abund_dict_dict=obj_uid_to_rs_uid_to_abund_dict_dict,
+        num_proc=2, multiprocess=False, block_size=5)
+    with pytest.raises(RuntimeError, match='block 5 failed'):
+        calculator.compute_distance_matrix()
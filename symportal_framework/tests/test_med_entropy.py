@@ -0,0 +1,47 @@
+"""
+Checks that the entropies of weighted_column_entropies, and so of Node.do_entropy, are identical to those of
+calling entropy() on a column string in which each read is repeated by its frequency (as was previously done).
+"""
+import os
+import random
+import sys
+import pytest
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lib', 'med_decompose'))
+try:
+    from Oligotyping.lib.entropy import entropy, encode_sequences, weighted_column_entropies
+except ImportError as e:
+    # Oligotyping.lib.entropy imports log2 from scipy, which only the older versions of scipy have
+    pytest.skip(f'Oligotyping.lib.entropy cannot be imported: {e}', allow_module_level=True)
+
+
+def _make_reads(num_unique_seqs=300, seq_length=80, seed=1234):
+    rand = random.Random(seed)
+    parent_seqs = [''.join(rand.choice('ACGT') for _ in range(seq_length)) for _ in range(3)]
+    seqs = set(parent_seqs)
+    while len(seqs) < num_unique_seqs:
+        seq = list(rand.choice(parent_seqs))
+        for _ in range(rand.randint(1, 4)):
+            seq[rand.randrange(seq_length)] = rand.choice('ACGTacgt-')
+        seqs.add(''.join(seq))
+    seqs = sorted(seqs)
+    return seqs, [max(1, int(rand.paretovariate(1.0) * 10)) for _ in seqs]
+
+
+def _column_string_entropies(seqs, frequencies):
+    entropies = []
+    for position in range(len(seqs[0])):
+        column = ''.join([seq[position] * frequency for seq, frequency in zip(seqs, frequencies)])
+        entropies.append(0.0 if len(set(column)) == 1 else entropy(column))
+    return entropies
+
+
+@pytest.mark.parametrize('rows_per_chunk', [10000, 7])
+def test_weighted_column_entropies_equal_entropy(rows_per_chunk):
+    seqs, frequencies = _make_reads()
+    # a column made of a single character
+    seqs = ['A' + seq for seq in seqs]
+    weighted_entropies = weighted_column_entropies(
+        encode_sequences(seqs), frequencies, rows_per_chunk=rows_per_chunk).tolist()
+    assert weighted_entropies == _column_string_entropies(seqs, frequencies)
+    assert weighted_entropies[0] == 0.0
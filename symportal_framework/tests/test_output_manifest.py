@@ -0,0 +1,141 @@
+"""
+Checks the freshness of the artefacts of an OutputManifest and that a reused artefact is copied into the new output
+with its files, text and study_data.js section rewritten to the date time string of the new output.
+"""
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from output_manifest import OutputManifest
+
+OLD_DATE_TIME_STR = '20240101T101010'
+NEW_DATE_TIME_STR = '20240202T202020'
+
+
+def _write(path, text, mode='w'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, mode) as f:
+        f.write(text)
+
+
+def _read(path, mode='r'):
+    with open(path, mode) as f:
+        return f.read()
+
+
+def _make_manifest(output_dir, date_time_str):
+    return OutputManifest(
+        output_dir=str(output_dir), js_file_path=os.path.join(str(output_dir), 'html', 'study_data.js'),
+        output_key='stand_alone', date_time_str=date_time_str)
+
+
+def _make_artefact(manifest, name, fingerprint, js_output_path_dict, files_dict, js_text, png_bytes=None):
+    manifest.begin_artefact(name=name, fingerprint=fingerprint, js_output_path_dict=js_output_path_dict)
+    for rel_path, text in files_dict.items():
+        _write(os.path.join(manifest.output_dir, rel_path), text)
+        js_output_path_dict[f'{name}_{os.path.dirname(rel_path)}'] = os.path.join(manifest.output_dir, rel_path)
+    if png_bytes is not None:
+        _write(os.path.join(manifest.output_dir, f'{name}.png'), png_bytes, mode='wb')
+    _write(manifest.js_file_path, js_text, mode='a')
+    manifest.end_artefact(name=name, js_output_path_dict=js_output_path_dict, state={'name': name})
+
+
+def _make_previous_output(tmp_path):
+    previous_manifest = _make_manifest(tmp_path / OLD_DATE_TIME_STR, OLD_DATE_TIME_STR)
+    os.makedirs(previous_manifest.output_dir)
+    js_output_path_dict = {}
+    _make_artefact(
+        previous_manifest, 'profiles', 'fp_profiles', js_output_path_dict,
+        {f'its2_type_profiles/1_{OLD_DATE_TIME_STR}.profiles.absolute.abund_and_meta.txt':
+            f'counts\noutput by SymPortal on {OLD_DATE_TIME_STR}\n'},
+        js_text=f'function getProfiles(){{return "{OLD_DATE_TIME_STR}";}}\n',
+        png_bytes=OLD_DATE_TIME_STR.encode())
+    _make_artefact(
+        previous_manifest, 'seqs', 'fp_seqs', js_output_path_dict,
+        {f'post_med_seqs/{OLD_DATE_TIME_STR}.seqs.fasta': '>seq\nACGT\n'},
+        js_text='function getSeqs(){return 1;}\n')
+    return previous_manifest
+
+
+def test_is_fresh(tmp_path):
+    manifest = _make_previous_output(tmp_path)
+    assert manifest.is_fresh('profiles', 'fp_profiles')
+    assert manifest.is_fresh('seqs', 'fp_seqs')
+    # A change to the inputs or an unknown artefact
+    assert not manifest.is_fresh('profiles', 'fp_changed')
+    assert not manifest.is_fresh('distances', 'fp_profiles')
+
+    # An artefact that was begun but never completed
+    manifest.begin_artefact(name='distances', fingerprint='fp_distances', js_output_path_dict={})
+    assert not manifest.is_fresh('distances', 'fp_distances')
+
+    # The section of study_data.js of an artefact has been changed
+    js_text = _read(manifest.js_file_path, 'rb')
+    _write(manifest.js_file_path, js_text.replace(b'getProfiles', b'getPrafiles'), mode='wb')
+    assert not manifest.is_fresh('profiles', 'fp_profiles')
+    assert manifest.is_fresh('seqs', 'fp_seqs')
+    _write(manifest.js_file_path, js_text, mode='wb')
+    assert manifest.is_fresh('profiles', 'fp_profiles')
+
+    # study_data.js no longer holds the section of the last artefact
+    _write(manifest.js_file_path, js_text[:-1], mode='wb')
+    assert manifest.is_fresh('profiles', 'fp_profiles')
+    assert not manifest.is_fresh('seqs', 'fp_seqs')
+
+    # One of the files of the artefact is missing
+    os.remove(os.path.join(manifest.output_dir, 'profiles.png'))
+    assert not manifest.is_fresh('profiles', 'fp_profiles')
+
+
+def test_read_and_find_previous(tmp_path):
+    previous_manifest = _make_previous_output(tmp_path)
+    new_output_dir = str(tmp_path / NEW_DATE_TIME_STR)
+    _make_manifest(new_output_dir, NEW_DATE_TIME_STR)
+    found_manifest = OutputManifest.find_previous(
+        outputs_dir=str(tmp_path), output_key='stand_alone', exclude_output_dir=new_output_dir)
+    assert found_manifest.output_dir == previous_manifest.output_dir
+    assert found_manifest.date_time_str == OLD_DATE_TIME_STR
+    assert found_manifest.artefacts == previous_manifest.artefacts
+    assert OutputManifest.find_previous(outputs_dir=str(tmp_path), output_key='study_1') is None
+
+
+def test_reuse_artefact_rewrites_the_date_time_str(tmp_path):
+    previous_manifest = OutputManifest.read(_make_previous_output(tmp_path).output_dir)
+    manifest = _make_manifest(tmp_path / NEW_DATE_TIME_STR, NEW_DATE_TIME_STR)
+    os.makedirs(manifest.output_dir)
+    # Something already in study_data.js so that the reused sections are appended at new offsets
+    _write(manifest.js_file_path, 'function getNewFirst(){return 0;}\n')
+    js_output_path_dict = {}
+
+    for name in ('profiles', 'seqs'):
+        assert manifest.reuse_artefact(
+            previous_manifest=previous_manifest, name=name, js_output_path_dict=js_output_path_dict) == {'name': name}
+        assert manifest.is_fresh(name, f'fp_{name}')
+
+    profiles_rel_path = f'its2_type_profiles/1_{NEW_DATE_TIME_STR}.profiles.absolute.abund_and_meta.txt'
+    seqs_rel_path = f'post_med_seqs/{NEW_DATE_TIME_STR}.seqs.fasta'
+    assert manifest.artefacts['profiles']['files'] == sorted([profiles_rel_path, 'profiles.png'])
+    assert manifest.artefacts['seqs']['files'] == [seqs_rel_path]
+    assert _read(os.path.join(manifest.output_dir, profiles_rel_path)) == \
+        f'counts\noutput by SymPortal on {NEW_DATE_TIME_STR}\n'
+    assert _read(os.path.join(manifest.output_dir, seqs_rel_path)) == '>seq\nACGT\n'
+    # Binary files are copied as they are
+    assert _read(os.path.join(manifest.output_dir, 'profiles.png'), 'rb') == OLD_DATE_TIME_STR.encode()
+
+    assert js_output_path_dict == {
+        'profiles_its2_type_profiles': os.path.join(manifest.output_dir, profiles_rel_path),
+        'seqs_post_med_seqs': os.path.join(manifest.output_dir, seqs_rel_path)}
+    assert manifest.artefacts['profiles']['js_output_paths'] == {'profiles_its2_type_profiles': profiles_rel_path}
+
+    js_text = _read(manifest.js_file_path)
+    assert js_text == (
+        'function getNewFirst(){return 0;}\n'
+        f'function getProfiles(){{return "{NEW_DATE_TIME_STR}";}}\n'
+        'function getSeqs(){return 1;}\n')
+    for name, js_section in (
+            ('profiles', f'function getProfiles(){{return "{NEW_DATE_TIME_STR}";}}\n'),
+            ('seqs', 'function getSeqs(){return 1;}\n')):
+        js_start, js_end = manifest.artefacts[name]['js']
+        assert js_text[js_start:js_end] == js_section
+
+    # The manifest of the new output can itself be reused from
+    assert OutputManifest.read(manifest.output_dir).artefacts == manifest.artefacts
@@ -0,0 +1,62 @@
+"""
+Checks that the leading axes of the RandomisedPCoA are those of the full eigendecomposition
+(as done by skbio.stats.ordination.pcoa with method='eigh').
+"""
+import os
+import sys
+import numpy as np
+import pytest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from randomised_pcoa import RandomisedPCoA
+
+
+def _make_dist_matrix(num_samples=300, num_clusters=6, seed=1234):
+    random_state = np.random.RandomState(seed)
+    centres = random_state.normal(scale=5, size=(num_clusters, 20))
+    points = centres[random_state.randint(num_clusters, size=num_samples)] + random_state.normal(
+        size=(num_samples, 20))
+    dist_matrix = np.sqrt(((points[:, None, :] - points[None, :, :]) ** 2).sum(axis=2))
+    return dist_matrix / dist_matrix.max()
+
+
+def _full_pcoa(dist_matrix):
+    num_objs = dist_matrix.shape[0]
+    centering_matrix = np.eye(num_objs) - 1 / num_objs
+    centred_matrix = -0.5 * centering_matrix @ (dist_matrix ** 2) @ centering_matrix
+    eigvals, eigvecs = np.linalg.eigh(centred_matrix)
+    order = np.argsort(eigvals)[::-1]
+    eigvals, eigvecs = eigvals[order], eigvecs[:, order]
+    return eigvals, eigvecs * np.sqrt(np.maximum(eigvals, 0)), eigvals / eigvals.sum()
+
+
+@pytest.mark.parametrize('memmap', [False, True])
+def test_leading_axes_match_the_full_eigendecomposition(memmap, tmp_path):
+    dist_matrix = _make_dist_matrix()
+    dist_data = dist_matrix
+    tolerance = 1e-6
+    if memmap:
+        dist_data = np.lib.format.open_memmap(
+            str(tmp_path / 'dist.npy'), mode='w+', dtype=np.float32, shape=dist_matrix.shape)
+        dist_data[:] = dist_matrix
+        dist_data.flush()
+        tolerance = 1e-4
+    randomised_pcoa = RandomisedPCoA(dist_matrix=dist_data, num_dimensions=5, block_size=64).compute()
+    eigvals, coordinates, proportion_explained = _full_pcoa(dist_matrix)
+    # The order of axes with near equal eigenvalues is arbitrary so only the axes that explain a meaningful
+    # proportion of the variance are compared
+    num_compared = int((proportion_explained[:5] > 1e-3).sum())
+    assert num_compared >= 3
+    assert np.abs(randomised_pcoa.eigvals[:num_compared] - eigvals[:num_compared]).max() / eigvals[0] < tolerance
+    assert np.abs(
+        randomised_pcoa.proportion_explained[:num_compared] - proportion_explained[:num_compared]).max() < tolerance
+    for i in range(num_compared):
+        # The sign of each axis is arbitrary
+        sign = np.sign(randomised_pcoa.coordinates[:, i] @ coordinates[:, i])
+        assert np.allclose(sign * randomised_pcoa.coordinates[:, i], coordinates[:, i], atol=1e-3)
+
+
+def test_zero_distances_give_zero_coordinates():
+    randomised_pcoa = RandomisedPCoA(dist_matrix=np.zeros((10, 10)), num_dimensions=3).compute()
+    assert randomised_pcoa.degenerate
+    assert not randomised_pcoa.coordinates.any()
+    assert not randomised_pcoa.proportion_explained.any()
@@ -0,0 +1,87 @@
+"""
+Checks that the SequenceContainmentIndex gives the same matches as the substring scan that it replaced
+(an exact match, else the first reference sequence that is a sub or superstring of the query).
+"""
+import os
+import pickle
+import random
+import subprocess
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from seq_index import SequenceContainmentIndex
+
+
+def _mutate(rand, seq, num_subs):
+    seq = list(seq)
+    for _ in range(num_subs):
+        seq[rand.randrange(len(seq))] = rand.choice('ACGT')
+    return ''.join(seq)
+
+
+def _make_variant(rand, seq):
+    seq = _mutate(rand, seq, rand.randint(1, 6))
+    return seq[rand.randint(0, 4):len(seq) - rand.randint(0, 20)]
+
+
+def _make_query(rand, ancestor, rs_list):
+    rs_seq = rand.choice(rs_list)
+    query_type = rand.random()
+    if query_type < 0.2:
+        return rs_seq
+    elif query_type < 0.4:
+        return rs_seq[rand.randint(1, 3):len(rs_seq) - rand.randint(1, 10)]
+    elif query_type < 0.5:
+        return 'A' + rs_seq + ''.join(rand.choice('ACGT') for _ in range(rand.randint(1, 5)))
+    elif query_type < 0.6:
+        # too short to have a minimizer
+        return rs_seq[5:20]
+    return _make_variant(rand, ancestor)
+
+
+def _substring_scan_match(nuc_seq, rs_list):
+    if nuc_seq in set(rs_list):
+        return nuc_seq
+    for rs_seq in rs_list:
+        if nuc_seq in rs_seq or rs_seq in nuc_seq:
+            return rs_seq
+    return None
+
+
+def test_first_match_is_that_of_the_substring_scan():
+    rand = random.Random(1234)
+    ancestor = ''.join(rand.choice('ACGT') for _ in range(300))
+    rs_list = [_make_variant(rand, ancestor) for _ in range(300)]
+    # short reference sequences are checked directly rather than indexed
+    rs_list.extend(rand.choice(rs_list)[30:45] for _ in range(5))
+    query_list = [_make_query(rand, ancestor, rs_list) for _ in range(500)]
+    rs_index = SequenceContainmentIndex(rs_list)
+    assert [rs_index.first_match(q) for q in query_list] == [_substring_scan_match(q, rs_list) for q in query_list]
+
+
+def test_sequences_added_after_the_index_is_built_are_matched():
+    rand = random.Random(5678)
+    ancestor = ''.join(rand.choice('ACGT') for _ in range(300))
+    rs_list = [_make_variant(rand, ancestor) for _ in range(50)]
+    rs_index = SequenceContainmentIndex(rs_list[:25])
+    for rs_seq in rs_list[25:]:
+        rs_index.add(rs_seq)
+    query_list = [_make_query(rand, ancestor, rs_list) for _ in range(200)]
+    assert [rs_index.first_match(q) for q in query_list] == [_substring_scan_match(q, rs_list) for q in query_list]
+
+
+def test_minimizers_do_not_depend_on_the_interpreter():
+    rand = random.Random(91011)
+    seq = ''.join(rand.choice('ACGT') for _ in range(300))
+    rs_index = SequenceContainmentIndex([seq])
+    # A python with a different string hash seed, as a spawned worker process would have
+    minimizers_script = (
+        f'import sys; sys.path.insert(0, {os.path.dirname(os.path.dirname(os.path.abspath(__file__)))!r}); '
+        f'from seq_index import SequenceContainmentIndex; '
+        f'print(SequenceContainmentIndex()._minimizers({seq!r}))')
+    for hash_seed in ('1', '2'):
+        other_interpreter_minimizers = subprocess.run(
+            [sys.executable, '-c', minimizers_script], env=dict(os.environ, PYTHONHASHSEED=hash_seed),
+            stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout.strip()
+        assert other_interpreter_minimizers == str(rs_index._minimizers(seq))
+    # A pickled copy of the index still finds the substrings of the sequence
+    assert pickle.loads(pickle.dumps(rs_index)).first_match(seq[40:200]) == seq
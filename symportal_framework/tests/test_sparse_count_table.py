@@ -0,0 +1,73 @@
+"""
+Checks that a count table written as a SparseCountTable (.sparse.npz) is read back (loaded or memory mapped)
+without loss.
+"""
+import os
+import sys
+import numpy as np
+import pytest
+pytest.importorskip('scipy')
+pd = pytest.importorskip('pandas')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sparse_count_table import SparseCountTable
+
+
+def _make_abundances(num_samples=200, num_seqs=500, seed=1234):
+    rng = np.random.default_rng(seed)
+    abundances = np.zeros((num_samples, num_seqs), dtype=np.int64)
+    seq_weights = rng.pareto(1.0, num_seqs) + 1
+    seq_weights /= seq_weights.sum()
+    # the last sample is empty
+    for row in range(num_samples - 1):
+        cols = rng.choice(num_seqs, size=rng.poisson(20) + 1, replace=False, p=seq_weights)
+        abundances[row, cols] = rng.integers(1, 5000, size=len(cols))
+    return abundances
+
+
+@pytest.mark.parametrize('mmap_mode', [None, 'r'])
+def test_round_trip_is_lossless(mmap_mode, tmp_path):
+    abundances = _make_abundances()
+    sample_uids = list(range(1, abundances.shape[0] + 1))
+    sample_names = [f'sample_{uid}' for uid in sample_uids]
+    seq_uids = list(range(1, abundances.shape[1] + 1))
+    seq_names = [f'{uid}_C' for uid in seq_uids]
+    npz_path = str(tmp_path / 'seqs.absolute.sparse.npz')
+    SparseCountTable.from_dense(
+        abundances, sample_uids=sample_uids, sample_names=sample_names, column_uids=seq_uids,
+        column_names=seq_names).write(npz_path)
+
+    sparse_count_table = SparseCountTable.read(npz_path, mmap_mode=mmap_mode)
+    assert np.array_equal(sparse_count_table.to_csr_matrix().toarray(), abundances)
+    assert sparse_count_table.sample_uids.tolist() == sample_uids
+    assert sparse_count_table.sample_names == sample_names
+    assert sparse_count_table.column_uids.tolist() == seq_uids
+    assert sparse_count_table.column_names == seq_names
+    assert sparse_count_table.to_dataframe().equals(
+        pd.DataFrame(abundances, index=sample_uids, columns=seq_names))
+
+
+def test_from_coordinates_equals_from_dense():
+    abundances = _make_abundances(num_samples=20, num_seqs=50)
+    rows, cols = np.nonzero(abundances)
+    order = np.random.default_rng(1).permutation(len(rows))
+    index_kwargs = dict(
+        sample_uids=list(range(20)), sample_names=[str(i) for i in range(20)], column_uids=list(range(50)),
+        column_names=[str(i) for i in range(50)])
+    from_coordinates = SparseCountTable.from_coordinates(
+        rows=rows[order], cols=cols[order], values=abundances[rows, cols][order], **index_kwargs)
+    from_dense = SparseCountTable.from_dense(abundances, **index_kwargs)
+    for key in SparseCountTable.csr_keys:
+        assert np.array_equal(getattr(from_coordinates, key), getattr(from_dense, key))
+
+
+def test_to_dataframe_of_selected_columns(tmp_path):
+    abundances = _make_abundances(num_samples=30, num_seqs=40)
+    seq_names = [f'{uid}_C' for uid in range(1, 41)]
+    npz_path = str(tmp_path / 'seqs.absolute.sparse.npz')
+    SparseCountTable.from_dense(
+        abundances, sample_uids=list(range(1, 31)), sample_names=[str(i) for i in range(1, 31)],
+        column_uids=list(range(1, 41)), column_names=seq_names).write(npz_path)
+    selected_seq_names = [seq_names[i] for i in [39, 0, 17, 5]]
+    df = SparseCountTable.read(npz_path, mmap_mode='r').to_dataframe(column_names=selected_seq_names, dtype='float')
+    assert df.equals(pd.DataFrame(abundances, index=list(range(1, 31)), columns=seq_names)[
+        selected_seq_names].astype('float'))
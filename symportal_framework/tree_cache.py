@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+A content addressed cache of the alignments and rooted trees used for the UniFrac distance calculations
+(see distance.TreeCreatorForUniFrac).
+
+Each entry is a directory named by the sha256 of the sorted ReferenceSequence uids and sequences that holds
+the sequences (seqs.tsv), the MAFFT alignment, the iqtree tree, the midpoint rooted tree and the substitution
+model. Entries are written to a temporary directory and then renamed into place so that they are always complete.
+find_base_entry returns an entry for a subset of the sequences that the missing sequences can be added to
+(mafft --add and a constrained tree) rather than starting from scratch.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+
+# Change this whenever the alignment or tree building settings change so that old entries are not used
+TREE_CACHE_VERSION = 'mafft_unifrac_iqtree_midpoint_v1'
+
+
+class UniFracTreeCache:
+    seqs_file_name = 'seqs.tsv'
+    aligned_fasta_file_name = 'seqs.aligned.fasta'
+    unrooted_tree_file_name = 'seqs.aligned.fasta.treefile'
+    rooted_tree_file_name = 'rooted.treefile'
+    model_file_name = 'model.txt'
+
+    def __init__(self, cache_dir, max_incremental_fraction=0.1):
+        """
+        :param cache_dir: the directory holding the entries. Created if it does not exist.
+        :param max_incremental_fraction: the largest number of sequences, as a fraction of the number of
+        sequences of an existing entry, that may be added to that entry. Beyond this, the alignment and tree
+        are built from scratch.
+        """
+        self.cache_dir = cache_dir
+        self.max_incremental_fraction = max_incremental_fraction
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def get_key(uid_to_seq_dict):
+        hasher = hashlib.sha256(TREE_CACHE_VERSION.encode())
+        for uid in sorted(uid_to_seq_dict):
+            hasher.update(f'\n{uid}\t{uid_to_seq_dict[uid]}'.encode())
+        return hasher.hexdigest()
+
+    def get_entry_dir(self, uid_to_seq_dict):
+        """Return the directory of the entry for exactly these sequences or None if there is no such entry"""
+        entry_dir = os.path.join(self.cache_dir, self.get_key(uid_to_seq_dict))
+        if os.path.exists(os.path.join(entry_dir, self.rooted_tree_file_name)):
+            return entry_dir
+        return None
+
+    def find_base_entry(self, uid_to_seq_dict):
+        """Return the (entry_dir, uid_to_seq_dict_of_entry) of the largest entry whose sequences are a subset
+        of uid_to_seq_dict and that is missing few enough sequences to be extended, else (None, None)"""
+        best_entry_dir, best_uid_to_seq_dict = None, None
+        for entry_name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, entry_name)
+            if not os.path.exists(os.path.join(entry_dir, self.rooted_tree_file_name)):
+                continue
+            entry_uid_to_seq_dict = self.read_entry_seqs(entry_dir)
+            if len(entry_uid_to_seq_dict) >= len(uid_to_seq_dict):
+                continue
+            if best_uid_to_seq_dict is not None and len(entry_uid_to_seq_dict) <= len(best_uid_to_seq_dict):
+                continue
+            num_missing = len(uid_to_seq_dict) - len(entry_uid_to_seq_dict)
+            if num_missing > self.max_incremental_fraction * len(entry_uid_to_seq_dict):
+                continue
+            if all(uid_to_seq_dict.get(uid) == seq for uid, seq in entry_uid_to_seq_dict.items()):
+                best_entry_dir, best_uid_to_seq_dict = entry_dir, entry_uid_to_seq_dict
+        return best_entry_dir, best_uid_to_seq_dict
+
+    def read_entry_seqs(self, entry_dir):
+        uid_to_seq_dict = {}
+        with open(os.path.join(entry_dir, self.seqs_file_name), 'r') as f:
+            for line in f:
+                uid, seq = line.rstrip('\n').split('\t')
+                uid_to_seq_dict[int(uid)] = seq
+        return uid_to_seq_dict
+
+    def read_entry_model(self, entry_dir):
+        with open(os.path.join(entry_dir, self.model_file_name), 'r') as f:
+            return f.read().strip()
+
+    def add_entry(self, uid_to_seq_dict, aligned_fasta_path, unrooted_tree_path, rooted_tree_path, model):
+        """Copy the alignment and trees into a new entry for uid_to_seq_dict and return its directory"""
+        entry_dir = os.path.join(self.cache_dir, self.get_key(uid_to_seq_dict))
+        if os.path.exists(entry_dir):
+            return entry_dir
+        temp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp_')
+        try:
+            with open(os.path.join(temp_dir, self.seqs_file_name), 'w') as f:
+                for uid in sorted(uid_to_seq_dict):
+                    f.write(f'{uid}\t{uid_to_seq_dict[uid]}\n')
+            with open(os.path.join(temp_dir, self.model_file_name), 'w') as f:
+                f.write(f'{model}\n')
+            shutil.copyfile(aligned_fasta_path, os.path.join(temp_dir, self.aligned_fasta_file_name))
+            shutil.copyfile(unrooted_tree_path, os.path.join(temp_dir, self.unrooted_tree_file_name))
+            # The rooted tree is copied last as its presence marks a complete entry
+            shutil.copyfile(rooted_tree_path, os.path.join(temp_dir, self.rooted_tree_file_name))
+            os.rename(temp_dir, entry_dir)
+        except OSError:
+            # Another instance may have added the same entry in the meantime
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            if not os.path.exists(os.path.join(entry_dir, self.rooted_tree_file_name)):
+                raise
+        return entry_dir
@@ -3,7 +3,11 @@ import sys
 from dbApp.models import DataSetSampleSequence, DataSetSample, CladeCollection, ReferenceSequence
 import json
 from collections import defaultdict
+from functools import lru_cache
+import numpy as np
+from scipy.sparse import csr_matrix
 import general
+from django_general import DBQueryCounter
 class VirtualObjectManager():
     """This class will link together an instance of a VirtualCladeCollectionManger and a VirtualAnalaysisTypeManger.
     I will therefore allow VirtualAnalysisTypes to access the information in the VirtualCladeCollections.
@@ -14,15 +18,21 @@ class VirtualObjectManager():
         if list_of_data_set_sample_uids:
             self.list_of_data_set_sample_uids = list_of_data_set_sample_uids
             data_set_samples = self._chunk_query_dss_from_dss_uids()
-            self.list_of_data_set_uids = set([dss.data_submission_from.id for dss in data_set_samples])
+            self.list_of_data_set_uids = set([dss.data_submission_from_id for dss in data_set_samples])
         else:
             self.list_of_data_set_uids = list_of_data_set_uids
             data_set_samples = self._chunk_query_dss_from_ds_uids()
             self.list_of_data_set_sample_uids = [dss.id for dss in data_set_samples]
-        ccs_of_analysis = self._set_ccs_of_analysis(data_set_samples=data_set_samples)
         self.within_clade_cutoff = within_clade_cutoff
         self.num_proc = num_proc
-        self.vcc_manager = VirtualCladeCollectionManager(obj_manager=self, ccs_of_analysis=ccs_of_analysis)
+        with DBQueryCounter() as db_query_counter:
+            self.ccs_of_analysis = self._set_ccs_of_analysis(data_set_samples=data_set_samples)
+            # The sequence abundances of all of the CladeCollections of the analysis.
+            # The VirtualCladeCollections are views onto the rows of this store.
+            self.cc_abundance_store = CladeCollectionAbundanceStore(ccs_of_analysis=self.ccs_of_analysis)
+            self.vcc_manager = VirtualCladeCollectionManager(obj_manager=self, ccs_of_analysis=self.ccs_of_analysis)
+        print(f'\n{len(self.vcc_manager.vcc_dict)} VirtualCladeCollections instantiated '
+              f'using {db_query_counter.count} database queries')
         # with open(os.path.join(self.sp_data_analysis.workflow_manager.symportal_root_directory, 'tests', 'objects', 'vcc_manager.p'), 'rb') as f:
         #     self.vcc_manager = pickle.load(f)
         self.vat_manager = VirtualAnalysisTypeManager(obj_manager=self)
@@ -43,9 +53,14 @@ class VirtualObjectManager():
 
     def _set_ccs_of_analysis(self, data_set_samples):
         print('Chunking query')
+        dss_uid_to_dss_obj_dict = {dss.id: dss for dss in data_set_samples}
         clade_collection_obj_list = []
         for uid_list in general.chunks(data_set_samples):
             clade_collection_obj_list.extend(list(CladeCollection.objects.filter(data_set_sample_from__in=uid_list)))
+        # Set the DataSetSample objects that we already have as the data_set_sample_from of the CladeCollections
+        # so that str(cc) and cc.data_set_sample_from don't cause a database look up for every CladeCollection.
+        for cc in clade_collection_obj_list:
+            cc.data_set_sample_from = dss_uid_to_dss_obj_dict[cc.data_set_sample_from_id]
         return clade_collection_obj_list
 
 
@@ -58,12 +73,15 @@ class VirtualDataSetSampleManager:
     def _populate_virtual_dss_manager_from_db(self):
         print('\nInstantiating VirtualDataSetSamples')
         list_of_data_set_samples_of_analysis = self._chunk_query_dss_objs_from_dss_uids()
+        dss_uid_to_cc_uid_list_dict = defaultdict(list)
+        for cc in self.virtual_obj_manager.ccs_of_analysis:
+            dss_uid_to_cc_uid_list_dict[cc.data_set_sample_from_id].append(cc.id)
 
         for dss in list_of_data_set_samples_of_analysis:
             sys.stdout.write(f'\r{dss.name}')
             new_vdss = self.VirtualDataSetSample(
-                uid=dss.id, data_set_id=dss.data_submission_from.id,
-                list_of_cc_uids=[cc.id for cc in CladeCollection.objects.filter(data_set_sample_from=dss)],
+                uid=dss.id, data_set_id=dss.data_submission_from_id,
+                list_of_cc_uids=dss_uid_to_cc_uid_list_dict[dss.id],
                 name=dss.name,list_of_cladal_abundances=[int(_) for _ in json.loads(dss.cladal_seq_totals)])
             self.vdss_dict[new_vdss.uid] = new_vdss
 
@@ -108,91 +126,232 @@ class VirtualCladeCollectionManager():
         VirtualCladeCollections so we will do this in a seperate method.
         """
 
+        print('Instantiating VirtualCladeCollectionManager')
         self.vcc_dict = self._create_cc_info_dict(ccs_of_analysis)
 
     def _create_cc_info_dict(self, ccs_of_analysis):
-        cc_uid_to_dsss_obj_list_default_dict = self._make_cc_uid_to_dss_obj_list_dict(ccs_of_analysis)
-
+        """Create all of the VirtualCladeCollections as views onto the rows of the
+        CladeCollectionAbundanceStore of the VirtualObjectManager. The footprints and the cutoff footprints
+        (equivalent to CladeCollection.cutoff_footprint) are computed from the store."""
+        abundance_store = self.obj_manager.cc_abundance_store
         cc_to_info_items_dict = {}
-
         for clade_collection_object in ccs_of_analysis:
-            self._instantiate_vcc_from_db_cc(cc_to_info_items_dict, cc_uid_to_dsss_obj_list_default_dict,
-                                             clade_collection_object)
-
-        return dict(cc_to_info_items_dict)
-
-    def _instantiate_vcc_from_db_cc(self, cc_to_info_items_dict, cc_uid_to_dsss_obj_list_default_dict,
-                                    clade_collection_object):
-        dss_objects_of_cc_list = cc_uid_to_dsss_obj_list_default_dict[clade_collection_object.id]
-        sys.stdout.write(f'\r{clade_collection_object.data_set_sample_from.name}')
-        sorted_dss_objects_of_cc_list = [dsss for dsss in
-                                         sorted(dss_objects_of_cc_list, key=lambda x: x.abundance, reverse=True)]
-        list_of_ref_seq_uids_in_cc = [
-            dsss.reference_sequence_of.id for dsss in dss_objects_of_cc_list]
-        above_cutoff_ref_seqs_obj_set = clade_collection_object.cutoff_footprint(
-            self.obj_manager.within_clade_cutoff)
-        total_sequences_in_cladecollection = sum([dsss.abundance for dsss in dss_objects_of_cc_list])
-        list_of_rel_abundances = [dsss.abundance / total_sequences_in_cladecollection for dsss in
-                                  dss_objects_of_cc_list]
-        ref_seq_frozen_set = frozenset(dsss.reference_sequence_of.id for dsss in dss_objects_of_cc_list)
-        ref_seq_id_to_rel_abund_dict = {}
-        for i in range(len(dss_objects_of_cc_list)):
-            ref_seq_id_to_rel_abund_dict[list_of_ref_seq_uids_in_cc[i]] = list_of_rel_abundances[i]
-        ref_seq_id_to_abs_abund_dict = {}
-        for dss in dss_objects_of_cc_list:
-            ref_seq_id_to_abs_abund_dict[dss.reference_sequence_of.id] = dss.abundance
-        cc_to_info_items_dict[clade_collection_object.id] = VirtualCladeCollection(
-            clade=clade_collection_object.clade,
-            footprint_as_frozen_set_of_ref_seq_uids=ref_seq_frozen_set,
-            ref_seq_id_to_rel_abund_dict=ref_seq_id_to_rel_abund_dict,
-            ref_seq_id_to_abs_abund_dict=ref_seq_id_to_abs_abund_dict,
-            total_seq_abundance=total_sequences_in_cladecollection,
-            cc_object=clade_collection_object,
-            above_cutoff_ref_seqs_obj_set=above_cutoff_ref_seqs_obj_set,
-            ordered_dsss_objs=sorted_dss_objects_of_cc_list,
-            vdss_uid=clade_collection_object.data_set_sample_from.id,
-            sample_from_name=str(clade_collection_object))
-
-    def _make_cc_uid_to_dss_obj_list_dict(self, ccs_of_analysis):
-        # Create a cc to dsss of cc list to speed up processing
-        print('Instantiating VirtualCladeCollectionManager')
-        print('Collecting DataSetSampleSequence objects of CladeCollections')
-
-        data_set_sample_sequence_objects_of_analysis = self._chunk_query_dsss_from_cc_objs(ccs_of_analysis)
-        cc_uid_to_dsss_obj_list_default_dict = defaultdict(list)
-        for dsss in data_set_sample_sequence_objects_of_analysis:
-            cc_uid_to_dsss_obj_list_default_dict[dsss.clade_collection_found_in.id].append(dsss)
-        return cc_uid_to_dsss_obj_list_default_dict
+            sys.stdout.write(f'\r{clade_collection_object.data_set_sample_from.name}')
+            row = abundance_store.cc_uid_to_row_dict[clade_collection_object.id]
+            cc_to_info_items_dict[clade_collection_object.id] = VirtualCladeCollection(
+                clade=clade_collection_object.clade,
+                cc_object=clade_collection_object,
+                abundance_store=abundance_store,
+                footprint_as_frozen_set_of_ref_seq_uids=abundance_store.get_footprint_uid_frozenset(row),
+                total_seq_abundance=abundance_store.get_total_abundance(row),
+                above_cutoff_ref_seqs_obj_set=abundance_store.get_above_cutoff_ref_seq_obj_frozenset(
+                    row, self.obj_manager.within_clade_cutoff),
+                vdss_uid=clade_collection_object.data_set_sample_from_id,
+                sample_from_name=str(clade_collection_object))
+        return cc_to_info_items_dict
+
+
+class CladeCollectionAbundanceStore:
+    """Columnar, compressed sparse row (CSR), store of the DataSetSampleSequence abundances of all of the
+    CladeCollections of an analysis.
+    Each row is a CladeCollection, each column is a ReferenceSequence uid. For each row, the column
+    indices, the absolute abundances (int32) and the uids of the DataSetSampleSequences they came from
+    are held in the order that the DataSetSampleSequences were created (i.e. by uid).
+
+    Holding the abundances like this, rather than as DataSetSampleSequence objects and dicts per
+    CladeCollection, means that the memory required grows by ~16 bytes, rather than several hundred
+    bytes, per sequence per sample. The per CladeCollection dicts and lists that the rest of the analysis
+    works with (see VirtualCladeCollection) are built from a row on request and a bounded number of them
+    are cached so that repeated access to the same VirtualCladeCollection stays cheap.
+    """
+    def __init__(self, ccs_of_analysis, view_cache_size=1024):
+        self.cc_uid_to_row_dict = {}
+        self.cc_uid_array = None
+        # Column index to ReferenceSequence uid (ascending) and object, and the reverse look up
+        self.ref_seq_uid_array = None
+        self.ref_seq_uid_list = []
+        self.ref_seq_obj_list = []
+        self.ref_seq_uid_to_col_dict = {}
+        # The CSR arrays
+        self.indptr = None
+        self.col_indices = None
+        self.abundances = None
+        self.dsss_uids = None
+        self.row_totals = None
+
+        self._populate_from_db(ccs_of_analysis)
+
+        self.get_abs_abund_dict = lru_cache(maxsize=view_cache_size)(self._make_abs_abund_dict)
+        self.get_rel_abund_dict = lru_cache(maxsize=view_cache_size)(self._make_rel_abund_dict)
+        self._get_ordered_dsss_tuple = lru_cache(maxsize=view_cache_size)(self._make_ordered_dsss_tuple)
+
+    def __len__(self):
+        return len(self.cc_uid_to_row_dict)
+
+    @property
+    def shape(self):
+        return len(self.cc_uid_to_row_dict), len(self.ref_seq_uid_list)
+
+    @property
+    def relative_abundances(self):
+        """The float32 relative abundances aligned to self.col_indices (i.e. the data array of the relative
+        abundance CSR matrix)."""
+        row_totals_per_entry = np.repeat(self.row_totals, np.diff(self.indptr))
+        return (self.abundances / row_totals_per_entry).astype(np.float32)
+
+    def to_csr_matrix(self, relative=False):
+        """Return the store as a scipy.sparse.csr_matrix of the absolute (int32) or relative (float32)
+        abundances. The arrays are shared with the store rather than copied where possible."""
+        data = self.relative_abundances if relative else self.abundances
+        return csr_matrix((data, self.col_indices, self.indptr), shape=self.shape)
+
+    def _populate_from_db(self, ccs_of_analysis):
+        print('Collecting DataSetSampleSequence abundances of CladeCollections')
+        dsss_value_tuples_of_analysis = self._chunk_query_dsss_values_from_cc_objs(ccs_of_analysis)
+        cc_uid_to_dsss_value_list_default_dict = defaultdict(list)
+        ref_seq_uid_set = set()
+        for dsss_uid, cc_uid, ref_seq_uid, abundance in dsss_value_tuples_of_analysis:
+            cc_uid_to_dsss_value_list_default_dict[cc_uid].append((dsss_uid, ref_seq_uid, abundance))
+            ref_seq_uid_set.add(ref_seq_uid)
+        del dsss_value_tuples_of_analysis
+
+        ref_seq_uid_to_ref_seq_obj_dict = self._chunk_query_ref_seq_objs_from_rs_uids(ref_seq_uid_set)
+        self.ref_seq_uid_list = sorted(ref_seq_uid_set)
+        self.ref_seq_obj_list = [ref_seq_uid_to_ref_seq_obj_dict[rs_uid] for rs_uid in self.ref_seq_uid_list]
+        self.ref_seq_uid_to_col_dict = {rs_uid: col for col, rs_uid in enumerate(self.ref_seq_uid_list)}
+        self.ref_seq_uid_array = np.array(self.ref_seq_uid_list, dtype=np.int64)
+
+        num_entries = sum(len(dsss_value_list) for dsss_value_list in cc_uid_to_dsss_value_list_default_dict.values())
+        self.indptr = np.zeros(len(ccs_of_analysis) + 1, dtype=np.int64)
+        self.col_indices = np.empty(num_entries, dtype=np.int32)
+        self.abundances = np.empty(num_entries, dtype=np.int32)
+        self.dsss_uids = np.empty(num_entries, dtype=np.int64)
+        self.cc_uid_array = np.empty(len(ccs_of_analysis), dtype=np.int64)
+        start = 0
+        for row, cc in enumerate(ccs_of_analysis):
+            self.cc_uid_to_row_dict[cc.id] = row
+            self.cc_uid_array[row] = cc.id
+            dsss_value_list = cc_uid_to_dsss_value_list_default_dict.pop(cc.id, [])
+            end = start + len(dsss_value_list)
+            if dsss_value_list:
+                dsss_uid_tup, ref_seq_uid_tup, abundance_tup = zip(*dsss_value_list)
+                self.dsss_uids[start:end] = dsss_uid_tup
+                self.col_indices[start:end] = [self.ref_seq_uid_to_col_dict[rs_uid] for rs_uid in ref_seq_uid_tup]
+                self.abundances[start:end] = abundance_tup
+            self.indptr[row + 1] = end
+            start = end
+        self.row_totals = np.add.reduceat(self.abundances.astype(np.int64), self.indptr[:-1]) if num_entries else \
+            np.zeros(len(ccs_of_analysis), dtype=np.int64)
+        # reduceat returns the value at the index for empty rows rather than 0
+        self.row_totals[np.diff(self.indptr) == 0] = 0
+
+    @staticmethod
+    def _chunk_query_dsss_values_from_cc_objs(ccs_of_analysis):
+        dsss_value_tuples_of_analysis = []
+        for uid_list in general.chunks([cc.id for cc in ccs_of_analysis]):
+            dsss_value_tuples_of_analysis.extend(
+                DataSetSampleSequence.objects.filter(clade_collection_found_in__in=uid_list).order_by(
+                    'id').values_list('id', 'clade_collection_found_in', 'reference_sequence_of', 'abundance'))
+        return dsss_value_tuples_of_analysis
+
+    @staticmethod
+    def _chunk_query_ref_seq_objs_from_rs_uids(ref_seq_uids):
+        ref_seq_uid_to_ref_seq_obj_dict = {}
+        for uid_list in general.chunks(list(ref_seq_uids)):
+            for ref_seq in ReferenceSequence.objects.filter(id__in=uid_list):
+                ref_seq_uid_to_ref_seq_obj_dict[ref_seq.id] = ref_seq
+        return ref_seq_uid_to_ref_seq_obj_dict
+
+    def _get_row_values(self, row):
+        """Return the column indices, abundances and DataSetSampleSequence uids of a row as python lists."""
+        start, end = self.indptr[row], self.indptr[row + 1]
+        return (
+            self.col_indices[start:end].tolist(), self.abundances[start:end].tolist(),
+            self.dsss_uids[start:end].tolist())
+
+    def get_total_abundance(self, row):
+        return int(self.row_totals[row])
+
+    def get_footprint_uid_frozenset(self, row):
+        # We use the uid ints held in self.ref_seq_uid_list so that they are shared between the footprints
+        start, end = self.indptr[row], self.indptr[row + 1]
+        return frozenset(self.ref_seq_uid_list[col] for col in self.col_indices[start:end].tolist())
+
+    def get_above_cutoff_ref_seq_obj_frozenset(self, row, within_clade_cutoff):
+        sequence_number_cutoff = within_clade_cutoff * self.get_total_abundance(row)
+        col_list, abundance_list, _ = self._get_row_values(row)
+        return frozenset(
+            self.ref_seq_obj_list[col] for col, abundance in zip(col_list, abundance_list)
+            if abundance > sequence_number_cutoff)
+
+    def _make_abs_abund_dict(self, row):
+        col_list, abundance_list, _ = self._get_row_values(row)
+        return {self.ref_seq_uid_list[col]: abundance for col, abundance in zip(col_list, abundance_list)}
+
+    def _make_rel_abund_dict(self, row):
+        # NB the relative abundances are calculated as python floats (i.e. float64) exactly as they were
+        # when the dicts were held per CladeCollection so that the profile discovery is unchanged.
+        total = self.get_total_abundance(row)
+        col_list, abundance_list, _ = self._get_row_values(row)
+        return {self.ref_seq_uid_list[col]: abundance / total for col, abundance in zip(col_list, abundance_list)}
+
+    def _make_ordered_dsss_tuple(self, row):
+        col_list, abundance_list, dsss_uid_list = self._get_row_values(row)
+        # sorted is stable so DataSetSampleSequences of equal abundance stay in uid order
+        order = sorted(range(len(abundance_list)), key=lambda i: abundance_list[i], reverse=True)
+        return tuple(
+            VirtualDataSetSampleSequence(
+                uid=dsss_uid_list[i], reference_sequence_of=self.ref_seq_obj_list[col_list[i]],
+                abundance=abundance_list[i]) for i in order)
+
+    def get_ordered_dsss_list(self, row):
+        return list(self._get_ordered_dsss_tuple(row))
+
+
+class VirtualDataSetSampleSequence:
+    """A light weight, read only, stand in for a DataSetSampleSequence object created from a row of the
+    CladeCollectionAbundanceStore. Equality is by uid so that instances created at different times for the
+    same DataSetSampleSequence are interchangeable."""
+    __slots__ = ('id', 'reference_sequence_of', 'abundance')
+
+    def __init__(self, uid, reference_sequence_of, abundance):
+        self.id = uid
+        self.reference_sequence_of = reference_sequence_of
+        self.abundance = abundance
+
+    def __eq__(self, other):
+        return isinstance(other, VirtualDataSetSampleSequence) and self.id == other.id
+
+    def __hash__(self):
+        return hash(self.id)
 
-    def _chunk_query_dsss_from_cc_objs(self, ccs_of_analysis):
-        data_set_sample_sequence_objects_of_analysis = []
-        for uid_list in general.chunks(ccs_of_analysis):
-            data_set_sample_sequence_objects_of_analysis.extend(
-                list(DataSetSampleSequence.objects.filter(clade_collection_found_in__in=uid_list)))
-        return data_set_sample_sequence_objects_of_analysis
+    def __str__(self):
+        if self.reference_sequence_of.has_name:
+            return self.reference_sequence_of.name
+        else:
+            return 'ID=' + str(self.id)
 
 
 class VirtualCladeCollection:
-    """A RAM stored representation of a CladeCollection object that already exists in the DB"""
+    """A RAM stored representation of a CladeCollection object that already exists in the DB.
+    The sequence abundances are held as a row of the CladeCollectionAbundanceStore."""
     def __init__(
-            self, clade, footprint_as_frozen_set_of_ref_seq_uids, ref_seq_id_to_rel_abund_dict,
-            ref_seq_id_to_abs_abund_dict, total_seq_abundance, cc_object, above_cutoff_ref_seqs_obj_set,
-            ordered_dsss_objs, vdss_uid, sample_from_name=None):
+            self, clade, cc_object, abundance_store, footprint_as_frozen_set_of_ref_seq_uids, total_seq_abundance,
+            above_cutoff_ref_seqs_obj_set, vdss_uid, sample_from_name=None):
 
         self.clade = clade
         self.cc_object = cc_object
         self.id = self.cc_object.id
+        self.abundance_store = abundance_store
+        self.row = self.abundance_store.cc_uid_to_row_dict[self.id]
         # This is the ref seq uids for all dss found in the cc as oposed to just those above the
         # within_clade_cutoff. The above cutoff equivalents are stored below
         self.footprint_as_frozen_set_of_ref_seq_uids = footprint_as_frozen_set_of_ref_seq_uids
-        self.ref_seq_id_to_rel_abund_dict = ref_seq_id_to_rel_abund_dict
-        self.ref_seq_id_to_abs_abund_dict = ref_seq_id_to_abs_abund_dict
         self.total_seq_abundance = total_seq_abundance
         self.vdss_uid = vdss_uid
         self.sample_from_name = sample_from_name
         self.above_cutoff_ref_seqs_obj_set = above_cutoff_ref_seqs_obj_set
         self.above_cutoff_ref_seqs_id_set = [rs.id for rs in self.above_cutoff_ref_seqs_obj_set]
-        self.ordered_dsss_objs = ordered_dsss_objs
 
         # key = AnalysisType object, value = the relative abundance of the cc that this AnalysisType represents
         # NB this dictionary is reset just before type assignment (losing all of the information from type discovery)
@@ -200,6 +359,19 @@ class VirtualCladeCollection:
         # vcc and the relative abundance they represent within the vcc.
         self.analysis_type_obj_to_representative_rel_abund_in_cc_dict = {}
 
+    @property
+    def ref_seq_id_to_rel_abund_dict(self):
+        return self.abundance_store.get_rel_abund_dict(self.row)
+
+    @property
+    def ref_seq_id_to_abs_abund_dict(self):
+        return self.abundance_store.get_abs_abund_dict(self.row)
+
+    @property
+    def ordered_dsss_objs(self):
+        """VirtualDataSetSampleSequences of the CladeCollection in order of decreasing abundance"""
+        return self.abundance_store.get_ordered_dsss_list(self.row)
+
     def __str__(self):
         try:
             return self.sample_from_name
@@ -430,6 +602,14 @@ class VirtualAnalysisTypeManager():
         self.next_uid = 1
         # key = uid of at, value = VirtualAnalysisType instance
         self.vat_dict = {}
+        # Inverted index of the DIVs of the VirtualAnalysisTypes
+        # key = ReferenceSequence uid, value = set of uids of the VirtualAnalysisTypes that have the
+        # ReferenceSequence as a DIV. Kept up to date as VirtualAnalysisTypes are made, reinitiated and deleted.
+        self.ref_seq_uid_to_vat_uid_set_dict = defaultdict(set)
+        # key = uid of at, value = the position of the at in the vat_dict so that VirtualAnalysisTypes
+        # found using the index can be returned in the same order as the vat_dict
+        self.vat_uid_to_vat_dict_position_dict = {}
+        self._next_vat_dict_position = 0
 
     def make_vat_post_profile_assignment_from_analysis_type(self, db_analysis_type_object):
         db_analysis_type_cc_uids = [
@@ -459,7 +639,7 @@ class VirtualAnalysisTypeManager():
         vat_init = VirutalAnalysisTypeInit(parent_vat_manager=self, vat_to_init=new_vat)
         vat_init.init_vat_post_profile_assignment()
 
-        self.vat_dict[new_vat.id] = new_vat
+        self._add_vat_to_vat_dict(new_vat)
 
         self.next_uid += 1
 
@@ -480,7 +660,7 @@ class VirtualAnalysisTypeManager():
                 ref_seq_obj_list=ref_seq_obj_list, id=db_at.id, name=db_at.name, abund_db=abundacnce_db)
         vat_init = VirutalAnalysisTypeInit(parent_vat_manager=self, vat_to_init=new_vat)
         vat_init.init_vat_post_profile_assignment_from_db_at()
-        self.vat_dict[new_vat.id] = new_vat
+        self._add_vat_to_vat_dict(new_vat)
         return new_vat
 
     def make_vat_pre_profile_assignment(self, clade_collection_obj_list, ref_seq_obj_list):
@@ -492,7 +672,7 @@ class VirtualAnalysisTypeManager():
         vat_init = VirutalAnalysisTypeInit(parent_vat_manager=self, vat_to_init=new_vat)
         vat_init.init_vat_pre_profile_assignment()
 
-        self.vat_dict[new_vat.id] = new_vat
+        self._add_vat_to_vat_dict(new_vat)
 
         self.next_uid += 1
 
@@ -506,6 +686,8 @@ class VirtualAnalysisTypeManager():
 
         vat_init.init_vat_post_profile_assignment()
 
+        self._reindex_vat_divs(vat_to_reinit)
+
     def reinit_vat_pre_profile_assignment(self, vat_to_reinit, new_clade_collection_obj_set):
         vat_to_reinit.clade_collection_obj_set_profile_discovery = set(new_clade_collection_obj_set)
 
@@ -513,6 +695,8 @@ class VirtualAnalysisTypeManager():
 
         vat_init.init_vat_pre_profile_assignment()
 
+        self._reindex_vat_divs(vat_to_reinit)
+
 
 
     def delete_virtual_analysis_type(self, virtual_analysis_type):
@@ -522,6 +706,61 @@ class VirtualAnalysisTypeManager():
             raise RuntimeError(
                 f'VirtualAnalysisType {virtual_analysis_type} '
                 f'not found in the VirtualAnalysisTypeManager\'s collection')
+        self._unindex_vat_divs(virtual_analysis_type)
+        del self.vat_uid_to_vat_dict_position_dict[virtual_analysis_type.id]
+
+    def _add_vat_to_vat_dict(self, vat):
+        self.vat_dict[vat.id] = vat
+        self.vat_uid_to_vat_dict_position_dict[vat.id] = self._next_vat_dict_position
+        self._next_vat_dict_position += 1
+        self._index_vat_divs(vat)
+
+    def _index_vat_divs(self, vat):
+        for ref_seq_uid in vat.ref_seq_uids_set:
+            self.ref_seq_uid_to_vat_uid_set_dict[ref_seq_uid].add(vat.id)
+        vat.indexed_ref_seq_uids_set = frozenset(vat.ref_seq_uids_set)
+
+    def _unindex_vat_divs(self, vat):
+        # We remove the DIVs that the vat was indexed under rather than its current DIVs in case these have changed
+        for ref_seq_uid in vat.indexed_ref_seq_uids_set:
+            vat_uid_set = self.ref_seq_uid_to_vat_uid_set_dict[ref_seq_uid]
+            vat_uid_set.discard(vat.id)
+            if not vat_uid_set:
+                del self.ref_seq_uid_to_vat_uid_set_dict[ref_seq_uid]
+        vat.indexed_ref_seq_uids_set = frozenset()
+
+    def _reindex_vat_divs(self, vat):
+        self._unindex_vat_divs(vat)
+        self._index_vat_divs(vat)
+
+    def rebuild_div_index(self):
+        """Rebuild the DIV index and the vat_dict positions from scratch.
+        This must be called if the vat_dict is replaced or the uids of the VirtualAnalysisTypes are changed."""
+        self.ref_seq_uid_to_vat_uid_set_dict = defaultdict(set)
+        self.vat_uid_to_vat_dict_position_dict = {}
+        self._next_vat_dict_position = 0
+        for vat in self.vat_dict.values():
+            self.vat_uid_to_vat_dict_position_dict[vat.id] = self._next_vat_dict_position
+            self._next_vat_dict_position += 1
+            self._index_vat_divs(vat)
+
+    def get_vats_with_divs_in_footprint(self, footprint_as_frozen_set_of_ref_seq_uids):
+        """Return the VirtualAnalysisTypes whose DIVs are all found in the given footprint, in the order
+        of the vat_dict. This is equivalent to checking vat.ref_seq_uids_set.issubset(footprint) for every
+        VirtualAnalysisType but only the VirtualAnalysisTypes that have at least one DIV in the footprint are
+        looked at: for each VirtualAnalysisType we count how many of its DIVs are in the footprint using the
+        DIV index and keep those where the count equals the number of DIVs."""
+        vat_uid_to_num_divs_in_footprint_dict = defaultdict(int)
+        for ref_seq_uid in footprint_as_frozen_set_of_ref_seq_uids:
+            vat_uid_set = self.ref_seq_uid_to_vat_uid_set_dict.get(ref_seq_uid)
+            if vat_uid_set:
+                for vat_uid in vat_uid_set:
+                    vat_uid_to_num_divs_in_footprint_dict[vat_uid] += 1
+        vat_uids_in_footprint = [
+            vat_uid for vat_uid, num_divs_in_footprint in vat_uid_to_num_divs_in_footprint_dict.items() if
+            num_divs_in_footprint == len(self.vat_dict[vat_uid].indexed_ref_seq_uids_set)]
+        vat_uids_in_footprint.sort(key=self.vat_uid_to_vat_dict_position_dict.__getitem__)
+        return [self.vat_dict[vat_uid] for vat_uid in vat_uids_in_footprint]
 
     def add_ccs_and_reinit_virtual_analysis_type(self, vat_to_add_ccs_to, list_of_clade_collection_objs_to_add):
 
@@ -588,6 +827,8 @@ class VirtualAnalysisTypeManager():
 
             self.footprint_as_ref_seq_objs_set = ref_seq_obj_list
             self.ref_seq_uids_set = set([rs.id for rs in self.footprint_as_ref_seq_objs_set])
+            # The DIVs that the VirtualAnalysisTypeManager has indexed this VirtualAnalysisType under
+            self.indexed_ref_seq_uids_set = frozenset()
             # NB in the type discovery part the DataAnalysis we will be concerned with relative sequence abundances
             # as a proportion of all of the sequences found within a CladeCollection. But, as we move into ProfileAssignment
             # we will be concerned with the relative abundances of the sequences as a proportion of only those sequences